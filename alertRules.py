@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+    File: alertRules.py: Match many alert rules against archives in one pass.
+        Classes:
+            AlertRulesError(Exception): Errors generated while loading, or evaluating, alert rules.
+            AhoCorasick(object): An Aho-Corasick automaton over fixed strings.
+            AlertRules(object): A set of fixed string and regex rules, compiled for one pass matching.
+        Methods:
+            alerts_path: The path of the alerts sidecar for an archive.
+            scan_archive: Scan an archive once with every rule, and save the alerts sidecar.
+            load_alerts: Load the alerts sidecar of an archive.
+            collect_alerts: The alerts of many archives, scanning only stale ones in a process pool.
+
+        Notes:
+            The rules file is JSON, a list of rules: {"name": str, "pattern": str, "fixed": bool, "ignore_case": bool},
+            fixed and ignore_case default to false. Rules match anywhere in the raw line, like grep.
+
+            All fixed string rules go into one Aho-Corasick automaton, two when some ignore case, one run on the line
+            and one on the lower cased line, so a line is walked once whatever the number of fixed strings. Uses
+            pyahocorasick when it's installed, else a pure Python automaton. All regex rules go into one alternation,
+            each in its own (?i:) or (?:) group, which is searched first: only lines it matches are searched with each
+            regex, to find every rule that matches. Leading global inline flags, ie: (?i), become the flags of the
+            group. Regexes with backreferences would change meaning in the alternation, and those whose group doesn't
+            compile, or reuses a group name, would break it, so they are searched on their own.
+
+            The alerts sidecar, ALERTS_SUFFIX, is JSON holding the archive size, the rules fingerprint, and per rule
+            match counts and the first sample lines. It's current while both match.
+"""
+from typing import Optional, Final, Iterable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import os
+import re
+import zlib
+import logFormat
+
+HAS_AHOCORASICK: bool = False
+try:
+    import ahocorasick
+    HAS_AHOCORASICK = True
+except ModuleNotFoundError:
+    pass
+
+ALERTS_SUFFIX: Final[str] = '.alerts'
+DEFAULT_SAMPLES: Final[int] = 5
+_READ_SIZE: Final[int] = 1048576
+_BACKREFERENCE_REGEX: Final[re.Pattern] = re.compile(r'\\[1-9]|\(\?P=')
+_GLOBAL_FLAGS_REGEX: Final[re.Pattern] = re.compile(rb'\(\?([aiLmsux]+)\)')
+
+
+class AlertRulesError(Exception):
+    """Class to store alert rule errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'OSError while reading the rules file.',
+        2: 'Invalid rules file, expected a JSON list of {"name", "pattern", "fixed", "ignore_case"} rules.',
+        3: 'Invalid rule regex.',
+        4: 'Error while reading an archive.',
+        5: 'OSError while writing an alerts sidecar.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+class AhoCorasick(object):
+    """
+    An Aho-Corasick automaton over fixed strings, finding which of them occur in a text in one pass over it.
+    """
+
+    def __init__(self, needles: list[tuple[bytes, int]]) -> None:
+        """
+        Build the automaton.
+        :param needles: list[tuple[bytes, int]]: The fixed strings, and the value reported when each occurs. Empty
+                        strings occur in every text.
+        """
+        self._always: frozenset[int] = frozenset(value for needle, value in needles if not needle)
+        self._automaton = None
+        if HAS_AHOCORASICK:
+            values: dict[str, set[int]] = {}
+            for needle, value in needles:
+                if needle:
+                    # Latin-1 maps each byte to one character, so any bytes round trip:
+                    values.setdefault(needle.decode('latin-1'), set()).add(value)
+            if values:
+                self._automaton = ahocorasick.Automaton()
+                for key, key_values in values.items():
+                    self._automaton.add_word(key, frozenset(key_values))
+                self._automaton.make_automaton()
+            return
+        # State 0 is the root, each state has goto transitions, a failure state, and the values ending there:
+        self._goto: list[dict[int, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[frozenset[int]] = [frozenset()]
+        for needle, value in needles:
+            if not needle:
+                continue
+            state: int = 0
+            for byte in needle:
+                next_state: Optional[int] = self._goto[state].get(byte)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(frozenset())
+                    self._goto[state][byte] = next_state
+                state = next_state
+            self._output[state] = self._output[state] | {value}
+        # Breadth first, so a state's failure state is finished before its children's:
+        queue: list[int] = list(self._goto[0].values())
+        position: int = 0
+        while position < len(queue):
+            state = queue[position]
+            position += 1
+            for byte, child in self._goto[state].items():
+                queue.append(child)
+                fail: int = self._fail[state]
+                while fail and byte not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(byte, 0)
+                self._output[child] = self._output[child] | self._output[self._fail[child]]
+        return
+
+    def find(self, text: bytes) -> set[int]:
+        """
+        Find which fixed strings occur in a text.
+        :param text: bytes: The text.
+        :return: set[int]: The values of the strings that occur.
+        """
+        found: set[int] = set(self._always)
+        if HAS_AHOCORASICK:
+            if self._automaton is not None:
+                for _, values in self._automaton.iter(text.decode('latin-1')):
+                    found |= values
+            return found
+        goto: list[dict[int, int]] = self._goto
+        fail: list[int] = self._fail
+        output: list[frozenset[int]] = self._output
+        state: int = 0
+        for byte in text:
+            while state and byte not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(byte, 0)
+            if output[state]:
+                found |= output[state]
+        return found
+
+
+def _scoped_group(pattern: bytes, ignore_case: bool) -> bytes:
+    """
+    Wrap a regex in a group for the combined alternation, moving its leading global inline flags onto the group.
+    :param pattern: bytes: The regex.
+    :param ignore_case: bool: True to match ignoring case.
+    :return: bytes: The group, ie: (?i:pattern).
+    """
+    flags: bytes = b'i' if ignore_case else b''
+    while (flags_match := _GLOBAL_FLAGS_REGEX.match(pattern)) is not None:
+        flags += bytes(flag for flag in flags_match.group(1) if flag not in flags)
+        pattern = pattern[flags_match.end():]
+    return b'(?' + flags + b':' + pattern + b')'
+
+
+class AlertRules(object):
+    """
+    A set of fixed string and regex rules, compiled for one pass matching.
+    """
+
+    def __init__(self, rules: list[dict]) -> None:
+        """
+        Compile the rules.
+        :param rules: list[dict]: The rules, as in the rules file.
+        :raises AlertRulesError: On invalid rules, or regexes.
+        """
+        if not isinstance(rules, list):
+            raise AlertRulesError(2)
+        names: list[str] = []
+        fixed: list[tuple[bytes, int]] = []
+        fixed_ignore_case: list[tuple[bytes, int]] = []
+        combined: list[bytes] = []
+        group_names: set[str] = set()
+        self._regexes: list[tuple[int, re.Pattern]] = []
+        self._standalone: list[tuple[int, re.Pattern]] = []
+        for rule in rules:
+            if (not isinstance(rule, dict) or not isinstance(rule.get('name'), str)
+                    or not isinstance(rule.get('pattern'), str) or rule['name'] in names):
+                raise AlertRulesError(2, rule)
+            rule_number: int = len(names)
+            names.append(rule['name'])
+            pattern: bytes = rule['pattern'].encode()
+            ignore_case: bool = bool(rule.get('ignore_case', False))
+            if rule.get('fixed', False):
+                if ignore_case:
+                    fixed_ignore_case.append((pattern.lower(), rule_number))
+                else:
+                    fixed.append((pattern, rule_number))
+                continue
+            try:
+                regex: re.Pattern = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+            except re.error as err:
+                raise AlertRulesError(3, rule['name'], err.msg)
+            group: bytes = _scoped_group(pattern, ignore_case)
+            if _BACKREFERENCE_REGEX.search(rule['pattern']) or not group_names.isdisjoint(regex.groupindex):
+                self._standalone.append((rule_number, regex))
+                continue
+            try:
+                re.compile(group)
+            except re.error:
+                # A flag, or group, that can't be scoped:
+                self._standalone.append((rule_number, regex))
+                continue
+            group_names.update(regex.groupindex)
+            self._regexes.append((rule_number, regex))
+            combined.append(group)
+        self._names: tuple[str, ...] = tuple(names)
+        self._fixed: Optional[AhoCorasick] = AhoCorasick(fixed) if fixed else None
+        self._fixed_ignore_case: Optional[AhoCorasick] = AhoCorasick(fixed_ignore_case) if fixed_ignore_case else None
+        self._combined: Optional[re.Pattern] = None
+        if combined:
+            try:
+                self._combined = re.compile(b'|'.join(combined))
+            except re.error:
+                # Too many groups, or some other limit, search the regexes one by one:
+                self._standalone.extend(self._regexes)
+                self._regexes = []
+        self._fingerprint: str = hashlib.sha1(json.dumps(rules, sort_keys=True).encode()).hexdigest()
+        return
+
+    @classmethod
+    def load(cls, file_path: str):
+        """
+        Load and compile a rules file.
+        :param file_path: str: The path to the rules file.
+        :return: AlertRules
+        :raises AlertRulesError: On read errors, and invalid rules.
+        """
+        try:
+            with open(file_path, 'r') as file_handle:
+                rules = json.load(file_handle)
+        except OSError as err:
+            raise AlertRulesError(1, "%s: %s" % (file_path, str(err)))
+        except json.JSONDecodeError as err:
+            raise AlertRulesError(2, "%s: %s" % (file_path, str(err)))
+        return cls(rules)
+
+    @property
+    def names(self) -> tuple[str, ...]:
+        """
+        The rule names, in rules file order.
+        :return: tuple[str, ...]
+        """
+        return self._names
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        A hash of the rules, which changes when any rule does.
+        :return: str
+        """
+        return self._fingerprint
+
+    def match(self, line: bytes) -> set[int]:
+        """
+        Find the rules a line matches.
+        :param line: bytes: The line.
+        :return: set[int]: The numbers of the matching rules, indexes into names.
+        """
+        matched: set[int] = set()
+        if self._fixed is not None:
+            matched |= self._fixed.find(line)
+        if self._fixed_ignore_case is not None:
+            matched |= self._fixed_ignore_case.find(line.lower())
+        if self._combined is not None and self._combined.search(line) is not None:
+            for rule_number, regex in self._regexes:
+                if regex.search(line) is not None:
+                    matched.add(rule_number)
+        for rule_number, regex in self._standalone:
+            if regex.search(line) is not None:
+                matched.add(rule_number)
+        return matched
+
+    def scan(self, lines: Iterable[bytes], samples: int = DEFAULT_SAMPLES) -> dict[str, tuple[int, list[str]]]:
+        """
+        Scan lines with every rule.
+        :param lines: Iterable[bytes]: The lines, without line endings.
+        :param samples: int: Keep up to this many matching lines per rule. Defaults to DEFAULT_SAMPLES.
+        :return: dict[str, tuple[int, list[str]]]: The match count and sample lines of each rule that matched, by
+                 name.
+        """
+        counts: list[int] = [0] * len(self._names)
+        sample_lines: list[list[str]] = [[] for _ in self._names]
+        for line in lines:
+            for rule_number in self.match(line):
+                counts[rule_number] += 1
+                if len(sample_lines[rule_number]) < samples:
+                    sample_lines[rule_number].append(line.decode('utf-8', 'replace'))
+        return {name: (count, rule_samples) for name, count, rule_samples in zip(self._names, counts, sample_lines)
+                if count > 0}
+
+
+def alerts_path(file_path: str) -> str:
+    """
+    The path of the alerts sidecar for an archive.
+    :param file_path: str: The path to the archive.
+    :return: str
+    """
+    return logFormat.sidecar_path(file_path, ALERTS_SUFFIX)
+
+
+def scan_archive(file_path: str,
+                 rules: AlertRules,
+                 samples: int = DEFAULT_SAMPLES,
+                 ) -> dict[str, tuple[int, list[str]]]:
+    """
+    Scan an archive once with every rule, and save the alerts sidecar.
+    :param file_path: str: The path to the archive.
+    :param rules: AlertRules: The rules.
+    :param samples: int: Keep up to this many matching lines per rule. Defaults to DEFAULT_SAMPLES.
+    :return: dict[str, tuple[int, list[str]]]: The match count and sample lines of each rule that matched, by name.
+    :raises AlertRulesError: On read and write errors.
+    """
+    try:
+        alerts = rules.scan(logFormat.iter_lines(logFormat.iter_archive_chunks(file_path, _READ_SIZE)), samples)
+    except (OSError, EOFError, zlib.error, ModuleNotFoundError) as err:
+        raise AlertRulesError(4, "%s: %s" % (file_path, str(err)))
+    temp_path: str = alerts_path(file_path) + '.tmp'
+    try:
+        with open(temp_path, 'w') as file_handle:
+            json.dump({'size': os.path.getsize(file_path), 'rules': rules.fingerprint, 'samples': samples,
+                       'alerts': alerts}, file_handle)
+        os.replace(temp_path, alerts_path(file_path))
+    except OSError as err:
+        raise AlertRulesError(5, "%s: %s" % (file_path, str(err)))
+    return alerts
+
+
+def load_alerts(file_path: str,
+                rules: AlertRules,
+                samples: int = DEFAULT_SAMPLES,
+                ) -> Optional[dict[str, tuple[int, list[str]]]]:
+    """
+    Load the alerts sidecar of an archive.
+    :param file_path: str: The path to the archive.
+    :param rules: AlertRules: The rules the sidecar must have been made with.
+    :param samples: int: The sidecar must have kept at least this many samples. Defaults to DEFAULT_SAMPLES.
+    :return: Optional[dict[str, tuple[int, list[str]]]]: The match count and sample lines of each rule that matched,
+             by name, or None if there isn't a current sidecar for the archive.
+    """
+    try:
+        with open(alerts_path(file_path), 'r') as file_handle:
+            sidecar: dict = json.load(file_handle)
+        if (sidecar['size'] != os.path.getsize(file_path) or sidecar['rules'] != rules.fingerprint
+                or sidecar['samples'] < samples):
+            return None
+        return {name: (count, rule_samples[:samples]) for name, (count, rule_samples) in sidecar['alerts'].items()}
+    except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def collect_alerts(file_paths: list[str],
+                   rules: AlertRules,
+                   samples: int = DEFAULT_SAMPLES,
+                   max_workers: Optional[int] = None,
+                   ) -> dict[str, dict[str, tuple[int, list[str]]]]:
+    """
+    The alerts of many archives, scanning only the archives without a current sidecar, in a process pool.
+    :param file_paths: list[str]: The archive paths.
+    :param rules: AlertRules: The rules.
+    :param samples: int: Keep up to this many matching lines per rule. Defaults to DEFAULT_SAMPLES.
+    :param max_workers: Optional[int]: The number of processes. Defaults to None, the number of cores.
+    :return: dict[str, dict[str, tuple[int, list[str]]]]: The alerts of each archive, by path.
+    :raises AlertRulesError: On read and write errors.
+    """
+    results: dict[str, dict[str, tuple[int, list[str]]]] = {}
+    stale_paths: list[str] = []
+    for file_path in file_paths:
+        alerts = load_alerts(file_path, rules, samples)
+        if alerts is None:
+            stale_paths.append(file_path)
+        else:
+            results[file_path] = alerts
+    if stale_paths:
+        cpu_count: int = os.cpu_count() or 1
+        if max_workers is None or max_workers > cpu_count:
+            max_workers = cpu_count
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(stale_paths))) as pool:
+            futures = {pool.submit(scan_archive, file_path, rules, samples): file_path for file_path in stale_paths}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+    return {file_path: results[file_path] for file_path in file_paths}
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+    File: anomaly.py: Spikes in per minute line counts, found with rolling robust statistics.
+        Classes:
+            AnomalyError(Exception): Errors generated while finding anomalies.
+            Anomaly(NamedTuple): A window of consecutive anomalous minutes in one series.
+        Methods:
+            count_series: Build the per minute count series of each group value from the rollups.
+            rolling_scores: The rolling median, mean, and MAD based z-score of each minute of each series.
+            find_anomalies: Find the anomalous windows of each series.
+
+        Notes:
+            Requires NumPy. The series come from the rollups, or are counted by stats when rollups are off, so they
+            are per severity, per source, per program, or in total, each grouping on its own. They can be counted for
+            just some severities, ie: error spikes per source, which the rollups answer in total and per severity,
+            and stats counts otherwise. Minutes no archive has a line in are left out, so gaps between the stored
+            archives don't look like drops, or the data after them like spikes.
+
+            Each minute is scored against the window minutes before it, not including itself, so a spike doesn't
+            raise its own baseline: z = 0.6745 * (count - median) / MAD, the modified z-score of Iglewicz and Hoaglin.
+            When more than half the window is the same, the MAD is 0, and the mean absolute deviation is used
+            instead, z = (count - median) / (1.2533 * mean absolute deviation). When that is 0 too any rise is
+            infinite. Minutes with a z at or above the threshold, and at least min_count lines, are anomalous.
+
+            All the statistics are taken over numpy sliding_window_view()s of the series, a block of series at a time
+            to bound memory, and runs of anomalous minutes are found with numpy.diff(), so there are no Python loops
+            over minutes.
+"""
+from typing import Optional, Final, NamedTuple
+from collections import Counter
+import rollups
+from stats import StatsError
+import stats
+
+HAS_NUMPY: bool = False
+try:
+    import numpy
+    from numpy.lib.stride_tricks import sliding_window_view
+    HAS_NUMPY = True
+except ModuleNotFoundError:
+    pass
+
+ANOMALY_GROUPS: Final[tuple[str, ...]] = tuple(group_by for group_by in rollups.ROLLUP_GROUPS if group_by is not None)
+TOTAL_GROUP: Final[str] = 'all'
+DEFAULT_WINDOW: Final[int] = 60
+DEFAULT_THRESHOLD: Final[float] = 3.5
+DEFAULT_MIN_COUNT: Final[int] = 10
+MINUTE_SECONDS: Final[int] = rollups.ROLLUP_SECONDS
+# Modified z-score constants, for a normal distribution the MAD is 0.6745, and the mean absolute deviation 0.7979,
+# standard deviations:
+_MAD_SCALE: Final[float] = 0.6745
+_MEAN_AD_SCALE: Final[float] = 1.2533
+# Most window elements to hold in memory at once:
+_MAX_BLOCK_ELEMENTS: Final[int] = 1 << 24
+
+
+class AnomalyError(Exception):
+    """Class to store anomaly detection errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'ModuleNotFoundError: anomaly detection requires NumPy.',
+        2: 'ValueError: unknown group by column.',
+        3: 'ValueError: window, threshold, and min count must be greater than zero.',
+        4: 'Error while counting an archive.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+class Anomaly(NamedTuple):
+    """A window of consecutive anomalous minutes in one series."""
+    group_by: str
+    value: str
+    start: int
+    end: int
+    count: int
+    expected: float
+    max_score: float
+
+
+def count_series(group_by: str,
+                 file_paths: list[str],
+                 start: Optional[int] = None,
+                 end: Optional[int] = None,
+                 max_workers: Optional[int] = None,
+                 use_rollups: bool = True,
+                 severities: Optional[list[str]] = None,
+                 ):
+    """
+    Build the per minute count series of each group value from the archive rollups, rebuilding stale rollups.
+    :param group_by: str: The column to group by, one of ANOMALY_GROUPS, or TOTAL_GROUP.
+    :param file_paths: list[str]: The archive paths.
+    :param start: Optional[int]: Only count lines generated at or after this time, on a whole minute. Defaults to
+                  None.
+    :param end: Optional[int]: Only count lines generated before this time, on a whole minute. Defaults to None.
+    :param max_workers: Optional[int]: The number of processes to rebuild rollups with. Defaults to None, the number
+                        of cores.
+    :param use_rollups: bool: Count from the rollups, else count the archives with stats.collect_stats(). Defaults
+                        to True.
+    :param severities: Optional[list[str]]: Only count lines with these severities, case-insensitive. Defaults to
+                       None, any severity.
+    :return: tuple[list[str], numpy.ndarray, numpy.ndarray]: The group values, the minute start times, int64, and the
+             counts, int64 [value, minute].
+    :raises AnomalyError: Without NumPy, on bad arguments, and on read errors.
+    """
+    if not HAS_NUMPY:
+        raise AnomalyError(1)
+    if group_by != TOTAL_GROUP and group_by not in ANOMALY_GROUPS:
+        raise AnomalyError(2, group_by)
+    try:
+        collect = rollups.collect_stats if use_rollups else stats.collect_stats
+        counts: Counter = collect(file_paths, None if group_by == TOTAL_GROUP else group_by,
+                                  MINUTE_SECONDS, start, end, max_workers, severities)
+    except StatsError as err:
+        raise AnomalyError(4, err.error_message, *err.args[1:])
+    if not counts:
+        return [], numpy.zeros(0, numpy.int64), numpy.zeros((0, 0), numpy.int64)
+    minutes = numpy.fromiter((minute for minute, _ in counts.keys()), numpy.int64, len(counts))
+    values: list[str] = [value for _, value in counts.keys()]
+    unique_minutes, minute_indexes = numpy.unique(minutes, return_inverse=True)
+    unique_values, value_indexes = numpy.unique(numpy.array(values), return_inverse=True)
+    series = numpy.zeros((len(unique_values), len(unique_minutes)), numpy.int64)
+    series[value_indexes, minute_indexes] = numpy.fromiter(counts.values(), numpy.int64, len(counts))
+    return unique_values.tolist(), unique_minutes, series
+
+
+def rolling_scores(series, window: int = DEFAULT_WINDOW):
+    """
+    The rolling median, mean, and modified z-score of each minute of each series, against the window minutes before
+        it.
+    :param series: numpy.ndarray: The counts [series, minute].
+    :param window: int: The minutes in the baseline window. Defaults to DEFAULT_WINDOW.
+    :return: tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]: The medians, means, and z-scores, float64 [series,
+             minute]. They are NaN for the first window minutes, which don't have a full baseline.
+    :raises AnomalyError: Without NumPy, or on a bad window.
+    """
+    if not HAS_NUMPY:
+        raise AnomalyError(1)
+    if window < 1:
+        raise AnomalyError(3)
+    series_count, minute_count = series.shape
+    medians = numpy.full(series.shape, numpy.nan)
+    means = numpy.full(series.shape, numpy.nan)
+    scores = numpy.full(series.shape, numpy.nan)
+    if minute_count <= window:
+        return medians, means, scores
+    block_size: int = max(1, _MAX_BLOCK_ELEMENTS // ((minute_count - window) * window))
+    for block_start in range(0, series_count, block_size):
+        block = series[block_start:block_start + block_size].astype(numpy.float64)
+        # The window ending just before each scored minute:
+        windows = sliding_window_view(block, window, axis=1)[:, :-1]
+        current = block[:, window:]
+        median = numpy.median(windows, axis=2)
+        deviations = numpy.abs(windows - median[..., numpy.newaxis])
+        mad = numpy.median(deviations, axis=2)
+        mean_ad = deviations.mean(axis=2)
+        rise = current - median
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            score = numpy.where(mad > 0, _MAD_SCALE * rise / mad,
+                                numpy.where(mean_ad > 0, rise / (_MEAN_AD_SCALE * mean_ad),
+                                            numpy.where(rise > 0, numpy.inf, 0.0)))
+        rows = slice(block_start, block_start + block_size)
+        medians[rows, window:] = median
+        means[rows, window:] = windows.mean(axis=2)
+        scores[rows, window:] = score
+    return medians, means, scores
+
+
+def find_anomalies(group_by: str,
+                   file_paths: list[str],
+                   window: int = DEFAULT_WINDOW,
+                   threshold: float = DEFAULT_THRESHOLD,
+                   min_count: int = DEFAULT_MIN_COUNT,
+                   start: Optional[int] = None,
+                   end: Optional[int] = None,
+                   max_workers: Optional[int] = None,
+                   use_rollups: bool = True,
+                   severities: Optional[list[str]] = None,
+                   ) -> list[Anomaly]:
+    """
+    Find windows of consecutive minutes where a series spikes above its rolling baseline.
+    :param group_by: str: The column to group by, one of ANOMALY_GROUPS, or TOTAL_GROUP.
+    :param file_paths: list[str]: The archive paths.
+    :param window: int: The minutes in the baseline window. Defaults to DEFAULT_WINDOW.
+    :param threshold: float: The z-score at or above which a minute is anomalous. Defaults to DEFAULT_THRESHOLD.
+    :param min_count: int: Anomalous minutes must have at least this many lines. Defaults to DEFAULT_MIN_COUNT.
+    :param start: Optional[int]: Only count lines generated at or after this time, on a whole minute. Defaults to
+                  None.
+    :param end: Optional[int]: Only count lines generated before this time, on a whole minute. Defaults to None.
+    :param max_workers: Optional[int]: The number of processes to rebuild rollups with. Defaults to None, the number
+                        of cores.
+    :param use_rollups: bool: Count from the rollups, else count the archives. Defaults to True.
+    :param severities: Optional[list[str]]: Only count lines with these severities, case-insensitive. Defaults to
+                       None, any severity.
+    :return: list[Anomaly]: The anomalies, by start time, then value.
+    :raises AnomalyError: Without NumPy, on bad arguments, and on read errors.
+    """
+    if window < 1 or threshold <= 0 or min_count < 1:
+        raise AnomalyError(3)
+    values, minutes, series = count_series(group_by, file_paths, start, end, max_workers, use_rollups, severities)
+    if len(values) == 0:
+        return []
+    medians, _, scores = rolling_scores(series, window)
+    flags = (scores >= threshold) & (series >= min_count)
+    # Runs of flagged minutes, as [start, end) column pairs, in row major order so starts and ends pair up:
+    edges = numpy.diff(numpy.pad(flags.astype(numpy.int8), ((0, 0), (1, 1))), axis=1)
+    start_rows, start_columns = numpy.nonzero(edges == 1)
+    _, end_columns = numpy.nonzero(edges == -1)
+    if len(start_rows) == 0:
+        return []
+    # Sum and max over each run with reduceat() on the flattened arrays, a sentinel past the end for runs that end
+    # on the last minute of the last series:
+    minute_count: int = series.shape[1]
+    bounds = numpy.column_stack((start_rows * minute_count + start_columns,
+                                 start_rows * minute_count + end_columns)).ravel()
+    run_counts = numpy.add.reduceat(numpy.append(series.ravel(), 0), bounds)[::2]
+    run_expected = numpy.add.reduceat(numpy.append(numpy.nan_to_num(medians).ravel(), 0.0), bounds)[::2]
+    # Infinite scores, rises over a flat baseline, are kept:
+    flat_scores = numpy.nan_to_num(scores, nan=0.0, posinf=numpy.inf).ravel()
+    run_scores = numpy.maximum.reduceat(numpy.append(flat_scores, 0.0), bounds)[::2]
+    # The end is the last anomalous minute's end, not the next observed minute:
+    end_times = minutes[end_columns - 1] + MINUTE_SECONDS
+    anomalies: list[Anomaly] = [Anomaly(group_by, values[row], int(start_time), int(end_time), int(count),
+                                        float(expected), float(score))
+                                for row, start_time, end_time, count, expected, score
+                                in zip(start_rows.tolist(), minutes[start_columns].tolist(), end_times.tolist(),
+                                       run_counts.tolist(), run_expected.tolist(), run_scores.tolist())]
+    anomalies.sort(key=lambda anomaly: (anomaly.start, anomaly.value))
+    return anomalies
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+    File: archiveDownload.py: Stream papertrail archives to disk.
+        Classes:
+            ArchiveDownloadError(Exception): Errors generated while downloading an archive.
+        Methods:
+            preallocate: Reserve disk space for a file about to be written.
+            download_archive: Download an archive into a preallocated file.
+            iter_decompressed: Decompress a stream of gzip data as it arrives.
+            iter_archive: Stream an archive's bytes from papertrail.
+            stream_archive: Write an archive's bytes to an output as they arrive.
+"""
+from typing import Optional, Callable, Any
+import errno
+import os
+import shutil
+import zlib
+import requests
+from PyPapertrail.Archive import Archive
+
+
+class ArchiveDownloadError(Exception):
+    """
+        Archive download exception.
+            Defines:
+                .error_number : int, The error number.
+                .error_message : str, The message associated with the error number.
+                .str_args : Optional[str], The result of str(err.args) on the error that occurred.
+    """
+    _error_messages: dict[int, str] = {
+        0: "No error.",
+        1: "Unspecified error.",
+        2: "Destination is not a directory.",
+        3: "Failed to open the destination file for writing.",
+        4: "Not enough free disk space for the archive.",
+        5: "Failed to preallocate disk space for the archive.",
+        6: "Request to papertrail failed.",
+        7: "Papertrail returned an HTTP error.",
+        8: "Failed to write to the destination file.",
+        9: "Exception during callback execution.",
+        10: "Corrupt gzip data.",
+    }
+
+    def __init__(self,
+                 error_number: int,
+                 error_message: Optional[str] = None,
+                 str_args: Optional[str] = None,
+                 *args: object
+                 ) -> None:
+        """
+        Initialize an archive download error.
+        :param error_number: int: The error number.
+        :param error_message: Optional[str]: The error message.
+        :param str_args: Optional[str]: The result of str(err.args) on the error that has occurred.
+        :param args: object: Additional arguments.
+        """
+        super().__init__(*args)
+        self.error_number = error_number
+        if error_message is None:
+            self.error_message = self._error_messages[error_number]
+        else:
+            self.error_message = error_message
+        self.str_args = str_args
+        return
+
+
+def _request_archive(archive: Archive, api_key: str) -> requests.Response:
+    """
+    Make the streaming http request for an archive.
+    :param archive: Archive: The archive to request.
+    :param api_key: str: The papertrail api key.
+    :return: requests.Response: The response, with the body not yet read.
+    :raises ArchiveDownloadError: On request and http errors.
+    """
+    headers: dict[str, str] = {"X-Papertrail-Token": api_key}
+    try:
+        response = requests.get(archive.link, headers=headers, stream=True)
+        response.raise_for_status()
+    except requests.HTTPError as err:
+        error: str = "Papertrail returned HTTP status %i." % err.response.status_code
+        raise ArchiveDownloadError(error_number=7, error_message=error, str_args=str(err.args))
+    except requests.RequestException as err:
+        raise ArchiveDownloadError(error_number=6, str_args=str(err.args))
+    return response
+
+
+def preallocate(file_handle, size: int) -> bool:
+    """
+    Reserve size bytes on disk for an open file, so it isn't fragmented as it grows chunk by chunk.
+    :param file_handle: A file object opened for binary writing.
+    :param size: int: The expected size of the file in bytes.
+    :return: bool: True if the space was allocated, False if the platform / filesystem can't preallocate.
+    :raises ArchiveDownloadError: If there isn't enough free space, or on any other allocation error.
+    """
+    if size <= 0:
+        return False
+    # Platforms without posix_fallocate, just check that the archive will fit:
+    if not hasattr(os, 'posix_fallocate'):
+        free_space: int = shutil.disk_usage(os.path.dirname(os.path.abspath(file_handle.name))).free
+        if free_space < size:
+            error: str = "Not enough free disk space for '%s': need %i bytes, %i available." % (
+                file_handle.name, size, free_space)
+            raise ArchiveDownloadError(error_number=4, error_message=error)
+        return False
+    try:
+        os.posix_fallocate(file_handle.fileno(), 0, size)
+    except OSError as err:
+        if err.errno in (errno.ENOSPC, errno.EDQUOT, errno.EFBIG):
+            error: str = "Not enough free disk space for '%s': need %i bytes." % (file_handle.name, size)
+            raise ArchiveDownloadError(error_number=4, error_message=error, str_args=str(err.args))
+        elif err.errno in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            return False
+        raise ArchiveDownloadError(error_number=5, str_args=str(err.args))
+    return True
+
+
+def download_archive(archive: Archive,
+                     destination_dir: str,
+                     api_key: str,
+                     file_name: Optional[str] = None,
+                     callback: Optional[Callable] = None,
+                     argument: Any = None,
+                     chunk_size: int = 8192,
+                     do_preallocate: bool = True,
+                     ) -> tuple[int, str]:
+    """
+    Download an archive, preallocating the expected archive size before streaming the data in. Existing files are
+        overwritten.
+    :param archive: Archive: The archive to download.
+    :param destination_dir: str: The directory to save the file in.
+    :param api_key: str: The papertrail api key.
+    :param file_name: Optional[str]: Override the archive file name with this name. Defaults to None.
+    :param callback: Optional[Callable]: Called after each chunk with the signature:
+                        callback(archive: Archive, bytes_downloaded: int, argument: Any) -> None. Defaults to None.
+    :param argument: Any: An argument passed to the callback. Defaults to None.
+    :param chunk_size: int: The chunk size to download at a time in bytes. Defaults to 8192.
+    :param do_preallocate: bool: Preallocate archive.file_size bytes before downloading. Defaults to True.
+    :return: tuple[int, str]: The number of bytes downloaded, and the path to the downloaded file.
+    :raises ArchiveDownloadError: On file, disk space, and http errors.
+    """
+    # Validate destination:
+    if not os.path.isdir(destination_dir):
+        error: str = "Destination: %s, is not a directory." % destination_dir
+        raise ArchiveDownloadError(error_number=2, error_message=error)
+    if file_name is None:
+        file_name = archive.file_name
+    download_path: str = os.path.join(destination_dir, file_name)
+    # Open the file, and reserve the space before making the request, so we fail fast on a full disk:
+    try:
+        file_handle = open(download_path, 'wb')
+    except OSError as err:
+        raise ArchiveDownloadError(error_number=3, str_args=str(err.args))
+    written_size: int = 0
+    try:
+        if do_preallocate:
+            preallocate(file_handle, archive.file_size)
+        # Make the http request:
+        response = _request_archive(archive, api_key)
+        # Call the callback with zero bytes downloaded:
+        if callback is not None:
+            try:
+                callback(archive, 0, argument)
+            except SystemExit as err:
+                raise err
+            except Exception as err:
+                raise ArchiveDownloadError(error_number=9, str_args=str(err.args))
+        # Stream the data in:
+        try:
+            for chunk in response.iter_content(chunk_size):
+                written_size += file_handle.write(chunk)
+                if callback is not None:
+                    try:
+                        callback(archive, written_size, argument)
+                    except SystemExit as err:
+                        raise err
+                    except Exception as err:
+                        raise ArchiveDownloadError(error_number=9, str_args=str(err.args))
+        except OSError as err:
+            if err.errno in (errno.ENOSPC, errno.EDQUOT):
+                raise ArchiveDownloadError(error_number=4, str_args=str(err.args))
+            raise ArchiveDownloadError(error_number=8, str_args=str(err.args))
+        except requests.RequestException as err:
+            raise ArchiveDownloadError(error_number=6, str_args=str(err.args))
+    finally:
+        # Drop any preallocated space past the end of the body:
+        try:
+            file_handle.truncate(written_size)
+        finally:
+            file_handle.close()
+    return written_size, download_path
+
+
+def iter_decompressed(chunks, max_length: int = 1048576):
+    """
+    Decompress a stream of gzip data as it arrives, handling multi-member gzip files.
+    :param chunks: Iterable[bytes]: The compressed chunks.
+    :param max_length: int: The largest block of decompressed data to produce at once, this bounds memory use when a
+                        small chunk inflates to a lot of data. Defaults to 1 MiB.
+    :return: Iterator[bytes]: The decompressed data.
+    :raises zlib.error: On corrupt data.
+    """
+    decompressor = zlib.decompressobj(wbits=31)
+    for chunk in chunks:
+        data: bytes = chunk
+        while data:
+            output: bytes = decompressor.decompress(data, max_length)
+            if output:
+                yield output
+            if decompressor.eof:
+                # Start of the next gzip member:
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+            else:
+                data = decompressor.unconsumed_tail
+    remaining: bytes = decompressor.flush()
+    if remaining:
+        yield remaining
+    return
+
+
+def iter_archive(archive: Archive,
+                 api_key: str,
+                 decompress: bool = False,
+                 chunk_size: int = 65536,
+                 ):
+    """
+    Stream an archive's bytes from papertrail as they arrive, without storing them.
+    :param archive: Archive: The archive to stream.
+    :param api_key: str: The papertrail api key.
+    :param decompress: bool: Decompress the gzip data on the fly. Defaults to False.
+    :param chunk_size: int: The chunk size to download at a time in bytes. Defaults to 65536.
+    :return: Iterator[bytes]: The archive data.
+    :raises ArchiveDownloadError: On http errors, or corrupt data.
+    """
+    response = _request_archive(archive, api_key)
+    try:
+        chunks = response.iter_content(chunk_size)
+        if decompress:
+            chunks = iter_decompressed(chunks)
+        for chunk in chunks:
+            yield chunk
+    except requests.RequestException as err:
+        raise ArchiveDownloadError(error_number=6, str_args=str(err.args))
+    except zlib.error as err:
+        error: str = "Corrupt gzip data in archive '%s'." % archive.file_name
+        raise ArchiveDownloadError(error_number=10, error_message=error, str_args=str(err.args))
+    finally:
+        response.close()
+    return
+
+
+def stream_archive(archive: Archive,
+                   api_key: str,
+                   output_handle,
+                   decompress: bool = False,
+                   chunk_size: int = 65536,
+                   ) -> int:
+    """
+    Write an archive's bytes to an output as they arrive, ie: stdout or a named pipe.
+    :param archive: Archive: The archive to stream.
+    :param api_key: str: The papertrail api key.
+    :param output_handle: A file object opened for binary writing.
+    :param decompress: bool: Decompress the gzip data on the fly. Defaults to False.
+    :param chunk_size: int: The chunk size to download at a time in bytes. Defaults to 65536.
+    :return: int: The number of bytes written.
+    :raises ArchiveDownloadError: On http errors, or corrupt data.
+    :raises BrokenPipeError: If the reader of the output goes away.
+    """
+    written_size: int = 0
+    for chunk in iter_archive(archive, api_key, decompress, chunk_size):
+        written_size += output_handle.write(chunk)
+    output_handle.flush()
+    return written_size
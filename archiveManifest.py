@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+    File: archiveManifest.py: Track what is stored in the output directory for each archive.
+        Classes:
+            ArchiveManifest(object): The manifest of an output directory.
+
+        Notes:
+            When the stored file isn't a plain copy of the archive (ie: filtered on ingest), its size can't be compared
+            to the archive size to decide whether to download again, so the manifest records the size of the archive
+            the stored file was made from.
+"""
+from typing import Optional, Final
+import json
+import os
+
+MANIFEST_FILE_NAME: Final[str] = 'manifest.json'
+
+
+class ArchiveManifest(object):
+    """
+    The manifest of an output directory, mapping archive file names to entries of:
+        {'size': int, the archive size, 'path': str, the stored file name, ...}
+    """
+
+    def __init__(self, directory: str) -> None:
+        """
+        Initialize the manifest, loading it if it exists.
+        :param directory: str: The output directory.
+        """
+        self._directory: str = directory
+        self._path: str = os.path.join(directory, MANIFEST_FILE_NAME)
+        self._entries: dict[str, dict] = {}
+        if os.path.exists(self._path):
+            try:
+                with open(self._path, 'r') as file_handle:
+                    self._entries = json.load(file_handle)
+            except (OSError, json.JSONDecodeError):
+                # A damaged manifest only means archives get downloaded again:
+                self._entries = {}
+        return
+
+    @property
+    def directory(self) -> str:
+        """
+        The output directory.
+        :return: str
+        """
+        return self._directory
+
+    def get(self, file_name: str) -> Optional[dict]:
+        """
+        Get the entry for an archive.
+        :param file_name: str: The archive file name.
+        :return: Optional[dict]: The entry, or None if the archive isn't recorded.
+        """
+        return self._entries.get(file_name)
+
+    def stored_path(self, file_name: str) -> Optional[str]:
+        """
+        Get the path to the stored file for an archive.
+        :param file_name: str: The archive file name.
+        :return: Optional[str]: The path, or None if the archive isn't recorded.
+        """
+        entry: Optional[dict] = self._entries.get(file_name)
+        if entry is None:
+            return None
+        return os.path.join(self._directory, entry['path'])
+
+    def is_current(self, file_name: str, size: int, **expected) -> bool:
+        """
+        Check if the stored file for an archive was made from an archive of the given size, and still exists.
+        :param file_name: str: The archive file name.
+        :param size: int: The current archive size.
+        :param expected: Any other entry values that must match, ie: filter=...
+        :return: bool: True if the stored file is up-to-date.
+        """
+        entry: Optional[dict] = self._entries.get(file_name)
+        if entry is None or entry['size'] != size:
+            return False
+        for key, value in expected.items():
+            if entry.get(key) != value:
+                return False
+        return os.path.exists(os.path.join(self._directory, entry['path']))
+
+    def record(self, file_name: str, size: int, path: str, **values) -> None:
+        """
+        Record the stored file for an archive, and save the manifest.
+        :param file_name: str: The archive file name.
+        :param size: int: The archive size.
+        :param path: str: The path to the stored file.
+        :param values: Any other JSON serializable values to store in the entry.
+        :return: None
+        """
+        entry: dict = {'size': size, 'path': os.path.relpath(path, self._directory)}
+        entry.update(values)
+        self._entries[file_name] = entry
+        self.save()
+        return
+
+    def update(self, file_name: str, **values) -> None:
+        """
+        Update values in an existing entry, and save the manifest.
+        :param file_name: str: The archive file name.
+        :param values: The JSON serializable values to store in the entry.
+        :return: None
+        :raises KeyError: If the archive isn't recorded.
+        """
+        self._entries[file_name].update(values)
+        self.save()
+        return
+
+    def file_names(self) -> list[str]:
+        """
+        Get the recorded archive file names, sorted, which is also time order.
+        :return: list[str]
+        """
+        return sorted(self._entries.keys())
+
+    def save(self) -> None:
+        """
+        Save the manifest, replacing the old one atomically.
+        :return: None
+        """
+        temp_path: str = self._path + '.tmp'
+        with open(temp_path, 'w') as file_handle:
+            json.dump(self._entries, file_handle, indent=4)
+        os.replace(temp_path, self._path)
+        return
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+    File: bloomIndex.py: Per archive bloom filter sidecars of tokens, for skipping archives.
+        Classes:
+            BloomBuilder(object): Build the bloom sidecar of an archive from its lines.
+        Methods:
+            bloom_path: The path of the bloom sidecar for an archive.
+            build_bloom: Build the bloom sidecar of an archive.
+            load_bloom: Load the bloom sidecar of an archive.
+            may_contain: Check if an archive may contain every token.
+            candidate_archives: Drop the archives that definitely don't contain every token.
+
+        Notes:
+            Tokens are logFormat.tokenize() tokens of every column from source_id on, the id and timestamps are left
+            out as they're unique per line. So when those columns are searched, tokens that could come from them, ones
+            made only of digits, 't' and 'z', aren't used to skip archives. To bound memory while building, distinct
+            tokens are collected up to MAX_SET_SIZE at a time, each batch becoming its own filter. The sidecar holds
+            the archive size it was built from, and a list of filters, a token may be in the archive if it's in any of
+            them.
+"""
+from typing import Optional, Final, Iterable
+import os
+import re
+import struct
+import logFormat
+from sketches import BloomFilter
+
+BLOOM_SUFFIX: Final[str] = '.bloom'
+DEFAULT_ERROR_RATE: Final[float] = 0.01
+MAX_SET_SIZE: Final[int] = 2000000
+_HEADER: Final[struct.Struct] = struct.Struct('<QQ')
+_LENGTH: Final[struct.Struct] = struct.Struct('<Q')
+# The columns left out of the filters, and the shape of the tokens they can make:
+_UNINDEXED_COLUMNS: Final[frozenset[int]] = frozenset(range(logFormat.SOURCE_ID))
+_UNINDEXED_TOKEN_REGEX: Final[re.Pattern] = re.compile(rb'[0-9tz]+')
+
+
+def bloom_path(file_path: str) -> str:
+    """
+    The path of the bloom sidecar for an archive.
+    :param file_path: str: The path to the archive.
+    :return: str
+    """
+    return logFormat.sidecar_path(file_path, BLOOM_SUFFIX)
+
+
+class BloomBuilder(object):
+    """
+    Build the bloom sidecar of an archive from its lines, so it can share a pass over the archive with other sidecars.
+    """
+
+    def __init__(self, file_path: str, error_rate: float = DEFAULT_ERROR_RATE) -> None:
+        """
+        Initialize an empty token set.
+        :param file_path: str: The path to the archive.
+        :param error_rate: float: The false positive rate of each filter. Defaults to DEFAULT_ERROR_RATE.
+        """
+        self._file_path: str = file_path
+        self._error_rate: float = error_rate
+        self._filters: list[BloomFilter] = []
+        self._tokens: set[bytes] = set()
+        self._token_count: int = 0
+        return
+
+    def _flush_tokens(self) -> None:
+        """
+        Put the tokens collected so far in a new filter.
+        :return: None
+        """
+        bloom_filter: BloomFilter = BloomFilter.for_capacity(len(self._tokens), self._error_rate)
+        for token in self._tokens:
+            bloom_filter.add(token)
+        self._filters.append(bloom_filter)
+        self._token_count += len(self._tokens)
+        self._tokens.clear()
+        return
+
+    def add_lines(self, lines: Iterable[bytes]) -> None:
+        """
+        Add the tokens of the next lines of the archive.
+        :param lines: Iterable[bytes]: The lines, without line endings.
+        :return: None
+        """
+        for line in lines:
+            fields: list[bytes] = logFormat.split_line(line)
+            if len(fields) > logFormat.SOURCE_ID:
+                self._tokens.update(logFormat.tokenize(b'\t'.join(fields[logFormat.SOURCE_ID:])))
+            if len(self._tokens) >= MAX_SET_SIZE:
+                self._flush_tokens()
+        return
+
+    def finish(self) -> int:
+        """
+        Save the sidecar, after the last lines are added.
+        :return: int: The number of distinct tokens added.
+        :raises OSError: On write errors.
+        """
+        if self._tokens or not self._filters:
+            self._flush_tokens()
+        temp_path: str = bloom_path(self._file_path) + '.tmp'
+        with open(temp_path, 'wb') as file_handle:
+            file_handle.write(_HEADER.pack(os.path.getsize(self._file_path), len(self._filters)))
+            for bloom_filter in self._filters:
+                data: bytes = bloom_filter.to_bytes()
+                file_handle.write(_LENGTH.pack(len(data)))
+                file_handle.write(data)
+        os.replace(temp_path, bloom_path(self._file_path))
+        return self._token_count
+
+
+def build_bloom(file_path: str, error_rate: float = DEFAULT_ERROR_RATE) -> int:
+    """
+    Build and save the bloom sidecar of an archive.
+    :param file_path: str: The path to the archive.
+    :param error_rate: float: The false positive rate of each filter. Defaults to DEFAULT_ERROR_RATE.
+    :return: int: The number of distinct tokens added.
+    :raises OSError: On read and write errors.
+    :raises zlib.error: On corrupt gzip data.
+    """
+    builder = BloomBuilder(file_path, error_rate)
+    builder.add_lines(logFormat.iter_lines(logFormat.iter_archive_chunks(file_path)))
+    return builder.finish()
+
+
+def load_bloom(file_path: str) -> Optional[list[BloomFilter]]:
+    """
+    Load the bloom sidecar of an archive.
+    :param file_path: str: The path to the archive.
+    :return: Optional[list[BloomFilter]]: The filters, or None if there isn't a current sidecar for the archive.
+    """
+    try:
+        with open(bloom_path(file_path), 'rb') as file_handle:
+            data: bytes = file_handle.read()
+        source_size, filter_count = _HEADER.unpack_from(data)
+        if source_size != os.path.getsize(file_path):
+            return None
+        filters: list[BloomFilter] = []
+        offset: int = _HEADER.size
+        for _ in range(filter_count):
+            (length,) = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            filters.append(BloomFilter.from_bytes(data[offset:offset + length]))
+            offset += length
+    except (OSError, struct.error, ValueError):
+        return None
+    return filters
+
+
+def may_contain(file_path: str, tokens: list[bytes]) -> bool:
+    """
+    Check if an archive may contain every token.
+    :param file_path: str: The path to the archive.
+    :param tokens: list[bytes]: The tokens, as made by logFormat.tokenize().
+    :return: bool: False if the archive definitely doesn't contain a token, True if it may, or has no sidecar.
+    """
+    filters: Optional[list[BloomFilter]] = load_bloom(file_path)
+    if filters is None:
+        return True
+    return all(any(token in bloom_filter for bloom_filter in filters) for token in tokens)
+
+
+def candidate_archives(file_paths: list[str],
+                       tokens: list[bytes],
+                       columns: Optional[tuple[int, ...]] = None,
+                       ) -> list[str]:
+    """
+    Drop the archives that definitely don't contain every token.
+    :param file_paths: list[str]: The archive paths.
+    :param tokens: list[bytes]: The tokens, as made by logFormat.tokenize().
+    :param columns: Optional[tuple[int, ...]]: The column indexes the tokens are searched for in. Defaults to None, the
+                    whole line.
+    :return: list[str]: The archives that may contain every token, in the same order.
+    """
+    if columns is None or not _UNINDEXED_COLUMNS.isdisjoint(columns):
+        # The id or a timestamp may hold these, and they aren't in the filters:
+        tokens = [token for token in tokens if _UNINDEXED_TOKEN_REGEX.fullmatch(token) is None]
+    if not tokens:
+        return list(file_paths)
+    return [file_path for file_path in file_paths if may_contain(file_path, tokens)]
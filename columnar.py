@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+    File: columnar.py: Columnar, memory mapped copies of stored archives.
+        Classes:
+            ColumnarError(Exception): Errors generated while converting or reading columnar archives.
+            ColumnarArchive(object): A read only, memory mapped columnar archive.
+        Methods:
+            columnar_path: The path of the columnar directory for an archive.
+            convert_archive: Convert an archive to columnar form.
+
+        Notes:
+            A columnar archive is a directory alongside the archive holding one file per column, and a meta.json:
+                id, generated_at, received_at, source_id: int64 values, times in seconds since the epoch, -1 when a
+                    line doesn't have a valid value.
+                source_name, source_ip, facility_name, severity_name, program: uint32 codes into a dictionary of the
+                    distinct values, stored in meta.json.
+                message: the message bytes back to back, with int64 offsets [rows + 1] in message.offsets.
+            Lines are parsed with logParser.iter_batches(), and arrays are written in native byte order with the array
+            module, so converting doesn't need NumPy. Reading maps the files, returning numpy.memmap arrays when NumPy
+            is installed, and memoryviews when it isn't, so an aggregate only touches the pages of the columns it uses.
+"""
+from typing import Final, Union
+from array import array
+import json
+import mmap
+import os
+import shutil
+import sys
+import zlib
+import logFormat
+import logParser
+
+HAS_NUMPY: bool = False
+try:
+    import numpy
+    HAS_NUMPY = True
+except ModuleNotFoundError:
+    pass
+
+COLUMNAR_SUFFIX: Final[str] = '.columns'
+COLUMNAR_VERSION: Final[int] = 1
+META_FILE_NAME: Final[str] = 'meta.json'
+MESSAGE_OFFSETS_FILE_NAME: Final[str] = 'message.offsets'
+INTEGER_COLUMNS: Final[tuple[int, ...]] = (logFormat.ID, logFormat.GENERATED_AT, logFormat.RECEIVED_AT,
+                                           logFormat.SOURCE_ID)
+DICTIONARY_COLUMNS: Final[tuple[int, ...]] = (logFormat.SOURCE_NAME, logFormat.SOURCE_IP, logFormat.FACILITY_NAME,
+                                              logFormat.SEVERITY_NAME, logFormat.PROGRAM)
+_INTEGER_TYPE: Final[str] = 'q'
+_CODE_TYPE: Final[str] = 'I'
+_BATCH_ROWS: Final[int] = 65536
+
+
+class ColumnarError(Exception):
+    """Class to store columnar errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'OSError while converting or reading the archive.',
+        2: "Corrupt compressed data in the archive, or its codec isn't installed.",
+        3: 'No current columnar copy of the archive.',
+        4: 'ValueError: unknown column name.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+def columnar_path(file_path: str) -> str:
+    """
+    The path of the columnar directory for an archive.
+    :param file_path: str: The path to the archive.
+    :return: str
+    """
+    return logFormat.sidecar_path(file_path, COLUMNAR_SUFFIX)
+
+
+def convert_archive(file_path: str) -> int:
+    """
+    Convert an archive to columnar form, replacing any older columnar copy.
+    :param file_path: str: The path to the archive.
+    :return: int: The number of rows.
+    :raises ColumnarError: On read, write, and corrupt data errors.
+    """
+    directory: str = columnar_path(file_path)
+    temp_directory: str = directory + '.tmp'
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    dictionaries: dict[int, dict[bytes, int]] = {column: {} for column in DICTIONARY_COLUMNS}
+    rows: int = 0
+    try:
+        os.makedirs(temp_directory)
+        handles: dict[int, object] = {}
+        offsets_handle = None
+        try:
+            for column in INTEGER_COLUMNS + DICTIONARY_COLUMNS + (logFormat.MESSAGE,):
+                handles[column] = open(os.path.join(temp_directory, logFormat.COLUMNS[column]), 'wb')
+            offsets_handle = open(os.path.join(temp_directory, MESSAGE_OFFSETS_FILE_NAME), 'wb')
+            message_offset: int = 0
+            array(_INTEGER_TYPE, [0]).tofile(offsets_handle)
+            lines = logFormat.iter_lines(logFormat.iter_archive_chunks(file_path))
+            for batch in logParser.iter_batches(lines, INTEGER_COLUMNS + DICTIONARY_COLUMNS + (logFormat.MESSAGE,),
+                                                _BATCH_ROWS, dictionaries):
+                for column in INTEGER_COLUMNS + DICTIONARY_COLUMNS:
+                    batch[column].tofile(handles[column])
+                messages: list[bytes] = batch[logFormat.MESSAGE]
+                handles[logFormat.MESSAGE].write(b''.join(messages))
+                offsets: array = array(_INTEGER_TYPE)
+                for message in messages:
+                    message_offset += len(message)
+                    offsets.append(message_offset)
+                offsets.tofile(offsets_handle)
+                rows += batch.rows
+        finally:
+            for handle in handles.values():
+                handle.close()
+            if offsets_handle is not None:
+                offsets_handle.close()
+        meta: dict = {
+            'version': COLUMNAR_VERSION,
+            'source_size': os.path.getsize(file_path),
+            'rows': rows,
+            'byteorder': sys.byteorder,
+            'dictionaries': {logFormat.COLUMNS[column]: [value.decode('utf-8', 'surrogateescape')
+                                                         for value in dictionary]
+                             for column, dictionary in dictionaries.items()},
+        }
+        with open(os.path.join(temp_directory, META_FILE_NAME), 'w') as file_handle:
+            json.dump(meta, file_handle, separators=(',', ':'))
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temp_directory, directory)
+    except (zlib.error, EOFError, ModuleNotFoundError) as err:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        raise ColumnarError(2, *err.args)
+    except OSError as err:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        raise ColumnarError(1, *err.args)
+    return rows
+
+
+class ColumnarArchive(object):
+    """
+    A read only, memory mapped columnar archive. Columns are mapped when first used.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        """
+        Open the columnar copy of an archive.
+        :param file_path: str: The path to the archive.
+        :raises ColumnarError: If there isn't a current columnar copy of the archive.
+        """
+        self._file_path: str = file_path
+        self._directory: str = columnar_path(file_path)
+        try:
+            with open(os.path.join(self._directory, META_FILE_NAME), 'r') as file_handle:
+                self._meta: dict = json.load(file_handle)
+        except (OSError, json.JSONDecodeError):
+            raise ColumnarError(3, file_path)
+        if (self._meta.get('version') != COLUMNAR_VERSION or not os.path.exists(file_path)
+                or self._meta['source_size'] != os.path.getsize(file_path)):
+            raise ColumnarError(3, file_path)
+        self._maps: dict[str, mmap.mmap] = {}
+        self._columns: dict[str, object] = {}
+        return
+
+    @classmethod
+    def is_current(cls, file_path: str) -> bool:
+        """
+        Check if an archive has a current columnar copy.
+        :param file_path: str: The path to the archive.
+        :return: bool
+        """
+        try:
+            cls(file_path).close()
+        except ColumnarError:
+            return False
+        return True
+
+    def close(self) -> None:
+        """
+        Unmap the columns.
+        :return: None
+        """
+        self._columns.clear()
+        for column_map in self._maps.values():
+            try:
+                column_map.close()
+            except BufferError:
+                # A caller still holds a view of the column, the map closes when it's released:
+                pass
+        self._maps.clear()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+        return
+
+    @property
+    def rows(self) -> int:
+        """
+        The number of rows.
+        :return: int
+        """
+        return self._meta['rows']
+
+    def _map(self, file_name: str, type_code: str) -> Union['numpy.ndarray', memoryview]:
+        """
+        Map a column file.
+        :param file_name: str: The column file name.
+        :param type_code: str: The array module type code of the values, or 'B' for bytes.
+        :return: Union[numpy.ndarray, memoryview]: The values.
+        """
+        if file_name in self._columns:
+            return self._columns[file_name]
+        path: str = os.path.join(self._directory, file_name)
+        try:
+            if os.path.getsize(path) == 0:
+                values = numpy.zeros(0, numpy.dtype(type_code)) if HAS_NUMPY else memoryview(b'').cast(type_code)
+            elif HAS_NUMPY:
+                dtype = numpy.dtype(type_code).newbyteorder('<' if self._meta['byteorder'] == 'little' else '>')
+                values = numpy.memmap(path, dtype=dtype, mode='r')
+            else:
+                with open(path, 'rb') as file_handle:
+                    self._maps[file_name] = mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+                values = memoryview(self._maps[file_name]).cast(type_code)
+        except OSError as err:
+            raise ColumnarError(1, *err.args)
+        self._columns[file_name] = values
+        return values
+
+    def column(self, name: str) -> Union['numpy.ndarray', memoryview]:
+        """
+        The values of an integer column, or the codes of a dictionary column.
+        :param name: str: The column name, any of logFormat.COLUMNS but message.
+        :return: Union[numpy.ndarray, memoryview]: int64 values, or uint32 codes.
+        :raises ColumnarError: On unknown column names, and read errors.
+        """
+        if name not in logFormat.COLUMNS or logFormat.COLUMNS.index(name) == logFormat.MESSAGE:
+            raise ColumnarError(4, name)
+        if logFormat.COLUMNS.index(name) in DICTIONARY_COLUMNS:
+            return self._map(name, _CODE_TYPE)
+        return self._map(name, _INTEGER_TYPE)
+
+    def dictionary(self, name: str) -> list[str]:
+        """
+        The distinct values of a dictionary column, indexed by code.
+        :param name: str: The column name, one of the DICTIONARY_COLUMNS.
+        :return: list[str]
+        :raises ColumnarError: On unknown column names.
+        """
+        if name not in self._meta['dictionaries']:
+            raise ColumnarError(4, name)
+        return self._meta['dictionaries'][name]
+
+    def message(self, row: int) -> bytes:
+        """
+        The message of a row.
+        :param row: int: The row number.
+        :return: bytes
+        :raises ColumnarError: On read errors.
+        """
+        offsets = self._map(MESSAGE_OFFSETS_FILE_NAME, _INTEGER_TYPE)
+        messages = self._map(logFormat.COLUMNS[logFormat.MESSAGE], 'B')
+        return bytes(messages[int(offsets[row]):int(offsets[row + 1])])
@@ -9,5 +9,19 @@ class Modes(IntEnum):
 
 SETTINGS: dict = {
     'output_dir': '',
-    'mode': Modes.OVERWRITE
+    'mode': Modes.OVERWRITE,
+    'preallocate': True,
+    'ingest_filter': None,
+    'recompress': None,
+    'gzip_index_span': None,
+    'inverted_index': False,
+    'bloom_sidecars': False,
+    'trigram_index': False,
+    'time_index': True,
+    'columnar': False,
+    'rollups': True,
+    'distinct_sketches': True,
+    'database_load': False,
+    'full_text': False,
+    'alert_rules': None,
 }
@@ -273,7 +273,8 @@ class ConfigFile(object):
 
         # Load the JSON and close the file:
         try:
-            common.SETTINGS = json.loads(file_handle.read())
+            # Update rather than replace, so settings missing from older config files keep their defaults:
+            common.SETTINGS.update(json.loads(file_handle.read()))
             file_handle.close()
             # Unlock the file if it was locked.
             if CAN_LOCK:
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+    File: correlate.py: Group the lines of stored archives by a request id, spilling to disk at a memory cap.
+        Classes:
+            CorrelateError(Exception): Errors generated while correlating.
+            PartitionedTable(object): A hash table of lines by id, partitioned so partitions can spill to disk.
+        Methods:
+            correlate_archives: Group the lines of stored archives by the id in their messages.
+
+        Notes:
+            The id is the first group of the id regex, or the whole match if it has no groups, at its first match in
+            the message. The table is split into PARTITIONS partitions by the crc32 of the id. When the lines held pass
+            the memory cap the largest partition is appended to its spill file in a temp directory, and any more lines
+            for it are held until it spills again. At the end the partitions that never spilled are output from
+            memory, then each spilled partition is read back alone, split again on the next bits of the crc32 if it's
+            still over the cap, as in a Grace hash join. Every id's lines are in one partition, so each timeline is
+            complete. Timelines are sorted by generated_at, then archive and file order; ids are output partition by
+            partition, not in time order.
+
+            With a trigram index only the blocks holding the literals of the id regex are read, and with a start or
+            end time, the time index is used to read the lines in range.
+"""
+from typing import Optional, Final, Callable, Iterator, Iterable
+import os
+import re
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+import logFormat
+from search import required_literals
+from timeIndex import TimeIndexError, TimeIndex, iter_archive_range
+from trigramIndex import iter_candidate_lines
+
+DEFAULT_ID_REGEX: Final[str] = r'\breq-[0-9A-Za-z]+\b'
+DEFAULT_MEMORY_CAP: Final[int] = 256 * 1048576
+PARTITION_BITS: Final[int] = 6
+PARTITIONS: Final[int] = 1 << PARTITION_BITS
+# Splitting again uses the next bits of the crc32, so there are only this many levels:
+_MAX_LEVEL: Final[int] = 32 // PARTITION_BITS - 1
+# Rough python overhead of holding a line, its id, and time, in the table:
+_ROW_OVERHEAD: Final[int] = 160
+_RECORD_HEADER: Final[struct.Struct] = struct.Struct('<qQII')
+_SPILL_SUFFIX: Final[str] = '.part'
+_WRITE_BUFFER: Final[int] = 1048576
+
+
+class CorrelateError(Exception):
+    """Class to store correlate errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'Invalid id regex.',
+        2: 'Error while reading an archive.',
+        3: 'OSError while writing or reading a spilled partition.',
+        4: 'ValueError: memory cap must be at least 1 MiB.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+class PartitionedTable(object):
+    """
+    A hash table of lines by id, partitioned so the largest partitions can spill to disk at a memory cap.
+    """
+
+    def __init__(self, memory_cap: int, spill_dir: str, level: int = 0) -> None:
+        """
+        Initialize an empty table.
+        :param memory_cap: int: The most memory, in bytes, to hold lines in.
+        :param spill_dir: str: The directory to write spilled partitions to.
+        :param level: int: How many times the lines have been split before, to pick the crc32 bits. Defaults to 0.
+        """
+        self._memory_cap: int = memory_cap
+        self._spill_dir: str = spill_dir
+        self._level: int = level
+        self._shift: int = level * PARTITION_BITS
+        self._partitions: list[dict[bytes, list[tuple[int, int, bytes]]]] = [{} for _ in range(PARTITIONS)]
+        self._sizes: list[int] = [0] * PARTITIONS
+        self._spill_paths: list[Optional[str]] = [None] * PARTITIONS
+        self._held: int = 0
+        self._spills: int = 0
+        return
+
+    @property
+    def spills(self) -> int:
+        """
+        The number of times a partition has spilled, including from split partitions once iterated.
+        :return: int
+        """
+        return self._spills
+
+    def add(self, key: bytes, line_time: int, sequence: int, line: bytes) -> None:
+        """
+        Add a line.
+        :param key: bytes: The id.
+        :param line_time: int: The time the line was generated, to order the timeline by.
+        :param sequence: int: The line's position, to order lines with equal times by.
+        :param line: bytes: The line, without the line ending.
+        :return: None
+        :raises CorrelateError: On write errors while spilling.
+        """
+        partition: int = (zlib.crc32(key) >> self._shift) & (PARTITIONS - 1)
+        rows: Optional[list[tuple[int, int, bytes]]] = self._partitions[partition].get(key)
+        if rows is None:
+            rows = self._partitions[partition][key] = []
+        rows.append((line_time, sequence, line))
+        size: int = len(key) + len(line) + _ROW_OVERHEAD
+        self._sizes[partition] += size
+        self._held += size
+        if self._held > self._memory_cap:
+            self._spill(max(range(PARTITIONS), key=self._sizes.__getitem__))
+        return
+
+    def _spill(self, partition: int) -> None:
+        """
+        Append the held lines of a partition to its spill file.
+        :param partition: int: The partition.
+        :return: None
+        :raises CorrelateError: On write errors.
+        """
+        if self._spill_paths[partition] is None:
+            self._spill_paths[partition] = os.path.join(self._spill_dir, "%i-%i-%02i%s"
+                                                        % (id(self), self._level, partition, _SPILL_SUFFIX))
+        try:
+            with open(self._spill_paths[partition], 'ab', buffering=_WRITE_BUFFER) as file_handle:
+                for key, rows in self._partitions[partition].items():
+                    for line_time, sequence, line in rows:
+                        file_handle.write(_RECORD_HEADER.pack(line_time, sequence, len(key), len(line)))
+                        file_handle.write(key)
+                        file_handle.write(line)
+        except OSError as err:
+            raise CorrelateError(3, "%s: %s" % (self._spill_paths[partition], str(err)))
+        self._partitions[partition] = {}
+        self._held -= self._sizes[partition]
+        self._sizes[partition] = 0
+        self._spills += 1
+        return
+
+    @staticmethod
+    def _iter_spill(spill_path: str) -> Iterator[tuple[bytes, int, int, bytes]]:
+        """
+        Read the records of a spill file.
+        :param spill_path: str: The spill file path.
+        :return: Iterator[tuple[bytes, int, int, bytes]]: The id, time, sequence, and line of each record.
+        :raises CorrelateError: On read errors.
+        """
+        try:
+            with open(spill_path, 'rb', buffering=_WRITE_BUFFER) as file_handle:
+                while header := file_handle.read(_RECORD_HEADER.size):
+                    line_time, sequence, key_length, line_length = _RECORD_HEADER.unpack(header)
+                    key: bytes = file_handle.read(key_length)
+                    yield key, line_time, sequence, file_handle.read(line_length)
+        except (OSError, struct.error) as err:
+            raise CorrelateError(3, "%s: %s" % (spill_path, str(err)))
+        return
+
+    @staticmethod
+    def _iter_groups(partition: dict[bytes, list[tuple[int, int, bytes]]]) -> Iterator[tuple[bytes, list[bytes]]]:
+        """
+        The timelines of a partition held in memory.
+        :param partition: dict[bytes, list[tuple[int, int, bytes]]]: The partition.
+        :return: Iterator[tuple[bytes, list[bytes]]]: The id, and its lines in time order.
+        """
+        for key, rows in partition.items():
+            rows.sort()
+            yield key, [line for _, _, line in rows]
+        return
+
+    def __iter__(self) -> Iterator[tuple[bytes, list[bytes]]]:
+        """
+        The timeline of every id, emptying the table, and removing its spill files.
+        :return: Iterator[tuple[bytes, list[bytes]]]: The id, and its lines in time order.
+        :raises CorrelateError: On write and read errors.
+        """
+        # The partitions that never spilled, freeing each as it's done:
+        for partition in range(PARTITIONS):
+            if self._spill_paths[partition] is None:
+                yield from self._iter_groups(self._partitions[partition])
+                self._partitions[partition] = {}
+                self._held -= self._sizes[partition]
+                self._sizes[partition] = 0
+        # Then the spilled ones, one at a time:
+        for partition in range(PARTITIONS):
+            spill_path: Optional[str] = self._spill_paths[partition]
+            if spill_path is None:
+                continue
+            if self._partitions[partition]:
+                self._spill(partition)
+            try:
+                spill_size: int = os.path.getsize(spill_path)
+            except OSError as err:
+                raise CorrelateError(3, "%s: %s" % (spill_path, str(err)))
+            if spill_size > self._memory_cap // 2 and self._level < _MAX_LEVEL:
+                # Still too big, split on the next crc32 bits:
+                sub_table = PartitionedTable(self._memory_cap, self._spill_dir, self._level + 1)
+                for key, line_time, sequence, line in self._iter_spill(spill_path):
+                    sub_table.add(key, line_time, sequence, line)
+                os.remove(spill_path)
+                yield from sub_table
+                self._spills += sub_table.spills
+            else:
+                groups: dict[bytes, list[tuple[int, int, bytes]]] = {}
+                for key, line_time, sequence, line in self._iter_spill(spill_path):
+                    rows: Optional[list[tuple[int, int, bytes]]] = groups.get(key)
+                    if rows is None:
+                        rows = groups[key] = []
+                    rows.append((line_time, sequence, line))
+                os.remove(spill_path)
+                yield from self._iter_groups(groups)
+            self._spill_paths[partition] = None
+        return
+
+
+def _iter_archive(file_path: str, literals: list[bytes], start: Optional[int], end: Optional[int]) -> Iterable[bytes]:
+    """
+    Read the lines of an archive that may hold an id.
+    :param file_path: str: The archive path.
+    :param literals: list[bytes]: The literals every id match contains.
+    :param start: Optional[int]: Only lines generated at or after this time, None for no start.
+    :param end: Optional[int]: Only lines generated before this time, None for no end.
+    :return: Iterable[bytes]: The lines, without line endings, in file order.
+    :raises TimeIndexError: On read errors.
+    :raises OSError: On read errors.
+    """
+    if start is None and end is None:
+        return iter_candidate_lines(file_path, literals)
+    return iter_archive_range(file_path, start, end)
+
+
+def correlate_archives(file_paths: list[str],
+                       id_regex: str = DEFAULT_ID_REGEX,
+                       memory_cap: int = DEFAULT_MEMORY_CAP,
+                       temp_dir: Optional[str] = None,
+                       start: Optional[int] = None,
+                       end: Optional[int] = None,
+                       report: Optional[Callable[[str], None]] = None,
+                       ) -> Iterator[tuple[bytes, list[bytes]]]:
+    """
+    Group the lines of stored archives by the id in their messages.
+    :param file_paths: list[str]: The archive paths.
+    :param id_regex: str: The id regex, the id is its first group, or the whole match without groups. Defaults to
+                     DEFAULT_ID_REGEX.
+    :param memory_cap: int: The most memory, in bytes, to hold lines in. Defaults to DEFAULT_MEMORY_CAP (256 MiB).
+    :param temp_dir: Optional[str]: Where to make the spill directory. Defaults to None, the system temp directory.
+    :param start: Optional[int]: Only lines generated at or after this time. Defaults to None.
+    :param end: Optional[int]: Only lines generated before this time. Defaults to None.
+    :param report: Optional[Callable[[str], None]]: Called with a line of throughput when the archives are read.
+                   Defaults to None.
+    :return: Iterator[tuple[bytes, list[bytes]]]: Each id, and its lines in generated_at order.
+    :raises CorrelateError: On bad arguments, and read and write errors.
+    """
+    try:
+        regex: re.Pattern = re.compile(id_regex.encode())
+        literals: list[bytes] = [literal for literal, _, _ in required_literals(regex.pattern)]
+    except re.error as err:
+        raise CorrelateError(1, err.msg)
+    if memory_cap < 1048576:
+        raise CorrelateError(4)
+    group: int = 1 if regex.groups > 0 else 0
+    if start is not None or end is not None:
+        file_paths = [file_path for file_path in file_paths
+                      if (time_index := TimeIndex.load(file_path)) is None or time_index.overlaps(start, end)]
+    try:
+        spill_dir: str = tempfile.mkdtemp(prefix='correlate-', dir=temp_dir)
+    except OSError as err:
+        raise CorrelateError(3, "%s: %s" % (temp_dir, str(err)))
+    try:
+        table = PartitionedTable(memory_cap, spill_dir)
+        start_time: float = time.perf_counter()
+        sequence: int = 0
+        for file_path in file_paths:
+            try:
+                for line in _iter_archive(file_path, literals, start, end):
+                    sequence += 1
+                    fields: list[bytes] = logFormat.split_line(line)
+                    if len(fields) < logFormat.NUM_COLUMNS:
+                        continue
+                    match: Optional[re.Match] = regex.search(fields[logFormat.MESSAGE])
+                    if match is None or not match.group(group):
+                        continue
+                    try:
+                        line_time: int = logFormat.parse_timestamp(fields[logFormat.GENERATED_AT])
+                    except ValueError:
+                        continue
+                    table.add(match.group(group), line_time, sequence, line)
+            except TimeIndexError as err:
+                raise CorrelateError(2, "%s: %s" % (file_path, err.error_message))
+            except (OSError, EOFError, zlib.error, ModuleNotFoundError) as err:
+                raise CorrelateError(2, "%s: %s" % (file_path, str(err)))
+        if report is not None:
+            seconds: float = max(time.perf_counter() - start_time, 1e-9)
+            report("read: %i lines in %.2fs (%.0f lines/s), %i partition spills"
+                   % (sequence, seconds, sequence / seconds, table.spills))
+        yield from table
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    return
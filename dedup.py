@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+    File: dedup.py: Drop repeated lines by Papertrail event id while streaming.
+        Classes:
+            ExactIdSet(object): An exact set of ids that spills to sorted runs on disk.
+            BloomIdSet(object): An approximate set of ids in a bloom filter.
+        Methods:
+            is_duplicate: Check if a line's id has been seen before.
+
+        Notes:
+            ExactIdSet keeps up to max_memory_ids ids in a python set, then writes them sorted to a run file of uint64
+            and memory maps it, lookups binary search each run. Runs are merged in tiers, a spilled run is tier 0, and
+            when the newest TIER_RUNS runs are all the same tier they're merged into one run of the next tier. So each
+            id is rewritten once per tier, and there are at most TIER_RUNS - 1 runs of each tier to search, both
+            growing with the log of the number of ids. BloomIdSet never drops a line that wasn't seen,
+            but drops a new line with probability error_rate, and needs the number of ids up front to size itself.
+"""
+from typing import Optional, Final, Union
+from array import array
+import bisect
+import heapq
+import mmap
+import os
+import shutil
+import tempfile
+import logFormat
+import logParser
+from sketches import BloomFilter
+
+DEFAULT_MAX_MEMORY_IDS: Final[int] = 4000000
+TIER_RUNS: Final[int] = 4
+DEFAULT_ERROR_RATE: Final[float] = 0.0001
+_ID_TYPE: Final[str] = 'Q'
+
+
+class ExactIdSet(object):
+    """
+    An exact set of ids that spills to sorted runs on disk. Use as a context manager, or call close(), to remove the
+        runs.
+    """
+
+    def __init__(self, max_memory_ids: int = DEFAULT_MAX_MEMORY_IDS, temp_dir: Optional[str] = None) -> None:
+        """
+        Initialize an empty set.
+        :param max_memory_ids: int: The most ids to hold in memory before spilling. Defaults to DEFAULT_MAX_MEMORY_IDS.
+        :param temp_dir: Optional[str]: Where to make the run directory. Defaults to None, the system temp directory.
+        """
+        self._max_memory_ids: int = max(max_memory_ids, 1)
+        self._temp_dir: Optional[str] = temp_dir
+        self._run_dir: Optional[str] = None
+        self._memory_ids: set[int] = set()
+        # The run path, map, view of the ids, and tier:
+        self._runs: list[tuple[str, mmap.mmap, memoryview, int]] = []
+        self._run_count: int = 0
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+        return
+
+    def close(self) -> None:
+        """
+        Remove the runs.
+        :return: None
+        """
+        for _, run_map, run_view, _ in self._runs:
+            run_view.release()
+            run_map.close()
+        self._runs.clear()
+        if self._run_dir is not None:
+            shutil.rmtree(self._run_dir, ignore_errors=True)
+            self._run_dir = None
+        return
+
+    def _open_run(self, run_path: str, tier: int) -> None:
+        """
+        Map a run file, and add it to the runs.
+        :param run_path: str: The path to the run.
+        :param tier: int: The number of merges the run's ids have been through.
+        :return: None
+        """
+        with open(run_path, 'rb') as run_handle:
+            run_map: mmap.mmap = mmap.mmap(run_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self._runs.append((run_path, run_map, memoryview(run_map).cast(_ID_TYPE), tier))
+        return
+
+    def _new_run_path(self) -> str:
+        """
+        The path for a new run file, making the run directory if needed.
+        :return: str
+        """
+        if self._run_dir is None:
+            self._run_dir = tempfile.mkdtemp(prefix='dedup-', dir=self._temp_dir)
+        self._run_count += 1
+        return os.path.join(self._run_dir, "%06i.ids" % self._run_count)
+
+    def _spill(self) -> None:
+        """
+        Write the in memory ids to a sorted run, merging the newest runs while the last TIER_RUNS are the same tier.
+        :return: None
+        :raises OSError: On write errors.
+        """
+        run_path: str = self._new_run_path()
+        with open(run_path, 'wb') as run_handle:
+            array(_ID_TYPE, sorted(self._memory_ids)).tofile(run_handle)
+        self._memory_ids.clear()
+        self._open_run(run_path, 0)
+        while len(self._runs) >= TIER_RUNS and len({run[3] for run in self._runs[-TIER_RUNS:]}) == 1:
+            self._merge_newest()
+        return
+
+    def _merge_newest(self) -> None:
+        """
+        Merge the newest TIER_RUNS runs into one run of the next tier.
+        :return: None
+        :raises OSError: On write errors.
+        """
+        merging: list[tuple[str, mmap.mmap, memoryview, int]] = self._runs[-TIER_RUNS:]
+        del self._runs[-TIER_RUNS:]
+        merged_path: str = self._new_run_path()
+        with open(merged_path, 'wb') as run_handle:
+            batch: array = array(_ID_TYPE)
+            for value in heapq.merge(*[run_view for _, _, run_view, _ in merging]):
+                batch.append(value)
+                if len(batch) >= 65536:
+                    batch.tofile(run_handle)
+                    batch = array(_ID_TYPE)
+            batch.tofile(run_handle)
+        for path, run_map, run_view, _ in merging:
+            run_view.release()
+            run_map.close()
+            os.remove(path)
+        self._open_run(merged_path, merging[0][3] + 1)
+        return
+
+    def __contains__(self, value: int) -> bool:
+        """
+        Check if an id is in the set.
+        :param value: int: The id.
+        :return: bool
+        """
+        if value in self._memory_ids:
+            return True
+        for _, _, run_view, _ in self._runs:
+            position: int = bisect.bisect_left(run_view, value)
+            if position < len(run_view) and run_view[position] == value:
+                return True
+        return False
+
+    def check_and_add(self, value: int) -> bool:
+        """
+        Add an id, reporting if it was already there.
+        :param value: int: The id.
+        :return: bool: True if the id was already in the set.
+        :raises OSError: On errors writing a run.
+        """
+        if value in self:
+            return True
+        self._memory_ids.add(value)
+        if len(self._memory_ids) >= self._max_memory_ids:
+            self._spill()
+        return False
+
+
+class BloomIdSet(object):
+    """
+    An approximate set of ids in a bloom filter, a new id is taken as seen with probability error_rate.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = DEFAULT_ERROR_RATE) -> None:
+        """
+        Initialize an empty set.
+        :param capacity: int: The expected number of ids.
+        :param error_rate: float: The false positive rate, between 0 and 1. Defaults to DEFAULT_ERROR_RATE.
+        :raises ValueError: If error_rate isn't between 0 and 1.
+        """
+        self._bloom_filter: BloomFilter = BloomFilter.for_capacity(capacity, error_rate)
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        return
+
+    def close(self) -> None:
+        """
+        Nothing to remove, for the same interface as ExactIdSet.
+        :return: None
+        """
+        return
+
+    @property
+    def size(self) -> int:
+        """
+        The size of the filter in bytes.
+        :return: int
+        """
+        return self._bloom_filter.size
+
+    def check_and_add(self, value: int) -> bool:
+        """
+        Add an id, reporting if it was probably already there.
+        :param value: int: The id.
+        :return: bool: True if the id was probably already in the set, False if it definitely wasn't.
+        """
+        item: bytes = value.to_bytes(8, 'little')
+        if item in self._bloom_filter:
+            return True
+        self._bloom_filter.add(item)
+        return False
+
+
+def is_duplicate(line: bytes, id_set: Union[ExactIdSet, BloomIdSet]) -> bool:
+    """
+    Check if a line's id has been seen before, adding it to the ids seen.
+    :param line: bytes: The line, without the line ending.
+    :param id_set: Union[ExactIdSet, BloomIdSet]: The ids seen so far.
+    :return: bool: True if the id was seen before, lines without a valid id are never duplicates.
+    """
+    value: Optional[bytes] = logParser.get_column(line, logFormat.ID)
+    if value is None or not value.isdigit():
+        return False
+    return id_set.check_and_add(int(value))
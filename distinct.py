@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+    File: distinct.py: Per archive HyperLogLog sidecars of column values, merged for distinct counts.
+        Classes:
+            DistinctError(Exception): Errors generated while building, or merging, the sketches.
+            DistinctBuilder(object): Build the distinct sidecar of an archive from batches of its lines.
+        Methods:
+            distinct_path: The path of the distinct sidecar for an archive.
+            build_distinct: Build the distinct sidecar of an archive.
+            load_distinct: Load the distinct sidecar of an archive.
+            collect_distinct: Estimate distinct counts per time bucket, rebuilding only stale sidecars.
+
+        Notes:
+            The sidecar holds a sketches.HyperLogLog for each of DISTINCT_COLUMNS, and the archive's generated_at
+            range. An archive counts toward the bucket its first generated_at falls in, and toward a time range if
+            its generated_at range overlaps it, so buckets and ranges are only as fine as the archives: hourly
+            archives answer per hour and per day, daily archives per day. Sidecar layout:
+                header (magic, archive size, min generated_at, max generated_at, sketch count),
+                then for each sketch: name length uint64, name, sketch length uint64, sketch.
+            Times are -1 when the archive had no valid time.
+"""
+from typing import Optional, Final, Iterable
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+import os
+import struct
+import zlib
+import logFormat
+import logParser
+from sketches import HyperLogLog
+
+DISTINCT_SUFFIX: Final[str] = '.hll'
+DISTINCT_MAGIC: Final[bytes] = b'PTDIST01'
+DISTINCT_COLUMNS: Final[tuple[str, ...]] = ('source_id', 'source_name', 'source_ip', 'program')
+DEFAULT_PRECISION: Final[int] = 14
+DEFAULT_BUCKET_SECONDS: Final[int] = 86400
+_HEADER: Final[struct.Struct] = struct.Struct('<8sQqqQ')
+_LENGTH: Final[struct.Struct] = struct.Struct('<Q')
+_NO_TIME: Final[int] = -1
+_BATCH_LINES: Final[int] = logParser.DEFAULT_BATCH_SIZE
+
+
+class DistinctError(Exception):
+    """Class to store distinct count errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'ValueError: unknown column name.',
+        2: 'ValueError: bucket_seconds must not be negative.',
+        3: 'Error while reading an archive.',
+        4: 'OSError while writing a distinct sidecar.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+def distinct_path(file_path: str) -> str:
+    """
+    The path of the distinct sidecar for an archive.
+    :param file_path: str: The path to the archive.
+    :return: str
+    """
+    return logFormat.sidecar_path(file_path, DISTINCT_SUFFIX)
+
+
+class DistinctBuilder(object):
+    """
+    Build the distinct sidecar of an archive from batches of its lines, so it can share a pass over the archive with
+        other sidecars.
+    """
+
+    def __init__(self, file_path: str, precision: int = DEFAULT_PRECISION) -> None:
+        """
+        Initialize empty sketches.
+        :param file_path: str: The path to the archive.
+        :param precision: int: The HyperLogLog precision. Defaults to DEFAULT_PRECISION.
+        """
+        self._file_path: str = file_path
+        self._columns: tuple[int, ...] = tuple(logFormat.COLUMNS.index(column) for column in DISTINCT_COLUMNS)
+        self._sketches: list[HyperLogLog] = [HyperLogLog(precision) for _ in self._columns]
+        self._max_split: int = max(self._columns) + 1
+        self._first_time: int = _NO_TIME
+        self._last_time: int = _NO_TIME
+        return
+
+    def add_lines(self, lines: Iterable[bytes]) -> None:
+        """
+        Add a batch of the archive's lines.
+        :param lines: Iterable[bytes]: The lines, without line endings.
+        :return: None
+        """
+        # Only hash each value once per batch:
+        values: list[set[bytes]] = [set() for _ in self._columns]
+        for line in lines:
+            fields: list[bytes] = line.split(b'\t', self._max_split)
+            for value_set, column in zip(values, self._columns):
+                if column < len(fields):
+                    value_set.add(fields[column])
+            try:
+                line_time: int = logFormat.parse_timestamp(fields[logFormat.GENERATED_AT])
+            except (ValueError, IndexError):
+                continue
+            if self._first_time == _NO_TIME or line_time < self._first_time:
+                self._first_time = line_time
+            if line_time > self._last_time:
+                self._last_time = line_time
+        for value_set, sketch in zip(values, self._sketches):
+            for value in value_set:
+                sketch.add(value)
+        return
+
+    def finish(self) -> tuple[Optional[tuple[int, int]], dict[str, HyperLogLog]]:
+        """
+        Save the sidecar, after the last lines are added.
+        :return: tuple[Optional[tuple[int, int]], dict[str, HyperLogLog]]: The generated_at range, None if no line had
+                 a valid time, and the sketches by column.
+        :raises DistinctError: On write errors.
+        """
+        temp_path: str = distinct_path(self._file_path) + '.tmp'
+        try:
+            with open(temp_path, 'wb') as file_handle:
+                file_handle.write(_HEADER.pack(DISTINCT_MAGIC, os.path.getsize(self._file_path), self._first_time,
+                                               self._last_time, len(self._sketches)))
+                for column, sketch in zip(DISTINCT_COLUMNS, self._sketches):
+                    data: bytes = sketch.to_bytes()
+                    file_handle.write(_LENGTH.pack(len(column)) + column.encode())
+                    file_handle.write(_LENGTH.pack(len(data)) + data)
+            os.replace(temp_path, distinct_path(self._file_path))
+        except OSError as err:
+            raise DistinctError(4, "%s: %s" % (self._file_path, str(err)))
+        time_range: Optional[tuple[int, int]] = (None if self._first_time == _NO_TIME
+                                                 else (self._first_time, self._last_time))
+        return time_range, dict(zip(DISTINCT_COLUMNS, self._sketches))
+
+
+def build_distinct(file_path: str,
+                   precision: int = DEFAULT_PRECISION,
+                   ) -> tuple[Optional[tuple[int, int]], dict[str, HyperLogLog]]:
+    """
+    Build and save the distinct sidecar of an archive.
+    :param file_path: str: The path to the archive.
+    :param precision: int: The HyperLogLog precision. Defaults to DEFAULT_PRECISION.
+    :return: tuple[Optional[tuple[int, int]], dict[str, HyperLogLog]]: The generated_at range, None if no line had a
+             valid time, and the sketches by column.
+    :raises DistinctError: On read and write errors.
+    """
+    builder = DistinctBuilder(file_path, precision)
+    try:
+        lines: Iterable[bytes] = logFormat.iter_lines(logFormat.iter_archive_chunks(file_path))
+        while batch := list(islice(lines, _BATCH_LINES)):
+            builder.add_lines(batch)
+    except (OSError, EOFError, zlib.error, ModuleNotFoundError) as err:
+        raise DistinctError(3, "%s: %s" % (file_path, str(err)))
+    return builder.finish()
+
+
+def load_distinct(file_path: str) -> Optional[tuple[Optional[tuple[int, int]], dict[str, HyperLogLog]]]:
+    """
+    Load the distinct sidecar of an archive.
+    :param file_path: str: The path to the archive.
+    :return: Optional[tuple[Optional[tuple[int, int]], dict[str, HyperLogLog]]]: The generated_at range, and the
+             sketches by column, or None if there isn't a current sidecar for the archive.
+    """
+    try:
+        with open(distinct_path(file_path), 'rb') as file_handle:
+            data: bytes = file_handle.read()
+        magic, source_size, first_time, last_time, sketch_count = _HEADER.unpack_from(data)
+        if magic != DISTINCT_MAGIC or source_size != os.path.getsize(file_path):
+            return None
+        sketches: dict[str, HyperLogLog] = {}
+        offset: int = _HEADER.size
+        for _ in range(sketch_count):
+            (length,) = _LENGTH.unpack_from(data, offset)
+            column: str = data[offset + _LENGTH.size:offset + _LENGTH.size + length].decode()
+            offset += _LENGTH.size + length
+            (length,) = _LENGTH.unpack_from(data, offset)
+            sketches[column] = HyperLogLog.from_bytes(data[offset + _LENGTH.size:offset + _LENGTH.size + length])
+            offset += _LENGTH.size + length
+    except (OSError, struct.error, ValueError):
+        return None
+    if any(column not in sketches for column in DISTINCT_COLUMNS):
+        return None
+    return None if first_time == _NO_TIME else (first_time, last_time), sketches
+
+
+def collect_distinct(file_paths: list[str],
+                     columns: tuple[str, ...] = DISTINCT_COLUMNS,
+                     bucket_seconds: int = DEFAULT_BUCKET_SECONDS,
+                     start: Optional[int] = None,
+                     end: Optional[int] = None,
+                     max_workers: Optional[int] = None,
+                     ) -> dict[tuple[int, str], int]:
+    """
+    Estimate distinct counts per time bucket by merging the archive sketches, rebuilding only the missing and stale
+        sidecars in a process pool.
+    :param file_paths: list[str]: The archive paths.
+    :param columns: tuple[str, ...]: The columns, each one of DISTINCT_COLUMNS. Defaults to DISTINCT_COLUMNS.
+    :param bucket_seconds: int: The bucket width, 0 for one bucket over everything. Defaults to
+                           DEFAULT_BUCKET_SECONDS (one day).
+    :param start: Optional[int]: Only archives with lines generated at or after this time. Defaults to None.
+    :param end: Optional[int]: Only archives with lines generated before this time. Defaults to None.
+    :param max_workers: Optional[int]: The number of processes. Defaults to None, the number of cores.
+    :return: dict[tuple[int, str], int]: The estimated distinct counts, keyed by (bucket start time, column), the
+             bucket start is 0 when bucket_seconds is 0.
+    :raises DistinctError: On bad arguments, and read and write errors.
+    """
+    for column in columns:
+        if column not in DISTINCT_COLUMNS:
+            raise DistinctError(1, column)
+    if bucket_seconds < 0:
+        raise DistinctError(2)
+    summaries: list[tuple[Optional[tuple[int, int]], dict[str, HyperLogLog]]] = []
+    stale_paths: list[str] = []
+    for file_path in file_paths:
+        summary = load_distinct(file_path)
+        if summary is None:
+            stale_paths.append(file_path)
+        else:
+            summaries.append(summary)
+    if stale_paths:
+        cpu_count: int = os.cpu_count() or 1
+        if max_workers is None or max_workers > cpu_count:
+            max_workers = cpu_count
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(stale_paths))) as pool:
+            futures = [pool.submit(build_distinct, file_path) for file_path in stale_paths]
+            for future in as_completed(futures):
+                summaries.append(future.result())
+    merged: dict[tuple[int, str], HyperLogLog] = defaultdict(lambda: HyperLogLog(DEFAULT_PRECISION))
+    for time_range, sketches in summaries:
+        if time_range is None:
+            continue
+        if (start is not None and time_range[1] < start) or (end is not None and time_range[0] >= end):
+            continue
+        bucket: int = time_range[0] - time_range[0] % bucket_seconds if bucket_seconds else 0
+        for column in columns:
+            merged[(bucket, column)].merge(sketches[column])
+    return {key: sketch.count() for key, sketch in merged.items()}
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+    File: externalSort.py: External merge sort of stored archives by any columns.
+        Classes:
+            SortError(Exception): Errors generated while sorting.
+            SortKey(object): The sort key of a line, from a list of columns.
+        Methods:
+            sort_archives: Sort the lines of stored archives, writing them to an output.
+
+        Notes:
+            The run phase reads archives in a process pool, one archive per task, sorting up to the memory cap's share
+            of lines at a time and spilling each sorted run to a gzip file (level 1, it's read once) in a temp
+            directory. The merge phase k-way merges the runs with heapq.merge(), in more than one pass if there are
+            more runs than can be open at once. Each open run costs its decompressor's buffers, and a few copies of its
+            read size while it's split into lines, so the fan in and read size are both sized so the open runs fit in
+            the memory cap, or each worker's share of it for the passes before the last. Each phase reports its
+            throughput. Times, id, and source_id sort numerically,
+            other columns sort by their bytes. Equal keys keep archive, then file, order.
+"""
+from typing import Optional, Final, Callable, Iterator, BinaryIO
+from concurrent.futures import ProcessPoolExecutor, Future
+import gzip
+import heapq
+import os
+import shutil
+import tempfile
+import time
+import zlib
+import logFormat
+import logParser
+from search import Matcher
+
+DEFAULT_MEMORY_CAP: Final[int] = 256 * 1048576
+DEFAULT_MAX_FAN_IN: Final[int] = 64
+# Rough python overhead of holding a line, and its key, in a list:
+_LINE_OVERHEAD: Final[int] = 150
+# Rough memory of an open run, the gzip reader's buffers and inflate state, plus this many copies of its read size,
+# the chunk, its join with the last partial line, and the lines split from it:
+_RUN_OVERHEAD: Final[int] = 256 * 1024
+_READ_COPIES: Final[int] = 3
+_MIN_READ_SIZE: Final[int] = 64 * 1024
+_MAX_READ_SIZE: Final[int] = 1048576
+_RUN_SUFFIX: Final[str] = '.run.gz'
+
+
+class SortError(Exception):
+    """Class to store sort errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'ValueError: unknown column name.',
+        2: 'Error while reading an archive.',
+        3: 'OSError while writing a sorted run.',
+        4: 'ValueError: memory cap must be at least 1 MiB.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+class SortKey(object):
+    """
+    The sort key of a line, from a list of columns. Picklable, so it can be sent to the pool.
+    """
+
+    def __init__(self, columns: list[str]) -> None:
+        """
+        Initialize the key.
+        :param columns: list[str]: The column names, most significant first.
+        :raises SortError: On unknown column names.
+        """
+        try:
+            self._columns: tuple[int, ...] = tuple(logFormat.COLUMNS.index(column) for column in columns)
+        except ValueError:
+            raise SortError(1, columns)
+        self._max_split: int = min(max(self._columns) + 1, logFormat.NUM_COLUMNS - 1) if self._columns else 0
+        return
+
+    def __call__(self, line: bytes) -> tuple:
+        """
+        The sort key of a line.
+        :param line: bytes: The line, without the line ending.
+        :return: tuple
+        """
+        fields: list[bytes] = line.split(b'\t', self._max_split)
+        key: list = []
+        for column in self._columns:
+            value: bytes = fields[column] if column < len(fields) else b''
+            if column in logParser.TIME_COLUMNS:
+                try:
+                    key.append(logFormat.parse_timestamp(value))
+                except ValueError:
+                    key.append(logParser.MISSING_VALUE)
+            elif column in logParser.INTEGER_COLUMNS:
+                key.append(int(value) if value.isdigit() else logParser.MISSING_VALUE)
+            else:
+                key.append(value)
+        return tuple(key)
+
+
+def _write_run(lines: list[bytes], run_path: str) -> None:
+    """
+    Write a sorted run.
+    :param lines: list[bytes]: The sorted lines.
+    :param run_path: str: The path of the run file.
+    :return: None
+    :raises SortError: On write errors.
+    """
+    try:
+        with gzip.open(run_path, 'wb', compresslevel=1) as run_handle:
+            for line in lines:
+                run_handle.write(line + b'\n')
+    except OSError as err:
+        raise SortError(3, "%s: %s" % (run_path, str(err)))
+    return
+
+
+def _iter_run(run_path: str, read_size: int = _MAX_READ_SIZE) -> Iterator[bytes]:
+    """
+    Read a sorted run.
+    :param run_path: str: The path of the run file.
+    :param read_size: int: The decompressed bytes to read at a time. Defaults to _MAX_READ_SIZE.
+    :return: Iterator[bytes]: The lines.
+    """
+    return logFormat.iter_lines(logFormat.iter_archive_chunks(run_path, read_size))
+
+
+def _merge_plan(memory_cap: int, max_fan_in: int) -> tuple[int, int]:
+    """
+    The most runs to merge at once, and the read size of each, so the open runs fit in a memory cap.
+    :param memory_cap: int: The most memory, in bytes, for the open runs.
+    :param max_fan_in: int: The most runs to merge at once, however much memory there is.
+    :return: tuple[int, int]: The fan in, at least 2, and the read size in bytes.
+    """
+    fan_in: int = max(2, min(max_fan_in, memory_cap // (_RUN_OVERHEAD + _READ_COPIES * _MIN_READ_SIZE)))
+    read_size: int = (memory_cap // fan_in - _RUN_OVERHEAD) // _READ_COPIES
+    return fan_in, min(max(read_size, _MIN_READ_SIZE), _MAX_READ_SIZE)
+
+
+def _make_runs(archive_number: int,
+               file_path: str,
+               sort_key: SortKey,
+               memory_cap: int,
+               temp_dir: str,
+               matcher: Optional[Matcher] = None,
+               ) -> tuple[list[str], int, int]:
+    """
+    Sort an archive into runs of at most memory_cap bytes.
+    :param archive_number: int: The position of the archive, to order its runs.
+    :param file_path: str: The archive path.
+    :param sort_key: SortKey: The sort key.
+    :param memory_cap: int: The most memory, in bytes, to hold lines in.
+    :param temp_dir: str: The directory to write runs to.
+    :param matcher: Optional[Matcher]: Only sort the lines it matches. Defaults to None, all lines.
+    :return: tuple[list[str], int, int]: The run paths in order, the number of lines, and the bytes read.
+    :raises SortError: On read and write errors.
+    """
+    run_paths: list[str] = []
+    lines: list[bytes] = []
+    line_count: int = 0
+    byte_count: int = 0
+    held: int = 0
+
+    def spill() -> None:
+        lines.sort(key=sort_key)
+        run_path: str = os.path.join(temp_dir, "%06i-%06i%s" % (archive_number, len(run_paths), _RUN_SUFFIX))
+        _write_run(lines, run_path)
+        run_paths.append(run_path)
+        lines.clear()
+        return
+
+    try:
+        for line in logFormat.iter_lines(logFormat.iter_archive_chunks(file_path)):
+            if matcher is not None and not matcher.matches(line):
+                continue
+            lines.append(line)
+            line_count += 1
+            byte_count += len(line) + 1
+            held += len(line) + _LINE_OVERHEAD
+            if held >= memory_cap:
+                spill()
+                held = 0
+    except (OSError, EOFError, zlib.error, ModuleNotFoundError) as err:
+        raise SortError(2, "%s: %s" % (file_path, str(err)))
+    if lines:
+        spill()
+    return run_paths, line_count, byte_count
+
+
+def _merge_runs(run_paths: list[str], sort_key: SortKey, run_path: str, read_size: int) -> None:
+    """
+    Merge sorted runs into one run, removing them.
+    :param run_paths: list[str]: The run paths, in order.
+    :param sort_key: SortKey: The sort key.
+    :param run_path: str: The path of the merged run.
+    :param read_size: int: The decompressed bytes to read from each run at a time.
+    :return: None
+    :raises SortError: On read and write errors.
+    """
+    try:
+        with gzip.open(run_path, 'wb', compresslevel=1) as run_handle:
+            for line in heapq.merge(*[_iter_run(path, read_size) for path in run_paths], key=sort_key):
+                run_handle.write(line + b'\n')
+    except (EOFError, zlib.error) as err:
+        raise SortError(2, "%s: %s" % (run_path, str(err)))
+    except OSError as err:
+        raise SortError(3, "%s: %s" % (run_path, str(err)))
+    for path in run_paths:
+        os.remove(path)
+    return
+
+
+def _report(report: Optional[Callable[[str], None]], phase: str, lines: int, byte_count: int, seconds: float) -> None:
+    """
+    Report the throughput of a phase.
+    :param report: Optional[Callable[[str], None]]: Where to report to, None to not report.
+    :param phase: str: The phase name.
+    :param lines: int: The lines processed.
+    :param byte_count: int: The uncompressed bytes processed.
+    :param seconds: float: How long it took.
+    :return: None
+    """
+    if report is None:
+        return
+    seconds = max(seconds, 1e-9)
+    report("%s: %i lines, %.1f MiB in %.2fs (%.0f lines/s, %.1f MiB/s)"
+           % (phase, lines, byte_count / 1048576, seconds, lines / seconds, byte_count / 1048576 / seconds))
+    return
+
+
+def sort_archives(file_paths: list[str],
+                  columns: list[str],
+                  output_handle: BinaryIO,
+                  memory_cap: int = DEFAULT_MEMORY_CAP,
+                  temp_dir: Optional[str] = None,
+                  max_workers: Optional[int] = None,
+                  max_fan_in: int = DEFAULT_MAX_FAN_IN,
+                  report: Optional[Callable[[str], None]] = None,
+                  matcher: Optional[Matcher] = None,
+                  ) -> int:
+    """
+    Sort the lines of stored archives by columns, writing them to an output.
+    :param file_paths: list[str]: The archive paths.
+    :param columns: list[str]: The column names to sort by, most significant first.
+    :param output_handle: BinaryIO: Where to write the sorted lines.
+    :param memory_cap: int: The most memory, in bytes, for all workers to hold lines in. Defaults to
+                       DEFAULT_MEMORY_CAP (256 MiB).
+    :param temp_dir: Optional[str]: Where to make the run directory. Defaults to None, the system temp directory.
+    :param max_workers: Optional[int]: The number of processes. Defaults to None, the number of cores.
+    :param max_fan_in: int: The most runs to merge at once, fewer if they wouldn't fit in the memory cap. Defaults to
+                       DEFAULT_MAX_FAN_IN.
+    :param report: Optional[Callable[[str], None]]: Called with a line of throughput for each phase. Defaults to None.
+    :param matcher: Optional[Matcher]: Only sort the lines it matches. Defaults to None, all lines.
+    :return: int: The number of lines written.
+    :raises SortError: On bad arguments, and read and write errors.
+    """
+    sort_key = SortKey(columns)
+    if memory_cap < 1048576:
+        raise SortError(4)
+    cpu_count: int = os.cpu_count() or 1
+    if max_workers is None or max_workers > cpu_count:
+        max_workers = cpu_count
+    max_workers = max(min(max_workers, len(file_paths)), 1)
+    # The last merge has the whole memory cap, the passes before it share it between the workers:
+    final_fan_in, final_read_size = _merge_plan(memory_cap, max_fan_in)
+    pass_fan_in, pass_read_size = _merge_plan(memory_cap // max_workers, max_fan_in)
+    try:
+        run_dir: str = tempfile.mkdtemp(prefix='sort-', dir=temp_dir)
+    except OSError as err:
+        raise SortError(3, "%s: %s" % (temp_dir, str(err)))
+    try:
+        # Run phase, sort archives into runs in parallel:
+        start_time: float = time.perf_counter()
+        run_paths: list[str] = []
+        line_count: int = 0
+        byte_count: int = 0
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures: list[Future] = [pool.submit(_make_runs, archive_number, file_path, sort_key,
+                                                 memory_cap // max_workers, run_dir, matcher)
+                                     for archive_number, file_path in enumerate(file_paths)]
+            for future in futures:
+                archive_runs, archive_lines, archive_bytes = future.result()
+                run_paths.extend(archive_runs)
+                line_count += archive_lines
+                byte_count += archive_bytes
+        _report(report, "runs (%i)" % len(run_paths), line_count, byte_count, time.perf_counter() - start_time)
+        # Intermediate merge passes, in parallel, until the runs can be merged at once:
+        merge_pass: int = 0
+        while len(run_paths) > final_fan_in:
+            start_time = time.perf_counter()
+            groups: list[list[str]] = [run_paths[group_start:group_start + pass_fan_in]
+                                       for group_start in range(0, len(run_paths), pass_fan_in)]
+            run_paths = [os.path.join(run_dir, "pass%i-%06i%s" % (merge_pass, group_number, _RUN_SUFFIX))
+                         for group_number in range(len(groups))]
+            with ProcessPoolExecutor(max_workers=min(max_workers, len(groups))) as pool:
+                for future in [pool.submit(_merge_runs, group, sort_key, run_path, pass_read_size)
+                               for group, run_path in zip(groups, run_paths)]:
+                    future.result()
+            merge_pass += 1
+            _report(report, "merge pass %i (%i runs)" % (merge_pass, len(run_paths)), line_count, byte_count,
+                    time.perf_counter() - start_time)
+        # Final merge, to the output:
+        start_time = time.perf_counter()
+        written: int = 0
+        try:
+            for line in heapq.merge(*[_iter_run(path, final_read_size) for path in run_paths], key=sort_key):
+                output_handle.write(line + b'\n')
+                written += 1
+        except (EOFError, zlib.error) as err:
+            raise SortError(2, str(err))
+        _report(report, "final merge", written, byte_count, time.perf_counter() - start_time)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return written
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+    File: gzipIndex.py: Seekable checkpoint index for gzip archives.
+        Classes:
+            GzipIndexError(Exception): Errors generated while indexing.
+            GzipIndex(object): The checkpoints of an archive, and random access by time.
+        Methods:
+            index_path: The path of the index sidecar for an archive.
+            build_index: Build the checkpoint index of an archive.
+
+        Notes:
+            zran style checkpoints need the 32K inflate window and a resume at an arbitrary bit offset, which the zlib
+            module can't do. Instead checkpoints are gzip member boundaries, where inflate starts from a clean state.
+            Archives with members further apart than the span are rewritten as a multi-member gzip with a member
+            starting on a line boundary every span bytes. The result is still a normal gzip file (zcat reads it), and
+            is verified against the original before it's replaced.
+"""
+from typing import Optional, Final, Iterator
+import bisect
+import gzip
+import hashlib
+import json
+import os
+import zlib
+from archiveDownload import iter_decompressed
+import logFormat
+import logParser
+
+INDEX_SUFFIX: Final[str] = '.gzindex'
+INDEX_VERSION: Final[int] = 1
+DEFAULT_SPAN: Final[int] = 4 * 1048576
+_READ_SIZE: Final[int] = 1048576
+
+
+class GzipIndexError(Exception):
+    """Class to store gzip index errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'ValueError: only gzip archives can be indexed.',
+        2: 'OSError while reading the archive.',
+        3: 'Corrupt gzip data in the archive.',
+        4: 'OSError while writing the seekable archive.',
+        5: 'Verification failed, seekable archive does not match the original.',
+        6: 'ValueError: span must be greater than zero.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+def index_path(file_path: str) -> str:
+    """
+    The path of the index sidecar for an archive.
+    :param file_path: str: The path to the archive.
+    :return: str
+    """
+    return logFormat.sidecar_path(file_path, INDEX_SUFFIX)
+
+
+class GzipIndex(object):
+    """
+    The checkpoints of a gzip archive. Each checkpoint is a tuple of:
+        (compressed_offset: int, uncompressed_offset: int, first_generated_at: int)
+    where first_generated_at is the timestamp of the first line after the checkpoint, in seconds since the epoch.
+    """
+
+    def __init__(self, file_path: str, span: int, checkpoints: list[tuple[int, int, int]]) -> None:
+        """
+        Initialize the index.
+        :param file_path: str: The path to the archive.
+        :param span: int: The uncompressed bytes between checkpoints.
+        :param checkpoints: list[tuple[int, int, int]]: The checkpoints, in file order.
+        """
+        self._file_path: str = file_path
+        self._span: int = span
+        self._checkpoints: list[tuple[int, int, int]] = checkpoints
+        return
+
+    @classmethod
+    def load(cls, file_path: str):
+        """
+        Load the index of an archive.
+        :param file_path: str: The path to the archive.
+        :return: Optional[GzipIndex]: The index, or None if there isn't a current index for the archive.
+        """
+        try:
+            with open(index_path(file_path), 'r') as file_handle:
+                index_dict: dict = json.load(file_handle)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if index_dict.get('version') != INDEX_VERSION:
+            return None
+        # An index of an older copy of the archive is no use:
+        if not os.path.exists(file_path) or index_dict['file_size'] != os.path.getsize(file_path):
+            return None
+        return cls(file_path, index_dict['span'], [tuple(checkpoint) for checkpoint in index_dict['checkpoints']])
+
+    def save(self) -> None:
+        """
+        Save the index sidecar.
+        :return: None
+        """
+        index_dict: dict = {
+            'version': INDEX_VERSION,
+            'file_size': os.path.getsize(self._file_path),
+            'span': self._span,
+            'checkpoints': self._checkpoints,
+        }
+        temp_path: str = index_path(self._file_path) + '.tmp'
+        with open(temp_path, 'w') as file_handle:
+            json.dump(index_dict, file_handle, separators=(',', ':'))
+        os.replace(temp_path, index_path(self._file_path))
+        return
+
+    @property
+    def file_path(self) -> str:
+        """
+        The path to the archive.
+        :return: str
+        """
+        return self._file_path
+
+    @property
+    def span(self) -> int:
+        """
+        The uncompressed bytes between checkpoints.
+        :return: int
+        """
+        return self._span
+
+    @property
+    def checkpoints(self) -> list[tuple[int, int, int]]:
+        """
+        The checkpoints, in file order.
+        :return: list[tuple[int, int, int]]
+        """
+        return self._checkpoints
+
+    def find(self, timestamp: int, max_disorder: int = 5) -> int:
+        """
+        Find the checkpoint to start reading from to see every line generated at or after a time.
+        :param timestamp: int: The time, in seconds since the epoch.
+        :param max_disorder: int: How far out of order, in seconds, lines can be in the archive. Defaults to 5.
+        :return: int: The checkpoint number.
+        """
+        first_times: list[int] = [checkpoint[2] for checkpoint in self._checkpoints]
+        return max(bisect.bisect_left(first_times, timestamp - max_disorder) - 1, 0)
+
+    def iter_chunks(self, checkpoint_number: int = 0) -> Iterator[bytes]:
+        """
+        Read decompressed data from a checkpoint to the end of the archive, without inflating what comes before it.
+        :param checkpoint_number: int: The checkpoint to start from. Defaults to 0, the start of the archive.
+        :return: Iterator[bytes]: The decompressed data.
+        :raises GzipIndexError: On read errors, or corrupt data.
+        """
+        if len(self._checkpoints) == 0:
+            return
+        try:
+            with open(self._file_path, 'rb') as file_handle:
+                file_handle.seek(self._checkpoints[checkpoint_number][0])
+                yield from iter_decompressed(iter(lambda: file_handle.read(_READ_SIZE), b''))
+        except OSError as err:
+            raise GzipIndexError(2, *err.args)
+        except zlib.error as err:
+            raise GzipIndexError(3, *err.args)
+        return
+
+    def iter_lines_from(self, timestamp: int, max_disorder: int = 5) -> Iterator[bytes]:
+        """
+        Read the lines generated at or after a time, jumping straight to the nearest checkpoint.
+        :param timestamp: int: The time, in seconds since the epoch.
+        :param max_disorder: int: How far out of order, in seconds, lines can be in the archive. Defaults to 5.
+        :return: Iterator[bytes]: The lines, without line endings.
+        """
+        for line in logFormat.iter_lines(self.iter_chunks(self.find(timestamp, max_disorder))):
+            line_time: Optional[int] = logParser.get_time(line)
+            if line_time is not None and line_time >= timestamp:
+                yield line
+        return
+
+
+def _first_timestamp(data: bytes) -> int:
+    """
+    The generated_at time of the first line in a block of data.
+    :param data: bytes: The decompressed data, starting at a line boundary.
+    :return: int: Seconds since the epoch, or 0 if the first line isn't a log line.
+    """
+    return logParser.get_time(data[:data.find(b'\n')] if b'\n' in data else data) or 0
+
+
+def _scan_members(file_path: str) -> tuple[list[tuple[int, int, int]], int]:
+    """
+    Find the gzip members of an archive that start on a line boundary.
+    :param file_path: str: The path to the archive.
+    :return: tuple[list[tuple[int, int, int]], int]: The checkpoint of each member starting on a line boundary, and
+                the uncompressed size.
+    :raises GzipIndexError: On read errors, or corrupt data.
+    """
+    members: list[tuple[int, int, int]] = []
+    compressed_offset: int = 0
+    uncompressed_offset: int = 0
+    decompressor = None
+    first_data: bytes = b''
+    # The start of the file counts as a line boundary:
+    last_byte: bytes = b'\n'
+    line_boundary: bool = True
+    try:
+        with open(file_path, 'rb') as file_handle:
+            while data := file_handle.read(_READ_SIZE):
+                while data:
+                    if decompressor is None:
+                        decompressor = zlib.decompressobj(wbits=31)
+                        line_boundary = last_byte == b'\n'
+                        if line_boundary:
+                            members.append((compressed_offset, uncompressed_offset, 0))
+                        first_data = b''
+                    output: bytes = decompressor.decompress(data, _READ_SIZE)
+                    if output:
+                        last_byte = output[-1:]
+                        if line_boundary and len(first_data) < 65536:
+                            first_data += output[:65536]
+                            members[-1] = (members[-1][0], members[-1][1], _first_timestamp(first_data))
+                    uncompressed_offset += len(output)
+                    if decompressor.eof:
+                        compressed_offset += len(data) - len(decompressor.unused_data)
+                        data = decompressor.unused_data
+                        decompressor = None
+                    else:
+                        compressed_offset += len(data) - len(decompressor.unconsumed_tail)
+                        data = decompressor.unconsumed_tail
+    except OSError as err:
+        raise GzipIndexError(2, *err.args)
+    except zlib.error as err:
+        raise GzipIndexError(3, *err.args)
+    return members, uncompressed_offset
+
+
+def _rewrite_seekable(file_path: str, span: int) -> list[tuple[int, int, int]]:
+    """
+    Rewrite an archive as a multi-member gzip, with a member starting on a line boundary every span bytes.
+    :param file_path: str: The path to the archive.
+    :param span: int: The uncompressed bytes per member.
+    :return: list[tuple[int, int, int]]: The checkpoint of each member.
+    :raises GzipIndexError: On read, write, corrupt data, and verification errors.
+    """
+    temp_path: str = file_path + '.part'
+    checkpoints: list[tuple[int, int, int]] = []
+    original_digest = hashlib.sha256()
+    uncompressed_offset: int = 0
+    try:
+        with gzip.open(file_path, 'rb') as input_handle, open(temp_path, 'wb') as output_handle:
+            remainder: bytes = b''
+            while True:
+                data: bytes = input_handle.read(span)
+                original_digest.update(data)
+                block: bytes = remainder + data
+                if not data:
+                    end: int = len(block)
+                else:
+                    end = block.rfind(b'\n') + 1
+                    if end == 0:
+                        # A line longer than the span, keep reading:
+                        remainder = block
+                        continue
+                if end > 0:
+                    checkpoints.append((output_handle.tell(), uncompressed_offset, _first_timestamp(block[:end])))
+                    output_handle.write(gzip.compress(block[:end], compresslevel=6, mtime=0))
+                    uncompressed_offset += end
+                remainder = block[end:]
+                if not data:
+                    break
+    except (OSError, EOFError) as err:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        if isinstance(err, gzip.BadGzipFile):
+            raise GzipIndexError(3, *err.args)
+        raise GzipIndexError(4, *err.args)
+    except zlib.error as err:
+        os.remove(temp_path)
+        raise GzipIndexError(3, *err.args)
+    # Verify before replacing the original:
+    rewritten_digest = hashlib.sha256()
+    with gzip.open(temp_path, 'rb') as file_handle:
+        while data := file_handle.read(_READ_SIZE):
+            rewritten_digest.update(data)
+    if rewritten_digest.digest() != original_digest.digest():
+        os.remove(temp_path)
+        raise GzipIndexError(5, file_path)
+    os.replace(temp_path, file_path)
+    return checkpoints
+
+
+def build_index(file_path: str, span: int = DEFAULT_SPAN) -> GzipIndex:
+    """
+    Build and save the checkpoint index of a gzip archive, rewriting it as a seekable gzip if the members starting on
+        line boundaries are too far apart.
+    :param file_path: str: The path to the archive.
+    :param span: int: The uncompressed bytes between checkpoints. Defaults to DEFAULT_SPAN (4 MiB).
+    :return: GzipIndex: The index.
+    :raises GzipIndexError: If the archive isn't gzip, or on read, write, corrupt data, and verification errors.
+    """
+    if not file_path.endswith('.gz'):
+        raise GzipIndexError(1, file_path)
+    if span < 1:
+        raise GzipIndexError(6)
+    members, uncompressed_size = _scan_members(file_path)
+    # Use the members as they are if they're close enough together, thinning them to at most two per span:
+    checkpoints: list[tuple[int, int, int]] = []
+    seekable: bool = True
+    for member_number, member in enumerate(members):
+        next_offset: int = (members[member_number + 1][1] if member_number + 1 < len(members)
+                            else uncompressed_size)
+        if next_offset - member[1] > 2 * span:
+            seekable = False
+            break
+        if len(checkpoints) == 0 or member[1] - checkpoints[-1][1] >= span // 2:
+            checkpoints.append(member)
+    if not seekable:
+        checkpoints = _rewrite_seekable(file_path, span)
+    index = GzipIndex(file_path, span, checkpoints)
+    index.save()
+    return index
@@ -0,0 +1,686 @@
+#!/usr/bin/env python3
+"""
+    File: invertedIndex.py: Persistent inverted index over archive messages.
+        Classes:
+            InvertedIndexError(Exception): Errors generated by the index.
+            Segment(object): A read only, memory mapped index segment.
+            InvertedIndex(object): The segments of an index directory, adding archives, merging, and querying.
+        Methods:
+            parse_query: Split a query into phrases of tokens.
+
+        Notes:
+            The message, program, and source_name columns are tokenized with logFormat.tokenize(). Each segment holds
+            the lines it indexes in zlib compressed blocks, and a sorted term table mapping each token to the sorted
+            line numbers (doc ids) containing it. A query intersects the postings of its tokens, then checks phrases
+            against the stored lines.
+
+            segments.json records the doc id ranges each archive's lines have in the segments. When a changed
+            archive is indexed again its old ranges are marked deleted in their segments, in the same save that adds
+            its new segments. Queries skip deleted docs, and merges drop them, renumbering the docs after them. A
+            segment with more than half its docs deleted is rewritten on its own.
+            Merges never make a segment of more than MAX_MERGED_DOCS docs, so doc ids fit in uint32.
+
+            Segment file layout, all integers are native uint64 unless noted:
+                doc blocks, block offsets [block_count + 1], block first doc ids [block_count],
+                postings (uint32 doc ids), postings offsets [term_count + 1],
+                terms, term offsets [term_count + 1], footer.
+"""
+from typing import Optional, Final, Iterator
+from array import array
+import bisect
+import json
+import mmap
+import os
+import re
+import struct
+import zlib
+import logFormat
+
+INDEX_DIR_NAME: Final[str] = 'inverted_index'
+SEGMENTS_FILE_NAME: Final[str] = 'segments.json'
+SEGMENT_MAGIC: Final[bytes] = b'PTIDX001'
+BLOCK_SIZE: Final[int] = 128
+MAX_SEGMENT_DOCS: Final[int] = 1000000
+MERGE_FACTOR: Final[int] = 8
+MAX_MERGED_DOCS: Final[int] = 1 << 32
+_FOOTER: Final[struct.Struct] = struct.Struct('<8Q8s')
+_INDEXED_COLUMNS: Final[tuple[int, ...]] = (logFormat.MESSAGE, logFormat.PROGRAM, logFormat.SOURCE_NAME)
+_QUERY_REGEX: Final[re.Pattern] = re.compile(r'"([^"]*)"|(\S+)')
+
+
+class InvertedIndexError(Exception):
+    """Class to store inverted index errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'Segment file is damaged or not an index segment.',
+        2: 'OSError while reading an archive.',
+        3: 'OSError while writing the index.',
+        4: 'ValueError: query has no searchable terms.',
+        5: 'Index state file is damaged.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+def parse_query(query: str) -> list[list[bytes]]:
+    """
+    Split a query into phrases, ie: 'timeout "req-00fa97"' -> [[b'timeout'], [b'req', b'00fa97']]. Every phrase must
+        match.
+    :param query: str: The query, bare words and "quoted phrases".
+    :return: list[list[bytes]]: The tokens of each phrase.
+    """
+    phrases: list[list[bytes]] = []
+    for quoted, bare in _QUERY_REGEX.findall(query):
+        tokens: list[bytes] = logFormat.tokenize((quoted or bare).encode())
+        if tokens:
+            phrases.append(tokens)
+    return phrases
+
+
+def _line_tokens(line: bytes) -> list[list[bytes]]:
+    """
+    Tokenize the indexed columns of a line.
+    :param line: bytes: The line.
+    :return: list[list[bytes]]: The tokens of each indexed column.
+    """
+    fields: list[bytes] = logFormat.split_line(line)
+    return [logFormat.tokenize(fields[column]) for column in _INDEXED_COLUMNS if column < len(fields)]
+
+
+def _contains_phrase(column_tokens: list[list[bytes]], phrase: list[bytes]) -> bool:
+    """
+    Check if a phrase appears, in order, in one of the tokenized columns.
+    :param column_tokens: list[list[bytes]]: The tokens of each column.
+    :param phrase: list[bytes]: The phrase tokens.
+    :return: bool
+    """
+    if len(phrase) == 1:
+        return any(phrase[0] in tokens for tokens in column_tokens)
+    length: int = len(phrase)
+    for tokens in column_tokens:
+        for start in range(len(tokens) - length + 1):
+            if tokens[start:start + length] == phrase:
+                return True
+    return False
+
+
+def _write_segment(file_path: str,
+                   blocks: list[bytes],
+                   block_first_docs: list[int],
+                   doc_count: int,
+                   postings: Iterator[tuple[bytes, bytes]],
+                   ) -> None:
+    """
+    Write a segment file.
+    :param file_path: str: The segment path.
+    :param blocks: list[bytes]: The compressed doc blocks.
+    :param block_first_docs: list[int]: The first doc id of each block.
+    :param doc_count: int: The number of docs.
+    :param postings: Iterator[tuple[bytes, bytes]]: The terms, in sorted order, and their packed uint32 doc ids.
+    :return: None
+    """
+    temp_path: str = file_path + '.tmp'
+    with open(temp_path, 'wb') as file_handle:
+        block_offsets = array('Q', [0])
+        for block in blocks:
+            file_handle.write(block)
+            block_offsets.append(block_offsets[-1] + len(block))
+        block_offsets_offset: int = file_handle.tell()
+        block_offsets.tofile(file_handle)
+        array('Q', block_first_docs).tofile(file_handle)
+        # Postings, collecting the terms as they go:
+        postings_offset: int = file_handle.tell()
+        postings_offsets = array('Q', [0])
+        terms: list[bytes] = []
+        for term, doc_ids in postings:
+            terms.append(term)
+            file_handle.write(doc_ids)
+            postings_offsets.append(postings_offsets[-1] + len(doc_ids))
+        postings_offsets_offset: int = file_handle.tell()
+        postings_offsets.tofile(file_handle)
+        terms_offset: int = file_handle.tell()
+        term_offsets = array('Q', [0])
+        for term in terms:
+            file_handle.write(term)
+            term_offsets.append(term_offsets[-1] + len(term))
+        term_offsets_offset: int = file_handle.tell()
+        term_offsets.tofile(file_handle)
+        file_handle.write(_FOOTER.pack(doc_count, len(blocks), block_offsets_offset, postings_offset,
+                                       postings_offsets_offset, len(terms), terms_offset, term_offsets_offset,
+                                       SEGMENT_MAGIC))
+    os.replace(temp_path, file_path)
+    return
+
+
+class _Deleted(object):
+    """
+    The deleted doc id ranges of a segment, to skip and renumber docs.
+    """
+
+    def __init__(self, ranges: list[list[int]]) -> None:
+        """
+        Index the ranges.
+        :param ranges: list[list[int]]: The sorted, non overlapping [start, end) doc id ranges.
+        """
+        self._starts: list[int] = [start for start, _ in ranges]
+        self._ends: list[int] = [end for _, end in ranges]
+        # The number of docs deleted before each range:
+        self._before: list[int] = [0]
+        for start, end in ranges:
+            self._before.append(self._before[-1] + end - start)
+        return
+
+    def __bool__(self) -> bool:
+        """
+        Check if any docs are deleted.
+        :return: bool
+        """
+        return bool(self._starts)
+
+    def __contains__(self, doc_id: int) -> bool:
+        """
+        Check if a doc is deleted.
+        :param doc_id: int: The doc id.
+        :return: bool
+        """
+        number: int = bisect.bisect_right(self._starts, doc_id) - 1
+        return number >= 0 and doc_id < self._ends[number]
+
+    def shift(self, doc_id: int) -> int:
+        """
+        The number of deleted docs before a live doc, to renumber it once they're dropped.
+        :param doc_id: int: The doc id, not deleted.
+        :return: int
+        """
+        return self._before[bisect.bisect_right(self._starts, doc_id)]
+
+
+def _add_range(ranges: list[list[int]], start: int, end: int) -> None:
+    """
+    Add a range to sorted, non overlapping ranges, joining touching ones.
+    :param ranges: list[list[int]]: The [start, end) ranges, changed in place.
+    :param start: int: The start of the range.
+    :param end: int: The end of the range, exclusive.
+    :return: None
+    """
+    ranges.append([start, end])
+    ranges.sort()
+    joined: list[list[int]] = []
+    for range_start, range_end in ranges:
+        if joined and range_start <= joined[-1][1]:
+            joined[-1][1] = max(joined[-1][1], range_end)
+        else:
+            joined.append([range_start, range_end])
+    ranges[:] = joined
+    return
+
+
+def _live_docs(entry: dict) -> int:
+    """
+    The number of docs of a segment that aren't deleted.
+    :param entry: dict: The segments.json entry of the segment.
+    :return: int
+    """
+    return entry['docs'] - sum(end - start for start, end in entry['deleted'])
+
+
+class Segment(object):
+    """
+    A read only, memory mapped index segment.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        """
+        Open a segment.
+        :param file_path: str: The segment path.
+        :raises InvertedIndexError: If the file isn't a segment.
+        """
+        self._file_path: str = file_path
+        with open(file_path, 'rb') as file_handle:
+            try:
+                self._map = mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise InvertedIndexError(1, file_path)
+        if len(self._map) < _FOOTER.size:
+            raise InvertedIndexError(1, file_path)
+        (self._doc_count, self._block_count, block_offsets_offset, self._postings_offset, postings_offsets_offset,
+         self._term_count, self._terms_offset, term_offsets_offset, magic) = _FOOTER.unpack_from(
+            self._map, len(self._map) - _FOOTER.size)
+        if magic != SEGMENT_MAGIC:
+            raise InvertedIndexError(1, file_path)
+        self._view = view = memoryview(self._map)
+        self._block_offsets = view[block_offsets_offset:
+                                   block_offsets_offset + (self._block_count + 1) * 8].cast('Q')
+        first_docs_offset: int = block_offsets_offset + (self._block_count + 1) * 8
+        self._block_first_docs = view[first_docs_offset:first_docs_offset + self._block_count * 8].cast('Q')
+        self._postings_offsets = view[postings_offsets_offset:
+                                      postings_offsets_offset + (self._term_count + 1) * 8].cast('Q')
+        self._term_offsets = view[term_offsets_offset:term_offsets_offset + (self._term_count + 1) * 8].cast('Q')
+        self._block_cache: dict[int, list[bytes]] = {}
+        return
+
+    def close(self) -> None:
+        """
+        Unmap the segment.
+        :return: None
+        """
+        self._block_offsets.release()
+        self._block_first_docs.release()
+        self._postings_offsets.release()
+        self._term_offsets.release()
+        self._view.release()
+        self._map.close()
+        return
+
+    @property
+    def doc_count(self) -> int:
+        """
+        The number of lines in the segment.
+        :return: int
+        """
+        return self._doc_count
+
+    def term(self, term_number: int) -> bytes:
+        """
+        Get a term from the sorted term table.
+        :param term_number: int: The term number.
+        :return: bytes
+        """
+        start: int = self._terms_offset + self._term_offsets[term_number]
+        return self._map[start:self._terms_offset + self._term_offsets[term_number + 1]]
+
+    def postings(self, term: bytes) -> array:
+        """
+        Look up the doc ids containing a term.
+        :param term: bytes: The term.
+        :return: array: The sorted doc ids, empty if the term isn't in the segment.
+        """
+        low: int = 0
+        high: int = self._term_count
+        while low < high:
+            middle: int = (low + high) // 2
+            if self.term(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        doc_ids = array('I')
+        if low < self._term_count and self.term(low) == term:
+            doc_ids.frombytes(self._map[self._postings_offset + self._postings_offsets[low]:
+                                        self._postings_offset + self._postings_offsets[low + 1]])
+        return doc_ids
+
+    def iter_postings(self) -> Iterator[tuple[bytes, array]]:
+        """
+        Iterate over every term, in sorted order, and its doc ids.
+        :return: Iterator[tuple[bytes, array]]
+        """
+        for term_number in range(self._term_count):
+            doc_ids = array('I')
+            doc_ids.frombytes(self._map[self._postings_offset + self._postings_offsets[term_number]:
+                                        self._postings_offset + self._postings_offsets[term_number + 1]])
+            yield self.term(term_number), doc_ids
+        return
+
+    def raw_block(self, block_number: int) -> bytes:
+        """
+        Get a compressed doc block.
+        :param block_number: int: The block number.
+        :return: bytes
+        """
+        return self._map[self._block_offsets[block_number]:self._block_offsets[block_number + 1]]
+
+    @property
+    def block_first_docs(self) -> list[int]:
+        """
+        The first doc id of each block.
+        :return: list[int]
+        """
+        return self._block_first_docs.tolist()
+
+    def doc(self, doc_id: int) -> bytes:
+        """
+        Get a stored line.
+        :param doc_id: int: The doc id.
+        :return: bytes: The line.
+        """
+        block_number: int = bisect.bisect_right(self._block_first_docs, doc_id) - 1
+        lines: Optional[list[bytes]] = self._block_cache.get(block_number)
+        if lines is None:
+            lines = zlib.decompress(self.raw_block(block_number)).split(b'\n')
+            if len(self._block_cache) > 64:
+                self._block_cache.clear()
+            self._block_cache[block_number] = lines
+        return lines[doc_id - self._block_first_docs[block_number]]
+
+
+class InvertedIndex(object):
+    """
+    The segments of an index directory. segments.json holds:
+        {'next_segment': int,
+         'segments': [{'name': str, 'docs': int, 'deleted': [[start, end], ...]}, ...],
+         'archives': {stem: {'size': int, 'ranges': [[segment name, start, end], ...]}, ...}}
+    with segments in the order their lines were added, and the deleted, and archive, doc id ranges [start, end) of
+    each segment.
+    """
+
+    def __init__(self, output_dir: str) -> None:
+        """
+        Open, or create, the index of an output directory.
+        :param output_dir: str: The output directory.
+        :raises InvertedIndexError: If the directory can't be made, or segments.json can't be read.
+        """
+        self._directory: str = os.path.join(output_dir, INDEX_DIR_NAME)
+        state_path: str = os.path.join(self._directory, SEGMENTS_FILE_NAME)
+        self._state: dict = {'next_segment': 0, 'segments': [], 'archives': {}}
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+        except OSError as err:
+            raise InvertedIndexError(3, "%s: %s" % (self._directory, str(err)))
+        try:
+            with open(state_path, 'r') as file_handle:
+                state: dict = json.load(file_handle)
+            self._state = {'next_segment': int(state['next_segment']), 'segments': list(state['segments']),
+                           'archives': dict(state['archives'])}
+        except FileNotFoundError:
+            pass
+        except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError) as err:
+            raise InvertedIndexError(5, "%s: %s" % (state_path, str(err)))
+        return
+
+    def _save_state(self) -> None:
+        """
+        Save segments.json, replacing the old one atomically.
+        :return: None
+        :raises InvertedIndexError: On write errors.
+        """
+        file_path: str = os.path.join(self._directory, SEGMENTS_FILE_NAME)
+        try:
+            with open(file_path + '.tmp', 'w') as file_handle:
+                json.dump(self._state, file_handle, indent=4)
+            os.replace(file_path + '.tmp', file_path)
+        except OSError as err:
+            raise InvertedIndexError(3, "%s: %s" % (file_path, str(err)))
+        return
+
+    def _new_segment_path(self) -> tuple[str, str]:
+        """
+        Allocate a segment file name.
+        :return: tuple[str, str]: The segment name, and path.
+        """
+        name: str = 'segment-%08i.idx' % self._state['next_segment']
+        self._state['next_segment'] += 1
+        return name, os.path.join(self._directory, name)
+
+    def _remove_segments(self, names: list[str]) -> None:
+        """
+        Remove segment files no longer in segments.json.
+        :param names: list[str]: The segment names.
+        :return: None
+        """
+        for name in names:
+            try:
+                os.remove(os.path.join(self._directory, name))
+            except OSError:
+                pass
+        return
+
+    def is_indexed(self, file_path: str, size: Optional[int] = None) -> bool:
+        """
+        Check if an archive has been indexed.
+        :param file_path: str: The path to the archive.
+        :param size: Optional[int]: The archive size it must have been indexed at. Defaults to None, any size.
+        :return: bool
+        """
+        archive: Optional[dict] = self._state['archives'].get(logFormat.archive_stem(file_path))
+        return archive is not None and (size is None or archive['size'] == size)
+
+    def add_archive(self, file_path: str, size: Optional[int] = None) -> int:
+        """
+        Index an archive, writing one segment per MAX_SEGMENT_DOCS lines, replacing the lines of an earlier version of
+            it, then merge segments if there are too many.
+        :param file_path: str: The path to the archive.
+        :param size: Optional[int]: The archive size to record. Defaults to None, the size of the file.
+        :return: int: The number of lines indexed.
+        :raises InvertedIndexError: On read and write errors.
+        """
+        line_count: int = 0
+        postings: dict[bytes, array] = {}
+        blocks: list[bytes] = []
+        block_first_docs: list[int] = []
+        block: list[bytes] = []
+        doc_id: int = 0
+        new_segments: list[dict] = []
+
+        def flush_segment() -> None:
+            nonlocal postings, blocks, block_first_docs, doc_id
+            if block:
+                block_first_docs.append(doc_id - len(block))
+                blocks.append(zlib.compress(b'\n'.join(block)))
+                block.clear()
+            if doc_id == 0:
+                return
+            name, segment_path = self._new_segment_path()
+            try:
+                _write_segment(segment_path, blocks, block_first_docs, doc_id,
+                               ((term, postings[term].tobytes()) for term in sorted(postings)))
+            except OSError as err:
+                raise InvertedIndexError(3, "%s: %s" % (segment_path, str(err)))
+            new_segments.append({'name': name, 'docs': doc_id, 'deleted': []})
+            postings, blocks, block_first_docs, doc_id = {}, [], [], 0
+            return
+
+        try:
+            for line in logFormat.iter_lines(logFormat.iter_archive_chunks(file_path)):
+                for term in set(token for tokens in _line_tokens(line) for token in tokens):
+                    doc_ids: Optional[array] = postings.get(term)
+                    if doc_ids is None:
+                        postings[term] = array('I', (doc_id,))
+                    else:
+                        doc_ids.append(doc_id)
+                block.append(line)
+                doc_id += 1
+                line_count += 1
+                if len(block) == BLOCK_SIZE:
+                    block_first_docs.append(doc_id - BLOCK_SIZE)
+                    blocks.append(zlib.compress(b'\n'.join(block)))
+                    block.clear()
+                if doc_id == MAX_SEGMENT_DOCS:
+                    flush_segment()
+            flush_segment()
+        except (OSError, EOFError, zlib.error, ModuleNotFoundError) as err:
+            self._remove_segments([entry['name'] for entry in new_segments])
+            raise InvertedIndexError(2, "%s: %s" % (file_path, str(err)))
+        except InvertedIndexError:
+            self._remove_segments([entry['name'] for entry in new_segments])
+            raise
+        if size is None:
+            size = os.path.getsize(file_path)
+        # Delete the lines of the earlier version, dropping the segments left with no lines:
+        stem: str = logFormat.archive_stem(file_path)
+        old_archive: Optional[dict] = self._state['archives'].get(stem)
+        emptied: list[str] = []
+        if old_archive is not None:
+            entries: dict[str, dict] = {entry['name']: entry for entry in self._state['segments']}
+            for name, start, end in old_archive['ranges']:
+                _add_range(entries[name]['deleted'], start, end)
+            emptied = [entry['name'] for entry in self._state['segments'] if _live_docs(entry) == 0]
+            self._state['segments'] = [entry for entry in self._state['segments'] if _live_docs(entry) > 0]
+        self._state['segments'].extend(new_segments)
+        self._state['archives'][stem] = {'size': size,
+                                         'ranges': [[entry['name'], 0, entry['docs']] for entry in new_segments]}
+        self._save_state()
+        self._remove_segments(emptied)
+        self.merge()
+        return line_count
+
+    def merge(self, merge_factor: int = MERGE_FACTOR) -> int:
+        """
+        Merge runs of merge_factor neighbouring segments of similar size, keeping the line order, and up to
+            MAX_MERGED_DOCS docs, then rewrite the segments with more than half their docs deleted.
+        :param merge_factor: int: How many segments to merge at once. Defaults to MERGE_FACTOR.
+        :return: int: The number of merges done.
+        :raises InvertedIndexError: On read and write errors.
+        """
+        merges: int = 0
+        while True:
+            segments: list[dict] = self._state['segments']
+            # Find the first run of merge_factor segments in the same size tier:
+            run_start: Optional[int] = None
+            for start in range(len(segments) - merge_factor + 1):
+                live_docs: list[int] = [_live_docs(segment) for segment in segments[start:start + merge_factor]]
+                tiers: set[int] = {len(str(docs // BLOCK_SIZE)) for docs in live_docs}
+                if len(tiers) == 1 and sum(live_docs) <= MAX_MERGED_DOCS:
+                    run_start = start
+                    break
+            if run_start is not None:
+                self._merge_run(run_start, merge_factor)
+                merges += 1
+                continue
+            for number, segment in enumerate(segments):
+                if 2 * _live_docs(segment) < segment['docs']:
+                    self._merge_run(number, 1)
+                    merges += 1
+                    break
+            else:
+                return merges
+
+    def _merge_run(self, run_start: int, count: int) -> None:
+        """
+        Merge neighbouring segments into one, dropping deleted docs. Doc blocks without deleted docs are copied as they
+            are, postings are renumbered and concatenated.
+        :param run_start: int: The index of the first segment in the run.
+        :param count: int: The number of segments to merge.
+        :return: None
+        :raises InvertedIndexError: On read and write errors.
+        """
+        run: list[dict] = self._state['segments'][run_start:run_start + count]
+        segments: list[Segment] = []
+        try:
+            for entry in run:
+                segments.append(Segment(os.path.join(self._directory, entry['name'])))
+            deleted: list[_Deleted] = [_Deleted(entry['deleted']) for entry in run]
+            blocks: list[bytes] = []
+            block_first_docs: list[int] = []
+            doc_offsets: list[int] = []
+            doc_count: int = 0
+            for segment, segment_deleted in zip(segments, deleted):
+                doc_offsets.append(doc_count)
+                first_docs: list[int] = segment.block_first_docs
+                block_ends: list[int] = first_docs[1:] + [segment.doc_count]
+                for block_number, (first_doc, block_end) in enumerate(zip(first_docs, block_ends)):
+                    if not segment_deleted or not any(doc_id in segment_deleted
+                                                      for doc_id in range(first_doc, block_end)):
+                        blocks.append(segment.raw_block(block_number))
+                        block_first_docs.append(doc_count + first_doc - segment_deleted.shift(first_doc))
+                        continue
+                    lines: list[bytes] = zlib.decompress(segment.raw_block(block_number)).split(b'\n')
+                    kept: list[bytes] = [line for doc_id, line in enumerate(lines, first_doc)
+                                         if doc_id not in segment_deleted]
+                    if kept:
+                        live_first: int = next(doc_id for doc_id in range(first_doc, block_end)
+                                               if doc_id not in segment_deleted)
+                        blocks.append(zlib.compress(b'\n'.join(kept)))
+                        block_first_docs.append(doc_count + live_first - segment_deleted.shift(live_first))
+                doc_count += segment.doc_count - segment_deleted.shift(segment.doc_count)
+
+            def renumbered(number: int, doc_ids: array) -> Iterator[int]:
+                offset: int = doc_offsets[number]
+                segment_deleted: _Deleted = deleted[number]
+                if not segment_deleted:
+                    return (doc_id + offset for doc_id in doc_ids)
+                return (doc_id + offset - segment_deleted.shift(doc_id) for doc_id in doc_ids
+                        if doc_id not in segment_deleted)
+
+            def merged_postings() -> Iterator[tuple[bytes, bytes]]:
+                iterators = [segment.iter_postings() for segment in segments]
+                heads: list[Optional[tuple[bytes, array]]] = [next(iterator, None) for iterator in iterators]
+                while True:
+                    live_terms: list[bytes] = [head[0] for head in heads if head is not None]
+                    if not live_terms:
+                        return
+                    term: bytes = min(live_terms)
+                    doc_ids = array('I')
+                    for number, head in enumerate(heads):
+                        if head is not None and head[0] == term:
+                            if doc_offsets[number] or deleted[number]:
+                                doc_ids.extend(renumbered(number, head[1]))
+                            else:
+                                doc_ids.extend(head[1])
+                            heads[number] = next(iterators[number], None)
+                    # Terms only in deleted docs are dropped:
+                    if doc_ids:
+                        yield term, doc_ids.tobytes()
+
+            name, segment_path = self._new_segment_path()
+            try:
+                _write_segment(segment_path, blocks, block_first_docs, doc_count, merged_postings())
+            except OSError as err:
+                raise InvertedIndexError(3, "%s: %s" % (segment_path, str(err)))
+        except OSError as err:
+            raise InvertedIndexError(1, "%s" % str(err))
+        finally:
+            for segment in segments:
+                segment.close()
+        # Move the archive ranges in the run to the merged segment:
+        run_numbers: dict[str, int] = {entry['name']: number for number, entry in enumerate(run)}
+        for archive in self._state['archives'].values():
+            for archive_range in archive['ranges']:
+                number: Optional[int] = run_numbers.get(archive_range[0])
+                if number is None:
+                    continue
+                start: int = doc_offsets[number] + archive_range[1] - deleted[number].shift(archive_range[1])
+                archive_range[:] = [name, start, start + archive_range[2] - archive_range[1]]
+        self._state['segments'][run_start:run_start + count] = [{'name': name, 'docs': doc_count, 'deleted': []}]
+        self._save_state()
+        self._remove_segments([entry['name'] for entry in run])
+        return
+
+    def query(self, query: str, limit: Optional[int] = None) -> Iterator[bytes]:
+        """
+        Find the lines matching every term / phrase of a query, in the order they were indexed.
+        :param query: str: The query, bare words and "quoted phrases", case-insensitive.
+        :param limit: Optional[int]: Stop after this many lines. Defaults to None, no limit.
+        :return: Iterator[bytes]: The matching lines.
+        :raises InvertedIndexError: If the query has no searchable terms, and on read errors.
+        """
+        phrases: list[list[bytes]] = parse_query(query)
+        if not phrases:
+            raise InvertedIndexError(4, query)
+        terms: set[bytes] = set(token for phrase in phrases for token in phrase)
+        check_phrases: bool = any(len(phrase) > 1 for phrase in phrases)
+        count: int = 0
+        for entry in self._state['segments']:
+            try:
+                segment = Segment(os.path.join(self._directory, entry['name']))
+            except OSError as err:
+                raise InvertedIndexError(1, "%s" % str(err))
+            deleted = _Deleted(entry['deleted'])
+            try:
+                # Intersect, smallest postings list first:
+                postings: list[array] = sorted((segment.postings(term) for term in terms), key=len)
+                if len(postings[0]) == 0:
+                    continue
+                doc_ids: set[int] = set(postings[0])
+                for doc_list in postings[1:]:
+                    doc_ids.intersection_update(doc_list)
+                    if not doc_ids:
+                        break
+                for doc_id in sorted(doc_ids):
+                    if doc_id in deleted:
+                        continue
+                    line: bytes = segment.doc(doc_id)
+                    if check_phrases:
+                        column_tokens: list[list[bytes]] = _line_tokens(line)
+                        if not all(_contains_phrase(column_tokens, phrase) for phrase in phrases):
+                            continue
+                    yield line
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
+            finally:
+                segment.close()
+        return
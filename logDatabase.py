@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+    File: logDatabase.py: Bulk load stored archives into a SQLite database for ad-hoc SQL, and full text search.
+        Classes:
+            LogDatabaseError(Exception): Errors generated while loading, and searching.
+            LogDatabase(object): A SQLite database of log lines, and the archives loaded into it.
+        Methods:
+            database_path: The default path of the database for an output directory.
+            format_row: Format a logs row as an archive line.
+
+        Notes:
+            Each archive is loaded in one transaction, with rows inserted by executemany() in batches, and its row in
+            the archives table written last, so a load that's killed or fails never leaves part of an archive behind,
+            and the archives still being loaded are loaded again on the next run. The database is in WAL mode, and
+            synchronous is off while loading, so that only holds for the process dying: an OS crash or power loss
+            during a load can lose committed archives, or corrupt the database, which then has to be deleted and
+            loaded again. When the new archives are bigger than what's already loaded, the indexes are dropped first
+            and created after, which is much faster than updating them row by row. An archive whose size has changed
+            since it was loaded, ie: re-downloaded, is deleted by its row range and loaded again.
+
+            Full text search is an FTS5 table over the message column with the trigram tokenizer, so any substring
+            of 3 or more characters is matched from the index, not just whole words. It's an external content table,
+            holding only the index, and is updated in the same transaction as the rows of each archive. Once created
+            it's kept up to date by every load, whether or not full_text is asked for.
+
+            Rows are numbered by the explicit integer primary key logs.row, so the numbers the archive ranges and the
+            full text index refer to are kept by VACUUM.
+
+            Tables:
+                logs(row, id, generated_at, received_at, source_id, source_name, source_ip, facility_name,
+                     severity_name, program, message), times are seconds since the epoch, ie: datetime(generated_at,
+                     'unixepoch').
+                archives(stem, size, first_row, last_row, lines, loaded_at), first_row and last_row are logs.row.
+                logs_fts(message), an FTS5 index of logs.message by logs.row.
+"""
+from typing import Optional, Final, Callable, Iterable, Iterator
+from datetime import datetime, timezone
+from itertools import islice
+import os
+import sqlite3
+import time
+import zlib
+import logFormat
+
+DATABASE_FILE_NAME: Final[str] = 'logs.sqlite3'
+DEFAULT_BATCH_SIZE: Final[int] = 10000
+_CACHE_KIB: Final[int] = 262144
+_LOG_COLUMNS: Final[str] = ', '.join(logFormat.COLUMNS)
+_SCHEMA: Final[tuple[str, ...]] = (
+    "CREATE TABLE IF NOT EXISTS logs (row INTEGER PRIMARY KEY, id INTEGER, generated_at INTEGER, "
+    "received_at INTEGER, source_id INTEGER, source_name TEXT, source_ip TEXT, facility_name TEXT, "
+    "severity_name TEXT, program TEXT, message TEXT)",
+    "CREATE TABLE IF NOT EXISTS archives (stem TEXT PRIMARY KEY, size INTEGER, first_row INTEGER, last_row INTEGER, "
+    "lines INTEGER, loaded_at INTEGER)",
+)
+_INDEXES: Final[dict[str, str]] = {
+    'logs_generated_at': "CREATE INDEX IF NOT EXISTS logs_generated_at ON logs (generated_at)",
+    'logs_source': "CREATE INDEX IF NOT EXISTS logs_source ON logs (source_name, generated_at)",
+}
+_INSERT: Final[str] = "INSERT INTO logs (%s) VALUES (%s)" % (_LOG_COLUMNS, ', '.join('?' * logFormat.NUM_COLUMNS))
+_FTS_TABLE: Final[str] = 'logs_fts'
+_FTS_SCHEMA: Final[str] = ("CREATE VIRTUAL TABLE %s USING fts5 (message, content='logs', content_rowid='row', "
+                           "tokenize='trigram')" % _FTS_TABLE)
+MIN_SEARCH_LENGTH: Final[int] = 3
+
+
+class LogDatabaseError(Exception):
+    """Class to store log database errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'sqlite3.Error while opening the database.',
+        2: 'Error while reading an archive.',
+        3: 'sqlite3.Error while writing the database.',
+        4: 'No full text table, load with --full_text on to create it.',
+        5: 'SQLite was built without FTS5, or its trigram tokenizer.',
+        6: 'ValueError: search text must be at least 3 characters.',
+        7: 'sqlite3.Error while searching the database.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+def database_path(output_dir: str) -> str:
+    """
+    The default path of the database for an output directory.
+    :param output_dir: str: The output directory.
+    :return: str
+    """
+    return os.path.join(output_dir, DATABASE_FILE_NAME)
+
+
+def format_row(row: tuple) -> bytes:
+    """
+    Format a logs row as an archive line, times as ISO 8601 UTC and NULLs as empty columns.
+    :param row: tuple: The logs columns, in order.
+    :return: bytes: The line, without the line ending.
+    """
+    fields: list[str] = []
+    for column, value in enumerate(row):
+        if value is None:
+            fields.append('')
+        elif column in (logFormat.GENERATED_AT, logFormat.RECEIVED_AT):
+            fields.append(datetime.fromtimestamp(value, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+        else:
+            fields.append(str(value))
+    return '\t'.join(fields).encode('utf-8')
+
+
+def _parse_row(line: bytes) -> tuple:
+    """
+    Convert a line to a logs row, missing and invalid values are NULL.
+    :param line: bytes: The line, without the line ending.
+    :return: tuple: The row.
+    """
+    fields: list[bytes] = logFormat.split_line(line)
+    fields.extend([b''] * (logFormat.NUM_COLUMNS - len(fields)))
+    row: list = []
+    for column, value in enumerate(fields):
+        if column in (logFormat.GENERATED_AT, logFormat.RECEIVED_AT):
+            try:
+                row.append(logFormat.parse_timestamp(value))
+            except ValueError:
+                row.append(None)
+        elif column in (logFormat.ID, logFormat.SOURCE_ID):
+            row.append(int(value) if value.isdigit() else None)
+        else:
+            row.append(value.decode('utf-8', 'replace') if value else None)
+    return tuple(row)
+
+
+def _iter_batches(rows: Iterable[tuple], batch_size: int) -> Iterator[list[tuple]]:
+    """
+    Group rows into batches.
+    :param rows: Iterable[tuple]: The rows.
+    :param batch_size: int: The most rows in a batch.
+    :return: Iterator[list[tuple]]: The batches.
+    """
+    iterator: Iterator[tuple] = iter(rows)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+    return
+
+
+class LogDatabase(object):
+    """
+    A SQLite database of log lines, and the archives loaded into it. Use as a context manager, or call close().
+    """
+
+    def __init__(self, file_path: str, full_text: bool = False) -> None:
+        """
+        Open, or create, a database.
+        :param file_path: str: The path to the database file.
+        :param full_text: bool: Create the full text table if it's missing, indexing the rows already loaded.
+                          Defaults to False.
+        :raises LogDatabaseError: On errors opening the database, or if full_text is asked for but SQLite can't.
+        """
+        self._file_path: str = file_path
+        try:
+            self._connection: sqlite3.Connection = sqlite3.connect(file_path, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute("PRAGMA cache_size = -%i" % _CACHE_KIB)
+            self._connection.execute("PRAGMA temp_store = MEMORY")
+            for statement in _SCHEMA:
+                self._connection.execute(statement)
+            self._full_text: bool = self._connection.execute(
+                "SELECT count(*) FROM sqlite_master WHERE name = ?", (_FTS_TABLE,)).fetchone()[0] > 0
+        except sqlite3.Error as err:
+            raise LogDatabaseError(1, "%s: %s" % (file_path, str(err)))
+        if full_text and not self._full_text:
+            try:
+                self._connection.execute(_FTS_SCHEMA)
+            except sqlite3.OperationalError as err:
+                raise LogDatabaseError(5, "%s: %s" % (file_path, str(err)))
+            try:
+                self._connection.execute("INSERT INTO %s (%s) VALUES ('rebuild')" % (_FTS_TABLE, _FTS_TABLE))
+            except sqlite3.Error as err:
+                raise LogDatabaseError(3, "%s: %s" % (file_path, str(err)))
+            self._full_text = True
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+        return
+
+    def close(self) -> None:
+        """
+        Close the database.
+        :return: None
+        """
+        self._connection.close()
+        return
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        The database connection, for queries.
+        :return: sqlite3.Connection
+        """
+        return self._connection
+
+    @property
+    def full_text(self) -> bool:
+        """
+        If the database has a full text table.
+        :return: bool
+        """
+        return self._full_text
+
+    def loaded_archives(self) -> dict[str, int]:
+        """
+        The archives loaded, and the size they were loaded at.
+        :return: dict[str, int]: The sizes, keyed by archive stem.
+        """
+        return dict(self._connection.execute("SELECT stem, size FROM archives"))
+
+    def _load_archive(self, file_path: str, batch_size: int) -> int:
+        """
+        Load an archive in one transaction, replacing the rows of an earlier load.
+        :param file_path: str: The path to the archive.
+        :param batch_size: int: The rows to insert per executemany().
+        :return: int: The number of rows loaded.
+        :raises LogDatabaseError: On read and write errors.
+        """
+        stem: str = logFormat.archive_stem(file_path)
+        cursor: sqlite3.Cursor = self._connection.cursor()
+        try:
+            cursor.execute("BEGIN")
+            previous: Optional[tuple[int, int]] = cursor.execute(
+                "SELECT first_row, last_row FROM archives WHERE stem = ?", (stem,)).fetchone()
+            if previous is not None:
+                if self._full_text:
+                    cursor.execute("INSERT INTO %s (%s, rowid, message) SELECT 'delete', row, message FROM logs "
+                                   "WHERE row BETWEEN ? AND ? AND message IS NOT NULL" % (_FTS_TABLE, _FTS_TABLE),
+                                   previous)
+                cursor.execute("DELETE FROM logs WHERE row BETWEEN ? AND ?", previous)
+            first_row: int = cursor.execute("SELECT ifnull(max(row), 0) + 1 FROM logs").fetchone()[0]
+            lines = logFormat.iter_lines(logFormat.iter_archive_chunks(file_path))
+            row_count: int = 0
+            for batch in _iter_batches(map(_parse_row, lines), batch_size):
+                cursor.executemany(_INSERT, batch)
+                row_count += len(batch)
+            if self._full_text:
+                cursor.execute("INSERT INTO %s (rowid, message) SELECT row, message FROM logs "
+                               "WHERE row BETWEEN ? AND ? AND message IS NOT NULL" % _FTS_TABLE,
+                               (first_row, first_row + row_count - 1))
+            cursor.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?)",
+                           (stem, os.path.getsize(file_path), first_row, first_row + row_count - 1, row_count,
+                            int(time.time())))
+            cursor.execute("COMMIT")
+        except (OSError, EOFError, zlib.error, ModuleNotFoundError) as err:
+            cursor.execute("ROLLBACK")
+            raise LogDatabaseError(2, "%s: %s" % (file_path, str(err)))
+        except sqlite3.Error as err:
+            if self._connection.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise LogDatabaseError(3, "%s: %s" % (file_path, str(err)))
+        return row_count
+
+    def load(self,
+             file_paths: list[str],
+             batch_size: int = DEFAULT_BATCH_SIZE,
+             report: Optional[Callable[[str, int, float], None]] = None,
+             ) -> tuple[int, int]:
+        """
+        Load the archives that aren't loaded yet, or have changed size since they were.
+        :param file_paths: list[str]: The archive paths.
+        :param batch_size: int: The rows to insert per executemany(). Defaults to DEFAULT_BATCH_SIZE.
+        :param report: Optional[Callable[[str, int, float], None]]: Called with the path, rows, and seconds taken
+                       after each archive is loaded. Defaults to None.
+        :return: tuple[int, int]: The number of archives, and rows, loaded.
+        :raises LogDatabaseError: On read and write errors.
+        """
+        loaded: dict[str, int] = self.loaded_archives()
+        new_paths: list[str] = [file_path for file_path in file_paths
+                                if loaded.get(logFormat.archive_stem(file_path)) != os.path.getsize(file_path)]
+        if len(new_paths) == 0:
+            return 0, 0
+        try:
+            self._connection.execute("PRAGMA synchronous = OFF")
+            # Rebuilding the indexes once is cheaper than updating them, unless the database is already bigger:
+            rebuild: bool = sum(os.path.getsize(file_path) for file_path in new_paths) > sum(loaded.values())
+            if rebuild:
+                for index_name in _INDEXES:
+                    self._connection.execute("DROP INDEX IF EXISTS %s" % index_name)
+        except sqlite3.Error as err:
+            raise LogDatabaseError(3, "%s: %s" % (self._file_path, str(err)))
+        row_count: int = 0
+        try:
+            for file_path in new_paths:
+                start_time: float = time.perf_counter()
+                archive_rows: int = self._load_archive(file_path, batch_size)
+                row_count += archive_rows
+                if report is not None:
+                    report(file_path, archive_rows, time.perf_counter() - start_time)
+        finally:
+            try:
+                for statement in _INDEXES.values():
+                    self._connection.execute(statement)
+                self._connection.execute("PRAGMA synchronous = NORMAL")
+                self._connection.execute("PRAGMA optimize")
+            except sqlite3.Error as err:
+                raise LogDatabaseError(3, "%s: %s" % (self._file_path, str(err)))
+        return len(new_paths), row_count
+
+    def search(self,
+               text: str,
+               raw: bool = False,
+               start: Optional[int] = None,
+               end: Optional[int] = None,
+               source_names: Optional[list[str]] = None,
+               programs: Optional[list[str]] = None,
+               severities: Optional[list[str]] = None,
+               limit: Optional[int] = None,
+               ) -> Iterator[tuple]:
+        """
+        Full text search the messages, filtered by time and source, in generated_at order.
+        :param text: str: The substring to find, case-insensitive.
+        :param raw: bool: Treat text as an FTS5 query, ie: 'timeout AND "req-00"', instead of a substring. Defaults
+                    to False.
+        :param start: Optional[int]: Only lines generated at or after this time. Defaults to None.
+        :param end: Optional[int]: Only lines generated before this time. Defaults to None.
+        :param source_names: Optional[list[str]]: Only lines from these sources. Defaults to None, any source.
+        :param programs: Optional[list[str]]: Only lines from these programs. Defaults to None, any program.
+        :param severities: Optional[list[str]]: Only lines with these severities. Defaults to None, any severity.
+        :param limit: Optional[int]: The most rows to return. Defaults to None, no limit.
+        :return: Iterator[tuple]: The logs columns, without row, in logFormat.COLUMNS order.
+        :raises LogDatabaseError: If there isn't a full text table, text is too short, or on SQLite errors.
+        """
+        if not self._full_text:
+            raise LogDatabaseError(4, self._file_path)
+        if not raw:
+            if len(text) < MIN_SEARCH_LENGTH:
+                raise LogDatabaseError(6, text)
+            text = '"%s"' % text.replace('"', '""')
+        conditions: list[str] = ["%s MATCH ?" % _FTS_TABLE]
+        parameters: list = [text]
+        if start is not None:
+            conditions.append("logs.generated_at >= ?")
+            parameters.append(start)
+        if end is not None:
+            conditions.append("logs.generated_at < ?")
+            parameters.append(end)
+        for column, values in (('source_name', source_names), ('program', programs), ('severity_name', severities)):
+            if values:
+                conditions.append("logs.%s IN (%s)" % (column, ', '.join('?' * len(values))))
+                parameters.extend(values)
+        statement: str = ("SELECT %s FROM %s JOIN logs ON logs.row = %s.rowid WHERE %s ORDER BY logs.generated_at, "
+                          "logs.row" % (', '.join('logs.' + column for column in logFormat.COLUMNS), _FTS_TABLE,
+                                        _FTS_TABLE, ' AND '.join(conditions)))
+        if limit is not None:
+            statement += " LIMIT ?"
+            parameters.append(limit)
+        try:
+            yield from self._connection.execute(statement, parameters)
+        except sqlite3.Error as err:
+            raise LogDatabaseError(7, str(err))
+        return
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+    File: logFilter.py: Filter log lines on ingest.
+        Classes:
+            LogFilter(object): Match log lines against program, source, severity, and message filters.
+        Methods:
+            filtered_file_name: The file name filtered output of an archive is stored under.
+            filter_ingest: Download an archive, storing only the matching lines.
+"""
+from typing import Optional, Callable, Any, Final
+import gzip
+import os
+import re
+import zlib
+from PyPapertrail.Archive import Archive
+from archiveDownload import iter_archive, iter_decompressed, ArchiveDownloadError
+import logFormat
+
+FILTERED_SUFFIX: Final[str] = '.filtered.tsv.gz'
+_WRITE_BATCH_SIZE: Final[int] = 4096
+
+
+class LogFilter(object):
+    """
+    Match log lines against filters. Each configured filter must match, within a filter any value may match.
+    """
+
+    def __init__(self,
+                 programs: Optional[list[str]] = None,
+                 source_names: Optional[list[str]] = None,
+                 severities: Optional[list[str]] = None,
+                 message_regex: Optional[str] = None,
+                 ) -> None:
+        """
+        Initialize the filter.
+        :param programs: Optional[list[str]]: Keep lines from these programs. Defaults to None, any program.
+        :param source_names: Optional[list[str]]: Keep lines from these sources. Defaults to None, any source.
+        :param severities: Optional[list[str]]: Keep lines with these severities, case-insensitive. Defaults to None,
+                            any severity.
+        :param message_regex: Optional[str]: Keep lines with a message matching this regex. Defaults to None,
+                                any message.
+        :raises re.error: If message_regex is invalid.
+        """
+        self._programs: Optional[frozenset[bytes]] = None
+        self._source_names: Optional[frozenset[bytes]] = None
+        self._severities: Optional[frozenset[bytes]] = None
+        self._message_regex: Optional[re.Pattern] = None
+        if programs:
+            self._programs = frozenset(value.encode() for value in programs)
+        if source_names:
+            self._source_names = frozenset(value.encode() for value in source_names)
+        if severities:
+            self._severities = frozenset(value.lower().encode() for value in severities)
+        if message_regex:
+            self._message_regex = re.compile(message_regex.encode())
+        self._settings: dict = {
+            'programs': programs or [],
+            'source_names': source_names or [],
+            'severities': severities or [],
+            'message_regex': message_regex,
+        }
+        return
+
+    @classmethod
+    def from_settings(cls, settings: Optional[dict]):
+        """
+        Create a filter from the 'ingest_filter' setting.
+        :param settings: Optional[dict]: The setting value.
+        :return: Optional[LogFilter]: The filter, or None if no filter is configured.
+        """
+        if not settings:
+            return None
+        log_filter = cls(settings.get('programs'),
+                         settings.get('source_names'),
+                         settings.get('severities'),
+                         settings.get('message_regex'))
+        if log_filter.is_empty:
+            return None
+        return log_filter
+
+    @property
+    def settings(self) -> dict:
+        """
+        The filter as a JSON serializable dict, suitable for the 'ingest_filter' setting.
+        :return: dict
+        """
+        return self._settings
+
+    @property
+    def is_empty(self) -> bool:
+        """
+        True if no filters are configured.
+        :return: bool
+        """
+        return (self._programs is None and self._source_names is None and self._severities is None
+                and self._message_regex is None)
+
+    def matches(self, fields: list[bytes]) -> bool:
+        """
+        Check if a split line matches the filter.
+        :param fields: list[bytes]: The line columns, as returned by logFormat.split_line().
+        :return: bool: True if the line should be kept.
+        """
+        if len(fields) != logFormat.NUM_COLUMNS:
+            return False
+        if self._programs is not None and fields[logFormat.PROGRAM] not in self._programs:
+            return False
+        if self._source_names is not None and fields[logFormat.SOURCE_NAME] not in self._source_names:
+            return False
+        if self._severities is not None and fields[logFormat.SEVERITY_NAME].lower() not in self._severities:
+            return False
+        if self._message_regex is not None and self._message_regex.search(fields[logFormat.MESSAGE]) is None:
+            return False
+        return True
+
+
+def filtered_file_name(file_name: str) -> str:
+    """
+    The file name filtered output of an archive is stored under, ie: '2023-05-12-00.tsv.gz' ->
+        '2023-05-12-00.filtered.tsv.gz'.
+    :param file_name: str: The archive file name.
+    :return: str
+    """
+    return logFormat.archive_stem(file_name) + FILTERED_SUFFIX
+
+
+def filter_ingest(archive: Archive,
+                  destination_dir: str,
+                  api_key: str,
+                  log_filter: LogFilter,
+                  callback: Optional[Callable] = None,
+                  argument: Any = None,
+                  ) -> tuple[int, int, str]:
+    """
+    Download an archive, decompressing and filtering it as it arrives, and storing only the matching lines gzip
+        compressed. The unfiltered archive is never written to disk.
+    :param archive: Archive: The archive to ingest.
+    :param destination_dir: str: The directory to store the filtered output in.
+    :param api_key: str: The papertrail api key.
+    :param log_filter: LogFilter: The filter to apply.
+    :param callback: Optional[Callable]: Called after each chunk with the signature:
+                        callback(archive: Archive, bytes_downloaded: int, argument: Any) -> None. Defaults to None.
+    :param argument: Any: An argument passed to the callback. Defaults to None.
+    :return: tuple[int, int, str]: The number of lines read, the number of lines kept, and the output path.
+    :raises ArchiveDownloadError: On http, file, and corrupt data errors.
+    """
+    download_path: str = os.path.join(destination_dir, filtered_file_name(archive.file_name))
+    temp_path: str = download_path + '.part'
+    bytes_downloaded: int = 0
+    lines_read: int = 0
+    lines_kept: int = 0
+
+    def counted_chunks():
+        nonlocal bytes_downloaded
+        for chunk in iter_archive(archive, api_key):
+            bytes_downloaded += len(chunk)
+            if callback is not None:
+                callback(archive, bytes_downloaded, argument)
+            yield chunk
+        return
+
+    try:
+        output_handle = gzip.open(temp_path, 'wb')
+    except OSError as err:
+        raise ArchiveDownloadError(error_number=3, str_args=str(err.args))
+    try:
+        batch: list[bytes] = []
+        for line in logFormat.iter_lines(iter_decompressed(counted_chunks())):
+            lines_read += 1
+            if log_filter.matches(logFormat.split_line(line)):
+                batch.append(line)
+                if len(batch) >= _WRITE_BATCH_SIZE:
+                    output_handle.write(b'\n'.join(batch) + b'\n')
+                    lines_kept += len(batch)
+                    batch.clear()
+        if batch:
+            output_handle.write(b'\n'.join(batch) + b'\n')
+            lines_kept += len(batch)
+        output_handle.close()
+    except OSError as err:
+        output_handle.close()
+        os.remove(temp_path)
+        raise ArchiveDownloadError(error_number=8, str_args=str(err.args))
+    except zlib.error as err:
+        output_handle.close()
+        os.remove(temp_path)
+        error: str = "Corrupt gzip data in archive '%s'." % archive.file_name
+        raise ArchiveDownloadError(error_number=10, error_message=error, str_args=str(err.args))
+    except BaseException:
+        output_handle.close()
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, download_path)
+    return lines_read, lines_kept, download_path
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+    File: logFormat.py: The papertrail archive TSV format.
+        Constants:
+            COLUMNS: The column names, in file order.
+            ID, GENERATED_AT, ..., MESSAGE: The column indexes.
+            DECOMPRESSION_ERRORS: The xz and zstd errors raised while reading corrupt archives.
+        Methods:
+            archive_stem: Strip the archive suffix from a file name.
+            find_archives: List the archives stored in a directory.
+            open_archive: Open a downloaded archive for reading.
+            iter_archive_chunks: Read the decompressed data of a downloaded archive in chunks.
+            iter_lines: Split a stream of data into lines.
+            split_line: Split a line into its columns.
+            tokenize: Split a column value into lower case word tokens.
+            parse_timestamp: Parse a generated_at / received_at column to seconds since the epoch.
+            sidecar_path: The path of a file stored alongside an archive.
+"""
+from typing import Final, Iterable, Iterator
+from datetime import datetime, timezone
+import gzip
+import lzma
+import os
+import re
+
+HAS_ZSTD: bool = False
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ModuleNotFoundError:
+    pass
+
+COLUMNS: Final[tuple[str, ...]] = (
+    'id',
+    'generated_at',
+    'received_at',
+    'source_id',
+    'source_name',
+    'source_ip',
+    'facility_name',
+    'severity_name',
+    'program',
+    'message',
+)
+ID: Final[int] = 0
+GENERATED_AT: Final[int] = 1
+RECEIVED_AT: Final[int] = 2
+SOURCE_ID: Final[int] = 3
+SOURCE_NAME: Final[int] = 4
+SOURCE_IP: Final[int] = 5
+FACILITY_NAME: Final[int] = 6
+SEVERITY_NAME: Final[int] = 7
+PROGRAM: Final[int] = 8
+MESSAGE: Final[int] = 9
+NUM_COLUMNS: Final[int] = len(COLUMNS)
+
+ARCHIVE_SUFFIX: Final[str] = '.tsv.gz'
+COMPRESSED_SUFFIXES: Final[tuple[str, ...]] = ('.gz', '.xz', '.zst')
+# gzip raises OSError, EOFError, and zlib.error, which readers already handle:
+DECOMPRESSION_ERRORS: Final[tuple[type, ...]] = (lzma.LZMAError,) + ((zstandard.ZstdError,) if HAS_ZSTD else ())
+
+TOKEN_REGEX: Final[re.Pattern] = re.compile(rb'[0-9a-z_]+')
+_MAX_CACHED_TIMESTAMPS: Final[int] = 65536
+_timestamp_cache: dict[bytes, int] = {}
+
+
+def archive_stem(file_name: str) -> str:
+    """
+    Strip the directory and archive suffix from a file name, ie: '/logs/2023-05-12-00.tsv.xz' -> '2023-05-12-00'.
+    :param file_name: str: The file name or path.
+    :return: str: The stem.
+    """
+    file_name = os.path.basename(file_name)
+    for suffix in COMPRESSED_SUFFIXES:
+        if file_name.endswith('.tsv' + suffix):
+            return file_name[:-len('.tsv' + suffix)]
+    return file_name
+
+
+def find_archives(directory: str) -> list[str]:
+    """
+    List the archives stored in a directory, plain, filtered, or recompressed.
+    :param directory: str: The directory.
+    :return: list[str]: The archive paths, sorted by name, which is also time order.
+    """
+    file_paths: list[str] = []
+    for file_name in os.listdir(directory):
+        if '.part' in file_name:
+            continue
+        if any(file_name.endswith('.tsv' + suffix) for suffix in COMPRESSED_SUFFIXES):
+            file_paths.append(os.path.join(directory, file_name))
+    file_paths.sort()
+    return file_paths
+
+
+def iter_archive_chunks(file_path: str, chunk_size: int = 1048576) -> Iterator[bytes]:
+    """
+    Read the decompressed data of a downloaded archive in chunks.
+    :param file_path: str: The path to the archive.
+    :param chunk_size: int: The size of each chunk. Defaults to 1 MiB.
+    :return: Iterator[bytes]: The data.
+    :raises OSError: On read errors, including corrupt xz and zstd data.
+    :raises EOFError: If a gzip archive is truncated.
+    :raises zlib.error: On corrupt gzip data.
+    """
+    try:
+        with open_archive(file_path) as file_handle:
+            while data := file_handle.read(chunk_size):
+                yield data
+    except DECOMPRESSION_ERRORS as err:
+        # So a corrupt recompressed archive is handled like a corrupt gzip one:
+        raise OSError(str(err)) from err
+    return
+
+
+def open_archive(file_path: str):
+    """
+    Open a downloaded archive for reading decompressed bytes, the codec is chosen by the file extension.
+    :param file_path: str: The path to the archive, gzip, xz, or zstd compressed.
+    :return: A binary file object.
+    :raises ModuleNotFoundError: If the archive is zstd compressed and zstandard isn't installed.
+    """
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'rb')
+    elif file_path.endswith('.xz'):
+        return lzma.open(file_path, 'rb')
+    elif file_path.endswith('.zst'):
+        if not HAS_ZSTD:
+            raise ModuleNotFoundError("zstandard is required to read '%s'." % file_path)
+        return zstandard.open(file_path, 'rb')
+    return open(file_path, 'rb')
+
+
+def iter_lines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Split a stream of data into lines, without the line endings.
+    :param chunks: Iterable[bytes]: The data.
+    :return: Iterator[bytes]: The lines.
+    """
+    remainder: bytes = b''
+    for chunk in chunks:
+        lines: list[bytes] = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        yield from lines
+    if remainder:
+        yield remainder
+    return
+
+
+def split_line(line: bytes) -> list[bytes]:
+    """
+    Split a line into its columns, tabs in the message are kept.
+    :param line: bytes: The line, without the line ending.
+    :return: list[bytes]: The columns, shorter than NUM_COLUMNS if the line is truncated.
+    """
+    return line.split(b'\t', NUM_COLUMNS - 1)
+
+
+def tokenize(value: bytes) -> list[bytes]:
+    """
+    Split a column value into lower case word tokens, ie: b'GET /api req-00fa97' -> [b'get', b'api', b'req', b'00fa97'].
+    :param value: bytes: The column value.
+    :return: list[bytes]: The tokens, in order.
+    """
+    return TOKEN_REGEX.findall(value.lower())
+
+
+def parse_timestamp(value: bytes) -> int:
+    """
+    Parse a generated_at / received_at column, ie: b'2023-05-12T00:00:02Z' or b'2011-02-10 00:19:36 -0800'.
+    :param value: bytes: The column value.
+    :return: int: Seconds since the epoch, times without an offset are taken as UTC.
+    :raises ValueError: If value isn't a timestamp.
+    """
+    # Log lines arrive many to a second, so the same values are parsed over and over:
+    seconds = _timestamp_cache.get(value)
+    if seconds is not None:
+        return seconds
+    text: str = value.decode('ascii').strip()
+    if text.endswith('Z'):
+        text = text[:-1] + '+00:00'
+    elif len(text) > 5 and text[-5] in '+-' and text[-4:].isdigit():
+        text = text[:-5].rstrip() + text[-5:-2] + ':' + text[-2:]
+    value_time: datetime = datetime.fromisoformat(text)
+    if value_time.tzinfo is None:
+        value_time = value_time.replace(tzinfo=timezone.utc)
+    seconds = int(value_time.timestamp())
+    if len(_timestamp_cache) >= _MAX_CACHED_TIMESTAMPS:
+        _timestamp_cache.clear()
+    _timestamp_cache[value] = seconds
+    return seconds
+
+
+def sidecar_path(file_path: str, suffix: str) -> str:
+    """
+    The path of a file stored alongside an archive, ie: ('/logs/2023-05-12-00.tsv.gz', '.gzindex') ->
+        '/logs/2023-05-12-00.gzindex'. Sidecars are named from the stem, so they survive recompression.
+    :param file_path: str: The path to the archive.
+    :param suffix: str: The sidecar suffix.
+    :return: str
+    """
+    return os.path.join(os.path.dirname(file_path), archive_stem(file_path) + suffix)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+    File: logParser.py: Streaming parser for the lines of stored archives.
+        Classes:
+            LogRecord(object): One line, split and decoded only as its columns are used.
+            ColumnBatch(object): The values of selected columns for a batch of lines.
+        Methods:
+            get_column: A single column of a line, without splitting the columns after it.
+            get_time: A generated_at / received_at column of a line in seconds since the epoch.
+            iter_records: Parse lines into LogRecords.
+            iter_batches: Parse lines into ColumnBatches of selected columns.
+
+        Notes:
+            Lines stay bytes from the archive to the caller. A column is found by splitting only up to it, so reading
+            the times never splits the message, and text is only decoded when a str is asked for. Batches hold
+            integer and time columns as array('q'), ready for numpy.frombuffer(), and text columns as lists of bytes
+            or, given a dictionary, array('I') codes.
+
+            Run this file with archive paths to benchmark the parsers against splitting decoded lines into dicts.
+"""
+from typing import Optional, Final, Iterable, Iterator, Union
+from array import array
+import logFormat
+
+MISSING_VALUE: Final[int] = -1
+TIME_COLUMNS: Final[tuple[int, ...]] = (logFormat.GENERATED_AT, logFormat.RECEIVED_AT)
+INTEGER_COLUMNS: Final[tuple[int, ...]] = (logFormat.ID, logFormat.SOURCE_ID)
+DEFAULT_BATCH_SIZE: Final[int] = 65536
+
+
+def get_column(line: bytes, column: int) -> Optional[bytes]:
+    """
+    A single column of a line, without splitting the columns after it.
+    :param line: bytes: The line, without the line ending.
+    :param column: int: The column index.
+    :return: Optional[bytes]: The column value, or None if the line is truncated before it.
+    """
+    fields: list[bytes] = line.split(b'\t', column + 1)
+    if column < len(fields):
+        return fields[column]
+    return None
+
+
+def get_time(line: bytes, column: int = logFormat.GENERATED_AT) -> Optional[int]:
+    """
+    A generated_at / received_at column of a line in seconds since the epoch.
+    :param line: bytes: The line, without the line ending.
+    :param column: int: The column index. Defaults to logFormat.GENERATED_AT.
+    :return: Optional[int]: The time, or None if the line doesn't have a valid time.
+    """
+    value: Optional[bytes] = get_column(line, column)
+    if value is None:
+        return None
+    try:
+        return logFormat.parse_timestamp(value)
+    except ValueError:
+        return None
+
+
+def _parse_integer(column: int, value: bytes) -> int:
+    """
+    Parse an integer or time column.
+    :param column: int: The column index.
+    :param value: bytes: The column value.
+    :return: int: The value, or MISSING_VALUE if it isn't valid.
+    """
+    try:
+        if column in TIME_COLUMNS:
+            return logFormat.parse_timestamp(value)
+        return int(value)
+    except ValueError:
+        return MISSING_VALUE
+
+
+class LogRecord(object):
+    """
+    One line, split and decoded only as its columns are used.
+    """
+    __slots__ = ('line', '_fields')
+
+    def __init__(self, line: bytes) -> None:
+        """
+        Initialize the record.
+        :param line: bytes: The line, without the line ending.
+        """
+        self.line: bytes = line
+        self._fields: Optional[list[bytes]] = None
+        return
+
+    def raw(self, column: int) -> bytes:
+        """
+        A column as bytes.
+        :param column: int: The column index.
+        :return: bytes: The value, empty if the line is truncated before it.
+        """
+        if self._fields is None:
+            self._fields = logFormat.split_line(self.line)
+        if column < len(self._fields):
+            return self._fields[column]
+        return b''
+
+    def text(self, column: int) -> str:
+        """
+        A column decoded as UTF-8, with invalid bytes replaced.
+        :param column: int: The column index.
+        :return: str
+        """
+        return self.raw(column).decode('utf-8', 'replace')
+
+    @property
+    def is_complete(self) -> bool:
+        """
+        True if the line has every column.
+        :return: bool
+        """
+        self.raw(0)
+        return len(self._fields) == logFormat.NUM_COLUMNS
+
+    @property
+    def id(self) -> int:
+        """
+        The message id, or MISSING_VALUE if it isn't valid.
+        :return: int
+        """
+        return _parse_integer(logFormat.ID, self.raw(logFormat.ID))
+
+    @property
+    def generated_at(self) -> int:
+        """
+        The time the line was generated, in seconds since the epoch, or MISSING_VALUE if it isn't valid.
+        :return: int
+        """
+        return _parse_integer(logFormat.GENERATED_AT, self.raw(logFormat.GENERATED_AT))
+
+    @property
+    def received_at(self) -> int:
+        """
+        The time the line was received, in seconds since the epoch, or MISSING_VALUE if it isn't valid.
+        :return: int
+        """
+        return _parse_integer(logFormat.RECEIVED_AT, self.raw(logFormat.RECEIVED_AT))
+
+    @property
+    def source_id(self) -> int:
+        """
+        The source id, or MISSING_VALUE if it isn't valid.
+        :return: int
+        """
+        return _parse_integer(logFormat.SOURCE_ID, self.raw(logFormat.SOURCE_ID))
+
+    @property
+    def source_name(self) -> str:
+        """
+        The source name.
+        :return: str
+        """
+        return self.text(logFormat.SOURCE_NAME)
+
+    @property
+    def source_ip(self) -> str:
+        """
+        The source IP address.
+        :return: str
+        """
+        return self.text(logFormat.SOURCE_IP)
+
+    @property
+    def facility_name(self) -> str:
+        """
+        The syslog facility name.
+        :return: str
+        """
+        return self.text(logFormat.FACILITY_NAME)
+
+    @property
+    def severity_name(self) -> str:
+        """
+        The syslog severity name.
+        :return: str
+        """
+        return self.text(logFormat.SEVERITY_NAME)
+
+    @property
+    def program(self) -> str:
+        """
+        The program name.
+        :return: str
+        """
+        return self.text(logFormat.PROGRAM)
+
+    @property
+    def message(self) -> str:
+        """
+        The message.
+        :return: str
+        """
+        return self.text(logFormat.MESSAGE)
+
+
+class ColumnBatch(object):
+    """
+    The values of selected columns for a batch of lines. Integer and time columns are array('q'), with MISSING_VALUE
+        for invalid values, other columns are lists of bytes, or array('I') codes when parsed with a dictionary.
+    """
+    __slots__ = ('rows', 'columns')
+
+    def __init__(self, rows: int, columns: dict[int, Union[array, list[bytes]]]) -> None:
+        """
+        Initialize the batch.
+        :param rows: int: The number of lines.
+        :param columns: dict[int, Union[array, list[bytes]]]: The values, by column index.
+        """
+        self.rows: int = rows
+        self.columns: dict[int, Union[array, list[bytes]]] = columns
+        return
+
+    def __getitem__(self, column: int) -> Union[array, list[bytes]]:
+        return self.columns[column]
+
+
+def iter_records(lines: Iterable[bytes]) -> Iterator[LogRecord]:
+    """
+    Parse lines into LogRecords.
+    :param lines: Iterable[bytes]: The lines, without line endings, ie: from logFormat.iter_lines().
+    :return: Iterator[LogRecord]
+    """
+    for line in lines:
+        yield LogRecord(line)
+    return
+
+
+def iter_batches(lines: Iterable[bytes],
+                 columns: Iterable[int],
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 dictionaries: Optional[dict[int, dict[bytes, int]]] = None,
+                 ) -> Iterator[ColumnBatch]:
+    """
+    Parse lines into ColumnBatches of selected columns, lines are only split as far as the last selected column.
+    :param lines: Iterable[bytes]: The lines, without line endings, ie: from logFormat.iter_lines().
+    :param columns: Iterable[int]: The column indexes.
+    :param batch_size: int: The lines per batch. Defaults to DEFAULT_BATCH_SIZE.
+    :param dictionaries: Optional[dict[int, dict[bytes, int]]]: Dictionaries for text columns, by column index, to
+                         return codes instead of bytes. New values are added to them. Defaults to None.
+    :return: Iterator[ColumnBatch]
+    """
+    columns = tuple(columns)
+    dictionaries = dictionaries or {}
+    max_split: int = min(max(columns) + 1, logFormat.NUM_COLUMNS - 1) if columns else 0
+    empty_fields: list[bytes] = [b''] * logFormat.NUM_COLUMNS
+
+    def new_batch() -> dict[int, Union[array, list[bytes]]]:
+        values: dict[int, Union[array, list[bytes]]] = {}
+        for batch_column in columns:
+            if batch_column in TIME_COLUMNS or batch_column in INTEGER_COLUMNS:
+                values[batch_column] = array('q')
+            elif batch_column in dictionaries:
+                values[batch_column] = array('I')
+            else:
+                values[batch_column] = []
+        return values
+
+    batch: dict[int, Union[array, list[bytes]]] = new_batch()
+    rows: int = 0
+    integer_columns: tuple[int, ...] = tuple(column for column in columns
+                                             if column in TIME_COLUMNS or column in INTEGER_COLUMNS)
+    coded_columns: tuple[int, ...] = tuple(column for column in columns
+                                           if column not in integer_columns and column in dictionaries)
+    raw_columns: tuple[int, ...] = tuple(column for column in columns
+                                         if column not in integer_columns and column not in coded_columns)
+    for line in lines:
+        fields: list[bytes] = line.split(b'\t', max_split)
+        if len(fields) <= max_split:
+            fields += empty_fields[len(fields):max_split + 1]
+        for column in integer_columns:
+            batch[column].append(_parse_integer(column, fields[column]))
+        for column in coded_columns:
+            dictionary: dict[bytes, int] = dictionaries[column]
+            code: Optional[int] = dictionary.get(fields[column])
+            if code is None:
+                code = dictionary[fields[column]] = len(dictionary)
+            batch[column].append(code)
+        for column in raw_columns:
+            batch[column].append(fields[column])
+        rows += 1
+        if rows >= batch_size:
+            yield ColumnBatch(rows, batch)
+            batch = new_batch()
+            rows = 0
+    if rows:
+        yield ColumnBatch(rows, batch)
+    return
+
+
+def _naive_parse(lines: Iterable[bytes]) -> Iterator[dict]:
+    """
+    The parser this module replaces, for benchmarking: decode, str.split, and build a dict per line.
+    :param lines: Iterable[bytes]: The lines.
+    :return: Iterator[dict]
+    """
+    for line in lines:
+        record_dict: dict = dict(zip(logFormat.COLUMNS, line.decode('utf-8', 'replace').split('\t')))
+        record_dict['generated_at'] = logFormat.parse_timestamp(record_dict['generated_at'].encode())
+        yield record_dict
+    return
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    if len(sys.argv) < 2:
+        print("Usage: %s ARCHIVE [ARCHIVE ...]" % sys.argv[0], file=sys.stderr)
+        exit(2)
+    # Decompress once, so only parsing is timed:
+    all_lines: list[bytes] = []
+    for archive_path in sys.argv[1:]:
+        all_lines.extend(logFormat.iter_lines(logFormat.iter_archive_chunks(archive_path)))
+    benchmark_columns: tuple[int, ...] = (logFormat.GENERATED_AT, logFormat.SEVERITY_NAME, logFormat.PROGRAM)
+
+    def run_naive() -> None:
+        for record_dict in _naive_parse(all_lines):
+            _ = (record_dict['generated_at'], record_dict['severity_name'], record_dict['program'])
+
+    def run_records() -> None:
+        for record in iter_records(all_lines):
+            _ = (record.generated_at, record.raw(logFormat.SEVERITY_NAME), record.raw(logFormat.PROGRAM))
+
+    def run_batches() -> None:
+        for _ in iter_batches(all_lines, benchmark_columns, dictionaries={logFormat.SEVERITY_NAME: {},
+                                                                          logFormat.PROGRAM: {}}):
+            pass
+
+    print("%i lines, reading generated_at, severity_name, and program:" % len(all_lines))
+    for benchmark_name, benchmark in (('naive dicts', run_naive), ('records', run_records),
+                                      ('batches', run_batches)):
+        start_time: float = time.perf_counter()
+        benchmark()
+        seconds: float = time.perf_counter() - start_time
+        print("%12s: %10.0f rows/s" % (benchmark_name, len(all_lines) / seconds if seconds > 0 else 0.0))
+    exit(0)
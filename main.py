@@ -1,12 +1,50 @@
 #!/usr/bin/env python3
 from typing import Optional, Any
 import argparse
+import gzip
+from concurrent.futures import Executor, Future, as_completed
 import os
+import re
+import sys
+import zlib
+from datetime import datetime, timezone
+from itertools import islice
 from PyPapertrail.Archive import Archive
 from PyPapertrail.Archives import Archives
 from apiKey import API_KEY
+from archiveDownload import download_archive, stream_archive, ArchiveDownloadError
+from archiveManifest import ArchiveManifest
 from configFile import ConfigFile, ConfigFileError
+import logFormat
+import logParser
 import common
+from search import SearchError, Matcher, search_archives
+from gzipIndex import GzipIndexError, GzipIndex, build_index
+from invertedIndex import InvertedIndexError, InvertedIndex
+from bloomIndex import BloomBuilder, load_bloom, candidate_archives
+from trigramIndex import TrigramIndexError, TrigramIndex, build_trigram_index
+from columnar import ColumnarError, ColumnarArchive, convert_archive
+import stats as archiveStats
+from stats import StatsError, GROUP_COLUMNS, DEFAULT_BUCKET_SECONDS
+import rollups
+from rollups import Rollup, RollupBuilder, build_rollup
+from timeIndex import TimeIndexError, TimeIndex, TimeIndexBuilder, iter_time_range
+from timeMerge import DEFAULT_MAX_DISORDER, merge_archives
+from dedup import DEFAULT_ERROR_RATE, ExactIdSet, BloomIdSet, is_duplicate
+from logDatabase import LogDatabaseError, DATABASE_FILE_NAME, LogDatabase, database_path, format_row
+from topK import TopKError, TOP_COLUMNS, DEFAULT_K, DEFAULT_WIDTH, DEFAULT_DEPTH, DEFAULT_PREFIX_WORDS, \
+    collect_heavy_hitters
+from distinct import DistinctError, DISTINCT_COLUMNS, DistinctBuilder, load_distinct, collect_distinct
+import distinct
+import anomaly
+from anomaly import AnomalyError, ANOMALY_GROUPS, TOTAL_GROUP, find_anomalies
+from alertRules import AlertRulesError, DEFAULT_SAMPLES, AlertRules, load_alerts, scan_archive, collect_alerts
+from templateMiner import TemplateMinerError, TemplateMiner, update_templates, template_counts
+import correlate as correlation
+from correlate import CorrelateError, DEFAULT_ID_REGEX, correlate_archives
+from externalSort import SortError, DEFAULT_MEMORY_CAP, sort_archives
+from recompress import RecompressError, CODECS, choose_codec, create_pool, submit
+from logFilter import LogFilter, filtered_file_name, filter_ingest
 from prettyPrint import print_coloured, print_error, print_warning
 from colours import Colours
 from spinner import Spinner, STYLE_LINE
@@ -18,43 +56,949 @@ def callback(archive: Archive, bytes_downloaded: int, argument: Spinner) -> None
     return
 
 
+def parse_time(value: str) -> datetime:
+    """
+    Parse an ISO date / time given on the command line, naive times are taken as UTC.
+    :param value: str: The date / time string.
+    :return: datetime: A timezone-aware datetime.
+    :raises argparse.ArgumentTypeError: If value is not an ISO date / time.
+    """
+    try:
+        value_time: datetime = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid date / time: '%s'" % value)
+    if value_time.tzinfo is None:
+        value_time = value_time.replace(tzinfo=timezone.utc)
+    return value_time
+
+
+def select_archives(log_archives: Archives,
+                    file_names: Optional[list[str]] = None,
+                    start_time: Optional[datetime] = None,
+                    end_time: Optional[datetime] = None,
+                    ) -> list[Archive]:
+    """
+    Select archives from the papertrail listing.
+    :param log_archives: Archives: The archive listing.
+    :param file_names: Optional[list[str]]: Only select archives with these file names. Defaults to None, all names.
+    :param start_time: Optional[datetime]: Only select archives ending after this time. Defaults to None.
+    :param end_time: Optional[datetime]: Only select archives starting before this time. Defaults to None.
+    :return: list[Archive]: The selected archives, in listing order.
+    """
+    selected: list[Archive] = []
+    for archive in log_archives:
+        if file_names and archive.file_name not in file_names:
+            continue
+        if start_time is not None and archive.end_time <= start_time:
+            continue
+        if end_time is not None and archive.start_time >= end_time:
+            continue
+        selected.append(archive)
+    return selected
+
+
+def stream(file_names: list[str],
+           start_time: Optional[datetime],
+           end_time: Optional[datetime],
+           output: str,
+           decompress: bool,
+           ) -> None:
+    """
+    Stream the selected archives to stdout or a named pipe, without storing them.
+    :param file_names: list[str]: The archive file names to stream, empty for all.
+    :param start_time: Optional[datetime]: Only stream archives ending after this time.
+    :param end_time: Optional[datetime]: Only stream archives starting before this time.
+    :param output: str: The file / named pipe to write to, '-' for stdout.
+    :param decompress: bool: Decompress the archives on the fly.
+    :return: None
+    """
+    log_archives = Archives(api_key=API_KEY)
+    archives: list[Archive] = select_archives(log_archives, file_names, start_time, end_time)
+    if len(archives) == 0:
+        print_warning("No archives selected.", file=sys.stderr)
+        return
+    if output == '-':
+        output_handle = sys.stdout.buffer
+    else:
+        try:
+            output_handle = open(output, 'wb')
+        except OSError as err:
+            print_error("Failed to open '%s' for writing: %s" % (output, err.strerror), file=sys.stderr)
+            exit(14)
+    try:
+        for archive in archives:
+            stream_archive(archive, API_KEY, output_handle, decompress=decompress)
+    except ArchiveDownloadError as err:
+        print_error(err.error_message, file=sys.stderr)
+        exit(13)
+    except BrokenPipeError:
+        # The reader went away, stop quietly:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, output_handle.fileno())
+    finally:
+        if output_handle is not sys.stdout.buffer:
+            output_handle.close()
+    return
+
+
+def print_recompressed(manifest: ArchiveManifest, futures: dict[Future, str], new_archives: bool = False) -> None:
+    """
+    Wait for recompression to complete, recording the results in the manifest, and run the post download stages on
+        the stored files.
+    :param manifest: ArchiveManifest: The output directory manifest.
+    :param futures: dict[Future, str]: The recompression futures, mapped to the archive file names.
+    :param new_archives: bool: The archives were just downloaded, and haven't been through the post download stages,
+                         so run them on the gzip archive when recompression fails. Defaults to False.
+    :return: None
+    """
+    for future in as_completed(futures):
+        file_name: str = futures[future]
+        try:
+            result: dict = future.result()
+        except RecompressError as err:
+            print_error("Recompressing %s failed: %s" % (file_name, err.error_message))
+            if new_archives:
+                post_download(manifest, file_name, manifest.stored_path(file_name))
+            continue
+        manifest.update(file_name,
+                        path=os.path.basename(result['path']),
+                        codec=result['codec'],
+                        compressed_size=result['compressed_size'],
+                        ratio=result['ratio'],
+                        recompress_seconds=result['seconds'])
+        print_coloured("Recompressed: ", fg_colour=Colours.fg.green, end='')
+        print("%s ratio: %.2f time: %.1fs" % (os.path.basename(result['path']), result['ratio'], result['seconds']))
+        # The sidecars are keyed to the stored file, so the stages only run once it's recompressed:
+        post_download(manifest, file_name, result['path'])
+    return
+
+
+def recompress_stored(codec: str) -> None:
+    """
+    Recompress the gzip archives already stored in the output directory.
+    :param codec: str: The codec, one of recompress.CODECS.
+    :return: None
+    """
+    manifest = ArchiveManifest(common.SETTINGS['output_dir'])
+    codec = choose_codec(codec)
+    with create_pool() as pool:
+        futures: dict[Future, str] = {}
+        for file_name in manifest.file_names():
+            file_path: Optional[str] = manifest.stored_path(file_name)
+            if file_path.endswith('.gz') and os.path.exists(file_path):
+                futures[submit(pool, file_path, codec)] = file_name
+        if len(futures) == 0:
+            print_warning("No gzip archives to recompress.")
+        print_recompressed(manifest, futures)
+    return
+
+
+def build_line_sidecars(file_name: str, file_path: str, builders: list[tuple[str, Any]]) -> None:
+    """
+    Build several sidecars of a stored archive in one pass, decompressing it once and feeding each batch of lines to
+        every builder, then saving each sidecar.
+    :param file_name: str: The archive file name.
+    :param file_path: str: The path to the stored archive.
+    :param builders: list[tuple[str, Any]]: What each builder does, for its error message, and the builder, with
+                     add_lines() and finish().
+    :return: None
+    """
+    if len(builders) == 0:
+        return
+    try:
+        lines = logFormat.iter_lines(logFormat.iter_archive_chunks(file_path))
+        while batch := list(islice(lines, logParser.DEFAULT_BATCH_SIZE)):
+            for _, builder in builders:
+                builder.add_lines(batch)
+    except (OSError, EOFError, zlib.error, ModuleNotFoundError) as err:
+        print_error("Reading %s failed: %s" % (file_name, str(err)))
+        return
+    for action, builder in builders:
+        try:
+            builder.finish()
+        except (TimeIndexError, StatsError, DistinctError) as err:
+            print_error("%s %s failed: %s" % (action, file_name, err.error_message))
+        except OSError as err:
+            print_error("%s %s failed: %s" % (action, file_name, str(err)))
+    return
+
+
+def post_download(manifest: ArchiveManifest, file_name: str, file_path: str) -> None:
+    """
+    Run the post download stages enabled in the settings on a stored archive, skipping stages already done.
+    :param manifest: ArchiveManifest: The output directory manifest.
+    :param file_name: str: The archive file name.
+    :param file_path: str: The path to the stored archive.
+    :return: None
+    """
+    size: int = manifest.get(file_name)['size']
+    if (common.SETTINGS['gzip_index_span'] and common.SETTINGS['recompress'] is None and file_path.endswith('.gz')
+            and GzipIndex.load(file_path) is None):
+        try:
+            index = build_index(file_path, common.SETTINGS['gzip_index_span'] * 1048576)
+        except GzipIndexError as err:
+            print_error("Indexing %s failed: %s" % (file_name, err.error_message))
+        else:
+            manifest.update(file_name, gzip_checkpoints=len(index.checkpoints))
+    if common.SETTINGS['inverted_index']:
+        try:
+            inverted_index = InvertedIndex(common.SETTINGS['output_dir'])
+            if not inverted_index.is_indexed(file_path, size):
+                inverted_index.add_archive(file_path, size)
+        except InvertedIndexError as err:
+            print_error("Indexing %s failed: %s %s"
+                        % (file_name, err.error_message, ' '.join(str(arg) for arg in err.args[1:])))
+    if common.SETTINGS['columnar'] and not ColumnarArchive.is_current(file_path):
+        try:
+            convert_archive(file_path)
+        except ColumnarError as err:
+            print_error("Converting %s to columnar failed: %s" % (file_name, err.error_message))
+    # The sidecars built from each line share one pass over the archive:
+    builders: list[tuple[str, Any]] = []
+    if common.SETTINGS['time_index'] and TimeIndex.load(file_path) is None:
+        builders.append(("Time indexing", TimeIndexBuilder(file_path)))
+    if common.SETTINGS['rollups'] and Rollup.load(file_path) is None:
+        if ColumnarArchive.is_current(file_path):
+            # Counted from the columns, without reading the archive:
+            try:
+                build_rollup(file_path)
+            except StatsError as err:
+                print_error("Rolling up %s failed: %s" % (file_name, err.error_message))
+        else:
+            builders.append(("Rolling up", RollupBuilder(file_path)))
+    if common.SETTINGS['distinct_sketches'] and load_distinct(file_path) is None:
+        builders.append(("Building distinct sketches for", DistinctBuilder(file_path)))
+    if common.SETTINGS['bloom_sidecars'] and load_bloom(file_path) is None:
+        builders.append(("Building bloom filter for", BloomBuilder(file_path)))
+    build_line_sidecars(file_name, file_path, builders)
+    if common.SETTINGS['trigram_index'] and TrigramIndex.load(file_path) is None:
+        try:
+            build_trigram_index(file_path)
+        except TrigramIndexError as err:
+            print_error("Trigram indexing %s failed: %s" % (file_name, err.error_message))
+    if common.SETTINGS['database_load']:
+        try:
+            with LogDatabase(database_path(common.SETTINGS['output_dir']),
+                             common.SETTINGS['full_text']) as log_database:
+                log_database.load([file_path])
+        except LogDatabaseError as err:
+            print_error("Loading %s into the database failed: %s" % (file_name, err.error_message))
+    if common.SETTINGS['alert_rules']:
+        try:
+            rules = AlertRules.load(common.SETTINGS['alert_rules'])
+            if load_alerts(file_path, rules) is None:
+                for rule_name, (count, samples) in scan_archive(file_path, rules).items():
+                    print_warning("%s: rule '%s' matched %i lines, ie: %s" % (file_name, rule_name, count, samples[0]))
+        except AlertRulesError as err:
+            print_error("Checking alert rules on %s failed: %s %s"
+                        % (file_name, err.error_message, ' '.join(str(arg) for arg in err.args[1:])))
+    return
+
+
+def run_post_download() -> None:
+    """
+    Run the post download stages enabled in the settings on the archives already in the output directory.
+    :return: None
+    """
+    manifest = ArchiveManifest(common.SETTINGS['output_dir'])
+    for file_name in manifest.file_names():
+        file_path: str = manifest.stored_path(file_name)
+        if not os.path.exists(file_path):
+            continue
+        print_coloured("Processing: ", fg_colour=Colours.fg.green, end='')
+        print(file_path)
+        post_download(manifest, file_name, file_path)
+    return
+
+
+def query(query_string: str, limit: Optional[int]) -> int:
+    """
+    Query the inverted index, printing the matching lines.
+    :param query_string: str: The query, bare words and "quoted phrases".
+    :param limit: Optional[int]: Stop after this many lines.
+    :return: int: The exit status, 0 if anything matched, 1 if nothing matched.
+    """
+    output_handle = sys.stdout.buffer
+    found: bool = False
+    try:
+        inverted_index = InvertedIndex(common.SETTINGS['output_dir'])
+        for line in inverted_index.query(query_string, limit):
+            found = True
+            output_handle.write(line + b'\n')
+        output_handle.flush()
+    except InvertedIndexError as err:
+        print_error("%s %s" % (err.error_message, ' '.join(str(arg) for arg in err.args[1:])), file=sys.stderr)
+        exit(19)
+    except BrokenPipeError:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, output_handle.fileno())
+    return 0 if found else 1
+
+
+def make_id_set(dedup: Optional[str], error_rate: float, file_paths: list[str]):
+    """
+    Make the set of ids seen, for dropping repeated lines.
+    :param dedup: Optional[str]: 'exact', 'bloom', or None for no dedup.
+    :param error_rate: float: The bloom filter false positive rate.
+    :param file_paths: list[str]: The archives to be read, to size the bloom filter from their time indexes.
+    :return: Optional[Union[ExactIdSet, BloomIdSet]]: The set, or None for no dedup.
+    """
+    if dedup is None:
+        return None
+    elif dedup == 'exact':
+        return ExactIdSet()
+    # Size from the line counts in the time indexes, or over guess 64 lines per compressed KiB without one:
+    capacity: int = 0
+    for file_path in file_paths:
+        time_index: Optional[TimeIndex] = TimeIndex.load(file_path)
+        capacity += time_index.lines if time_index is not None else os.path.getsize(file_path) // 16
+    try:
+        return BloomIdSet(capacity, error_rate)
+    except ValueError as err:
+        print_error(str(err), file=sys.stderr)
+        exit(23)
+
+
+def export_archives(contains: Optional[str]) -> tuple[list[str], Optional[Matcher]]:
+    """
+    The stored archives to export, and the matcher for the lines to keep. Archives whose bloom sidecars say they don't
+        contain the word are skipped.
+    :param contains: Optional[str]: Only keep lines containing this whole word, None to keep all lines.
+    :return: tuple[list[str], Optional[Matcher]]: The archive paths, and the matcher, or None to keep all lines.
+    """
+    file_paths: list[str] = logFormat.find_archives(common.SETTINGS['output_dir'])
+    if contains is None:
+        return file_paths, None
+    matcher = Matcher(contains, fixed=True, word=True)
+    return candidate_archives(file_paths, matcher.required_tokens(), matcher.columns), matcher
+
+
+def read(start_time: Optional[datetime],
+         end_time: Optional[datetime],
+         with_file_name: bool,
+         dedup: Optional[str],
+         error_rate: float,
+         contains: Optional[str] = None,
+         ) -> int:
+    """
+    Print the stored lines generated in a time range, using the time indexes to skip archives and blocks.
+    :param start_time: Optional[datetime]: The start of the range, inclusive, None for no start.
+    :param end_time: Optional[datetime]: The end of the range, exclusive, None for no end.
+    :param with_file_name: bool: Prefix each line with the archive file name.
+    :param dedup: Optional[str]: Drop repeated ids, 'exact', 'bloom', or None to keep them.
+    :param error_rate: float: The false positive rate for bloom dedup.
+    :param contains: Optional[str]: Only print lines containing this whole word, None for all lines.
+    :return: int: The exit status, 0 if any lines were in range, 1 if none were.
+    """
+    start: Optional[int] = None if start_time is None else int(start_time.timestamp())
+    end: Optional[int] = None if end_time is None else int(end_time.timestamp())
+    file_paths, matcher = export_archives(contains)
+    id_set = make_id_set(dedup, error_rate, file_paths)
+    output_handle = sys.stdout.buffer
+    found: bool = False
+    try:
+        for file_path, line in iter_time_range(file_paths, start, end):
+            if matcher is not None and not matcher.matches(line):
+                continue
+            if id_set is not None and is_duplicate(line, id_set):
+                continue
+            found = True
+            if with_file_name:
+                output_handle.write(os.path.basename(file_path).encode() + b':')
+            output_handle.write(line + b'\n')
+        output_handle.flush()
+    except TimeIndexError as err:
+        print_error(err.error_message, file=sys.stderr)
+        exit(20)
+    except BrokenPipeError:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, output_handle.fileno())
+    except OSError as err:
+        print_error("OSError: %s" % str(err), file=sys.stderr)
+        exit(23)
+    finally:
+        if id_set is not None:
+            id_set.close()
+    return 0 if found else 1
+
+
+def merge(start_time: Optional[datetime],
+          end_time: Optional[datetime],
+          output: str,
+          max_disorder: int,
+          with_file_name: bool,
+          dedup: Optional[str],
+          error_rate: float,
+          contains: Optional[str] = None,
+          ) -> int:
+    """
+    Merge the stored archives into one stream in generated_at order.
+    :param start_time: Optional[datetime]: The start of the range, inclusive, None for no start.
+    :param end_time: Optional[datetime]: The end of the range, exclusive, None for no end.
+    :param output: str: The file / named pipe to write to, '-' for stdout, gzip compressed if it ends in '.gz'.
+    :param max_disorder: int: How far out of order, in seconds, lines can be in an archive.
+    :param with_file_name: bool: Prefix each line with the archive file name.
+    :param dedup: Optional[str]: Drop repeated ids, 'exact', 'bloom', or None to keep them.
+    :param error_rate: float: The false positive rate for bloom dedup.
+    :param contains: Optional[str]: Only merge lines containing this whole word, None for all lines.
+    :return: int: The exit status, 0 if any lines were merged, 1 if none were.
+    """
+    start: Optional[int] = None if start_time is None else int(start_time.timestamp())
+    end: Optional[int] = None if end_time is None else int(end_time.timestamp())
+    if output == '-':
+        output_handle = sys.stdout.buffer
+    else:
+        try:
+            output_handle = gzip.open(output, 'wb') if output.endswith('.gz') else open(output, 'wb')
+        except OSError as err:
+            print_error("Failed to open '%s' for writing: %s" % (output, err.strerror), file=sys.stderr)
+            exit(14)
+    file_paths, matcher = export_archives(contains)
+    id_set = make_id_set(dedup, error_rate, file_paths)
+    found: bool = False
+    try:
+        for _, file_path, line in merge_archives(file_paths, start, end, max_disorder):
+            if matcher is not None and not matcher.matches(line):
+                continue
+            if id_set is not None and is_duplicate(line, id_set):
+                continue
+            found = True
+            if with_file_name:
+                output_handle.write(os.path.basename(file_path).encode() + b':')
+            output_handle.write(line + b'\n')
+        output_handle.flush()
+    except TimeIndexError as err:
+        print_error(err.error_message, file=sys.stderr)
+        exit(20)
+    except BrokenPipeError:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, output_handle.fileno())
+    except OSError as err:
+        print_error("OSError: %s" % str(err), file=sys.stderr)
+        exit(23)
+    finally:
+        if output_handle is not sys.stdout.buffer:
+            output_handle.close()
+        if id_set is not None:
+            id_set.close()
+    return 0 if found else 1
+
+
+def sort(columns: list[str],
+         output: str,
+         memory_mib: int,
+         temp_dir: Optional[str],
+         jobs: Optional[int],
+         contains: Optional[str] = None,
+         ) -> None:
+    """
+    Sort the stored archives by columns with an external merge sort, reporting the throughput of each phase.
+    :param columns: list[str]: The column names to sort by, most significant first.
+    :param output: str: The file / named pipe to write to, '-' for stdout, gzip compressed if it ends in '.gz'.
+    :param memory_mib: int: The memory cap in MiB.
+    :param temp_dir: Optional[str]: Where to spill sorted runs, None for the system temp directory.
+    :param jobs: Optional[int]: The number of processes, None for the number of cores.
+    :param contains: Optional[str]: Only sort lines containing this whole word, None for all lines.
+    :return: None
+    """
+    if output == '-':
+        output_handle = sys.stdout.buffer
+    else:
+        try:
+            output_handle = gzip.open(output, 'wb') if output.endswith('.gz') else open(output, 'wb')
+        except OSError as err:
+            print_error("Failed to open '%s' for writing: %s" % (output, err.strerror), file=sys.stderr)
+            exit(14)
+    file_paths, matcher = export_archives(contains)
+    try:
+        sort_archives(file_paths,
+                      columns,
+                      output_handle,
+                      memory_mib * 1048576,
+                      temp_dir,
+                      jobs,
+                      report=lambda message: print_coloured(message, fg_colour=Colours.fg.green, file=sys.stderr),
+                      matcher=matcher)
+        output_handle.flush()
+    except SortError as err:
+        print_error("%s %s" % (err.error_message, ' '.join(str(arg) for arg in err.args[1:])), file=sys.stderr)
+        exit(22)
+    except BrokenPipeError:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, output_handle.fileno())
+    finally:
+        if output_handle is not sys.stdout.buffer:
+            output_handle.close()
+    return
+
+
+def stats(group_by: Optional[str],
+          bucket_seconds: int,
+          start_time: Optional[datetime],
+          end_time: Optional[datetime],
+          jobs: Optional[int],
+          ) -> None:
+    """
+    Print line counts per time bucket, and group, over the stored archives, merging the archive rollups when they're
+        enabled and the query is on whole minutes.
+    :param group_by: Optional[str]: The column to group by, None for no grouping.
+    :param bucket_seconds: int: The bucket width in seconds.
+    :param start_time: Optional[datetime]: Only count lines generated at or after this time.
+    :param end_time: Optional[datetime]: Only count lines generated before this time.
+    :param jobs: Optional[int]: The number of processes, None for the number of cores.
+    :return: None
+    """
+    start: Optional[int] = None if start_time is None else int(start_time.timestamp())
+    end: Optional[int] = None if end_time is None else int(end_time.timestamp())
+    try:
+        # Rollups are only kept up to date, or used, when enabled:
+        collect = rollups.collect_stats if common.SETTINGS['rollups'] else archiveStats.collect_stats
+        counts = collect(logFormat.find_archives(common.SETTINGS['output_dir']), group_by, bucket_seconds, start, end,
+                         jobs)
+    except StatsError as err:
+        print_error("%s %s" % (err.error_message, ' '.join(str(arg) for arg in err.args[1:])), file=sys.stderr)
+        exit(21)
+    print("time\t%s\tcount" % (group_by or 'all'))
+    for (bucket, value), count in sorted(counts.items()):
+        bucket_time: str = datetime.fromtimestamp(bucket, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        print("%s\t%s\t%i" % (bucket_time, value or '-', count))
+    return
+
+
+def anomalies(group_by: list[str],
+              window: int,
+              threshold: float,
+              min_count: int,
+              start_time: Optional[datetime],
+              end_time: Optional[datetime],
+              severities: Optional[list[str]],
+              jobs: Optional[int],
+              ) -> None:
+    """
+    Print the windows where per minute line counts spike above their rolling baseline, over the stored archives, as
+        TSV.
+    :param group_by: list[str]: The columns to find anomalies per value of, or 'all' for the total.
+    :param window: int: The minutes in the baseline window.
+    :param threshold: float: The modified z-score at or above which a minute is anomalous.
+    :param min_count: int: Anomalous minutes must have at least this many lines.
+    :param start_time: Optional[datetime]: Only count lines generated at or after this time.
+    :param end_time: Optional[datetime]: Only count lines generated before this time.
+    :param severities: Optional[list[str]]: Only count lines with these severities, None for any severity.
+    :param jobs: Optional[int]: The number of processes, None for the number of cores.
+    :return: None
+    """
+    start: Optional[int] = None if start_time is None else int(start_time.timestamp())
+    end: Optional[int] = None if end_time is None else int(end_time.timestamp())
+    file_paths: list[str] = logFormat.find_archives(common.SETTINGS['output_dir'])
+    found: list = []
+    try:
+        for column in group_by:
+            found.extend(find_anomalies(column, file_paths, window, threshold, min_count, start, end, jobs,
+                                        common.SETTINGS['rollups'], severities))
+    except AnomalyError as err:
+        print_error("%s %s" % (err.error_message, ' '.join(str(arg) for arg in err.args[1:])), file=sys.stderr)
+        exit(29)
+    print("start\tend\tcolumn\tvalue\tcount\texpected\tscore")
+    for found_anomaly in sorted(found, key=lambda item: (item.start, item.group_by, item.value)):
+        print("%s\t%s\t%s\t%s\t%i\t%.1f\t%.2f"
+              % (datetime.fromtimestamp(found_anomaly.start, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                 datetime.fromtimestamp(found_anomaly.end, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                 found_anomaly.group_by, found_anomaly.value or '-', found_anomaly.count, found_anomaly.expected,
+                 found_anomaly.max_score))
+    return
+
+
+def load(database: Optional[str]) -> None:
+    """
+    Load the stored archives into a SQLite database, skipping the ones already loaded, with a full text table if
+        full_text is set.
+    :param database: Optional[str]: The path to the database, None for logs.sqlite3 in the output directory.
+    :return: None
+    """
+    if database is None:
+        database = database_path(common.SETTINGS['output_dir'])
+
+    def report(file_path: str, rows: int, seconds: float) -> None:
+        print_coloured("Loaded %s: %i lines in %.2fs (%.0f lines/s)."
+                       % (os.path.basename(file_path), rows, seconds, rows / max(seconds, 1e-9)),
+                       fg_colour=Colours.fg.green)
+        return
+
+    try:
+        with LogDatabase(database, common.SETTINGS['full_text']) as log_database:
+            archive_count, row_count = log_database.load(logFormat.find_archives(common.SETTINGS['output_dir']),
+                                                         report=report)
+    except LogDatabaseError as err:
+        print_error("%s %s" % (err.error_message, ' '.join(str(arg) for arg in err.args[1:])), file=sys.stderr)
+        exit(24)
+    print_coloured("Loaded %i archives, %i lines, into '%s'." % (archive_count, row_count, database),
+                   fg_colour=Colours.fg.green)
+    return
+
+
+def text_search(text: str,
+                raw: bool,
+                start_time: Optional[datetime],
+                end_time: Optional[datetime],
+                source_names: Optional[list[str]],
+                programs: Optional[list[str]],
+                severities: Optional[list[str]],
+                max_count: Optional[int],
+                database: Optional[str],
+                ) -> int:
+    """
+    Full text search the loaded messages, printing matching lines in time order.
+    :param text: str: The substring, or FTS5 query if raw, to find.
+    :param raw: bool: Treat text as an FTS5 query.
+    :param start_time: Optional[datetime]: Only lines generated at or after this time.
+    :param end_time: Optional[datetime]: Only lines generated before this time.
+    :param source_names: Optional[list[str]]: Only lines from these sources.
+    :param programs: Optional[list[str]]: Only lines from these programs.
+    :param severities: Optional[list[str]]: Only lines with these severities.
+    :param max_count: Optional[int]: Stop after this many lines.
+    :param database: Optional[str]: The path to the database, None for logs.sqlite3 in the output directory.
+    :return: int: The exit status, 0 if anything matched, 1 if nothing matched.
+    """
+    if database is None:
+        database = database_path(common.SETTINGS['output_dir'])
+    start: Optional[int] = None if start_time is None else int(start_time.timestamp())
+    end: Optional[int] = None if end_time is None else int(end_time.timestamp())
+    output_handle = sys.stdout.buffer
+    found: bool = False
+    try:
+        with LogDatabase(database) as log_database:
+            for row in log_database.search(text, raw, start, end, source_names, programs, severities, max_count):
+                found = True
+                output_handle.write(format_row(row) + b'\n')
+        output_handle.flush()
+    except LogDatabaseError as err:
+        print_error("%s %s" % (err.error_message, ' '.join(str(arg) for arg in err.args[1:])), file=sys.stderr)
+        exit(24)
+    except BrokenPipeError:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, output_handle.fileno())
+    return 0 if found else 1
+
+
+def top(columns: list[str],
+        k: int,
+        width: int,
+        depth: int,
+        prefix_words: int,
+        start_time: Optional[datetime],
+        end_time: Optional[datetime],
+        jobs: Optional[int],
+        ) -> None:
+    """
+    Print the most frequent values of columns over the stored archives, with estimated counts, as TSV.
+    :param columns: list[str]: The columns.
+    :param k: int: How many values per column.
+    :param width: int: The sketch counters per row.
+    :param depth: int: The sketch rows.
+    :param prefix_words: int: The words in a message prefix.
+    :param start_time: Optional[datetime]: Only count lines generated at or after this time.
+    :param end_time: Optional[datetime]: Only count lines generated before this time.
+    :param jobs: Optional[int]: The number of processes, None for the number of cores.
+    :return: None
+    """
+    start: Optional[int] = None if start_time is None else int(start_time.timestamp())
+    end: Optional[int] = None if end_time is None else int(end_time.timestamp())
+    try:
+        top_items = collect_heavy_hitters(logFormat.find_archives(common.SETTINGS['output_dir']), tuple(columns), k,
+                                          width, depth, prefix_words, start, end, jobs)
+    except TopKError as err:
+        print_error("%s %s" % (err.error_message, ' '.join(str(arg) for arg in err.args[1:])), file=sys.stderr)
+        exit(25)
+    print("column\tvalue\tcount")
+    for column, items in top_items.items():
+        for item, count in items:
+            print("%s\t%s\t%i" % (column, item.decode('utf-8', 'replace'), count))
+    return
+
+
+def distinct_counts(columns: list[str],
+                    bucket_seconds: int,
+                    start_time: Optional[datetime],
+                    end_time: Optional[datetime],
+                    jobs: Optional[int],
+                    ) -> None:
+    """
+    Print estimated distinct counts of columns per time bucket over the stored archives, as TSV.
+    :param columns: list[str]: The columns.
+    :param bucket_seconds: int: The bucket width in seconds, 0 for one bucket over everything.
+    :param start_time: Optional[datetime]: Only archives with lines generated at or after this time.
+    :param end_time: Optional[datetime]: Only archives with lines generated before this time.
+    :param jobs: Optional[int]: The number of processes, None for the number of cores.
+    :return: None
+    """
+    start: Optional[int] = None if start_time is None else int(start_time.timestamp())
+    end: Optional[int] = None if end_time is None else int(end_time.timestamp())
+    try:
+        counts = collect_distinct(logFormat.find_archives(common.SETTINGS['output_dir']), tuple(columns),
+                                  bucket_seconds, start, end, jobs)
+    except DistinctError as err:
+        print_error("%s %s" % (err.error_message, ' '.join(str(arg) for arg in err.args[1:])), file=sys.stderr)
+        exit(26)
+    print("time\tcolumn\tdistinct")
+    for (bucket, column), count in sorted(counts.items(), key=lambda item: (item[0][0], columns.index(item[0][1]))):
+        bucket_time: str = ('-' if bucket_seconds == 0
+                            else datetime.fromtimestamp(bucket, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+        print("%s\t%s\t%i" % (bucket_time, column, count))
+    return
+
+
+def templates(bucket_seconds: int,
+              start_time: Optional[datetime],
+              end_time: Optional[datetime],
+              min_count: int,
+              jobs: Optional[int],
+              ) -> None:
+    """
+    Mine message templates from the stored archives, mining only archives new since the last run, and print the
+        template counts per time bucket as TSV.
+    :param bucket_seconds: int: The bucket width in seconds, a multiple of 60, 0 for one total per template.
+    :param start_time: Optional[datetime]: Only count messages generated at or after this time.
+    :param end_time: Optional[datetime]: Only count messages generated before this time.
+    :param min_count: int: Only print counts of at least this.
+    :param jobs: Optional[int]: The number of processes, None for the number of cores.
+    :return: None
+    """
+    start: Optional[int] = None if start_time is None else int(start_time.timestamp())
+    end: Optional[int] = None if end_time is None else int(end_time.timestamp())
+    try:
+        miner, archives = update_templates(common.SETTINGS['output_dir'],
+                                           logFormat.find_archives(common.SETTINGS['output_dir']), TemplateMiner(),
+                                           jobs)
+        counts = template_counts(archives, bucket_seconds, start, end)
+    except TemplateMinerError as err:
+        print_error("%s %s" % (err.error_message, ' '.join(str(arg) for arg in err.args[1:])), file=sys.stderr)
+        exit(27)
+    clusters: dict = {cluster.cluster_id: cluster for cluster in miner.clusters}
+    print("time\tid\tcount\ttemplate")
+    # Largest first within each bucket:
+    for (bucket, cluster_id), count in sorted(counts.items(), key=lambda item: (item[0][0], -item[1], item[0][1])):
+        if count < min_count:
+            continue
+        bucket_time: str = ('-' if bucket_seconds == 0
+                            else datetime.fromtimestamp(bucket, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+        print("%s\t%i\t%i\t%s" % (bucket_time, cluster_id, count, clusters[cluster_id].template))
+    return
+
+
+def alerts(rules_path: Optional[str], samples: int, show_samples: bool, jobs: Optional[int]) -> None:
+    """
+    Print the alert rule match counts, or sample lines, of the stored archives as TSV, scanning the archives that
+        haven't been scanned with the current rules.
+    :param rules_path: Optional[str]: The rules file, None for the 'alert_rules' setting.
+    :param samples: int: Keep up to this many sample lines per rule and archive.
+    :param show_samples: bool: Print the sample lines instead of the counts.
+    :param jobs: Optional[int]: The number of processes, None for the number of cores.
+    :return: None
+    """
+    rules_path = rules_path or common.SETTINGS['alert_rules']
+    if not rules_path:
+        print_error("No alert rules file, use --rules, or --alert_rules.", file=sys.stderr)
+        exit(28)
+    try:
+        rules = AlertRules.load(rules_path)
+        archive_alerts = collect_alerts(logFormat.find_archives(common.SETTINGS['output_dir']), rules, samples, jobs)
+    except AlertRulesError as err:
+        print_error("%s %s" % (err.error_message, ' '.join(str(arg) for arg in err.args[1:])), file=sys.stderr)
+        exit(28)
+    print("rule\tarchive\tsample" if show_samples else "rule\tarchive\tcount")
+    for rule_name in rules.names:
+        for file_path, alerts_found in archive_alerts.items():
+            if rule_name not in alerts_found:
+                continue
+            count, sample_lines = alerts_found[rule_name]
+            if show_samples:
+                for line in sample_lines:
+                    print("%s\t%s\t%s" % (rule_name, os.path.basename(file_path), line))
+            else:
+                print("%s\t%s\t%i" % (rule_name, os.path.basename(file_path), count))
+    return
+
+
+def search(pattern: str,
+           fixed: bool,
+           ignore_case: bool,
+           columns: Optional[list[str]],
+           word: bool,
+           max_count: Optional[int],
+           with_file_name: bool,
+           jobs: Optional[int],
+           ) -> int:
+    """
+    Search the archives in the output directory, printing matching lines in time order.
+    :param pattern: str: The regex or fixed string.
+    :param fixed: bool: Treat pattern as a fixed string.
+    :param ignore_case: bool: Match case-insensitively.
+    :param columns: Optional[list[str]]: The columns to match against, None for the whole line.
+    :param word: bool: Only match whole words.
+    :param max_count: Optional[int]: Stop after this many matches.
+    :param with_file_name: bool: Prefix each line with the archive file name.
+    :param jobs: Optional[int]: The number of processes, None for the number of cores.
+    :return: int: The exit status, 0 if anything matched, 1 if nothing matched.
+    """
+    try:
+        matcher = Matcher(pattern, fixed, ignore_case, columns, word)
+    except SearchError as err:
+        print_error(err.error_message, file=sys.stderr)
+        exit(17)
+    # Skip the archives whose bloom sidecars say they can't match:
+    file_paths: list[str] = candidate_archives(logFormat.find_archives(common.SETTINGS['output_dir']),
+                                               matcher.required_tokens(), matcher.columns)
+    output_handle = sys.stdout.buffer
+    found: bool = False
+    try:
+        for file_path, line in search_archives(file_paths, matcher, max_count, jobs):
+            found = True
+            if with_file_name:
+                output_handle.write(os.path.basename(file_path).encode() + b':')
+            output_handle.write(line + b'\n')
+        output_handle.flush()
+    except SearchError as err:
+        print_error("%s %s" % (err.error_message, err.args[1]), file=sys.stderr)
+        exit(18)
+    except BrokenPipeError:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, output_handle.fileno())
+    return 0 if found else 1
+
+
+def correlate(id_regex: str,
+              min_lines: int,
+              min_sources: int,
+              memory_mib: int,
+              temp_dir: Optional[str],
+              start_time: Optional[datetime],
+              end_time: Optional[datetime],
+              ) -> int:
+    """
+    Group the lines of the stored archives by the id in their messages, printing each id's timeline, prefixed with
+        the id, in time order.
+    :param id_regex: str: The id regex, the id is its first group, or the whole match without groups.
+    :param min_lines: int: Only print ids on at least this many lines.
+    :param min_sources: int: Only print ids from at least this many sources.
+    :param memory_mib: int: The memory cap in MiB.
+    :param temp_dir: Optional[str]: Where to spill partitions, None for the system temp directory.
+    :param start_time: Optional[datetime]: Only lines generated at or after this time.
+    :param end_time: Optional[datetime]: Only lines generated before this time.
+    :return: int: The exit status, 0 if any id was printed, 1 if not.
+    """
+    start: Optional[int] = None if start_time is None else int(start_time.timestamp())
+    end: Optional[int] = None if end_time is None else int(end_time.timestamp())
+    output_handle = sys.stdout.buffer
+    found: bool = False
+    try:
+        for key, lines in correlate_archives(logFormat.find_archives(common.SETTINGS['output_dir']), id_regex,
+                                             memory_mib * 1048576, temp_dir, start, end,
+                                             report=lambda message: print_coloured(message, fg_colour=Colours.fg.green,
+                                                                                   file=sys.stderr)):
+            if len(lines) < min_lines:
+                continue
+            if min_sources > 1 and len({logFormat.split_line(line)[logFormat.SOURCE_NAME]
+                                        for line in lines}) < min_sources:
+                continue
+            found = True
+            for line in lines:
+                output_handle.write(key + b'\t' + line + b'\n')
+        output_handle.flush()
+    except CorrelateError as err:
+        print_error("%s %s" % (err.error_message, ' '.join(str(arg) for arg in err.args[1:])), file=sys.stderr)
+        exit(30)
+    except BrokenPipeError:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, output_handle.fileno())
+    return 0 if found else 1
+
+
 def main() -> None:
     log_archives = Archives(api_key=API_KEY)
+    manifest = ArchiveManifest(common.SETTINGS['output_dir'])
+    log_filter: Optional[LogFilter] = LogFilter.from_settings(common.SETTINGS['ingest_filter'])
+    # Recompress in the background while downloading continues:
+    recompress_pool: Optional[Executor] = None
+    recompress_futures: dict[Future, str] = {}
+    if common.SETTINGS['recompress'] is not None:
+        codec: str = choose_codec(common.SETTINGS['recompress'])
+        if codec != common.SETTINGS['recompress']:
+            print_warning("zstandard not installed, recompressing to %s." % codec)
+        recompress_pool = create_pool()
+        if common.SETTINGS['gzip_index_span']:
+            print_warning("Recompressed archives can't be gzip indexed, skipping indexing.")
     for archive in log_archives:
-        file_path = os.path.join(common.SETTINGS['output_dir'], archive.file_name)
+        if log_filter is None:
+            file_path = os.path.join(common.SETTINGS['output_dir'], archive.file_name)
+        else:
+            file_path = os.path.join(common.SETTINGS['output_dir'], filtered_file_name(archive.file_name))
         print_coloured("Archive date/time: ", fg_colour=Colours.fg.green, end='')
         print(archive.formatted_start_time)
         print_coloured("Archive path: ", fg_colour=Colours.fg.green, end='')
         print(file_path, end=' ')
         print_coloured("File Size: ", fg_colour=Colours.fg.green, end='')
         print(str(archive.file_size))
-        if os.path.exists(file_path):
-            if common.SETTINGS['mode'] == common.Modes.UPDATE:
+        if common.SETTINGS['mode'] == common.Modes.UPDATE:
+            # Stored files may be filtered or recompressed, so check what they were made from:
+            filter_settings: Optional[dict] = None if log_filter is None else log_filter.settings
+            if manifest.is_current(archive.file_name, archive.file_size, filter=filter_settings):
+                print_coloured("Stored archive consistent, skipping.", fg_colour=Colours.fg.orange)
+                continue
+            if log_filter is None and os.path.exists(file_path):
                 size_on_disk: int = os.path.getsize(file_path)
                 print_coloured("Existing file size: ", fg_colour=Colours.fg.green, end='')
                 print(str(size_on_disk))
                 if size_on_disk == archive.file_size:
                     print_coloured("File size consistent, skipping.", fg_colour=Colours.fg.orange)
+                    manifest.record(archive.file_name, archive.file_size, file_path)
                     continue
                 print_coloured("File size inconsistent, re-downloading.", fg_colour=Colours.fg.orange)
+            elif os.path.exists(file_path):
+                print_coloured("Stored archive inconsistent, re-downloading.", fg_colour=Colours.fg.orange)
         spinner = Spinner(style_name=STYLE_LINE, fg_colour=Colours.fg.white, bold=True)
         print_coloured(" Downloading: ", fg_colour=Colours.fg.green, end='')
         spinner.print(increment_step=False, end='\r')
-        archive.download(common.SETTINGS['output_dir'],
-                         overwrite=True,
-                         callback=callback,
-                         argument=spinner,
-                         chunk_size=1024)
+        try:
+            if log_filter is None:
+                download_archive(archive,
+                                 common.SETTINGS['output_dir'],
+                                 API_KEY,
+                                 callback=callback,
+                                 argument=spinner,
+                                 chunk_size=1024,
+                                 do_preallocate=common.SETTINGS['preallocate'])
+                manifest.record(archive.file_name, archive.file_size, file_path)
+            else:
+                lines_read, lines_kept, _ = filter_ingest(archive,
+                                                          common.SETTINGS['output_dir'],
+                                                          API_KEY,
+                                                          log_filter,
+                                                          callback=callback,
+                                                          argument=spinner)
+                manifest.record(archive.file_name, archive.file_size, file_path, filter=log_filter.settings,
+                                lines_read=lines_read, lines_kept=lines_kept)
+        except ArchiveDownloadError as err:
+            print()
+            print_error(err.error_message)
+            exit(13)
         spinner.complete = True
         print_coloured(" Downloading: ", fg_colour=Colours.fg.green, end='')
         spinner.print(end='\n')
+        if log_filter is not None:
+            print_coloured("Lines kept: ", fg_colour=Colours.fg.green, end='')
+            print("%i / %i" % (lines_kept, lines_read))
+        if recompress_pool is None:
+            post_download(manifest, archive.file_name, file_path)
+        else:
+            # Run the post download stages once, on the recompressed file:
+            recompress_futures[submit(recompress_pool, file_path, codec)] = archive.file_name
+    if recompress_pool is not None:
+        print_recompressed(manifest, recompress_futures, new_archives=True)
+        recompress_pool.shutdown()
     return
 
 
 if __name__ == '__main__':
-    print_coloured("+++ Log Downloader +++",
-                   fg_colour=Colours.fg.blue,
-                   underline=True)
     # Command line arguments:
     parser = argparse.ArgumentParser(description="Download Papertrail log files.")
     # Config file arguments:
@@ -75,7 +1019,459 @@ if __name__ == '__main__':
     write_args.add_argument("-u", "--update",
                             help="Update the directory, overwrite only if size is not equal to expected size.",
                             action='store_true')
+    parser.add_argument('--no_preallocate',
+                        help="Don't preallocate disk space for archives before downloading.",
+                        action='store_true')
+    # Ingest filter arguments:
+    parser.add_argument('--filter_program',
+                        help="Store only lines from this program, may be given more than once.",
+                        action='append',
+                        type=str)
+    parser.add_argument('--filter_source',
+                        help="Store only lines from this source name, may be given more than once.",
+                        action='append',
+                        type=str)
+    parser.add_argument('--filter_severity',
+                        help="Store only lines with this severity, may be given more than once.",
+                        action='append',
+                        type=str)
+    parser.add_argument('--filter_message',
+                        help="Store only lines with a message matching this regex.",
+                        type=str)
+    parser.add_argument('--no_filter',
+                        help="Clear the ingest filter, and store whole archives.",
+                        action='store_true')
+    # Storage arguments:
+    parser.add_argument('--recompress',
+                        help="Recompress downloaded archives for storage, zstd falls back to xz without zstandard.",
+                        choices=CODECS + ('none',),
+                        type=str)
+    parser.add_argument('--gzip_index',
+                        help="Index downloaded gzip archives with a checkpoint every N MiB for random access, 0 to "
+                             "disable.",
+                        metavar='N',
+                        type=int)
+    parser.add_argument('--inverted_index',
+                        help="Add downloaded archives to the inverted index used by the query sub command.",
+                        choices=('on', 'off'),
+                        type=str)
+    parser.add_argument('--bloom_sidecars',
+                        help="Build a bloom filter sidecar of the tokens in each downloaded archive, used by search "
+                             "and --contains to skip archives.",
+                        choices=('on', 'off'),
+                        type=str)
+    parser.add_argument('--trigram_index',
+                        help="Build a sidecar of the trigrams in each block of each downloaded archive, used by "
+                             "search to only read the blocks that may match a regex.",
+                        choices=('on', 'off'),
+                        type=str)
+    parser.add_argument('--time_index',
+                        help="Build a time range sidecar for each downloaded archive, used by the read sub command. "
+                             "Defaults to on.",
+                        choices=('on', 'off'),
+                        type=str)
+    parser.add_argument('--columnar',
+                        help="Keep a columnar, memory mapped copy of each downloaded archive for fast aggregates.",
+                        choices=('on', 'off'),
+                        type=str)
+    parser.add_argument('--rollups',
+                        help="Store per minute line counts by severity, source, and program for each downloaded "
+                             "archive, used by the stats sub command. Defaults to on.",
+                        choices=('on', 'off'),
+                        type=str)
+    parser.add_argument('--distinct_sketches',
+                        help="Store HyperLogLog sketches of source ids, names, ips, and programs for each downloaded "
+                             "archive, used by the distinct sub command. Defaults to on.",
+                        choices=('on', 'off'),
+                        type=str)
+    parser.add_argument('--database_load',
+                        help="Load each downloaded archive into the SQLite database used by the text_search sub "
+                             "command.",
+                        choices=('on', 'off'),
+                        type=str)
+    parser.add_argument('--full_text',
+                        help="Keep a full text index of the messages loaded into the SQLite database.",
+                        choices=('on', 'off'),
+                        type=str)
+    parser.add_argument('--alert_rules',
+                        help="Scan each downloaded archive once with the rules in this JSON rules file, reporting "
+                             "matches, an empty string to stop.",
+                        metavar='FILE',
+                        type=str)
+    # Sub commands, downloading when none is given:
+    sub_parsers = parser.add_subparsers(dest='command')
+    stream_parser = sub_parsers.add_parser('stream',
+                                           help="Stream archives to stdout or a named pipe without storing them.")
+    stream_parser.add_argument('file_names',
+                               help="Archive file names to stream, defaults to all archives.",
+                               nargs='*')
+    stream_parser.add_argument('--start',
+                               help="Only stream archives ending after this ISO date / time (UTC if no offset).",
+                               type=parse_time)
+    stream_parser.add_argument('--end',
+                               help="Only stream archives starting before this ISO date / time (UTC if no offset).",
+                               type=parse_time)
+    stream_parser.add_argument('-O', '--output',
+                               help="File or named pipe to write to, defaults to '-' (stdout).",
+                               type=str,
+                               default='-')
+    stream_parser.add_argument('-z', '--decompress',
+                               help="Decompress the archives as they arrive.",
+                               action='store_true')
+    read_parser = sub_parsers.add_parser('read',
+                                         help="Print the stored lines generated in a time range.")
+    read_parser.add_argument('--start',
+                             help="Only print lines generated at or after this ISO date / time (UTC if no offset).",
+                             type=parse_time)
+    read_parser.add_argument('--end',
+                             help="Only print lines generated before this ISO date / time (UTC if no offset).",
+                             type=parse_time)
+    read_parser.add_argument('--dedup',
+                             help="Drop lines whose Papertrail id was already seen, exactly (spilling ids to disk) "
+                                  "or with a bloom filter.",
+                             choices=('exact', 'bloom'))
+    read_parser.add_argument('--dedup_error_rate',
+                             help="The chance bloom dedup drops a new line, defaults to %g." % DEFAULT_ERROR_RATE,
+                             type=float,
+                             default=DEFAULT_ERROR_RATE)
+    read_parser.add_argument('-H', '--with_file_name',
+                             help="Prefix each line with the archive file name.",
+                             action='store_true')
+    read_parser.add_argument('--contains',
+                             help="Only print lines containing this whole word, eg: a request id or host name. "
+                                  "Archives whose bloom sidecars don't have it are skipped.",
+                             type=str)
+    merge_parser = sub_parsers.add_parser('merge',
+                                          help="Merge the stored archives into one stream in generated_at order.")
+    merge_parser.add_argument('--start',
+                              help="Only merge lines generated at or after this ISO date / time (UTC if no offset).",
+                              type=parse_time)
+    merge_parser.add_argument('--end',
+                              help="Only merge lines generated before this ISO date / time (UTC if no offset).",
+                              type=parse_time)
+    merge_parser.add_argument('-O', '--output',
+                              help="File or named pipe to write to, gzip compressed if it ends in '.gz', defaults to "
+                                   "'-' (stdout).",
+                              type=str,
+                              default='-')
+    merge_parser.add_argument('--max_disorder',
+                              help="How far out of order, in seconds, lines can be in an archive, defaults to %i."
+                                   % DEFAULT_MAX_DISORDER,
+                              type=int,
+                              default=DEFAULT_MAX_DISORDER)
+    merge_parser.add_argument('--dedup',
+                              help="Drop lines whose Papertrail id was already seen, exactly (spilling ids to disk) "
+                                   "or with a bloom filter.",
+                              choices=('exact', 'bloom'))
+    merge_parser.add_argument('--dedup_error_rate',
+                              help="The chance bloom dedup drops a new line, defaults to %g." % DEFAULT_ERROR_RATE,
+                              type=float,
+                              default=DEFAULT_ERROR_RATE)
+    merge_parser.add_argument('-H', '--with_file_name',
+                              help="Prefix each line with the archive file name.",
+                              action='store_true')
+    merge_parser.add_argument('--contains',
+                              help="Only merge lines containing this whole word, eg: a request id or host name. "
+                                   "Archives whose bloom sidecars don't have it are skipped.",
+                              type=str)
+    sort_parser = sub_parsers.add_parser('sort',
+                                         help="Sort the stored archives by any columns, spilling to disk.")
+    sort_parser.add_argument('--key',
+                             help="Comma separated columns to sort by, defaults to generated_at. Columns are: %s."
+                                  % ', '.join(logFormat.COLUMNS),
+                             type=lambda value: value.split(','),
+                             default=['generated_at'])
+    sort_parser.add_argument('-O', '--output',
+                             help="File or named pipe to write to, gzip compressed if it ends in '.gz', defaults to "
+                                  "'-' (stdout).",
+                             type=str,
+                             default='-')
+    sort_parser.add_argument('--memory',
+                             help="Memory cap in MiB for holding lines, shared by all processes, defaults to %i."
+                                  % (DEFAULT_MEMORY_CAP // 1048576),
+                             type=int,
+                             default=DEFAULT_MEMORY_CAP // 1048576)
+    sort_parser.add_argument('--temp_dir',
+                             help="Where to spill sorted runs, defaults to the system temp directory.",
+                             type=str)
+    sort_parser.add_argument('-j', '--jobs',
+                             help="Number of processes to use, defaults to the number of cores.",
+                             type=int)
+    sort_parser.add_argument('--contains',
+                             help="Only sort lines containing this whole word, eg: a request id or host name. "
+                                  "Archives whose bloom sidecars don't have it are skipped.",
+                             type=str)
+    recompress_parser = sub_parsers.add_parser('recompress',
+                                               help="Recompress gzip archives already in the output directory.")
+    recompress_parser.add_argument('codec',
+                                   help="The codec to recompress to.",
+                                   choices=CODECS)
+    search_parser = sub_parsers.add_parser('search',
+                                           help="Search the archives in the destination in parallel.")
+    search_parser.add_argument('pattern',
+                               help="The regex, or fixed string with -F, to search for.",
+                               type=str)
+    search_parser.add_argument('-F', '--fixed',
+                               help="Treat the pattern as a fixed string.",
+                               action='store_true')
+    search_parser.add_argument('-i', '--ignore_case',
+                               help="Match case-insensitively.",
+                               action='store_true')
+    search_parser.add_argument('-w', '--word',
+                               help="Only match whole words, which lets bloom sidecars skip archives.",
+                               action='store_true')
+    search_parser.add_argument('--columns',
+                               help="Comma separated columns to match against, defaults to the whole line. Columns "
+                                    "are: %s." % ', '.join(logFormat.COLUMNS),
+                               type=lambda value: value.split(','))
+    search_parser.add_argument('-m', '--max_count',
+                               help="Stop after this many matching lines.",
+                               type=int)
+    search_parser.add_argument('-H', '--with_file_name',
+                               help="Prefix each line with the archive file name.",
+                               action='store_true')
+    search_parser.add_argument('-j', '--jobs',
+                               help="Number of processes to use, defaults to the number of cores.",
+                               type=int)
+    stats_parser = sub_parsers.add_parser('stats',
+                                          help="Count the stored lines per time bucket, and group, as TSV.")
+    stats_parser.add_argument('--by',
+                              help="The column to group by, defaults to no grouping.",
+                              choices=GROUP_COLUMNS)
+    stats_parser.add_argument('--bucket',
+                              help="The time bucket width in seconds, defaults to %i." % DEFAULT_BUCKET_SECONDS,
+                              type=int,
+                              default=DEFAULT_BUCKET_SECONDS)
+    stats_parser.add_argument('--start',
+                              help="Only count lines generated at or after this ISO date / time (UTC if no offset).",
+                              type=parse_time)
+    stats_parser.add_argument('--end',
+                              help="Only count lines generated before this ISO date / time (UTC if no offset).",
+                              type=parse_time)
+    stats_parser.add_argument('-j', '--jobs',
+                              help="Number of processes to use, defaults to the number of cores.",
+                              type=int)
+    load_parser = sub_parsers.add_parser('load',
+                                         help="Load the stored archives into a SQLite database for SQL queries, "
+                                              "skipping the ones already loaded.")
+    load_parser.add_argument('--database',
+                             help="The database file, defaults to %s in the destination." % DATABASE_FILE_NAME,
+                             type=str)
+    text_search_parser = sub_parsers.add_parser('text_search',
+                                                help="Full text search the messages loaded into the SQLite "
+                                                     "database, needs --full_text on when loading.")
+    text_search_parser.add_argument('text',
+                                    help="The substring to find, at least 3 characters, case-insensitive.",
+                                    type=str)
+    text_search_parser.add_argument('--raw',
+                                    help="Treat the text as an FTS5 query, ie: 'timeout AND \"req-00\"'.",
+                                    action='store_true')
+    text_search_parser.add_argument('--start',
+                                    help="Only print lines generated at or after this ISO date / time (UTC if no "
+                                         "offset).",
+                                    type=parse_time)
+    text_search_parser.add_argument('--end',
+                                    help="Only print lines generated before this ISO date / time (UTC if no offset).",
+                                    type=parse_time)
+    text_search_parser.add_argument('--source',
+                                    help="Only print lines from this source name, may be given more than once.",
+                                    action='append',
+                                    type=str)
+    text_search_parser.add_argument('--program',
+                                    help="Only print lines from this program, may be given more than once.",
+                                    action='append',
+                                    type=str)
+    text_search_parser.add_argument('--severity',
+                                    help="Only print lines with this severity, may be given more than once.",
+                                    action='append',
+                                    type=str)
+    text_search_parser.add_argument('-m', '--max_count',
+                                    help="Stop after this many matching lines.",
+                                    type=int)
+    text_search_parser.add_argument('--database',
+                                    help="The database file, defaults to %s in the destination." % DATABASE_FILE_NAME,
+                                    type=str)
+    top_parser = sub_parsers.add_parser('top',
+                                        help="Estimate the most frequent values of columns in one pass with "
+                                             "Count-Min Sketches, as TSV.")
+    top_parser.add_argument('--by',
+                            help="Comma separated columns, defaults to program,source_name,prefix. Columns are: %s."
+                                 % ', '.join(TOP_COLUMNS),
+                            type=lambda value: value.split(','),
+                            default=['program', 'source_name', 'prefix'])
+    top_parser.add_argument('-k',
+                            help="How many values per column, defaults to %i." % DEFAULT_K,
+                            type=int,
+                            default=DEFAULT_K)
+    top_parser.add_argument('--width',
+                            help="Sketch counters per row, counts are high by at most 2.72 / width of the lines, "
+                                 "defaults to %i." % DEFAULT_WIDTH,
+                            type=int,
+                            default=DEFAULT_WIDTH)
+    top_parser.add_argument('--depth',
+                            help="Sketch rows, defaults to %i." % DEFAULT_DEPTH,
+                            type=int,
+                            default=DEFAULT_DEPTH)
+    top_parser.add_argument('--prefix_words',
+                            help="The words of the message in a prefix, defaults to %i." % DEFAULT_PREFIX_WORDS,
+                            type=int,
+                            default=DEFAULT_PREFIX_WORDS)
+    top_parser.add_argument('--start',
+                            help="Only count lines generated at or after this ISO date / time (UTC if no offset).",
+                            type=parse_time)
+    top_parser.add_argument('--end',
+                            help="Only count lines generated before this ISO date / time (UTC if no offset).",
+                            type=parse_time)
+    top_parser.add_argument('-j', '--jobs',
+                            help="Number of processes to use, defaults to the number of cores.",
+                            type=int)
+    distinct_parser = sub_parsers.add_parser('distinct',
+                                             help="Estimate distinct counts of columns per time bucket from the "
+                                                  "archive HyperLogLog sidecars, as TSV.")
+    distinct_parser.add_argument('--by',
+                                 help="Comma separated columns, defaults to all of: %s." % ', '.join(DISTINCT_COLUMNS),
+                                 type=lambda value: value.split(','),
+                                 default=list(DISTINCT_COLUMNS))
+    distinct_parser.add_argument('--bucket',
+                                 help="The time bucket width in seconds, 0 for one total, defaults to %i. Archives "
+                                      "count toward the bucket they start in." % distinct.DEFAULT_BUCKET_SECONDS,
+                                 type=int,
+                                 default=distinct.DEFAULT_BUCKET_SECONDS)
+    distinct_parser.add_argument('--start',
+                                 help="Only archives with lines generated at or after this ISO date / time (UTC if no "
+                                      "offset).",
+                                 type=parse_time)
+    distinct_parser.add_argument('--end',
+                                 help="Only archives with lines generated before this ISO date / time (UTC if no "
+                                      "offset).",
+                                 type=parse_time)
+    distinct_parser.add_argument('-j', '--jobs',
+                                 help="Number of processes to rebuild stale sketches with, defaults to the number of "
+                                      "cores.",
+                                 type=int)
+    templates_parser = sub_parsers.add_parser('templates',
+                                              help="Mine message templates from the stored archives, caching them "
+                                                   "between runs, and print template counts per time bucket as TSV.")
+    templates_parser.add_argument('--bucket',
+                                  help="The time bucket width in seconds, a multiple of 60, 0 for one total per "
+                                       "template, defaults to 3600.",
+                                  type=int,
+                                  default=3600)
+    templates_parser.add_argument('--start',
+                                  help="Only count messages generated at or after this ISO date / time (UTC if no "
+                                       "offset).",
+                                  type=parse_time)
+    templates_parser.add_argument('--end',
+                                  help="Only count messages generated before this ISO date / time (UTC if no offset).",
+                                  type=parse_time)
+    templates_parser.add_argument('--min_count',
+                                  help="Only print counts of at least this, defaults to 1.",
+                                  type=int,
+                                  default=1)
+    templates_parser.add_argument('-j', '--jobs',
+                                  help="Number of processes to mine new archives with, defaults to the number of "
+                                       "cores.",
+                                  type=int)
+    alerts_parser = sub_parsers.add_parser('alerts',
+                                           help="Print alert rule match counts per archive as TSV, scanning archives "
+                                                "not yet scanned with the current rules.")
+    alerts_parser.add_argument('--rules',
+                               help="The JSON rules file, defaults to the --alert_rules file.",
+                               type=str)
+    alerts_parser.add_argument('-s', '--samples',
+                               help="Print up to N sample lines per rule and archive instead of the counts.",
+                               metavar='N',
+                               type=int)
+    alerts_parser.add_argument('-j', '--jobs',
+                               help="Number of processes to scan archives with, defaults to the number of cores.",
+                               type=int)
+    anomalies_parser = sub_parsers.add_parser('anomalies',
+                                              help="Find spikes in per minute line counts against a rolling median "
+                                                   "baseline, as TSV.")
+    anomalies_parser.add_argument('--by',
+                                  help="Comma separated columns to find spikes per value of, from: %s, or %s for the "
+                                       "total, defaults to severity_name,source_name."
+                                       % (', '.join(ANOMALY_GROUPS), TOTAL_GROUP),
+                                  type=lambda value: value.split(','),
+                                  default=['severity_name', 'source_name'])
+    anomalies_parser.add_argument('--window',
+                                  help="The minutes in the rolling baseline window, defaults to %i."
+                                       % anomaly.DEFAULT_WINDOW,
+                                  type=int,
+                                  default=anomaly.DEFAULT_WINDOW)
+    anomalies_parser.add_argument('--threshold',
+                                  help="The modified z-score at or above which a minute is anomalous, defaults to "
+                                       "%.1f." % anomaly.DEFAULT_THRESHOLD,
+                                  type=float,
+                                  default=anomaly.DEFAULT_THRESHOLD)
+    anomalies_parser.add_argument('--min_count',
+                                  help="Anomalous minutes must have at least this many lines, defaults to %i."
+                                       % anomaly.DEFAULT_MIN_COUNT,
+                                  type=int,
+                                  default=anomaly.DEFAULT_MIN_COUNT)
+    anomalies_parser.add_argument('--start',
+                                  help="Only count lines generated at or after this ISO date / time (UTC if no "
+                                       "offset).",
+                                  type=parse_time)
+    anomalies_parser.add_argument('--end',
+                                  help="Only count lines generated before this ISO date / time (UTC if no offset).",
+                                  type=parse_time)
+    anomalies_parser.add_argument('--severity',
+                                  help="Only count lines with this severity, before grouping, ie: --by source_name "
+                                       "--severity error for error spikes per source, may be given more than once.",
+                                  action='append',
+                                  type=str)
+    anomalies_parser.add_argument('-j', '--jobs',
+                                  help="Number of processes to count archives with, defaults to the number of cores.",
+                                  type=int)
+    correlate_parser = sub_parsers.add_parser('correlate',
+                                              help="Group the stored lines by a request id in their messages, "
+                                                   "printing each id's timeline, spilling to disk.")
+    correlate_parser.add_argument('--id_regex',
+                                  help="The id regex, the id is its first group, or the whole match without groups, "
+                                       "defaults to '%s'." % DEFAULT_ID_REGEX.replace('%', '%%'),
+                                  type=str,
+                                  default=DEFAULT_ID_REGEX)
+    correlate_parser.add_argument('--min_lines',
+                                  help="Only print ids on at least this many lines, defaults to 1.",
+                                  type=int,
+                                  default=1)
+    correlate_parser.add_argument('--min_sources',
+                                  help="Only print ids from at least this many sources, defaults to 1.",
+                                  type=int,
+                                  default=1)
+    correlate_parser.add_argument('--memory',
+                                  help="Memory cap in MiB for holding lines, defaults to %i."
+                                       % (correlation.DEFAULT_MEMORY_CAP // 1048576),
+                                  type=int,
+                                  default=correlation.DEFAULT_MEMORY_CAP // 1048576)
+    correlate_parser.add_argument('--temp_dir',
+                                  help="Where to spill partitions, defaults to the system temp directory.",
+                                  type=str)
+    correlate_parser.add_argument('--start',
+                                  help="Only lines generated at or after this ISO date / time (UTC if no offset).",
+                                  type=parse_time)
+    correlate_parser.add_argument('--end',
+                                  help="Only lines generated before this ISO date / time (UTC if no offset).",
+                                  type=parse_time)
+    sub_parsers.add_parser('index',
+                           help="Run the enabled post download stages (indexes, sidecars) on stored archives.")
+    query_parser = sub_parsers.add_parser('query',
+                                          help="Query the inverted index.")
+    query_parser.add_argument('query',
+                              help='Words and "quoted phrases" that must all appear, case-insensitive.',
+                              type=str)
+    query_parser.add_argument('-m', '--max_count',
+                              help="Stop after this many matching lines.",
+                              type=int)
     args = parser.parse_args()
+    # Keep stdout clean when streaming to it:
+    print_coloured("+++ Log Downloader +++",
+                   fg_colour=Colours.fg.blue,
+                   underline=True,
+                   file=sys.stderr if args.command in ('stream', 'read', 'merge', 'sort', 'search', 'query', 'stats',
+                                                       'text_search', 'top', 'distinct', 'templates', 'alerts',
+                                                       'anomalies', 'correlate') else sys.stdout)
     # Parse args.config, and create Config file:
     try:
         config_file = ConfigFile("PapertrailLogDownloader", args.config, do_load=True)
@@ -96,6 +1492,71 @@ if __name__ == '__main__':
         common.SETTINGS['mode'] = common.Modes.OVERWRITE
     elif args.update:
         common.SETTINGS['mode'] = common.Modes.UPDATE
+    # Parse preallocation:
+    if args.no_preallocate:
+        common.SETTINGS['preallocate'] = False
+    # Parse ingest filter:
+    if args.no_filter:
+        common.SETTINGS['ingest_filter'] = None
+    elif args.filter_program or args.filter_source or args.filter_severity or args.filter_message:
+        try:
+            common.SETTINGS['ingest_filter'] = LogFilter(args.filter_program,
+                                                         args.filter_source,
+                                                         args.filter_severity,
+                                                         args.filter_message).settings
+        except re.error as err:
+            error: str = "Invalid message filter regex: %s" % err.msg
+            print_error(error)
+            exit(15)
+    # Parse recompression:
+    if args.recompress == 'none':
+        common.SETTINGS['recompress'] = None
+    elif args.recompress is not None:
+        common.SETTINGS['recompress'] = args.recompress
+    # Parse gzip indexing:
+    if args.gzip_index is not None:
+        if args.gzip_index < 0:
+            error: str = "--gzip_index must not be negative."
+            print_error(error)
+            exit(16)
+        common.SETTINGS['gzip_index_span'] = args.gzip_index or None
+    # Parse inverted index:
+    if args.inverted_index is not None:
+        common.SETTINGS['inverted_index'] = args.inverted_index == 'on'
+    # Parse time index:
+    if args.time_index is not None:
+        common.SETTINGS['time_index'] = args.time_index == 'on'
+    # Parse columnar copies:
+    if args.columnar is not None:
+        common.SETTINGS['columnar'] = args.columnar == 'on'
+    # Parse rollups:
+    if args.rollups is not None:
+        common.SETTINGS['rollups'] = args.rollups == 'on'
+    # Parse distinct sketches:
+    if args.distinct_sketches is not None:
+        common.SETTINGS['distinct_sketches'] = args.distinct_sketches == 'on'
+    # Parse database loading:
+    if args.database_load is not None:
+        common.SETTINGS['database_load'] = args.database_load == 'on'
+    if args.full_text is not None:
+        common.SETTINGS['full_text'] = args.full_text == 'on'
+    # Parse trigram indexes:
+    if args.trigram_index is not None:
+        common.SETTINGS['trigram_index'] = args.trigram_index == 'on'
+    # Parse alert rules:
+    if args.alert_rules is not None:
+        if args.alert_rules:
+            try:
+                AlertRules.load(args.alert_rules)
+            except AlertRulesError as err:
+                print_error("%s %s" % (err.error_message, ' '.join(str(arg) for arg in err.args[1:])))
+                exit(28)
+            common.SETTINGS['alert_rules'] = os.path.abspath(args.alert_rules)
+        else:
+            common.SETTINGS['alert_rules'] = None
+    # Parse bloom sidecars:
+    if args.bloom_sidecars is not None:
+        common.SETTINGS['bloom_sidecars'] = args.bloom_sidecars == 'on'
     # Parse writing config now that all options are set:
     if args.write_config:
         try:
@@ -107,6 +1568,58 @@ if __name__ == '__main__':
             print_error(error)
             exit(12)
         exit(0)
+    # Run the sub command:
+    if args.command == 'stream':
+        stream(args.file_names, args.start, args.end, args.output, args.decompress)
+        exit(0)
+    elif args.command == 'read':
+        exit(read(args.start, args.end, args.with_file_name, args.dedup, args.dedup_error_rate, args.contains))
+    elif args.command == 'merge':
+        exit(merge(args.start, args.end, args.output, args.max_disorder, args.with_file_name, args.dedup,
+                   args.dedup_error_rate, args.contains))
+    elif args.command == 'sort':
+        sort(args.key, args.output, args.memory, args.temp_dir, args.jobs, args.contains)
+        exit(0)
+    elif args.command == 'stats':
+        stats(args.by, args.bucket, args.start, args.end, args.jobs)
+        exit(0)
+    elif args.command == 'top':
+        top(args.by, args.k, args.width, args.depth, args.prefix_words, args.start, args.end, args.jobs)
+        exit(0)
+    elif args.command == 'distinct':
+        distinct_counts(args.by, args.bucket, args.start, args.end, args.jobs)
+        exit(0)
+    elif args.command == 'correlate':
+        exit(correlate(args.id_regex, args.min_lines, args.min_sources, args.memory, args.temp_dir, args.start,
+                       args.end))
+    elif args.command == 'anomalies':
+        anomalies(args.by, args.window, args.threshold, args.min_count, args.start, args.end, args.severity,
+                  args.jobs)
+        exit(0)
+    elif args.command == 'alerts':
+        alerts(args.rules, DEFAULT_SAMPLES if args.samples is None else args.samples, args.samples is not None,
+               args.jobs)
+        exit(0)
+    elif args.command == 'templates':
+        templates(args.bucket, args.start, args.end, args.min_count, args.jobs)
+        exit(0)
+    elif args.command == 'search':
+        exit(search(args.pattern, args.fixed, args.ignore_case, args.columns, args.word, args.max_count,
+                    args.with_file_name, args.jobs))
+    elif args.command == 'query':
+        exit(query(args.query, args.max_count))
+    elif args.command == 'text_search':
+        exit(text_search(args.text, args.raw, args.start, args.end, args.source, args.program, args.severity,
+                         args.max_count, args.database))
+    elif args.command == 'load':
+        load(args.database)
+        exit(0)
+    elif args.command == 'index':
+        run_post_download()
+        exit(0)
+    elif args.command == 'recompress':
+        recompress_stored(args.codec)
+        exit(0)
     # Download some logs:
     main()
     exit(0)
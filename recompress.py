@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+    File: recompress.py: Recompress downloaded archives into a denser codec for storage.
+        Classes:
+            RecompressError(Exception): Errors generated while recompressing.
+        Methods:
+            choose_codec: Pick the codec to use, falling back to xz without zstandard.
+            recompressed_path: The path an archive is recompressed to.
+            recompress_archive: Recompress one archive, verifying the output before removing the original.
+            create_pool: Create a process pool bounded by the core count.
+            submit: Queue an archive for recompression in the background.
+
+        Notes:
+            zstd requires the optional zstandard module, xz uses the standard library.
+"""
+from typing import Optional, Final
+from concurrent.futures import ProcessPoolExecutor, Executor, Future
+import hashlib
+import lzma
+import os
+import time
+import zlib
+import logFormat
+
+HAS_ZSTD: bool = False
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ModuleNotFoundError:
+    pass
+
+CODEC_XZ: Final[str] = 'xz'
+CODEC_ZSTD: Final[str] = 'zstd'
+CODECS: Final[tuple[str, ...]] = (CODEC_XZ, CODEC_ZSTD)
+_SUFFIXES: Final[dict[str, str]] = {CODEC_XZ: '.xz', CODEC_ZSTD: '.zst'}
+_READ_SIZE: Final[int] = 1048576
+
+
+class RecompressError(Exception):
+    """Class to store recompress errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'ValueError: codec must be one of: xz, zstd.',
+        2: 'OSError while reading the original archive.',
+        3: 'OSError while writing the recompressed archive.',
+        4: 'Verification failed, recompressed data does not match the original.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        # error_number is passed on so the error pickles back from the process pool:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+def choose_codec(requested: str) -> str:
+    """
+    Pick the codec to use.
+    :param requested: str: The requested codec, one of CODECS.
+    :return: str: The requested codec, or xz if zstd was requested and zstandard isn't installed.
+    :raises RecompressError: If requested isn't a known codec.
+    """
+    if requested not in CODECS:
+        raise RecompressError(1)
+    if requested == CODEC_ZSTD and not HAS_ZSTD:
+        return CODEC_XZ
+    return requested
+
+
+def recompressed_path(file_path: str, codec: str) -> str:
+    """
+    The path an archive is recompressed to, ie: '2023-05-12-00.tsv.gz' -> '2023-05-12-00.tsv.xz'.
+    :param file_path: str: The path to the gzip archive.
+    :param codec: str: The codec, one of CODECS.
+    :return: str
+    """
+    if file_path.endswith('.gz'):
+        file_path = file_path[:-len('.gz')]
+    return file_path + _SUFFIXES[codec]
+
+
+def _open_output(file_path: str, codec: str):
+    """
+    Open a compressed output file for writing.
+    :param file_path: str: The path to write.
+    :param codec: str: The codec, one of CODECS.
+    :return: A binary file object.
+    """
+    if codec == CODEC_ZSTD:
+        return zstandard.open(file_path, 'wb', cctx=zstandard.ZstdCompressor(level=19, threads=1))
+    return lzma.open(file_path, 'wb', preset=6)
+
+
+def _verify(file_path: str, hex_digest: str) -> bool:
+    """
+    Verify the decompressed contents of an archive against a hash.
+    :param file_path: str: The path to the archive.
+    :param hex_digest: str: The expected sha256 hex digest.
+    :return: bool: True if the archive reads back and matches.
+    """
+    digest = hashlib.sha256()
+    try:
+        with logFormat.open_archive(file_path) as file_handle:
+            while data := file_handle.read(_READ_SIZE):
+                digest.update(data)
+    except Exception:
+        # Any failure to read it back is a failed verification:
+        return False
+    return digest.hexdigest() == hex_digest
+
+
+def recompress_archive(file_path: str, codec: str) -> dict:
+    """
+    Recompress a gzip archive, keeping the original until the recompressed output has been read back and verified.
+    :param file_path: str: The path to the gzip archive.
+    :param codec: str: The codec, one of CODECS.
+    :return: dict: {'source': str, 'path': str, 'codec': str, 'original_size': int, 'compressed_size': int,
+                    'ratio': float, 'seconds': float}
+    :raises RecompressError: On read, write, or verification errors.
+    """
+    start_time: float = time.monotonic()
+    output_path: str = recompressed_path(file_path, codec)
+    # Keep the codec suffix on the temporary file, so it can be read back by open_archive():
+    temp_path: str = output_path[:-len(_SUFFIXES[codec])] + '.part' + _SUFFIXES[codec]
+    digest = hashlib.sha256()
+    # Recompress, hashing the data as it goes through:
+    try:
+        input_handle = logFormat.open_archive(file_path)
+    except OSError as err:
+        raise RecompressError(2, *err.args)
+    try:
+        with input_handle, _open_output(temp_path, codec) as output_handle:
+            while True:
+                try:
+                    data: bytes = input_handle.read(_READ_SIZE)
+                except (OSError, EOFError, zlib.error) + logFormat.DECOMPRESSION_ERRORS as err:
+                    raise RecompressError(2, *err.args)
+                if not data:
+                    break
+                digest.update(data)
+                output_handle.write(data)
+    except OSError as err:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise RecompressError(3, *err.args)
+    except RecompressError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    # Verify before dropping the original:
+    if not _verify(temp_path, digest.hexdigest()):
+        os.remove(temp_path)
+        raise RecompressError(4, file_path)
+    os.replace(temp_path, output_path)
+    original_size: int = os.path.getsize(file_path)
+    compressed_size: int = os.path.getsize(output_path)
+    os.remove(file_path)
+    return {
+        'source': file_path,
+        'path': output_path,
+        'codec': codec,
+        'original_size': original_size,
+        'compressed_size': compressed_size,
+        'ratio': original_size / compressed_size if compressed_size else 0.0,
+        'seconds': time.monotonic() - start_time,
+    }
+
+
+def create_pool(max_workers: Optional[int] = None) -> Executor:
+    """
+    Create a process pool for recompression, bounded by the core count.
+    :param max_workers: Optional[int]: The number of processes. Defaults to None, the number of cores.
+    :return: Executor
+    """
+    cpu_count: int = os.cpu_count() or 1
+    if max_workers is None or max_workers > cpu_count:
+        max_workers = cpu_count
+    return ProcessPoolExecutor(max_workers=max_workers)
+
+
+def submit(pool: Executor, file_path: str, codec: str) -> Future:
+    """
+    Queue an archive for recompression in the background.
+    :param pool: Executor: The pool, from create_pool().
+    :param file_path: str: The path to the gzip archive.
+    :param codec: str: The codec, one of CODECS.
+    :return: Future: Resolves to the result of recompress_archive().
+    """
+    return pool.submit(recompress_archive, file_path, codec)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+    File: rollups.py: Per archive rollups of line counts per minute, merged to answer stats queries.
+        Classes:
+            Rollup(object): The per minute line counts of an archive, by severity, source, and program.
+            RollupBuilder(object): Count the lines of an archive for its rollup as they're fed in.
+        Methods:
+            rollup_path: The path of the rollup sidecar for an archive.
+            build_rollup: Count an archive and save its rollup.
+            can_answer: Check if a stats query can be answered from rollups.
+            collect_stats: Answer a stats query from rollups, rebuilding only stale ones.
+
+        Notes:
+            A rollup is current while the archive has the size it was built from. If the size matches but the
+            modification time doesn't, the archive's sha256 is checked against the one in the rollup, and the rollup
+            is trusted again if it still matches. Queries with buckets, and start and end times, on whole minutes
+            are answered by re-bucketing the rollups; anything finer falls back to stats.collect_stats(). Queries for
+            some severities are answered from the severity counts when in total, or by severity, other groupings fall
+            back too.
+"""
+from typing import Optional, Final, Iterable
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import os
+import logFormat
+from stats import StatsError
+import stats
+
+ROLLUP_SUFFIX: Final[str] = '.rollup'
+ROLLUP_VERSION: Final[int] = 1
+ROLLUP_SECONDS: Final[int] = 60
+ROLLUP_GROUPS: Final[tuple[Optional[str], ...]] = (None, 'severity_name', 'source_name', 'program')
+_SEVERITY_GROUP: Final[str] = 'severity_name'
+_ALL_KEY: Final[str] = 'all'
+_READ_SIZE: Final[int] = 1048576
+
+
+def rollup_path(file_path: str) -> str:
+    """
+    The path of the rollup sidecar for an archive.
+    :param file_path: str: The path to the archive.
+    :return: str
+    """
+    return logFormat.sidecar_path(file_path, ROLLUP_SUFFIX)
+
+
+def _file_checksum(file_path: str) -> str:
+    """
+    The sha256 of a file.
+    :param file_path: str: The path to the file.
+    :return: str: The hex digest.
+    :raises OSError: On read errors.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file_handle:
+        while data := file_handle.read(_READ_SIZE):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class Rollup(object):
+    """
+    The per minute line counts of an archive, by severity, source, and program, and in total.
+    """
+
+    def __init__(self, file_path: str, checksum: str, counts: dict[Optional[str], Counter]) -> None:
+        """
+        Initialize the rollup.
+        :param file_path: str: The path to the archive.
+        :param checksum: str: The sha256 of the archive.
+        :param counts: dict[Optional[str], Counter]: The counts for each of ROLLUP_GROUPS, keyed by (minute start
+                       time, group value).
+        """
+        self._file_path: str = file_path
+        self._checksum: str = checksum
+        self._counts: dict[Optional[str], Counter] = counts
+        return
+
+    @classmethod
+    def load(cls, file_path: str):
+        """
+        Load the rollup of an archive.
+        :param file_path: str: The path to the archive.
+        :return: Optional[Rollup]: The rollup, or None if there isn't a current rollup for the archive.
+        """
+        try:
+            with open(rollup_path(file_path), 'r') as file_handle:
+                rollup_dict: dict = json.load(file_handle)
+            if rollup_dict.get('version') != ROLLUP_VERSION:
+                return None
+            file_stat: os.stat_result = os.stat(file_path)
+            if rollup_dict['file_size'] != file_stat.st_size:
+                return None
+            checksum: str = rollup_dict['checksum']
+            if rollup_dict['mtime'] != file_stat.st_mtime_ns and _file_checksum(file_path) != checksum:
+                return None
+        except (OSError, json.JSONDecodeError, KeyError):
+            return None
+        counts: dict[Optional[str], Counter] = {}
+        for group_by in ROLLUP_GROUPS:
+            counts[group_by] = Counter({(bucket, value): count
+                                        for bucket, value, count in rollup_dict['counts'][group_by or _ALL_KEY]})
+        rollup = cls(file_path, checksum, counts)
+        if rollup_dict['mtime'] != file_stat.st_mtime_ns:
+            # Touched but unchanged, save the new time so the checksum isn't needed next time:
+            try:
+                rollup.save()
+            except StatsError:
+                pass
+        return rollup
+
+    def save(self) -> None:
+        """
+        Save the rollup sidecar.
+        :return: None
+        :raises StatsError: On write errors.
+        """
+        try:
+            file_stat: os.stat_result = os.stat(self._file_path)
+            rollup_dict: dict = {
+                'version': ROLLUP_VERSION,
+                'file_size': file_stat.st_size,
+                'mtime': file_stat.st_mtime_ns,
+                'checksum': self._checksum,
+                'counts': {group_by or _ALL_KEY: [[bucket, value, count]
+                                                  for (bucket, value), count in sorted(counts.items())]
+                           for group_by, counts in self._counts.items()},
+            }
+            temp_path: str = rollup_path(self._file_path) + '.tmp'
+            with open(temp_path, 'w') as file_handle:
+                json.dump(rollup_dict, file_handle, separators=(',', ':'))
+            os.replace(temp_path, rollup_path(self._file_path))
+        except OSError as err:
+            raise StatsError(4, "%s: %s" % (self._file_path, str(err)))
+        return
+
+    @property
+    def checksum(self) -> str:
+        """
+        The sha256 of the archive the rollup was built from.
+        :return: str
+        """
+        return self._checksum
+
+    def counts(self,
+               group_by: Optional[str] = None,
+               bucket_seconds: int = ROLLUP_SECONDS,
+               start: Optional[int] = None,
+               end: Optional[int] = None,
+               severities: Optional[list[str]] = None,
+               ) -> Counter:
+        """
+        Re-bucket the counts for a query, see can_answer().
+        :param group_by: Optional[str]: The column to group by, one of ROLLUP_GROUPS. Defaults to None, no grouping.
+        :param bucket_seconds: int: The bucket width, a multiple of ROLLUP_SECONDS. Defaults to ROLLUP_SECONDS.
+        :param start: Optional[int]: Only count lines generated at or after this time. Defaults to None.
+        :param end: Optional[int]: Only count lines generated before this time. Defaults to None.
+        :param severities: Optional[list[str]]: Only count lines with these severities, case-insensitive, when not
+                           grouping or grouping by severity_name. Defaults to None, any severity.
+        :return: Counter: The counts, keyed by (bucket start time, group value).
+        """
+        counts: Counter = Counter()
+        if severities:
+            wanted: frozenset[str] = frozenset(severity.lower() for severity in severities)
+            for (bucket, value), count in self._counts[_SEVERITY_GROUP].items():
+                if value.lower() in wanted and (start is None or bucket >= start) and (end is None or bucket < end):
+                    counts[(bucket - bucket % bucket_seconds, '' if group_by is None else value)] += count
+            return counts
+        for (bucket, value), count in self._counts[group_by].items():
+            if (start is None or bucket >= start) and (end is None or bucket < end):
+                counts[(bucket - bucket % bucket_seconds, value)] += count
+        return counts
+
+
+def _save_rollup(file_path: str, counts: dict[Optional[str], Counter]) -> Rollup:
+    """
+    Save the rollup of an archive from its counts.
+    :param file_path: str: The path to the archive.
+    :param counts: dict[Optional[str], Counter]: The counts for each of ROLLUP_GROUPS.
+    :return: Rollup
+    :raises StatsError: On read and write errors.
+    """
+    try:
+        checksum: str = _file_checksum(file_path)
+    except OSError as err:
+        raise StatsError(3, "%s: %s" % (file_path, str(err)))
+    rollup = Rollup(file_path, checksum, counts)
+    rollup.save()
+    return rollup
+
+
+class RollupBuilder(object):
+    """
+    Count the lines of an archive for its rollup as they're fed in, so the counting can share a pass over the archive
+        with other sidecars.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        """
+        Initialize the builder.
+        :param file_path: str: The path to the archive.
+        """
+        self._file_path: str = file_path
+        self._counter = stats.GroupCounter(ROLLUP_GROUPS, ROLLUP_SECONDS)
+        return
+
+    def add_lines(self, lines: Iterable[bytes]) -> None:
+        """
+        Count the next lines of the archive.
+        :param lines: Iterable[bytes]: The lines, without line endings.
+        :return: None
+        """
+        self._counter.add_lines(lines)
+        return
+
+    def finish(self) -> Rollup:
+        """
+        Save the rollup, after the last lines are added.
+        :return: Rollup
+        :raises StatsError: On read and write errors.
+        """
+        return _save_rollup(self._file_path, self._counter.finish())
+
+
+def build_rollup(file_path: str) -> Rollup:
+    """
+    Count an archive and save its rollup.
+    :param file_path: str: The path to the archive.
+    :return: Rollup
+    :raises StatsError: On read and write errors.
+    """
+    return _save_rollup(file_path, stats.archive_group_stats(file_path, ROLLUP_GROUPS, ROLLUP_SECONDS))
+
+
+def can_answer(group_by: Optional[str],
+               bucket_seconds: int,
+               start: Optional[int],
+               end: Optional[int],
+               severities: Optional[list[str]] = None,
+               ) -> bool:
+    """
+    Check if a stats query can be answered from rollups.
+    :param group_by: Optional[str]: The column to group by, None for no grouping.
+    :param bucket_seconds: int: The bucket width.
+    :param start: Optional[int]: The start time, None for no start.
+    :param end: Optional[int]: The end time, None for no end.
+    :param severities: Optional[list[str]]: The severities to count, None for any severity. Defaults to None.
+    :return: bool: True if the group is rolled up, the bucket and times are on whole minutes, and a severity filter is
+             only used in total, or by severity.
+    """
+    return (group_by in ROLLUP_GROUPS and bucket_seconds > 0 and bucket_seconds % ROLLUP_SECONDS == 0
+            and (start is None or start % ROLLUP_SECONDS == 0) and (end is None or end % ROLLUP_SECONDS == 0)
+            and (not severities or group_by in (None, _SEVERITY_GROUP)))
+
+
+def _refresh_counts(file_path: str,
+                    group_by: Optional[str],
+                    bucket_seconds: int,
+                    start: Optional[int],
+                    end: Optional[int],
+                    severities: Optional[list[str]],
+                    ) -> Counter:
+    """
+    Rebuild the rollup of an archive, and answer a query from it.
+    :param file_path: str: The path to the archive.
+    :param group_by: Optional[str]: The column to group by, None for no grouping.
+    :param bucket_seconds: int: The bucket width.
+    :param start: Optional[int]: Only count lines generated at or after this time.
+    :param end: Optional[int]: Only count lines generated before this time.
+    :param severities: Optional[list[str]]: Only count lines with these severities, None for any severity.
+    :return: Counter: The counts, keyed by (bucket start time, group value).
+    """
+    return build_rollup(file_path).counts(group_by, bucket_seconds, start, end, severities)
+
+
+def collect_stats(file_paths: list[str],
+                  group_by: Optional[str] = None,
+                  bucket_seconds: int = ROLLUP_SECONDS,
+                  start: Optional[int] = None,
+                  end: Optional[int] = None,
+                  max_workers: Optional[int] = None,
+                  severities: Optional[list[str]] = None,
+                  ) -> Counter:
+    """
+    Answer a stats query by merging the archive rollups, rebuilding only the missing and stale ones in a process pool.
+        Queries rollups can't answer are passed to stats.collect_stats().
+    :param file_paths: list[str]: The archive paths.
+    :param group_by: Optional[str]: The column to group by, one of stats.GROUP_COLUMNS. Defaults to None, no grouping.
+    :param bucket_seconds: int: The bucket width. Defaults to ROLLUP_SECONDS.
+    :param start: Optional[int]: Only count lines generated at or after this time. Defaults to None.
+    :param end: Optional[int]: Only count lines generated before this time. Defaults to None.
+    :param max_workers: Optional[int]: The number of processes. Defaults to None, the number of cores.
+    :param severities: Optional[list[str]]: Only count lines with these severities, case-insensitive. Defaults to
+                       None, any severity.
+    :return: Counter: The counts, keyed by (bucket start time, group value), the value is '' when not grouping.
+    :raises StatsError: On bad arguments, and read and write errors.
+    """
+    if not can_answer(group_by, bucket_seconds, start, end, severities):
+        return stats.collect_stats(file_paths, group_by, bucket_seconds, start, end, max_workers, severities)
+    counts: Counter = Counter()
+    stale_paths: list[str] = []
+    for file_path in file_paths:
+        rollup: Optional[Rollup] = Rollup.load(file_path)
+        if rollup is None:
+            stale_paths.append(file_path)
+        else:
+            counts.update(rollup.counts(group_by, bucket_seconds, start, end, severities))
+    if len(stale_paths) == 0:
+        return counts
+    cpu_count: int = os.cpu_count() or 1
+    if max_workers is None or max_workers > cpu_count:
+        max_workers = cpu_count
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(stale_paths))) as pool:
+        futures = [pool.submit(_refresh_counts, file_path, group_by, bucket_seconds, start, end, severities)
+                   for file_path in stale_paths]
+        for future in as_completed(futures):
+            counts.update(future.result())
+    return counts
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+    File: search.py: Parallel search across downloaded archives.
+        Classes:
+            SearchError(Exception): Errors generated while searching.
+            Matcher(object): Match a regex or fixed string against selected columns of a line.
+        Methods:
+            required_literals: The literal strings every match of a regex must contain.
+            search_archives: Search archives in a process pool, yielding matching lines in time order.
+"""
+from typing import Optional, Final, Iterator
+import functools
+import multiprocessing
+import os
+import queue
+import re
+import zlib
+try:
+    from re import _parser as _regex_parser
+except ImportError:
+    import sre_parse as _regex_parser
+import logFormat
+from timeIndex import TimeIndexError
+from trigramIndex import iter_candidate_lines
+
+_BATCH_SIZE: Final[int] = 256
+# Most batches of later archives held back, waiting for the ones before them, and most batches in the result queue:
+_MAX_PENDING_BATCHES: Final[int] = 64
+_MAX_QUEUED_BATCHES: Final[int] = 16
+# How often blocked workers, and the error callback, check if the search has stopped:
+_WAIT_SECONDS: Final[float] = 0.1
+_DONE: Final[str] = 'done'
+_LINES: Final[str] = 'lines'
+_ERROR: Final[str] = 'error'
+
+# Zero width assertions that put a literal next to them on a token boundary:
+_BOUNDARY_CODES: Final[tuple] = (_regex_parser.AT_BOUNDARY, _regex_parser.AT_BEGINNING,
+                                 _regex_parser.AT_BEGINNING_STRING, _regex_parser.AT_END, _regex_parser.AT_END_STRING)
+_REPEAT_OPS: Final[tuple] = (_regex_parser.MAX_REPEAT, _regex_parser.MIN_REPEAT)
+
+# Set in each worker by _init_worker():
+_result_queue: Optional[multiprocessing.Queue] = None
+_stop_event = None
+_credits = None
+_next_archive = None
+
+
+class SearchError(Exception):
+    """Class to store search errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'ValueError: unknown column name.',
+        2: 'ValueError: invalid regex.',
+        3: 'Error while reading an archive.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+class Matcher(object):
+    """
+    Match a regex or fixed string against selected columns of a line.
+    """
+
+    def __init__(self,
+                 pattern: str,
+                 fixed: bool = False,
+                 ignore_case: bool = False,
+                 columns: Optional[list[str]] = None,
+                 word: bool = False,
+                 ) -> None:
+        """
+        Initialize the matcher.
+        :param pattern: str: The regex or fixed string.
+        :param fixed: bool: Treat pattern as a fixed string. Defaults to False.
+        :param ignore_case: bool: Match case-insensitively. Defaults to False.
+        :param columns: Optional[list[str]]: The columns to match against, any may match. Defaults to None, the whole
+                        line.
+        :param word: bool: Only match whole words. Defaults to False.
+        :raises SearchError: On unknown column names, or an invalid regex.
+        """
+        self._pattern: str = pattern
+        self._fixed: bool = fixed
+        self._ignore_case: bool = ignore_case
+        self._columns: Optional[tuple[int, ...]] = None
+        if columns:
+            try:
+                self._columns = tuple(logFormat.COLUMNS.index(column) for column in columns)
+            except ValueError:
+                raise SearchError(1, columns)
+        self._needle: bytes = pattern.encode()
+        self._regex: Optional[re.Pattern] = None
+        if fixed and not word:
+            if ignore_case:
+                self._needle = self._needle.lower()
+        else:
+            regex: bytes = re.escape(self._needle) if fixed else self._needle
+            if word:
+                regex = rb'\b(?:' + regex + rb')\b'
+            try:
+                self._regex = re.compile(regex, re.IGNORECASE if ignore_case else 0)
+            except re.error as err:
+                raise SearchError(2, err.msg)
+        return
+
+    @property
+    def pattern(self) -> str:
+        """
+        The regex or fixed string.
+        :return: str
+        """
+        return self._pattern
+
+    @property
+    def fixed(self) -> bool:
+        """
+        True if the pattern is a fixed string.
+        :return: bool
+        """
+        return self._fixed
+
+    @property
+    def ignore_case(self) -> bool:
+        """
+        True if matching case-insensitively.
+        :return: bool
+        """
+        return self._ignore_case
+
+    @property
+    def columns(self) -> Optional[tuple[int, ...]]:
+        """
+        The column indexes matched against, None for the whole line.
+        :return: Optional[tuple[int, ...]]
+        """
+        return self._columns
+
+    def required_substrings(self) -> list[bytes]:
+        """
+        The lower case substrings every matching line must contain.
+        :return: list[bytes]
+        """
+        if self._regex is None:
+            return [self._needle.lower()]
+        return [literal for literal, _, _ in required_literals(self._regex.pattern)]
+
+    def required_tokens(self) -> list[bytes]:
+        """
+        The logFormat.tokenize() tokens every matching line must contain. A literal may start or end part way through a
+        token of the line, so its first and last tokens only count when it's known to be on a word boundary there.
+        :return: list[bytes]
+        """
+        if self._regex is None:
+            literals: list[tuple[bytes, bool, bool]] = [(self._needle.lower(), False, False)]
+        else:
+            literals = required_literals(self._regex.pattern)
+        tokens: list[bytes] = []
+        for literal, bounded_before, bounded_after in literals:
+            for match in logFormat.TOKEN_REGEX.finditer(literal):
+                if ((match.start() > 0 or bounded_before) and (match.end() < len(literal) or bounded_after)
+                        and match.group() not in tokens):
+                    tokens.append(match.group())
+        return tokens
+
+    def _match_value(self, value: bytes) -> bool:
+        """
+        Match a single value.
+        :param value: bytes: The line or column value.
+        :return: bool
+        """
+        if self._regex is not None:
+            return self._regex.search(value) is not None
+        if self._ignore_case:
+            return self._needle in value.lower()
+        return self._needle in value
+
+    def matches(self, line: bytes) -> bool:
+        """
+        Check if a line matches.
+        :param line: bytes: The line, without the line ending.
+        :return: bool
+        """
+        if self._columns is None:
+            return self._match_value(line)
+        fields: list[bytes] = logFormat.split_line(line)
+        for column in self._columns:
+            if column < len(fields) and self._match_value(fields[column]):
+                return True
+        return False
+
+
+def _collect_literals(items, literals: list[tuple[bytes, bool, bool]], state: dict) -> None:
+    """
+    Walk a parsed regex, collecting the runs of literal bytes every match must contain.
+    :param items: The parsed regex items.
+    :param literals: list[tuple[bytes, bool, bool]]: Where to put the finished literals.
+    :param state: dict: The literal being built, 'current', and if it starts at a word boundary, 'bounded'.
+    :return: None
+    """
+    def end_literal(bounded_after: bool) -> None:
+        if state['current']:
+            literals.append((bytes(state['current']), state['bounded'], bounded_after))
+            state['current'].clear()
+        state['bounded'] = bounded_after
+        return
+
+    for op, value in items:
+        if op == _regex_parser.LITERAL:
+            state['current'].append(value)
+        elif op == _regex_parser.SUBPATTERN:
+            # Groups don't change what's matched, so walk them in line:
+            _collect_literals(value[-1], literals, state)
+        elif op == _regex_parser.AT:
+            if value in _BOUNDARY_CODES:
+                end_literal(True)
+        elif op in _REPEAT_OPS and value[0] >= 1:
+            # Whatever is repeated must be there at least once, but not necessarily next to what's around it:
+            end_literal(False)
+            _collect_literals(value[2], literals, state)
+            end_literal(False)
+        else:
+            end_literal(False)
+    return
+
+
+def required_literals(pattern: bytes) -> list[tuple[bytes, bool, bool]]:
+    """
+    The literal strings every match of a regex must contain, in lower case. Alternations, classes and optional parts
+    are skipped, so the result may be empty.
+    :param pattern: bytes: The regex.
+    :return: list[tuple[bytes, bool, bool]]: The literal, and if it's known to start and end at a word boundary.
+    :raises re.error: If pattern isn't a valid regex.
+    """
+    literals: list[tuple[bytes, bool, bool]] = []
+    state: dict = {'current': bytearray(), 'bounded': False}
+    _collect_literals(_regex_parser.parse(pattern), literals, state)
+    if state['current']:
+        literals.append((bytes(state['current']), state['bounded'], False))
+    return [(literal.lower(), bounded_before, bounded_after) for literal, bounded_before, bounded_after in literals]
+
+
+def _init_worker(result_queue: multiprocessing.Queue, stop_event, credits, next_archive) -> None:
+    """
+    Store the shared queue, stop event, and flow control in a worker process.
+    :param result_queue: multiprocessing.Queue: Where to send results.
+    :param stop_event: multiprocessing.Event: Set when the search should stop early.
+    :param credits: multiprocessing.Semaphore: One per batch a later archive may have held back.
+    :param next_archive: multiprocessing.Value: The archive being sent on, which doesn't need credits.
+    :return: None
+    """
+    global _result_queue, _stop_event, _credits, _next_archive
+    _result_queue = result_queue
+    _stop_event = stop_event
+    _credits = credits
+    _next_archive = next_archive
+    return
+
+
+def _put(result_queue: multiprocessing.Queue, stop_event, message: tuple) -> bool:
+    """
+    Put a message on the bounded result queue, giving up if the search stops.
+    :param result_queue: multiprocessing.Queue: The result queue.
+    :param stop_event: multiprocessing.Event: Set when the search should stop early.
+    :param message: tuple: The archive number, kind, and payload.
+    :return: bool: True if the message was put.
+    """
+    while not stop_event.is_set():
+        try:
+            result_queue.put(message, timeout=_WAIT_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _send_batch(archive_number: int, batch: list[bytes]) -> bool:
+    """
+    Send a batch of matching lines. Archives after the one being sent on wait for a credit first, so at most
+        _MAX_PENDING_BATCHES batches are held back in the parent.
+    :param archive_number: int: The position of the archive in time order.
+    :param batch: list[bytes]: The matching lines.
+    :return: bool: True if the batch was sent, False if the search stopped.
+    """
+    credited: bool = False
+    while archive_number != _next_archive.value:
+        if _stop_event.is_set():
+            return False
+        if _credits.acquire(timeout=_WAIT_SECONDS):
+            credited = True
+            break
+    return _put(_result_queue, _stop_event, (archive_number, _LINES, (batch, credited)))
+
+
+def _search_archive(archive_number: int, file_path: str, matcher: Matcher, max_count: Optional[int]) -> None:
+    """
+    Search one archive, sending batches of matching lines back as they're found. Only the blocks its trigram index
+        shows may match are read. Done is always sent, even after an error.
+    :param archive_number: int: The position of the archive in time order.
+    :param file_path: str: The path to the archive.
+    :param matcher: Matcher: What to match.
+    :param max_count: Optional[int]: Stop after this many matches.
+    :return: None
+    """
+    batch: list[bytes] = []
+    count: int = 0
+    try:
+        for line in iter_candidate_lines(file_path, matcher.required_substrings()):
+            if matcher.matches(line):
+                batch.append(line)
+                count += 1
+                if max_count is not None and count >= max_count:
+                    break
+                if len(batch) >= _BATCH_SIZE:
+                    if not _send_batch(archive_number, batch):
+                        return
+                    batch = []
+                    if _stop_event.is_set():
+                        return
+        if batch:
+            _send_batch(archive_number, batch)
+    except (OSError, EOFError, zlib.error, ModuleNotFoundError) as err:
+        _put(_result_queue, _stop_event, (archive_number, _ERROR, "%s: %s" % (file_path, str(err))))
+    except TimeIndexError as err:
+        _put(_result_queue, _stop_event, (archive_number, _ERROR, "%s: %s" % (file_path, err.error_message)))
+    except Exception as err:
+        _put(_result_queue, _stop_event,
+             (archive_number, _ERROR, "%s: %s: %s" % (file_path, type(err).__name__, str(err))))
+    finally:
+        _put(_result_queue, _stop_event, (archive_number, _DONE, None))
+    return
+
+
+def _task_failed(result_queue: multiprocessing.Queue,
+                 stop_event,
+                 archive_number: int,
+                 file_path: str,
+                 err: BaseException,
+                 ) -> None:
+    """
+    The pool error callback, for a task that failed outside _search_archive()'s own handling, so the parent doesn't
+        wait for it forever.
+    :param result_queue: multiprocessing.Queue: The result queue.
+    :param stop_event: multiprocessing.Event: Set when the search should stop early.
+    :param archive_number: int: The position of the archive in time order.
+    :param file_path: str: The path to the archive.
+    :param err: BaseException: What the task raised.
+    :return: None
+    """
+    _put(result_queue, stop_event, (archive_number, _ERROR, "%s: %s: %s" % (file_path, type(err).__name__, str(err))))
+    return
+
+
+def search_archives(file_paths: list[str],
+                    matcher: Matcher,
+                    max_count: Optional[int] = None,
+                    max_workers: Optional[int] = None,
+                    ) -> Iterator[tuple[str, bytes]]:
+    """
+    Search archives in a process pool, yielding matches as they arrive, in time order.
+    :param file_paths: list[str]: The archive paths, in time order.
+    :param matcher: Matcher: What to match.
+    :param max_count: Optional[int]: Stop after this many matches in total. Defaults to None, no limit.
+    :param max_workers: Optional[int]: The number of processes. Defaults to None, the number of cores.
+    :return: Iterator[tuple[str, bytes]]: The archive path, and the matching line.
+    :raises SearchError: If an archive can't be read.
+    """
+    if len(file_paths) == 0:
+        return
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    result_queue: multiprocessing.Queue = multiprocessing.Queue(_MAX_QUEUED_BATCHES)
+    stop_event = multiprocessing.Event()
+    credits = multiprocessing.Semaphore(_MAX_PENDING_BATCHES)
+    shared_next_archive = multiprocessing.Value('q', 0, lock=False)
+    pool = multiprocessing.Pool(min(max_workers, len(file_paths)), _init_worker,
+                                (result_queue, stop_event, credits, shared_next_archive))
+    try:
+        for archive_number, file_path in enumerate(file_paths):
+            pool.apply_async(_search_archive, (archive_number, file_path, matcher, max_count),
+                             error_callback=functools.partial(_task_failed, result_queue, stop_event, archive_number,
+                                                              file_path))
+        # Later archives are held back until the ones before them are done, to keep time order:
+        pending: dict[int, list[tuple[list[bytes], bool]]] = {}
+        done: set[int] = set()
+        next_archive: int = 0
+        count: int = 0
+        while next_archive < len(file_paths):
+            archive_number, kind, payload = result_queue.get()
+            if kind == _ERROR:
+                raise SearchError(3, payload)
+            elif kind == _DONE:
+                done.add(archive_number)
+            else:
+                pending.setdefault(archive_number, []).append(payload)
+            # Emit everything that's now in order:
+            while next_archive < len(file_paths):
+                for batch, credited in pending.pop(next_archive, []):
+                    if credited:
+                        credits.release()
+                    for line in batch:
+                        yield file_paths[next_archive], line
+                        count += 1
+                        if max_count is not None and count >= max_count:
+                            return
+                if next_archive not in done:
+                    break
+                next_archive += 1
+                shared_next_archive.value = next_archive
+    finally:
+        stop_event.set()
+        pool.terminate()
+        pool.join()
+    return
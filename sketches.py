@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""
+    File: sketches.py: Probabilistic summaries of log data.
+        Classes:
+            BloomFilter(object): Set membership with a bounded false positive rate.
+            CountMinSketch(object): Item frequencies with a bounded over count, in fixed memory.
+            HeavyHitters(object): The most frequent items of a stream, from a Count-Min Sketch and a heap.
+            HyperLogLog(object): The approximate number of distinct items, in fixed memory.
+
+        Notes:
+            Hashes come from hashlib.blake2b rather than hash(), so sketches built in different processes, or on
+            different runs, agree and can be stored and merged.
+
+            HeavyHitters keeps a Count-Min Sketch of every item, and the current estimates of only the capacity
+            largest in a dict, with a min heap to find the smallest. Heap entries are left in place when an estimate
+            grows and skipped when they're popped out of date. Memory depends on the sketch size and capacity, not on
+            how many distinct items there are.
+
+            HyperLogLog keeps 2 ** precision one byte registers, the standard error of a count is about
+            1.04 / sqrt(2 ** precision), 0.8% at the default precision of 14 (16 KiB). Merging takes the maximum of
+            each register, so the merge of two sketches is the sketch of the union of their items.
+"""
+from typing import Final
+from array import array
+import hashlib
+import heapq
+import math
+import struct
+
+_BLOOM_HEADER: Final[struct.Struct] = struct.Struct('<8sQQQ')
+_BLOOM_MAGIC: Final[bytes] = b'PTBLOOM1'
+_HLL_HEADER: Final[struct.Struct] = struct.Struct('<8sQ')
+_HLL_MAGIC: Final[bytes] = b'PTHLL001'
+
+
+def hash_pair(item: bytes) -> tuple[int, int]:
+    """
+    Hash an item to two independent 64 bit values, for double hashing.
+    :param item: bytes: The item.
+    :return: tuple[int, int]
+    """
+    digest: bytes = hashlib.blake2b(item, digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+
+
+class BloomFilter(object):
+    """
+    Set membership with a bounded false positive rate, and no false negatives.
+    """
+
+    def __init__(self, bit_count: int, hash_count: int) -> None:
+        """
+        Initialize an empty filter.
+        :param bit_count: int: The number of bits.
+        :param hash_count: int: The number of hash functions.
+        :raises ValueError: If bit_count or hash_count is less than one.
+        """
+        if bit_count < 1 or hash_count < 1:
+            raise ValueError("bit_count and hash_count must be greater than zero.")
+        self._bit_count: int = bit_count
+        self._hash_count: int = hash_count
+        self._bits: bytearray = bytearray((bit_count + 7) // 8)
+        self._count: int = 0
+        return
+
+    @classmethod
+    def for_capacity(cls, capacity: int, error_rate: float = 0.01):
+        """
+        Create a filter sized to hold capacity items at the given false positive rate.
+        :param capacity: int: The expected number of items.
+        :param error_rate: float: The false positive rate, between 0 and 1. Defaults to 0.01.
+        :return: BloomFilter
+        :raises ValueError: If error_rate isn't between 0 and 1.
+        """
+        if not 0.0 < error_rate < 1.0:
+            raise ValueError("error_rate must be between 0 and 1.")
+        capacity = max(capacity, 1)
+        bit_count: int = max(int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))), 8)
+        hash_count: int = max(int(round(bit_count / capacity * math.log(2))), 1)
+        return cls(bit_count, hash_count)
+
+    @property
+    def count(self) -> int:
+        """
+        The number of items added.
+        :return: int
+        """
+        return self._count
+
+    @property
+    def size(self) -> int:
+        """
+        The size of the bit array in bytes.
+        :return: int
+        """
+        return len(self._bits)
+
+    def _positions(self, item: bytes) -> list[int]:
+        """
+        The bit positions of an item.
+        :param item: bytes: The item.
+        :return: list[int]
+        """
+        first, second = hash_pair(item)
+        return [(first + number * second) % self._bit_count for number in range(self._hash_count)]
+
+    def add(self, item: bytes) -> None:
+        """
+        Add an item.
+        :param item: bytes: The item.
+        :return: None
+        """
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self._count += 1
+        return
+
+    def __contains__(self, item: bytes) -> bool:
+        """
+        Check if an item may have been added.
+        :param item: bytes: The item.
+        :return: bool: False if the item was definitely not added, True if it probably was.
+        """
+        for position in self._positions(item):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the filter.
+        :return: bytes
+        """
+        return _BLOOM_HEADER.pack(_BLOOM_MAGIC, self._bit_count, self._hash_count, self._count) + bytes(self._bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """
+        Deserialize a filter made by to_bytes().
+        :param data: bytes: The serialized filter.
+        :return: BloomFilter
+        :raises ValueError: If data isn't a serialized filter.
+        """
+        if len(data) < _BLOOM_HEADER.size:
+            raise ValueError("Not a serialized bloom filter.")
+        magic, bit_count, hash_count, count = _BLOOM_HEADER.unpack_from(data)
+        if magic != _BLOOM_MAGIC or len(data) - _BLOOM_HEADER.size != (bit_count + 7) // 8:
+            raise ValueError("Not a serialized bloom filter.")
+        bloom_filter = cls(bit_count, hash_count)
+        bloom_filter._bits[:] = data[_BLOOM_HEADER.size:]
+        bloom_filter._count = count
+        return bloom_filter
+
+
+class CountMinSketch(object):
+    """
+    Item frequencies with a bounded over count, in fixed memory. An estimate is never less than the true count, and
+        is more than it by at most e / width * total, with probability 1 - e ** -depth.
+    """
+
+    def __init__(self, width: int, depth: int) -> None:
+        """
+        Initialize an empty sketch.
+        :param width: int: The counters per row.
+        :param depth: int: The number of rows, one hash function each.
+        :raises ValueError: If width or depth is less than one.
+        """
+        if width < 1 or depth < 1:
+            raise ValueError("width and depth must be greater than zero.")
+        self._width: int = width
+        self._depth: int = depth
+        self._rows: list[array] = [array('Q', bytes(8 * width)) for _ in range(depth)]
+        self._total: int = 0
+        return
+
+    @classmethod
+    def for_error(cls, epsilon: float, delta: float):
+        """
+        Create a sketch that over counts by at most epsilon * total, with probability 1 - delta.
+        :param epsilon: float: The error as a fraction of the total, between 0 and 1.
+        :param delta: float: The chance of a larger error, between 0 and 1.
+        :return: CountMinSketch
+        :raises ValueError: If epsilon or delta isn't between 0 and 1.
+        """
+        if not 0.0 < epsilon < 1.0 or not 0.0 < delta < 1.0:
+            raise ValueError("epsilon and delta must be between 0 and 1.")
+        return cls(int(math.ceil(math.e / epsilon)), int(math.ceil(math.log(1 / delta))))
+
+    @property
+    def width(self) -> int:
+        """
+        The counters per row.
+        :return: int
+        """
+        return self._width
+
+    @property
+    def depth(self) -> int:
+        """
+        The number of rows.
+        :return: int
+        """
+        return self._depth
+
+    @property
+    def total(self) -> int:
+        """
+        The sum of the counts added.
+        :return: int
+        """
+        return self._total
+
+    def _positions(self, item: bytes) -> list[int]:
+        """
+        The counter of an item in each row.
+        :param item: bytes: The item.
+        :return: list[int]
+        """
+        first, second = hash_pair(item)
+        return [(first + number * second) % self._width for number in range(self._depth)]
+
+    def add(self, item: bytes, count: int = 1) -> int:
+        """
+        Add to the count of an item, with a conservative update: counters are only raised as far as the new
+            estimate, which over counts much less than adding to every row and still never under counts.
+        :param item: bytes: The item.
+        :param count: int: How much to add. Defaults to 1.
+        :return: int: The estimated count of the item, after adding.
+        """
+        positions: list[int] = self._positions(item)
+        estimate: int = min(row[position] for row, position in zip(self._rows, positions)) + count
+        for row, position in zip(self._rows, positions):
+            if row[position] < estimate:
+                row[position] = estimate
+        self._total += count
+        return estimate
+
+    def estimate(self, item: bytes) -> int:
+        """
+        The estimated count of an item.
+        :param item: bytes: The item.
+        :return: int: At least the true count.
+        """
+        return min(row[position] for row, position in zip(self._rows, self._positions(item)))
+
+    def merge(self, other) -> None:
+        """
+        Add the counts of another sketch of the same size, as if its items were added to this one.
+        :param other: CountMinSketch: The sketch to merge.
+        :return: None
+        :raises ValueError: If the sketches are different sizes.
+        """
+        if other.width != self._width or other.depth != self._depth:
+            raise ValueError("Only sketches of the same width and depth can be merged.")
+        for row, other_row in zip(self._rows, other._rows):
+            for position in range(self._width):
+                row[position] += other_row[position]
+        self._total += other.total
+        return
+
+
+class HeavyHitters(object):
+    """
+    The most frequent items of a stream, from a Count-Min Sketch and a heap of the largest estimates.
+    """
+
+    def __init__(self, capacity: int, width: int, depth: int) -> None:
+        """
+        Initialize an empty tracker.
+        :param capacity: int: The number of candidate items to keep.
+        :param width: int: The sketch counters per row.
+        :param depth: int: The sketch rows.
+        :raises ValueError: If capacity, width, or depth is less than one.
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be greater than zero.")
+        self._capacity: int = capacity
+        self._sketch: CountMinSketch = CountMinSketch(width, depth)
+        self._candidates: dict[bytes, int] = {}
+        self._heap: list[tuple[int, bytes]] = []
+        return
+
+    @property
+    def sketch(self) -> CountMinSketch:
+        """
+        The sketch of every item.
+        :return: CountMinSketch
+        """
+        return self._sketch
+
+    def _offer(self, item: bytes, estimate: int) -> None:
+        """
+        Make an item a candidate if it's among the largest estimates.
+        :param item: bytes: The item.
+        :param estimate: int: Its estimated count.
+        :return: None
+        """
+        if item in self._candidates:
+            self._candidates[item] = estimate
+            heapq.heappush(self._heap, (estimate, item))
+        elif len(self._candidates) < self._capacity:
+            self._candidates[item] = estimate
+            heapq.heappush(self._heap, (estimate, item))
+        else:
+            # Drop out of date heap entries to find the smallest candidate:
+            while self._heap[0][0] != self._candidates.get(self._heap[0][1]):
+                heapq.heappop(self._heap)
+            if estimate > self._heap[0][0]:
+                del self._candidates[heapq.heappop(self._heap)[1]]
+                self._candidates[item] = estimate
+                heapq.heappush(self._heap, (estimate, item))
+        # Out of date entries can pile up for items that keep growing, rebuild before the heap gets large:
+        if len(self._heap) > 4 * self._capacity:
+            self._heap = [(estimate, item) for item, estimate in self._candidates.items()]
+            heapq.heapify(self._heap)
+        return
+
+    def add(self, item: bytes, count: int = 1) -> None:
+        """
+        Add to the count of an item.
+        :param item: bytes: The item.
+        :param count: int: How much to add. Defaults to 1.
+        :return: None
+        """
+        self._offer(item, self._sketch.add(item, count))
+        return
+
+    def merge(self, other) -> None:
+        """
+        Merge another tracker of the same sketch size, re-estimating the candidates of both from the merged sketch.
+        :param other: HeavyHitters: The tracker to merge.
+        :return: None
+        :raises ValueError: If the sketches are different sizes.
+        """
+        self._sketch.merge(other.sketch)
+        items: set[bytes] = set(self._candidates) | set(other._candidates)
+        self._candidates = {}
+        self._heap = []
+        for item in items:
+            self._offer(item, self._sketch.estimate(item))
+        return
+
+    def top(self, count: int) -> list[tuple[bytes, int]]:
+        """
+        The items with the largest estimated counts.
+        :param count: int: How many items.
+        :return: list[tuple[bytes, int]]: The items, and their estimated counts, largest first.
+        """
+        return sorted(self._candidates.items(), key=lambda candidate: (-candidate[1], candidate[0]))[:count]
+
+
+class HyperLogLog(object):
+    """
+    The approximate number of distinct items, in fixed memory.
+    """
+
+    def __init__(self, precision: int = 14) -> None:
+        """
+        Initialize an empty sketch.
+        :param precision: int: The number of index bits, between 4 and 18. Defaults to 14.
+        :raises ValueError: If precision is out of range.
+        """
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be between 4 and 18.")
+        self._precision: int = precision
+        self._registers: bytearray = bytearray(1 << precision)
+        return
+
+    @property
+    def precision(self) -> int:
+        """
+        The number of index bits.
+        :return: int
+        """
+        return self._precision
+
+    def add(self, item: bytes) -> None:
+        """
+        Add an item.
+        :param item: bytes: The item.
+        :return: None
+        """
+        value: int = hash_pair(item)[0]
+        remaining_bits: int = 64 - self._precision
+        register: int = value >> remaining_bits
+        rank: int = remaining_bits - (value & ((1 << remaining_bits) - 1)).bit_length() + 1
+        if rank > self._registers[register]:
+            self._registers[register] = rank
+        return
+
+    def count(self) -> int:
+        """
+        The estimated number of distinct items added.
+        :return: int
+        """
+        register_count: int = len(self._registers)
+        if register_count >= 128:
+            alpha: float = 0.7213 / (1 + 1.079 / register_count)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[register_count]
+        estimate: float = alpha * register_count * register_count / sum(2.0 ** -rank for rank in self._registers)
+        zeros: int = self._registers.count(0)
+        # Linear counting is more accurate while many registers are still empty:
+        if estimate <= 2.5 * register_count and zeros > 0:
+            estimate = register_count * math.log(register_count / zeros)
+        return int(round(estimate))
+
+    def merge(self, other) -> None:
+        """
+        Merge another sketch of the same precision, as if its items were added to this one.
+        :param other: HyperLogLog: The sketch to merge.
+        :return: None
+        :raises ValueError: If the sketches have different precisions.
+        """
+        if other.precision != self._precision:
+            raise ValueError("Only sketches of the same precision can be merged.")
+        self._registers = bytearray(map(max, self._registers, other._registers))
+        return
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the sketch.
+        :return: bytes
+        """
+        return _HLL_HEADER.pack(_HLL_MAGIC, self._precision) + bytes(self._registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """
+        Deserialize a sketch made by to_bytes().
+        :param data: bytes: The serialized sketch.
+        :return: HyperLogLog
+        :raises ValueError: If data isn't a serialized sketch.
+        """
+        if len(data) < _HLL_HEADER.size:
+            raise ValueError("Not a serialized HyperLogLog.")
+        magic, precision = _HLL_HEADER.unpack_from(data)
+        if magic != _HLL_MAGIC or not 4 <= precision <= 18 or len(data) - _HLL_HEADER.size != 1 << precision:
+            raise ValueError("Not a serialized HyperLogLog.")
+        sketch = cls(precision)
+        sketch._registers[:] = data[_HLL_HEADER.size:]
+        return sketch
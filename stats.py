@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+    File: stats.py: Line counts per time bucket and group over stored archives.
+        Classes:
+            StatsError(Exception): Errors generated while counting.
+            GroupCounter(object): Count lines per time bucket, grouped by several columns, from batches of lines.
+        Methods:
+            archive_group_stats: Count the lines of one archive per time bucket, grouped by several columns in one pass.
+            archive_stats: Count the lines of one archive per time bucket and group.
+            collect_stats: Count the lines of many archives in a process pool, merging the results.
+
+        Notes:
+            Archives with a current columnar copy are counted from its memory mapped columns, others are parsed in
+            batches with logParser.iter_batches(). Times and group codes become NumPy int64 arrays, and each batch is
+            counted with one numpy.unique() over bucket * group_count + code keys, so there's no per line Python
+            work. Without NumPy the same counts are made with a Python loop. A severity filter is applied before
+            grouping, by giving the lines with other severities no time, so any column can be counted for just,
+            ie: errors.
+"""
+from typing import Optional, Final, Iterable
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import zlib
+from columnar import ColumnarError, ColumnarArchive, DICTIONARY_COLUMNS
+import logFormat
+import logParser
+from timeIndex import TimeIndex
+
+HAS_NUMPY: bool = False
+try:
+    import numpy
+    HAS_NUMPY = True
+except ModuleNotFoundError:
+    pass
+
+GROUP_COLUMNS: Final[tuple[str, ...]] = tuple(logFormat.COLUMNS[column] for column in DICTIONARY_COLUMNS)
+DEFAULT_BUCKET_SECONDS: Final[int] = 60
+_BATCH_ROWS: Final[int] = 1048576
+
+
+class StatsError(Exception):
+    """Class to store stats errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'ValueError: unknown group by column.',
+        2: 'ValueError: bucket_seconds must be greater than zero.',
+        3: 'Error while reading an archive.',
+        4: 'OSError while writing a rollup.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+def _count_batch(counts: Counter,
+                 times: Iterable[int],
+                 codes: Optional[Iterable[int]],
+                 values: list[str],
+                 bucket_seconds: int,
+                 start: Optional[int],
+                 end: Optional[int],
+                 ) -> None:
+    """
+    Count a batch of lines per time bucket and group.
+    :param counts: Counter: The counts to add to, keyed by (bucket start time, group value).
+    :param times: Iterable[int]: The generated_at times, negative for missing times.
+    :param codes: Optional[Iterable[int]]: The group codes, None when not grouping.
+    :param values: list[str]: The group values, indexed by code.
+    :param bucket_seconds: int: The bucket width.
+    :param start: Optional[int]: Only count lines generated at or after this time.
+    :param end: Optional[int]: Only count lines generated before this time.
+    :return: None
+    """
+    if not HAS_NUMPY:
+        for row, line_time in enumerate(times):
+            if line_time < 0 or (start is not None and line_time < start) or (end is not None and line_time >= end):
+                continue
+            value: str = '' if codes is None else values[codes[row]]
+            counts[(line_time - line_time % bucket_seconds, value)] += 1
+        return
+    time_array = numpy.asarray(times, dtype=numpy.int64)
+    mask = time_array >= 0
+    if start is not None:
+        mask &= time_array >= start
+    if end is not None:
+        mask &= time_array < end
+    buckets = time_array[mask] // bucket_seconds
+    group_count: int = max(len(values), 1)
+    if codes is None:
+        keys = buckets
+    else:
+        keys = buckets * group_count + numpy.asarray(codes, dtype=numpy.int64)[mask]
+    unique_keys, unique_counts = numpy.unique(keys, return_counts=True)
+    for key, count in zip(unique_keys.tolist(), unique_counts.tolist()):
+        if codes is None:
+            counts[(key * bucket_seconds, '')] += count
+        else:
+            bucket, code = divmod(key, group_count)
+            counts[(bucket * bucket_seconds, values[code])] += count
+    return
+
+
+def _select_rows(times: Iterable[int], codes: Iterable[int], wanted: list[int]):
+    """
+    Give the lines whose code isn't wanted no time, so _count_batch() skips them.
+    :param times: Iterable[int]: The generated_at times, negative for missing times.
+    :param codes: Iterable[int]: The codes of the filtered column.
+    :param wanted: list[int]: The codes to keep.
+    :return: Iterable[int]: The times, -1 for the lines filtered out.
+    """
+    if not HAS_NUMPY:
+        wanted_codes: set[int] = set(wanted)
+        return [line_time if code in wanted_codes else -1 for line_time, code in zip(times, codes)]
+    return numpy.where(numpy.isin(numpy.asarray(codes, dtype=numpy.int64), wanted),
+                       numpy.asarray(times, dtype=numpy.int64), -1)
+
+
+def _severity_set(severities: Optional[list[str]]) -> Optional[frozenset[str]]:
+    """
+    The lower cased severities to keep.
+    :param severities: Optional[list[str]]: The severities, None or empty for any severity.
+    :return: Optional[frozenset[str]]: The severities, or None for any severity.
+    """
+    return frozenset(severity.lower() for severity in severities) if severities else None
+
+
+def _columnar_stats(file_path: str,
+                    group_bys: tuple[Optional[str], ...],
+                    bucket_seconds: int,
+                    start: Optional[int],
+                    end: Optional[int],
+                    severities: Optional[frozenset[str]],
+                    ) -> Optional[dict[Optional[str], Counter]]:
+    """
+    Count the lines of one archive from its columnar copy.
+    :param file_path: str: The path to the archive.
+    :param group_bys: tuple[Optional[str], ...]: The columns to group by, None for no grouping.
+    :param bucket_seconds: int: The bucket width.
+    :param start: Optional[int]: Only count lines generated at or after this time.
+    :param end: Optional[int]: Only count lines generated before this time.
+    :param severities: Optional[frozenset[str]]: Only count lines with these lower cased severities, None for any.
+    :return: Optional[dict[Optional[str], Counter]]: The counts by group by column, or None if there isn't a current
+             columnar copy.
+    """
+    group_counts: dict[Optional[str], Counter] = {group_by: Counter() for group_by in group_bys}
+    try:
+        with ColumnarArchive(file_path) as columnar_archive:
+            times = columnar_archive.column('generated_at')
+            severity_codes = None if severities is None else columnar_archive.column('severity_name')
+            wanted: list[int] = ([] if severities is None else
+                                 [code for code, value in enumerate(columnar_archive.dictionary('severity_name'))
+                                  if value.lower() in severities])
+            for group_by in group_bys:
+                codes = None if group_by is None else columnar_archive.column(group_by)
+                values: list[str] = [] if group_by is None else columnar_archive.dictionary(group_by)
+                for row in range(0, columnar_archive.rows, _BATCH_ROWS):
+                    batch_times = times[row:row + _BATCH_ROWS]
+                    if severity_codes is not None:
+                        batch_times = _select_rows(batch_times, severity_codes[row:row + _BATCH_ROWS], wanted)
+                    _count_batch(group_counts[group_by],
+                                 batch_times,
+                                 None if codes is None else codes[row:row + _BATCH_ROWS],
+                                 values, bucket_seconds, start, end)
+                    del batch_times
+                del codes
+            del times, severity_codes
+    except ColumnarError:
+        return None
+    return group_counts
+
+
+class GroupCounter(object):
+    """
+    Count lines per time bucket, grouped by several columns, from lines fed in batches, so the counting can share a
+        pass over an archive with other sidecars.
+    """
+
+    def __init__(self,
+                 group_bys: tuple[Optional[str], ...],
+                 bucket_seconds: int = DEFAULT_BUCKET_SECONDS,
+                 start: Optional[int] = None,
+                 end: Optional[int] = None,
+                 severities: Optional[list[str]] = None,
+                 ) -> None:
+        """
+        Initialize empty counts.
+        :param group_bys: tuple[Optional[str], ...]: The columns to group by, each one of GROUP_COLUMNS, or None for no
+                          grouping.
+        :param bucket_seconds: int: The bucket width. Defaults to DEFAULT_BUCKET_SECONDS (one minute).
+        :param start: Optional[int]: Only count lines generated at or after this time. Defaults to None.
+        :param end: Optional[int]: Only count lines generated before this time. Defaults to None.
+        :param severities: Optional[list[str]]: Only count lines with these severities, case-insensitive. Defaults to
+                           None, any severity.
+        :raises StatsError: On an unknown group by column, or a bucket width less than one.
+        """
+        for group_by in group_bys:
+            if group_by is not None and group_by not in GROUP_COLUMNS:
+                raise StatsError(1, group_by)
+        if bucket_seconds < 1:
+            raise StatsError(2)
+        self._group_bys: tuple[Optional[str], ...] = group_bys
+        self._bucket_seconds: int = bucket_seconds
+        self._start: Optional[int] = start
+        self._end: Optional[int] = end
+        self._group_counts: dict[Optional[str], Counter] = {group_by: Counter() for group_by in group_bys}
+        self._severities: Optional[frozenset[str]] = _severity_set(severities)
+        self._group_columns: dict[str, int] = {group_by: logFormat.COLUMNS.index(group_by) for group_by in group_bys
+                                               if group_by is not None}
+        self._columns: tuple[int, ...] = (logFormat.GENERATED_AT,) + tuple(self._group_columns.values())
+        if self._severities is not None and logFormat.SEVERITY_NAME not in self._columns:
+            self._columns += (logFormat.SEVERITY_NAME,)
+        self._dictionaries: dict[int, dict[bytes, int]] = {column: {} for column in self._columns
+                                                           if column != logFormat.GENERATED_AT}
+        self._values: dict[int, list[str]] = {column: [] for column in self._group_columns.values()}
+        return
+
+    def add_lines(self, lines: Iterable[bytes]) -> None:
+        """
+        Count the next lines.
+        :param lines: Iterable[bytes]: The lines, without line endings.
+        :return: None
+        """
+        for batch in logParser.iter_batches(lines, self._columns, logParser.DEFAULT_BATCH_SIZE, self._dictionaries):
+            times = batch[logFormat.GENERATED_AT]
+            if self._severities is not None:
+                wanted: list[int] = [code for value, code in self._dictionaries[logFormat.SEVERITY_NAME].items()
+                                     if value.decode('utf-8', 'replace').lower() in self._severities]
+                times = _select_rows(times, batch[logFormat.SEVERITY_NAME], wanted)
+            for group_by in self._group_bys:
+                if group_by is None:
+                    _count_batch(self._group_counts[group_by], times, None, [], self._bucket_seconds, self._start,
+                                 self._end)
+                    continue
+                column: int = self._group_columns[group_by]
+                values: list[str] = self._values[column]
+                values.extend(value.decode('utf-8', 'replace')
+                              for value in list(self._dictionaries[column])[len(values):])
+                _count_batch(self._group_counts[group_by], times, batch[column], values, self._bucket_seconds,
+                             self._start, self._end)
+        return
+
+    def finish(self) -> dict[Optional[str], Counter]:
+        """
+        The counts, after the last lines are added.
+        :return: dict[Optional[str], Counter]: The counts by group by column, keyed by (bucket start time, group
+                 value), the value is '' when not grouping.
+        """
+        return self._group_counts
+
+
+def archive_group_stats(file_path: str,
+                        group_bys: tuple[Optional[str], ...],
+                        bucket_seconds: int = DEFAULT_BUCKET_SECONDS,
+                        start: Optional[int] = None,
+                        end: Optional[int] = None,
+                        severities: Optional[list[str]] = None,
+                        ) -> dict[Optional[str], Counter]:
+    """
+    Count the lines of one archive per time bucket, grouped by several columns in one pass.
+    :param file_path: str: The path to the archive.
+    :param group_bys: tuple[Optional[str], ...]: The columns to group by, each one of GROUP_COLUMNS, or None for no
+                      grouping.
+    :param bucket_seconds: int: The bucket width. Defaults to DEFAULT_BUCKET_SECONDS (one minute).
+    :param start: Optional[int]: Only count lines generated at or after this time. Defaults to None.
+    :param end: Optional[int]: Only count lines generated before this time. Defaults to None.
+    :param severities: Optional[list[str]]: Only count lines with these severities, case-insensitive. Defaults to
+                       None, any severity.
+    :return: dict[Optional[str], Counter]: The counts by group by column, keyed by (bucket start time, group value),
+             the value is '' when not grouping.
+    :raises StatsError: On bad arguments, and read errors.
+    """
+    for group_by in group_bys:
+        if group_by is not None and group_by not in GROUP_COLUMNS:
+            raise StatsError(1, group_by)
+    if bucket_seconds < 1:
+        raise StatsError(2)
+    group_counts: Optional[dict[Optional[str], Counter]] = _columnar_stats(file_path, group_bys, bucket_seconds,
+                                                                           start, end, _severity_set(severities))
+    if group_counts is not None:
+        return group_counts
+    counter = GroupCounter(group_bys, bucket_seconds, start, end, severities)
+    try:
+        counter.add_lines(logFormat.iter_lines(logFormat.iter_archive_chunks(file_path)))
+    except (OSError, EOFError, zlib.error, ModuleNotFoundError) as err:
+        raise StatsError(3, "%s: %s" % (file_path, str(err)))
+    return counter.finish()
+
+
+def archive_stats(file_path: str,
+                  group_by: Optional[str] = None,
+                  bucket_seconds: int = DEFAULT_BUCKET_SECONDS,
+                  start: Optional[int] = None,
+                  end: Optional[int] = None,
+                  severities: Optional[list[str]] = None,
+                  ) -> Counter:
+    """
+    Count the lines of one archive per time bucket and group.
+    :param file_path: str: The path to the archive.
+    :param group_by: Optional[str]: The column to group by, one of GROUP_COLUMNS. Defaults to None, no grouping.
+    :param bucket_seconds: int: The bucket width. Defaults to DEFAULT_BUCKET_SECONDS (one minute).
+    :param start: Optional[int]: Only count lines generated at or after this time. Defaults to None.
+    :param end: Optional[int]: Only count lines generated before this time. Defaults to None.
+    :param severities: Optional[list[str]]: Only count lines with these severities, case-insensitive. Defaults to
+                       None, any severity.
+    :return: Counter: The counts, keyed by (bucket start time, group value), the value is '' when not grouping.
+    :raises StatsError: On bad arguments, and read errors.
+    """
+    return archive_group_stats(file_path, (group_by,), bucket_seconds, start, end, severities)[group_by]
+
+
+def collect_stats(file_paths: list[str],
+                  group_by: Optional[str] = None,
+                  bucket_seconds: int = DEFAULT_BUCKET_SECONDS,
+                  start: Optional[int] = None,
+                  end: Optional[int] = None,
+                  max_workers: Optional[int] = None,
+                  severities: Optional[list[str]] = None,
+                  ) -> Counter:
+    """
+    Count the lines of many archives in a process pool, one archive per task, merging the results. Archives whose time
+        index shows they're outside the time range are skipped.
+    :param file_paths: list[str]: The archive paths.
+    :param group_by: Optional[str]: The column to group by, one of GROUP_COLUMNS. Defaults to None, no grouping.
+    :param bucket_seconds: int: The bucket width. Defaults to DEFAULT_BUCKET_SECONDS (one minute).
+    :param start: Optional[int]: Only count lines generated at or after this time. Defaults to None.
+    :param end: Optional[int]: Only count lines generated before this time. Defaults to None.
+    :param max_workers: Optional[int]: The number of processes. Defaults to None, the number of cores.
+    :param severities: Optional[list[str]]: Only count lines with these severities, case-insensitive. Defaults to
+                       None, any severity.
+    :return: Counter: The counts, keyed by (bucket start time, group value), the value is '' when not grouping.
+    :raises StatsError: On bad arguments, and read errors.
+    """
+    if group_by is not None and group_by not in GROUP_COLUMNS:
+        raise StatsError(1, group_by)
+    if bucket_seconds < 1:
+        raise StatsError(2)
+    if start is not None or end is not None:
+        file_paths = [file_path for file_path in file_paths
+                      if (time_index := TimeIndex.load(file_path)) is None or time_index.overlaps(start, end)]
+    counts: Counter = Counter()
+    if len(file_paths) == 0:
+        return counts
+    cpu_count: int = os.cpu_count() or 1
+    if max_workers is None or max_workers > cpu_count:
+        max_workers = cpu_count
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(file_paths))) as pool:
+        futures = [pool.submit(archive_stats, file_path, group_by, bucket_seconds, start, end, severities)
+                   for file_path in file_paths]
+        for future in as_completed(futures):
+            counts.update(future.result())
+    return counts
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+    File: templateMiner.py: Drain style template mining of messages, cached between runs.
+        Classes:
+            TemplateMinerError(Exception): Errors generated while mining.
+            LogCluster(object): A template, and how many messages it has matched.
+            TemplateMiner(object): The Drain prefix tree of templates.
+        Methods:
+            mask_message: Replace the obvious variables of a message with the wildcard.
+            mine_archive: Mine the messages of one archive, counting templates per minute.
+            update_templates: Mine the new and changed archives in a process pool, merging into the cache.
+            template_counts: Template counts per time bucket, from the cache.
+
+        Notes:
+            Drain (He et al., ICWS 2017) routes a message down a fixed depth tree, first by its number of tokens,
+            then by its first tokens (tokens with digits go down the wildcard branch), to a leaf of templates. The
+            message joins the most similar template if the fraction of equal tokens, counting wildcards as equal, is
+            at least sim_threshold, and the tokens that differ become wildcards. The tree is bounded: a node has at
+            most max_children children, the rest go down the wildcard branch, and once there are max_clusters
+            templates a message joins the most similar template in its leaf whatever the similarity, or the all
+            wildcard template of its length.
+
+            Each archive is mined in its own process, by a miner seeded with the cached templates, and the templates
+            it returns are merged into the cached miner, so a template found in two archives becomes one. The cache,
+            TEMPLATES_FILE_NAME in the output directory, holds the templates and each archive's per minute counts by
+            template id, so only new and changed archives are mined again.
+"""
+from typing import Optional, Final
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
+import re
+import zlib
+import logFormat
+
+TEMPLATES_FILE_NAME: Final[str] = 'templates.json'
+TEMPLATES_VERSION: Final[int] = 1
+WILDCARD: Final[str] = '<*>'
+DEFAULT_DEPTH: Final[int] = 4
+DEFAULT_SIM_THRESHOLD: Final[float] = 0.4
+DEFAULT_MAX_CHILDREN: Final[int] = 100
+DEFAULT_MAX_CLUSTERS: Final[int] = 10000
+COUNT_SECONDS: Final[int] = 60
+_MASK_REGEX: Final[re.Pattern] = re.compile(
+    r'(?<!\S)(?:[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'
+    r'|\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?|0x[0-9a-fA-F]+|[-+]?\d+(?:\.\d+)?)(?!\S)')
+_MAX_CACHED_MESSAGES: Final[int] = 65536
+
+
+class TemplateMinerError(Exception):
+    """Class to store template miner errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'ValueError: depth must be at least 3, and the threshold between 0 and 1.',
+        2: 'Error while reading an archive.',
+        3: 'OSError while writing the template cache.',
+        4: 'ValueError: bucket_seconds must be a multiple of 60, or 0.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+def mask_message(message: str) -> str:
+    """
+    Replace the obvious variables of a message, numbers, IPs, UUIDs, and hex values, with the wildcard.
+    :param message: str: The message.
+    :return: str
+    """
+    return _MASK_REGEX.sub(WILDCARD, message)
+
+
+class LogCluster(object):
+    """
+    A template, and how many messages it has matched.
+    """
+    __slots__ = ('cluster_id', 'tokens', 'count')
+
+    def __init__(self, cluster_id: int, tokens: list[str], count: int = 0) -> None:
+        """
+        Initialize the cluster.
+        :param cluster_id: int: The cluster id, never reused.
+        :param tokens: list[str]: The template tokens.
+        :param count: int: The messages matched. Defaults to 0.
+        """
+        self.cluster_id: int = cluster_id
+        self.tokens: list[str] = tokens
+        self.count: int = count
+        return
+
+    @property
+    def template(self) -> str:
+        """
+        The template, tokens joined by spaces.
+        :return: str
+        """
+        return ' '.join(self.tokens)
+
+
+class TemplateMiner(object):
+    """
+    The Drain prefix tree of templates.
+    """
+
+    def __init__(self,
+                 depth: int = DEFAULT_DEPTH,
+                 sim_threshold: float = DEFAULT_SIM_THRESHOLD,
+                 max_children: int = DEFAULT_MAX_CHILDREN,
+                 max_clusters: int = DEFAULT_MAX_CLUSTERS,
+                 ) -> None:
+        """
+        Initialize an empty miner.
+        :param depth: int: The tree depth, the length level and leaf level plus depth - 2 token levels. Defaults to
+                      DEFAULT_DEPTH.
+        :param sim_threshold: float: The fraction of equal tokens to join a template. Defaults to
+                              DEFAULT_SIM_THRESHOLD.
+        :param max_children: int: The most children of a token node. Defaults to DEFAULT_MAX_CHILDREN.
+        :param max_clusters: int: The most templates. Defaults to DEFAULT_MAX_CLUSTERS.
+        :raises TemplateMinerError: On bad arguments.
+        """
+        if depth < 3 or not 0.0 < sim_threshold <= 1.0 or max_children < 1 or max_clusters < 1:
+            raise TemplateMinerError(1)
+        self._depth: int = depth
+        self._sim_threshold: float = sim_threshold
+        self._max_children: int = max_children
+        self._max_clusters: int = max_clusters
+        # Length -> token -> ... -> list of clusters:
+        self._root: dict = {}
+        self._clusters: dict[int, LogCluster] = {}
+        self._next_id: int = 1
+        self._cache: dict[str, LogCluster] = {}
+        return
+
+    @property
+    def parameters(self) -> dict:
+        """
+        The parameters, which must match for a cache to be reused.
+        :return: dict
+        """
+        return {'depth': self._depth, 'sim_threshold': self._sim_threshold, 'max_children': self._max_children,
+                'max_clusters': self._max_clusters}
+
+    @property
+    def clusters(self) -> list[LogCluster]:
+        """
+        The clusters, in id order.
+        :return: list[LogCluster]
+        """
+        return list(self._clusters.values())
+
+    def _leaf(self, tokens: list[str]) -> list[LogCluster]:
+        """
+        Find, or make, the leaf a message routes to.
+        :param tokens: list[str]: The message tokens.
+        :return: list[LogCluster]: The leaf's clusters.
+        """
+        node: dict = self._root.setdefault(len(tokens), {})
+        levels: int = min(self._depth - 2, len(tokens))
+        for level in range(levels):
+            token: str = tokens[level]
+            if any(character.isdigit() for character in token):
+                token = WILDCARD
+            elif token not in node and len(node) >= self._max_children:
+                token = WILDCARD
+            node = node.setdefault(token, {} if level < levels - 1 else [])
+        if levels == 0:
+            node = node.setdefault(WILDCARD, [])
+        return node
+
+    @staticmethod
+    def _similarity(template: list[str], tokens: list[str]) -> float:
+        """
+        The fraction of tokens equal to the template's, wildcards are equal to anything.
+        :param template: list[str]: The template tokens.
+        :param tokens: list[str]: The message tokens, the same length.
+        :return: float
+        """
+        if not tokens:
+            return 1.0
+        return sum(1 for template_token, token in zip(template, tokens)
+                   if template_token == token or template_token == WILDCARD) / len(tokens)
+
+    def add_tokens(self, tokens: list[str], count: int = 1) -> LogCluster:
+        """
+        Add a message, or a template from another miner, updating the template it joins.
+        :param tokens: list[str]: The masked message tokens.
+        :param count: int: How many messages it stands for. Defaults to 1.
+        :return: LogCluster: The cluster it joined, or made.
+        """
+        leaf: list[LogCluster] = self._leaf(tokens)
+        best: Optional[LogCluster] = None
+        best_similarity: float = -1.0
+        for cluster in leaf:
+            similarity: float = self._similarity(cluster.tokens, tokens)
+            if similarity > best_similarity:
+                best, best_similarity = cluster, similarity
+        full: bool = len(self._clusters) >= self._max_clusters
+        if best is None or (best_similarity < self._sim_threshold and not full):
+            if full:
+                # No room for another template, use the all wildcard one of this length:
+                best = LogCluster(self._next_id, [WILDCARD] * len(tokens))
+                for cluster in leaf:
+                    if cluster.tokens == best.tokens:
+                        best = cluster
+                        break
+                else:
+                    self._next_id += 1
+                    self._clusters[best.cluster_id] = best
+                    leaf.append(best)
+            else:
+                best = LogCluster(self._next_id, list(tokens))
+                self._next_id += 1
+                self._clusters[best.cluster_id] = best
+                leaf.append(best)
+        else:
+            best.tokens = [template_token if template_token == token else WILDCARD
+                           for template_token, token in zip(best.tokens, tokens)]
+        best.count += count
+        return best
+
+    def add_message(self, message: str) -> LogCluster:
+        """
+        Add a message.
+        :param message: str: The message.
+        :return: LogCluster: The cluster it joined, or made.
+        """
+        masked: str = mask_message(message)
+        cluster: Optional[LogCluster] = self._cache.get(masked)
+        if cluster is not None and cluster.cluster_id in self._clusters:
+            # Seen before, and the template can only have grown to cover it:
+            cluster.count += 1
+            return cluster
+        cluster = self.add_tokens(masked.split())
+        if len(self._cache) >= _MAX_CACHED_MESSAGES:
+            self._cache.clear()
+        self._cache[masked] = cluster
+        return cluster
+
+    def remove_count(self, cluster_id: int, count: int) -> None:
+        """
+        Take messages off a cluster's count, when an archive is mined again.
+        :param cluster_id: int: The cluster id.
+        :param count: int: How many messages.
+        :return: None
+        """
+        cluster: Optional[LogCluster] = self._clusters.get(cluster_id)
+        if cluster is not None:
+            cluster.count = max(cluster.count - count, 0)
+        return
+
+    def to_dict(self) -> dict:
+        """
+        The miner as a JSON serializable dict.
+        :return: dict
+        """
+        return {'parameters': self.parameters, 'next_id': self._next_id,
+                'clusters': [[cluster.cluster_id, cluster.tokens, cluster.count]
+                             for cluster in self._clusters.values()]}
+
+    @classmethod
+    def from_dict(cls, miner_dict: dict):
+        """
+        Rebuild a miner made by to_dict().
+        :param miner_dict: dict: The miner dict.
+        :return: TemplateMiner
+        :raises TemplateMinerError: On bad parameters.
+        :raises KeyError: If the dict is incomplete.
+        """
+        miner = cls(**miner_dict['parameters'])
+        for cluster_id, tokens, count in miner_dict['clusters']:
+            cluster = LogCluster(cluster_id, tokens, count)
+            miner._clusters[cluster_id] = cluster
+            miner._leaf(tokens).append(cluster)
+        miner._next_id = miner_dict['next_id']
+        return miner
+
+
+def mine_archive(file_path: str, miner_dict: dict) -> list[tuple[list[str], dict[int, int]]]:
+    """
+    Mine the messages of one archive with a miner seeded with known templates.
+    :param file_path: str: The path to the archive.
+    :param miner_dict: dict: The seed miner, from TemplateMiner.to_dict().
+    :return: list[tuple[list[str], dict[int, int]]]: The template tokens, and the messages per minute start time, of
+             each template that matched a message.
+    :raises TemplateMinerError: On read errors.
+    """
+    miner: TemplateMiner = TemplateMiner.from_dict(miner_dict)
+    counts: dict[int, Counter] = {}
+    try:
+        for line in logFormat.iter_lines(logFormat.iter_archive_chunks(file_path)):
+            fields: list[bytes] = logFormat.split_line(line)
+            if len(fields) < logFormat.NUM_COLUMNS:
+                continue
+            try:
+                line_time: int = logFormat.parse_timestamp(fields[logFormat.GENERATED_AT])
+            except ValueError:
+                continue
+            cluster: LogCluster = miner.add_message(fields[logFormat.MESSAGE].decode('utf-8', 'replace'))
+            counts.setdefault(cluster.cluster_id, Counter())[line_time - line_time % COUNT_SECONDS] += 1
+    except (OSError, EOFError, zlib.error, ModuleNotFoundError) as err:
+        raise TemplateMinerError(2, "%s: %s" % (file_path, str(err)))
+    clusters: dict[int, LogCluster] = {cluster.cluster_id: cluster for cluster in miner.clusters}
+    return [(clusters[cluster_id].tokens, dict(minute_counts)) for cluster_id, minute_counts in counts.items()]
+
+
+def _load_cache(cache_path: str, miner: TemplateMiner) -> tuple[TemplateMiner, dict]:
+    """
+    Load the template cache, if it was made with the same parameters.
+    :param cache_path: str: The path to the cache.
+    :param miner: TemplateMiner: An empty miner with the wanted parameters.
+    :return: tuple[TemplateMiner, dict]: The miner, and the archive counts, {stem: {'size': int, 'counts':
+             [[cluster id, minute start time, count], ...]}}.
+    """
+    try:
+        with open(cache_path, 'r') as file_handle:
+            cache_dict: dict = json.load(file_handle)
+        if (cache_dict.get('version') != TEMPLATES_VERSION
+                or cache_dict['miner']['parameters'] != miner.parameters):
+            return miner, {}
+        return TemplateMiner.from_dict(cache_dict['miner']), cache_dict['archives']
+    except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError, TemplateMinerError):
+        return miner, {}
+
+
+def update_templates(output_dir: str,
+                     file_paths: list[str],
+                     miner: Optional[TemplateMiner] = None,
+                     max_workers: Optional[int] = None,
+                     ) -> tuple[TemplateMiner, dict]:
+    """
+    Mine the archives that aren't in the cache, or have changed size, in a process pool, merging their templates
+        into the cached miner, and save the cache.
+    :param output_dir: str: The output directory holding the cache.
+    :param file_paths: list[str]: The archive paths.
+    :param miner: Optional[TemplateMiner]: An empty miner with the wanted parameters. Defaults to None, the default
+                  parameters. A cache made with other parameters is started again.
+    :param max_workers: Optional[int]: The number of processes. Defaults to None, the number of cores.
+    :return: tuple[TemplateMiner, dict]: The miner, and the counts of each archive in file_paths, {stem: {'size':
+             int, 'counts': [[cluster id, minute start time, count], ...]}}.
+    :raises TemplateMinerError: On read and write errors.
+    """
+    cache_path: str = os.path.join(output_dir, TEMPLATES_FILE_NAME)
+    miner, archives = _load_cache(cache_path, miner or TemplateMiner())
+    stale_paths: list[str] = []
+    for file_path in file_paths:
+        stem: str = logFormat.archive_stem(file_path)
+        archive: Optional[dict] = archives.get(stem)
+        if archive is not None and archive['size'] == os.path.getsize(file_path):
+            continue
+        if archive is not None:
+            for cluster_id, _, count in archive['counts']:
+                miner.remove_count(cluster_id, count)
+        stale_paths.append(file_path)
+    if stale_paths:
+        cpu_count: int = os.cpu_count() or 1
+        if max_workers is None or max_workers > cpu_count:
+            max_workers = cpu_count
+        seed: dict = miner.to_dict()
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(stale_paths))) as pool:
+            futures = {pool.submit(mine_archive, file_path, seed): file_path for file_path in stale_paths}
+            for future in as_completed(futures):
+                file_path: str = futures[future]
+                archive_counts: Counter = Counter()
+                for tokens, minute_counts in future.result():
+                    cluster: LogCluster = miner.add_tokens(tokens, 0)
+                    for minute, count in minute_counts.items():
+                        archive_counts[(cluster.cluster_id, minute)] += count
+                        cluster.count += count
+                archives[logFormat.archive_stem(file_path)] = {
+                    'size': os.path.getsize(file_path),
+                    'counts': [[cluster_id, minute, count]
+                               for (cluster_id, minute), count in sorted(archive_counts.items())],
+                }
+        try:
+            with open(cache_path + '.tmp', 'w') as file_handle:
+                json.dump({'version': TEMPLATES_VERSION, 'miner': miner.to_dict(), 'archives': archives},
+                          file_handle, separators=(',', ':'))
+            os.replace(cache_path + '.tmp', cache_path)
+        except OSError as err:
+            raise TemplateMinerError(3, "%s: %s" % (cache_path, str(err)))
+    stems: set[str] = {logFormat.archive_stem(file_path) for file_path in file_paths}
+    return miner, {stem: archive for stem, archive in archives.items() if stem in stems}
+
+
+def template_counts(archives: dict,
+                    bucket_seconds: int = 3600,
+                    start: Optional[int] = None,
+                    end: Optional[int] = None,
+                    ) -> Counter:
+    """
+    Template counts per time bucket, from the archive counts returned by update_templates().
+    :param archives: dict: The archive counts.
+    :param bucket_seconds: int: The bucket width, a multiple of COUNT_SECONDS, or 0 for one bucket. Defaults to 3600.
+    :param start: Optional[int]: Only messages generated at or after this time. Defaults to None.
+    :param end: Optional[int]: Only messages generated before this time. Defaults to None.
+    :return: Counter: The counts, keyed by (bucket start time, cluster id), the bucket start is 0 when bucket_seconds
+             is 0.
+    :raises TemplateMinerError: If bucket_seconds isn't a multiple of COUNT_SECONDS.
+    """
+    if bucket_seconds < 0 or bucket_seconds % COUNT_SECONDS != 0:
+        raise TemplateMinerError(4)
+    counts: Counter = Counter()
+    for archive in archives.values():
+        for cluster_id, minute, count in archive['counts']:
+            if (start is not None and minute < start) or (end is not None and minute >= end):
+                continue
+            counts[(minute - minute % bucket_seconds if bucket_seconds else 0, cluster_id)] += count
+    return counts
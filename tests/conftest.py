@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+    File: conftest.py: Shared pytest fixtures.
+        Methods:
+            make_lines: Make archive lines with increasing generated_at times.
+            write_archive: Write lines as a single member gzip archive.
+
+        Notes:
+            The modules live at the top of the repository, so it's put on the import path here.
+"""
+from typing import Final
+import gzip
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+START_TIME: Final[int] = 1683849600  # 2023-05-12T00:00:00Z
+
+
+def make_lines(count: int, seconds_per_line: float = 0.1, sources: tuple[str, ...] = ('web', 'db')) -> list[bytes]:
+    """
+    Make archive lines with increasing generated_at times.
+    :param count: int: The number of lines.
+    :param seconds_per_line: float: The time between lines. Defaults to 0.1.
+    :param sources: tuple[str, ...]: The source names, used in turn. Defaults to ('web', 'db').
+    :return: list[bytes]: The lines, without line endings.
+    """
+    from datetime import datetime, timezone
+    lines: list[bytes] = []
+    for line_number in range(count):
+        line_time: str = datetime.fromtimestamp(START_TIME + int(line_number * seconds_per_line),
+                                                timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        source: str = sources[line_number % len(sources)]
+        lines.append(('%i\t%s\t%s\t%i\t%s\t10.0.0.%i\tlocal0\tinfo\tapp\tGET /api/%i req-%06x done in %ims'
+                      % (line_number + 1, line_time, line_time, line_number % len(sources) + 1, source,
+                         line_number % len(sources) + 1, line_number % 50, line_number, line_number % 997)).encode())
+    return lines
+
+
+def write_archive(file_path: str, lines: list[bytes]) -> bytes:
+    """
+    Write lines as a single member gzip archive.
+    :param file_path: str: The path to write.
+    :param lines: list[bytes]: The lines, without line endings.
+    :return: bytes: The uncompressed data.
+    """
+    data: bytes = b''.join(line + b'\n' for line in lines)
+    with gzip.open(file_path, 'wb') as file_handle:
+        file_handle.write(data)
+    return data
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+    File: test_alertRules.py: Tests for one pass matching of alert rules.
+"""
+import random
+import re
+from alertRules import AhoCorasick, AlertRules
+
+
+def _rule_matches(rule: dict, line: bytes) -> bool:
+    pattern: bytes = rule['pattern'].encode()
+    if rule.get('fixed'):
+        return pattern.lower() in line.lower() if rule.get('ignore_case') else pattern in line
+    return re.search(pattern, line, re.IGNORECASE if rule.get('ignore_case') else 0) is not None
+
+
+def test_aho_corasick_matches_substring_search():
+    generator = random.Random(42)
+    # A small alphabet, so needles overlap, nest, and share prefixes and suffixes:
+    needles: list[bytes] = sorted({bytes(generator.choice(b'abc') for _ in range(generator.randint(1, 5)))
+                                   for _ in range(40)})
+    automaton = AhoCorasick([(needle, number) for number, needle in enumerate(needles)])
+    for _ in range(200):
+        text: bytes = bytes(generator.choice(b'abcd') for _ in range(generator.randint(0, 30)))
+        assert automaton.find(text) == {number for number, needle in enumerate(needles) if needle in text}
+
+
+def test_aho_corasick_repeated_and_empty_needles():
+    automaton = AhoCorasick([(b'err', 0), (b'err', 1), (b'', 2), (b'\xff\x00', 3)])
+    assert automaton.find(b'no match') == {2}
+    assert automaton.find(b'an error') == {0, 1, 2}
+    assert automaton.find(b'bin \xff\x00 err') == {0, 1, 2, 3}
+
+
+def test_rules_match_like_separate_searches():
+    rules: list[dict] = [
+        {'name': 'fixed', 'pattern': 'Timeout', 'fixed': True},
+        {'name': 'fixed_case', 'pattern': 'timeout', 'fixed': True, 'ignore_case': True},
+        {'name': 'regex', 'pattern': r'status=5\d\d'},
+        {'name': 'regex_case', 'pattern': r'panic:', 'ignore_case': True},
+        {'name': 'global_flags', 'pattern': r'(?i)(?s)disk.full'},
+        {'name': 'verbose', 'pattern': r'(?x) out \s of \s memory'},
+        {'name': 'named', 'pattern': r'user=(?P<user>\w+) denied'},
+        {'name': 'named_again', 'pattern': r'(?P<user>root) login'},
+        {'name': 'backreference', 'pattern': r'(\w+) \1'},
+    ]
+    alert_rules = AlertRules(rules)
+    # Only the regexes that can't go in the alternation are searched on their own:
+    assert sorted(alert_rules.names[number] for number, _ in alert_rules._standalone) == ['backreference',
+                                                                                          'named_again']
+    lines: list[bytes] = [b'GET / status=503', b'PANIC: oops', b'Disk Full on /var', b'out of memory',
+                          b'user=bob denied', b'root login', b'again again', b'TIMEOUT', b'Timeout', b'fine']
+    for line in lines:
+        expected: set[int] = {number for number, rule in enumerate(rules) if _rule_matches(rule, line)}
+        assert alert_rules.match(line) == expected, line
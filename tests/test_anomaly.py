@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+    File: test_anomaly.py: Tests for severity filtered counts, and the spikes found in them.
+"""
+from collections import Counter
+import os
+import pytest
+from conftest import START_TIME, make_lines, write_archive
+from columnar import convert_archive
+import anomaly
+import rollups
+import stats
+
+# Minutes of db lines that are all errors, against a steady baseline of errors from both sources:
+_BURST_MINUTES: range = range(120, 123)
+
+
+def _archive(tmp_path) -> str:
+    lines: list[bytes] = []
+    for line_number, line in enumerate(make_lines(4 * 3600, seconds_per_line=1.0)):
+        minute: int = line_number // 60
+        is_db: bool = line_number % 2 == 1
+        if line_number % 10 in (0, 1) or (is_db and minute in _BURST_MINUTES):
+            line = line.replace(b'\tinfo\t', b'\tError\t')
+        lines.append(line)
+    file_path: str = os.path.join(tmp_path, '2023-05-12-00.tsv.gz')
+    write_archive(file_path, lines)
+    return file_path
+
+
+def test_severity_filter_counts_agree(tmp_path):
+    file_path: str = _archive(tmp_path)
+    parsed: dict = stats.archive_group_stats(file_path, (None, 'severity_name', 'source_name'), severities=['error'])
+    assert sum(parsed[None].values()) == 4 * 3600 // 5 + len(_BURST_MINUTES) * 24
+    assert set(value for _, value in parsed['severity_name']) == {'Error'}
+    assert parsed[None][(START_TIME + _BURST_MINUTES[0] * 60, '')] == 36
+    assert parsed['source_name'][(START_TIME + _BURST_MINUTES[0] * 60, 'db')] == 30
+    for group_by in (None, 'severity_name', 'source_name'):
+        # The rollups answer in total and by severity, and pass the rest on to stats:
+        assert rollups.collect_stats([file_path], group_by, severities=['ERROR'], max_workers=1) == parsed[group_by]
+    convert_archive(file_path)
+    assert stats.archive_group_stats(file_path, (None, 'source_name'), severities=['error']) == {
+        None: parsed[None], 'source_name': parsed['source_name']}
+    assert stats.archive_stats(file_path, 'source_name', severities=['missing']) == Counter()
+
+
+@pytest.mark.skipif(not anomaly.HAS_NUMPY, reason="requires NumPy")
+@pytest.mark.parametrize('use_rollups', (True, False))
+def test_error_spike_per_source(tmp_path, use_rollups):
+    file_path: str = _archive(tmp_path)
+    # Each source has the same number of lines every minute, the burst only shows in its errors:
+    assert anomaly.find_anomalies('source_name', [file_path], max_workers=1, use_rollups=use_rollups) == []
+    found: list = anomaly.find_anomalies('source_name', [file_path], max_workers=1, use_rollups=use_rollups,
+                                         severities=['error'])
+    assert [(item.value, item.start, item.end, item.count) for item in found] == [
+        ('db', START_TIME + _BURST_MINUTES[0] * 60, START_TIME + (_BURST_MINUTES[-1] + 1) * 60,
+         30 * len(_BURST_MINUTES))]
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+    File: test_bloomIndex.py: Tests for skipping archives with bloom sidecars.
+"""
+import os
+from conftest import make_lines, write_archive
+from bloomIndex import build_bloom, candidate_archives
+from search import Matcher
+
+
+def _archives(tmp_path) -> tuple[list[str], list[bytes]]:
+    file_paths: list[str] = []
+    all_lines: list[bytes] = []
+    for hour, source in enumerate(('alpha', 'bravo', 'charlie')):
+        file_path: str = os.path.join(tmp_path, '2023-05-12-%02i.tsv.gz' % hour)
+        lines: list[bytes] = make_lines(1000, sources=(source,))
+        write_archive(file_path, lines)
+        build_bloom(file_path)
+        file_paths.append(file_path)
+        all_lines.extend(lines)
+    return file_paths, all_lines
+
+
+def test_skips_archives_without_token(tmp_path):
+    file_paths, _ = _archives(tmp_path)
+    matcher = Matcher('bravo', fixed=True, word=True)
+    assert candidate_archives(file_paths, matcher.required_tokens(), matcher.columns) == file_paths[1:2]
+    matcher = Matcher('missing', word=True)
+    assert candidate_archives(file_paths, matcher.required_tokens(), matcher.columns) == []
+
+
+def test_keeps_archives_for_id_and_time_tokens(tmp_path):
+    file_paths, lines = _archives(tmp_path)
+    for pattern, word, columns in (('555', True, None), ('555', True, ['id']), ('00:01:15', False, None),
+                                   ('00:01:30', False, ['generated_at'])):
+        matcher = Matcher(pattern, word=word, columns=columns)
+        candidates: list[str] = candidate_archives(file_paths, matcher.required_tokens(), matcher.columns)
+        assert any(matcher.matches(line) for line in lines)
+        assert candidates == file_paths
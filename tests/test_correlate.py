@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+    File: test_correlate.py: Tests for grouping lines by id through spilled, and re-split, partitions.
+"""
+import os
+import random
+from correlate import PartitionedTable
+
+
+def test_spilled_partitions_keep_whole_timelines(tmp_path):
+    generator = random.Random(7)
+    expected: dict[bytes, list[tuple[int, int, bytes]]] = {}
+    # About 5 MiB of rows against a 20 KB cap, so partitions spill, and are still too big to read back whole:
+    table = PartitionedTable(20000, str(tmp_path))
+    for sequence in range(20000):
+        key: bytes = b'req-%i' % generator.randrange(500)
+        line_time: int = generator.randrange(1000)
+        line: bytes = b'%s line %i at %i' % (key, sequence, line_time)
+        table.add(key, line_time, sequence, line)
+        expected.setdefault(key, []).append((line_time, sequence, line))
+    spills: int = table.spills
+    assert spills > 0
+    timelines: list[tuple[bytes, list[bytes]]] = list(table)
+    # The sub tables made to split the large partitions spilled too:
+    assert table.spills > spills
+    assert sorted(key for key, _ in timelines) == sorted(expected)
+    for key, lines in timelines:
+        assert lines == [line for _, _, line in sorted(expected[key])]
+    assert os.listdir(tmp_path) == []
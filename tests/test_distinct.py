@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+    File: test_distinct.py: Tests for merging the distinct sidecars of archives.
+"""
+import os
+from conftest import START_TIME, make_lines, write_archive
+from distinct import collect_distinct, load_distinct
+
+
+def test_collect_distinct_merges_archives(tmp_path):
+    file_paths: list[str] = []
+    # Overlapping sources, 300 in all:
+    for hour, source_numbers in enumerate((range(0, 200), range(100, 300))):
+        file_path: str = os.path.join(tmp_path, '2023-05-12-%02i.tsv.gz' % hour)
+        write_archive(file_path, make_lines(3000, sources=tuple('source-%i' % number for number in source_numbers)))
+        file_paths.append(file_path)
+    counts: dict[tuple[int, str], int] = collect_distinct(file_paths, ('source_name',), max_workers=1)
+    # Within 2%, the standard error at precision 14 is 0.8%:
+    assert abs(counts[(START_TIME, 'source_name')] - 300) <= 6
+    assert all(load_distinct(file_path) is not None for file_path in file_paths)
+    # Answered again from the saved sidecars:
+    assert collect_distinct(file_paths, ('source_name',), max_workers=1) == counts
+    assert abs(collect_distinct(file_paths[:1], ('source_name',), max_workers=1)[(START_TIME, 'source_name')]
+               - 200) <= 4
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+    File: test_externalSort.py: Tests for the external merge sort of archives.
+"""
+import io
+import os
+from conftest import make_lines, write_archive
+import externalSort
+from externalSort import SortKey, sort_archives
+
+
+def test_runs_and_merge_passes_match_sort(tmp_path):
+    lines: list[bytes] = make_lines(40000)
+    file_paths: list[str] = []
+    for archive_number in range(4):
+        file_path: str = os.path.join(tmp_path, '%03i.tsv.gz' % archive_number)
+        write_archive(file_path, lines[archive_number::4])
+        file_paths.append(file_path)
+    reports: list[str] = []
+    output_handle = io.BytesIO()
+    # A 1 MiB cap spills many runs per archive, more than fit in one merge:
+    written: int = sort_archives(file_paths, ['source_name', 'message'], output_handle, 1048576,
+                                 str(tmp_path), 1, report=reports.append)
+    assert written == len(lines)
+    assert output_handle.getvalue() == b''.join(line + b'\n'
+                                                for line in sorted(lines, key=SortKey(['source_name', 'message'])))
+    assert any(report.startswith('merge pass') for report in reports)
+    # The run directory is removed:
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(file_path) for file_path in file_paths)
+
+
+def test_merge_plan_fits_memory_cap():
+    for memory_cap in (1048576, 4 * 1048576, 256 * 1048576):
+        fan_in, read_size = externalSort._merge_plan(memory_cap, externalSort.DEFAULT_MAX_FAN_IN)
+        assert 2 <= fan_in <= externalSort.DEFAULT_MAX_FAN_IN
+        assert fan_in * (externalSort._RUN_OVERHEAD + externalSort._READ_COPIES * read_size) <= memory_cap
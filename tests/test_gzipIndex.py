@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+    File: test_gzipIndex.py: Tests for the seekable gzip checkpoint index.
+"""
+import gzip
+import os
+from conftest import START_TIME, make_lines, write_archive
+import logParser
+from gzipIndex import GzipIndex, build_index
+
+SPAN: int = 65536
+
+
+def test_rewrite_is_byte_identical(tmp_path):
+    file_path: str = os.path.join(tmp_path, '2023-05-12-00.tsv.gz')
+    data: bytes = write_archive(file_path, make_lines(20000))
+    index: GzipIndex = build_index(file_path, SPAN)
+    assert len(index.checkpoints) > 1
+    with gzip.open(file_path, 'rb') as file_handle:
+        assert file_handle.read() == data
+    # Each checkpoint is a member starting on a line boundary:
+    for compressed_offset, uncompressed_offset, first_time in index.checkpoints:
+        assert uncompressed_offset == 0 or data[uncompressed_offset - 1:uncompressed_offset] == b'\n'
+        assert b''.join(index.iter_chunks(index.checkpoints.index((compressed_offset, uncompressed_offset,
+                                                                   first_time)))) == data[uncompressed_offset:]
+
+
+def test_iter_lines_from_matches_full_scan(tmp_path):
+    file_path: str = os.path.join(tmp_path, '2023-05-12-00.tsv.gz')
+    lines: list[bytes] = make_lines(20000)
+    write_archive(file_path, lines)
+    build_index(file_path, SPAN)
+    index: GzipIndex = GzipIndex.load(file_path)
+    assert index is not None
+    for offset in (0, 1, 777, 1500, 1999, 5000):
+        timestamp: int = START_TIME + offset
+        expected: list[bytes] = [line for line in lines if logParser.get_time(line) >= timestamp]
+        assert list(index.iter_lines_from(timestamp)) == expected
+
+
+def test_seekable_archive_is_not_rewritten(tmp_path):
+    file_path: str = os.path.join(tmp_path, '2023-05-12-00.tsv.gz')
+    write_archive(file_path, make_lines(20000))
+    build_index(file_path, SPAN)
+    with open(file_path, 'rb') as file_handle:
+        rewritten: bytes = file_handle.read()
+    # Indexing again finds the members, and leaves the file alone:
+    index: GzipIndex = build_index(file_path, SPAN)
+    with open(file_path, 'rb') as file_handle:
+        assert file_handle.read() == rewritten
+    assert len(index.checkpoints) > 1
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+    File: test_invertedIndex.py: Tests for the inverted index against a brute force scan.
+"""
+import json
+import os
+import pytest
+from conftest import make_lines, write_archive
+import invertedIndex
+import logFormat
+from invertedIndex import InvertedIndexError, InvertedIndex, parse_query
+
+_QUERIES: tuple[str, ...] = ('api', 'alpha', 'bravo', 'zulu', '"api 7"', 'done 7', '"in 5ms"', 'req-00002a',
+                             'web alpha', '"alpha get"')
+
+
+def _archive_lines(word: str, count: int) -> list[bytes]:
+    # A word per archive version, so lines of a replaced version can be told apart:
+    return [line.replace(b'\tGET ', b'\t%s GET ' % word.encode()) for line in make_lines(count)]
+
+
+def _matches(line: bytes, phrases: list[list[bytes]]) -> bool:
+    fields: list[bytes] = logFormat.split_line(line)
+    columns: list[list[bytes]] = [logFormat.tokenize(fields[column])
+                                  for column in (logFormat.MESSAGE, logFormat.PROGRAM, logFormat.SOURCE_NAME)]
+    return all(any(tokens[start:start + len(phrase)] == phrase
+                   for tokens in columns for start in range(len(tokens) - len(phrase) + 1))
+               for phrase in phrases)
+
+
+def _check_queries(index: InvertedIndex, indexed: dict[str, list[bytes]]) -> None:
+    # Lines come back in the order they were indexed, a re-indexed archive last:
+    all_lines: list[bytes] = [line for lines in indexed.values() for line in lines]
+    for query in _QUERIES:
+        phrases: list[list[bytes]] = parse_query(query)
+        assert list(index.query(query)) == [line for line in all_lines if _matches(line, phrases)], query
+    assert len(list(index.query('api', limit=5))) == 5
+
+
+def _add(index: InvertedIndex, indexed: dict[str, list[bytes]], file_path: str, lines: list[bytes]) -> None:
+    write_archive(file_path, lines)
+    assert index.add_archive(file_path) == len(lines)
+    assert index.is_indexed(file_path, os.path.getsize(file_path))
+    indexed.pop(file_path, None)
+    indexed[file_path] = lines
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    # Many small segments and blocks, so archives span segments, and segments merge:
+    monkeypatch.setattr(invertedIndex, 'MAX_SEGMENT_DOCS', 300)
+    monkeypatch.setattr(invertedIndex, 'BLOCK_SIZE', 16)
+
+
+def test_segments_merge_and_reindex(tmp_path, small_segments):
+    index = InvertedIndex(str(tmp_path))
+    indexed: dict[str, list[bytes]] = {}
+    archive_paths: list[str] = [os.path.join(tmp_path, '2023-05-12-%02i.tsv.gz' % hour) for hour in range(12)]
+    for file_path in archive_paths[:5]:
+        _add(index, indexed, file_path, _archive_lines('alpha', 600))
+    # Ten segments of 300 lines, the first eight merged into one:
+    assert [segment['docs'] for segment in index._state['segments']] == [2400, 300, 300]
+    _check_queries(index, indexed)
+    # Re-index changed archives, two in the merged segment, and one spanning two segments:
+    _add(index, indexed, archive_paths[1], _archive_lines('bravo', 450))
+    _add(index, indexed, archive_paths[2], _archive_lines('bravo', 10))
+    _add(index, indexed, archive_paths[4], _archive_lines('zulu', 100))
+    # The lines of the first two in the merged segment are deleted, the two segments of the third are dropped:
+    assert [(segment['docs'], segment['deleted']) for segment in index._state['segments']] == [
+        (2400, [[600, 1800]]), (300, []), (150, []), (10, []), (100, [])]
+    _check_queries(index, indexed)
+    # Reopened from segments.json:
+    index = InvertedIndex(str(tmp_path))
+    _check_queries(index, indexed)
+    # Once over half its lines are deleted, the segment is rewritten without them, renumbering the rest:
+    _add(index, indexed, archive_paths[3], _archive_lines('zulu', 700))
+    assert [(segment['docs'], segment['deleted']) for segment in index._state['segments']] == [
+        (600, []), (300, []), (150, []), (10, []), (100, []), (300, []), (300, []), (100, [])]
+    _check_queries(index, indexed)
+    # And merged with the rest:
+    for file_path in archive_paths[5:]:
+        _add(index, indexed, file_path, _archive_lines('alpha', 600))
+    assert sum(segment['docs'] for segment in index._state['segments']) == sum(map(len, indexed.values()))
+    _check_queries(index, indexed)
+    # Every archive's ranges still hold its own lines:
+    for file_path, lines in indexed.items():
+        archive: dict = index._state['archives'][logFormat.archive_stem(file_path)]
+        ranges_lines: list[bytes] = []
+        for name, start, end in archive['ranges']:
+            segment = invertedIndex.Segment(os.path.join(tmp_path, invertedIndex.INDEX_DIR_NAME, name))
+            ranges_lines.extend(segment.doc(doc_id) for doc_id in range(start, end))
+            segment.close()
+        assert ranges_lines == lines
+    names: set[str] = {segment['name'] for segment in index._state['segments']}
+    assert set(os.listdir(os.path.join(tmp_path, invertedIndex.INDEX_DIR_NAME))) == names | {'segments.json'}
+
+
+def test_merge_renumbers_after_deleted_lines(tmp_path, small_segments):
+    index = InvertedIndex(str(tmp_path))
+    indexed: dict[str, list[bytes]] = {}
+    archive_paths: list[str] = [os.path.join(tmp_path, '2023-05-12-%02i.tsv.gz' % hour) for hour in range(8)]
+    for file_path in archive_paths:
+        _add(index, indexed, file_path, _archive_lines('alpha', 600))
+    _add(index, indexed, archive_paths[5], _archive_lines('bravo', 50))
+    assert [(segment['docs'], segment['deleted']) for segment in index._state['segments']] == [
+        (2400, []), (2400, [[600, 1200]]), (50, [])]
+    # The deleted lines are in the second segment of the run:
+    assert index.merge(2) == 1
+    assert [(segment['docs'], segment['deleted']) for segment in index._state['segments']] == [(4200, []), (50, [])]
+    _check_queries(index, indexed)
+
+
+def test_merge_size_cap(tmp_path, small_segments, monkeypatch):
+    monkeypatch.setattr(invertedIndex, 'MAX_MERGED_DOCS', 2000)
+    index = InvertedIndex(str(tmp_path))
+    indexed: dict[str, list[bytes]] = {}
+    for hour in range(5):
+        _add(index, indexed, os.path.join(tmp_path, '2023-05-12-%02i.tsv.gz' % hour), _archive_lines('alpha', 600))
+    # Eight 300 line segments would make a 2400 line one:
+    assert [segment['docs'] for segment in index._state['segments']] == [300] * 10
+    _check_queries(index, indexed)
+
+
+def test_damaged_state(tmp_path):
+    os.makedirs(os.path.join(tmp_path, invertedIndex.INDEX_DIR_NAME))
+    with open(os.path.join(tmp_path, invertedIndex.INDEX_DIR_NAME, invertedIndex.SEGMENTS_FILE_NAME), 'w') as handle:
+        handle.write(json.dumps({'next_segment': 3, 'segments': []})[:-5])
+    with pytest.raises(InvertedIndexError) as error:
+        InvertedIndex(str(tmp_path))
+    assert error.value.error_number == 5
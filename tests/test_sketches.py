@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+    File: test_sketches.py: Tests for the sketches, and merging them.
+"""
+from collections import Counter
+import random
+import pytest
+from sketches import CountMinSketch, HeavyHitters, HyperLogLog
+
+
+def _skewed_items(seed: int, count: int) -> list[bytes]:
+    generator = random.Random(seed)
+    # Zipf like, a few items are most of the stream:
+    return [b'item-%i' % int(generator.paretovariate(1.0)) for _ in range(count)]
+
+
+def test_count_min_merge_never_under_counts():
+    first_items: list[bytes] = _skewed_items(1, 20000)
+    second_items: list[bytes] = _skewed_items(2, 20000)
+    first = CountMinSketch.for_error(0.001, 0.01)
+    second = CountMinSketch.for_error(0.001, 0.01)
+    for item in first_items:
+        first.add(item)
+    for item in second_items:
+        second.add(item)
+    first.merge(second)
+    assert first.total == 40000
+    for item, count in Counter(first_items + second_items).items():
+        assert count <= first.estimate(item) <= count + 0.001 * first.total
+
+
+def test_count_min_merge_needs_same_size():
+    with pytest.raises(ValueError):
+        CountMinSketch(100, 4).merge(CountMinSketch(100, 5))
+
+
+def test_heavy_hitters_merge_finds_top_items():
+    first_items: list[bytes] = _skewed_items(3, 20000)
+    second_items: list[bytes] = _skewed_items(4, 20000)
+    first = HeavyHitters(20, 2000, 5)
+    second = HeavyHitters(20, 2000, 5)
+    for item in first_items:
+        first.add(item)
+    for item in second_items:
+        second.add(item)
+    first.merge(second)
+    expected: list[tuple[bytes, int]] = Counter(first_items + second_items).most_common(5)
+    assert [item for item, _ in first.top(5)] == [item for item, _ in expected]
+    for (_, estimate), (_, count) in zip(first.top(5), expected):
+        assert estimate >= count
+
+
+def test_hyperloglog_merge_matches_union():
+    first = HyperLogLog(14)
+    second = HyperLogLog(14)
+    union = HyperLogLog(14)
+    for number in range(60000):
+        item: bytes = b'user-%i' % number
+        # Overlapping halves, the middle third is in both:
+        if number < 40000:
+            first.add(item)
+        if number >= 20000:
+            second.add(item)
+        union.add(item)
+    first.merge(second)
+    assert first.to_bytes() == union.to_bytes()
+    assert abs(first.count() - 60000) < 60000 * 0.03
+    assert HyperLogLog.from_bytes(first.to_bytes()).count() == first.count()
+
+
+def test_hyperloglog_merge_needs_same_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(12).merge(HyperLogLog(14))
+    with pytest.raises(ValueError):
+        HyperLogLog.from_bytes(b'not a sketch')
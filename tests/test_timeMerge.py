@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+    File: test_timeMerge.py: Tests for the time ordered merge of archives.
+"""
+import os
+from conftest import START_TIME, make_lines, write_archive
+import logParser
+from timeIndex import time_index_path
+from timeMerge import merge_archives
+
+
+def test_merge_matches_sort(tmp_path):
+    lines: list[bytes] = make_lines(6000, seconds_per_line=2)
+    file_paths: list[str] = []
+    for archive_number in range(20):
+        file_path: str = os.path.join(tmp_path, '%03i.tsv.gz' % archive_number)
+        chunk: list[bytes] = lines[archive_number * 300:(archive_number + 1) * 300]
+        # Swap neighbours, so each archive is a little out of order:
+        chunk[::2], chunk[1::2] = chunk[1::2], chunk[::2]
+        write_archive(file_path, chunk)
+        file_paths.append(file_path)
+    # Archives in reverse, to check they're opened by time, not by position:
+    file_paths.reverse()
+    merged: list[tuple[int, str, bytes]] = list(merge_archives(file_paths))
+    assert [line for _, _, line in merged] == lines
+    assert all(os.path.exists(time_index_path(file_path)) for file_path in file_paths)
+    start: int = START_TIME + 3001
+    end: int = START_TIME + 7001
+    assert ([line for _, _, line in merge_archives(file_paths, start, end)]
+            == [line for line in lines if start <= logParser.get_time(line) < end])
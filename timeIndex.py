@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+"""
+    File: timeIndex.py: Time range sidecar index of stored archives.
+        Classes:
+            TimeIndexError(Exception): Errors generated while building or reading time indexes.
+            TimeIndex(object): The time range of an archive, and of each block in it.
+            TimeIndexBuilder(object): Build the time index of an archive from its lines.
+        Methods:
+            time_index_path: The path of the time index sidecar for an archive.
+            build_time_index: Build the time index of an archive.
+            iter_archive_range: Read the lines generated in a time range from one stored archive.
+            iter_time_range: Read the lines generated in a time range from stored archives.
+
+        Notes:
+            Blocks line up with the gzip index checkpoints when the archive has a current gzip index, so the blocks
+            in a time range can be read without inflating the rest of the archive. Otherwise blocks are every
+            DEFAULT_BLOCK_SIZE uncompressed bytes, reading still has to inflate from the start but stops after the
+            last block in range, and skips splitting lines in blocks out of range.
+"""
+from typing import Optional, Final, Iterable, Iterator
+import json
+import os
+import zlib
+from archiveDownload import iter_decompressed
+from gzipIndex import GzipIndex
+import logFormat
+import logParser
+
+TIME_INDEX_SUFFIX: Final[str] = '.timeindex'
+TIME_INDEX_VERSION: Final[int] = 1
+DEFAULT_BLOCK_SIZE: Final[int] = 1048576
+_READ_SIZE: Final[int] = 1048576
+_NO_OFFSET: Final[int] = -1
+
+
+class TimeIndexError(Exception):
+    """Class to store time index errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'OSError while reading the archive.',
+        2: 'Corrupt compressed data in the archive.',
+        3: 'OSError while writing the time index.',
+        4: 'ValueError: block_size must be greater than zero.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+def time_index_path(file_path: str) -> str:
+    """
+    The path of the time index sidecar for an archive.
+    :param file_path: str: The path to the archive.
+    :return: str
+    """
+    return logFormat.sidecar_path(file_path, TIME_INDEX_SUFFIX)
+
+
+class TimeIndex(object):
+    """
+    The time range of an archive, and of each block in it. Times are seconds since the epoch, ranges are (min, max),
+        or None when nothing in the archive had a valid time. Each block is a tuple of:
+        (compressed_offset: int, uncompressed_offset: int, min_generated_at: int, max_generated_at: int)
+        where compressed_offset is -1 when the block can't be seeked to.
+    """
+
+    def __init__(self,
+                 file_path: str,
+                 generated_at: Optional[tuple[int, int]],
+                 received_at: Optional[tuple[int, int]],
+                 lines: int,
+                 blocks: list[tuple[int, int, int, int]],
+                 ) -> None:
+        """
+        Initialize the index.
+        :param file_path: str: The path to the archive.
+        :param generated_at: Optional[tuple[int, int]]: The min and max generated_at.
+        :param received_at: Optional[tuple[int, int]]: The min and max received_at.
+        :param lines: int: The number of lines.
+        :param blocks: list[tuple[int, int, int, int]]: The blocks, in file order.
+        """
+        self._file_path: str = file_path
+        self._generated_at: Optional[tuple[int, int]] = generated_at
+        self._received_at: Optional[tuple[int, int]] = received_at
+        self._lines: int = lines
+        self._blocks: list[tuple[int, int, int, int]] = blocks
+        return
+
+    @classmethod
+    def load(cls, file_path: str):
+        """
+        Load the time index of an archive.
+        :param file_path: str: The path to the archive.
+        :return: Optional[TimeIndex]: The index, or None if there isn't a current index for the archive.
+        """
+        try:
+            with open(time_index_path(file_path), 'r') as file_handle:
+                index_dict: dict = json.load(file_handle)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if index_dict.get('version') != TIME_INDEX_VERSION:
+            return None
+        # Offsets into an older, or recompressed, copy of the archive are no use:
+        if not os.path.exists(file_path) or index_dict['file_size'] != os.path.getsize(file_path):
+            return None
+        generated_at: Optional[list[int]] = index_dict['generated_at']
+        received_at: Optional[list[int]] = index_dict['received_at']
+        return cls(file_path,
+                   None if generated_at is None else tuple(generated_at),
+                   None if received_at is None else tuple(received_at),
+                   index_dict['lines'],
+                   [tuple(block) for block in index_dict['blocks']])
+
+    def save(self) -> None:
+        """
+        Save the time index sidecar.
+        :return: None
+        :raises TimeIndexError: On write errors.
+        """
+        index_dict: dict = {
+            'version': TIME_INDEX_VERSION,
+            'file_size': os.path.getsize(self._file_path),
+            'generated_at': self._generated_at,
+            'received_at': self._received_at,
+            'lines': self._lines,
+            'blocks': self._blocks,
+        }
+        temp_path: str = time_index_path(self._file_path) + '.tmp'
+        try:
+            with open(temp_path, 'w') as file_handle:
+                json.dump(index_dict, file_handle, separators=(',', ':'))
+            os.replace(temp_path, time_index_path(self._file_path))
+        except OSError as err:
+            raise TimeIndexError(3, *err.args)
+        return
+
+    @property
+    def file_path(self) -> str:
+        """
+        The path to the archive.
+        :return: str
+        """
+        return self._file_path
+
+    @property
+    def generated_at(self) -> Optional[tuple[int, int]]:
+        """
+        The min and max generated_at, None if no line had a valid time.
+        :return: Optional[tuple[int, int]]
+        """
+        return self._generated_at
+
+    @property
+    def received_at(self) -> Optional[tuple[int, int]]:
+        """
+        The min and max received_at, None if no line had a valid time.
+        :return: Optional[tuple[int, int]]
+        """
+        return self._received_at
+
+    @property
+    def lines(self) -> int:
+        """
+        The number of lines.
+        :return: int
+        """
+        return self._lines
+
+    @property
+    def blocks(self) -> list[tuple[int, int, int, int]]:
+        """
+        The blocks, in file order.
+        :return: list[tuple[int, int, int, int]]
+        """
+        return self._blocks
+
+    def overlaps(self, start: Optional[int], end: Optional[int]) -> bool:
+        """
+        Check if the archive may have lines generated in a time range.
+        :param start: Optional[int]: The start of the range, inclusive, None for no start.
+        :param end: Optional[int]: The end of the range, exclusive, None for no end.
+        :return: bool
+        """
+        if self._generated_at is None:
+            return False
+        return _in_range(self._generated_at[0], self._generated_at[1], start, end)
+
+    def _block_ranges(self, start: Optional[int], end: Optional[int]) -> list[tuple[int, int]]:
+        """
+        Group the blocks overlapping a time range into runs of consecutive blocks.
+        :param start: Optional[int]: The start of the range, inclusive, None for no start.
+        :param end: Optional[int]: The end of the range, exclusive, None for no end.
+        :return: list[tuple[int, int]]: The first block number, and one past the last block number, of each run.
+        """
+        runs: list[tuple[int, int]] = []
+        for block_number, block in enumerate(self._blocks):
+            if not _in_range(block[2], block[3], start, end):
+                continue
+            if runs and runs[-1][1] == block_number:
+                runs[-1] = (runs[-1][0], block_number + 1)
+            else:
+                runs.append((block_number, block_number + 1))
+        return runs
+
+    def _block_end(self, block_number: int) -> Optional[int]:
+        """
+        The uncompressed offset where a block ends.
+        :param block_number: int: The block number.
+        :return: Optional[int]: The offset, or None for the last block.
+        """
+        if block_number < len(self._blocks):
+            return self._blocks[block_number][1]
+        return None
+
+    def _iter_run(self, file_handle, first_block: int, end_block: int) -> Iterator[bytes]:
+        """
+        Read the decompressed data of a run of seekable blocks.
+        :param file_handle: The archive, opened for binary reading.
+        :param first_block: int: The first block number.
+        :param end_block: int: One past the last block number.
+        :return: Iterator[bytes]: The decompressed data.
+        """
+        remaining: Optional[int] = self._block_end(end_block)
+        if remaining is not None:
+            remaining -= self._blocks[first_block][1]
+        file_handle.seek(self._blocks[first_block][0])
+        for chunk in iter_decompressed(iter(lambda: file_handle.read(_READ_SIZE), b'')):
+            if remaining is not None:
+                if len(chunk) >= remaining:
+                    yield chunk[:remaining]
+                    return
+                remaining -= len(chunk)
+            yield chunk
+        return
+
+    def iter_lines(self, start: Optional[int] = None, end: Optional[int] = None) -> Iterator[bytes]:
+        """
+        Read the lines generated in a time range, only reading the blocks that overlap it.
+        :param start: Optional[int]: The start of the range, inclusive. Defaults to None, no start.
+        :param end: Optional[int]: The end of the range, exclusive. Defaults to None, no end.
+        :return: Iterator[bytes]: The lines, without line endings, in file order.
+        :raises TimeIndexError: On read errors, or corrupt data.
+        """
+        yield from _filter_lines(self._iter_runs(self._block_ranges(start, end)), start, end)
+        return
+
+    def iter_block_lines(self, block_numbers: list[int]) -> Iterator[bytes]:
+        """
+        Read the lines of some of the blocks, only reading those blocks when the archive is seekable.
+        :param block_numbers: list[int]: The block numbers, in order.
+        :return: Iterator[bytes]: The lines, without line endings, in file order.
+        :raises TimeIndexError: On read errors, or corrupt data.
+        """
+        runs: list[tuple[int, int]] = []
+        for block_number in block_numbers:
+            if runs and runs[-1][1] == block_number:
+                runs[-1] = (runs[-1][0], block_number + 1)
+            else:
+                runs.append((block_number, block_number + 1))
+        yield from self._iter_runs(runs)
+        return
+
+    def _iter_runs(self, runs: list[tuple[int, int]]) -> Iterator[bytes]:
+        """
+        Read the lines of runs of blocks.
+        :param runs: list[tuple[int, int]]: The first block number, and one past the last block number, of each run.
+        :return: Iterator[bytes]: The lines, without line endings, in file order.
+        :raises TimeIndexError: On read errors, or corrupt data.
+        """
+        if len(runs) == 0:
+            return
+        try:
+            if all(block[0] != _NO_OFFSET for block in self._blocks):
+                with open(self._file_path, 'rb') as file_handle:
+                    for first_block, end_block in runs:
+                        yield from logFormat.iter_lines(self._iter_run(file_handle, first_block, end_block))
+            else:
+                yield from logFormat.iter_lines(self._iter_blocks(runs))
+        except OSError as err:
+            raise TimeIndexError(1, *err.args)
+        except (zlib.error, EOFError) as err:
+            raise TimeIndexError(2, *err.args)
+        return
+
+    def _iter_blocks(self, runs: list[tuple[int, int]]) -> Iterator[bytes]:
+        """
+        Inflate the archive from the start, yielding the data of the blocks in the runs, and stopping after the last.
+        :param runs: list[tuple[int, int]]: The runs of blocks to read.
+        :return: Iterator[bytes]: The decompressed data.
+        """
+        ranges: list[tuple[int, Optional[int]]] = [(self._blocks[first_block][1], self._block_end(end_block))
+                                                   for first_block, end_block in runs]
+        range_number: int = 0
+        offset: int = 0
+        for chunk in logFormat.iter_archive_chunks(self._file_path, _READ_SIZE):
+            chunk_end: int = offset + len(chunk)
+            while range_number < len(ranges):
+                range_start, range_end = ranges[range_number]
+                if range_start >= chunk_end:
+                    break
+                yield chunk[max(range_start - offset, 0):None if range_end is None else max(range_end - offset, 0)]
+                if range_end is None or range_end > chunk_end:
+                    break
+                range_number += 1
+            if range_number >= len(ranges):
+                return
+            offset = chunk_end
+        return
+
+
+def _in_range(minimum: int, maximum: int, start: Optional[int], end: Optional[int]) -> bool:
+    """
+    Check if [minimum, maximum] overlaps [start, end).
+    :param minimum: int: The smallest time.
+    :param maximum: int: The largest time.
+    :param start: Optional[int]: The start of the range, inclusive, None for no start.
+    :param end: Optional[int]: The end of the range, exclusive, None for no end.
+    :return: bool
+    """
+    return (start is None or maximum >= start) and (end is None or minimum < end)
+
+
+def _filter_lines(lines: Iterator[bytes], start: Optional[int], end: Optional[int]) -> Iterator[bytes]:
+    """
+    Keep the lines generated in a time range.
+    :param lines: Iterator[bytes]: The lines, without line endings.
+    :param start: Optional[int]: The start of the range, inclusive, None for no start.
+    :param end: Optional[int]: The end of the range, exclusive, None for no end.
+    :return: Iterator[bytes]
+    """
+    for line in lines:
+        generated_at: Optional[int] = logParser.get_time(line)
+        if generated_at is not None and _in_range(generated_at, generated_at, start, end):
+            yield line
+    return
+
+
+class TimeIndexBuilder(object):
+    """
+    Build the time index of an archive from its lines, fed in file order, so it can share a pass over the archive with
+        other sidecars.
+    """
+
+    def __init__(self, file_path: str, block_size: int = DEFAULT_BLOCK_SIZE) -> None:
+        """
+        Initialize the builder, using the gzip index checkpoints as blocks when there's a current gzip index.
+        :param file_path: str: The path to the archive.
+        :param block_size: int: The uncompressed bytes per block without a gzip index. Defaults to DEFAULT_BLOCK_SIZE
+                                (1 MiB).
+        :raises TimeIndexError: If block_size is less than one.
+        """
+        if block_size < 1:
+            raise TimeIndexError(4)
+        self._file_path: str = file_path
+        self._block_size: int = block_size
+        gzip_index: Optional[GzipIndex] = GzipIndex.load(file_path) if file_path.endswith('.gz') else None
+        # Block starts as (compressed_offset, uncompressed_offset):
+        self._starts: Optional[list[tuple[int, int]]] = None
+        if gzip_index is not None and len(gzip_index.checkpoints) > 0:
+            self._starts = [checkpoint[:2] for checkpoint in gzip_index.checkpoints]
+        self._blocks: list[list[int]] = []
+        self._generated_at: Optional[list[int]] = None
+        self._received_at: Optional[list[int]] = None
+        self._lines: int = 0
+        self._offset: int = 0
+        return
+
+    def add_lines(self, lines: Iterable[bytes]) -> None:
+        """
+        Add the next lines of the archive.
+        :param lines: Iterable[bytes]: The lines, without line endings.
+        :return: None
+        """
+        starts: Optional[list[tuple[int, int]]] = self._starts
+        blocks: list[list[int]] = self._blocks
+        generated_at: Optional[list[int]] = self._generated_at
+        received_at: Optional[list[int]] = self._received_at
+        offset: int = self._offset
+        for line in lines:
+            # Start a new block at each checkpoint, or every block_size bytes:
+            if starts is not None:
+                while len(blocks) < len(starts) and offset >= starts[len(blocks)][1]:
+                    blocks.append([starts[len(blocks)][0], starts[len(blocks)][1], None, None])
+            elif len(blocks) == 0 or offset - blocks[-1][1] >= self._block_size:
+                blocks.append([_NO_OFFSET, offset, None, None])
+            offset += len(line) + 1
+            self._lines += 1
+            line_generated: Optional[int] = logParser.get_time(line)
+            if line_generated is None:
+                continue
+            block: list[int] = blocks[-1]
+            if block[2] is None:
+                block[2] = block[3] = line_generated
+            else:
+                block[2] = min(block[2], line_generated)
+                block[3] = max(block[3], line_generated)
+            if generated_at is None:
+                generated_at = [line_generated, line_generated]
+            else:
+                generated_at[0] = min(generated_at[0], line_generated)
+                generated_at[1] = max(generated_at[1], line_generated)
+            line_received: Optional[int] = logParser.get_time(line, logFormat.RECEIVED_AT)
+            if line_received is None:
+                continue
+            if received_at is None:
+                received_at = [line_received, line_received]
+            else:
+                received_at[0] = min(received_at[0], line_received)
+                received_at[1] = max(received_at[1], line_received)
+        self._generated_at = generated_at
+        self._received_at = received_at
+        self._offset = offset
+        return
+
+    def finish(self) -> TimeIndex:
+        """
+        Make and save the index, after the last lines are added.
+        :return: TimeIndex: The index.
+        :raises TimeIndexError: On write errors.
+        """
+        # Blocks without a valid time can't hold lines in any range, give them an empty range:
+        index = TimeIndex(self._file_path,
+                          None if self._generated_at is None else tuple(self._generated_at),
+                          None if self._received_at is None else tuple(self._received_at),
+                          self._lines,
+                          [(block[0], block[1], 1, 0) if block[2] is None else tuple(block) for block in self._blocks])
+        index.save()
+        return index
+
+
+def build_time_index(file_path: str, block_size: int = DEFAULT_BLOCK_SIZE) -> TimeIndex:
+    """
+    Build and save the time index of an archive, using the gzip index checkpoints as blocks when there's a current
+        gzip index.
+    :param file_path: str: The path to the archive.
+    :param block_size: int: The uncompressed bytes per block without a gzip index. Defaults to DEFAULT_BLOCK_SIZE
+                            (1 MiB).
+    :return: TimeIndex: The index.
+    :raises TimeIndexError: On read, write, and corrupt data errors, or if block_size is less than one.
+    """
+    builder = TimeIndexBuilder(file_path, block_size)
+    try:
+        builder.add_lines(logFormat.iter_lines(logFormat.iter_archive_chunks(file_path, _READ_SIZE)))
+    except OSError as err:
+        raise TimeIndexError(1, *err.args)
+    except (zlib.error, EOFError) as err:
+        raise TimeIndexError(2, *err.args)
+    return builder.finish()
+
+
+def iter_archive_range(file_path: str, start: Optional[int], end: Optional[int]) -> Iterator[bytes]:
+    """
+    Read the lines generated in a time range from one stored archive, using its time index if it has a current one.
+    :param file_path: str: The archive path.
+    :param start: Optional[int]: The start of the range, inclusive, None for no start.
+    :param end: Optional[int]: The end of the range, exclusive, None for no end.
+    :return: Iterator[bytes]: The lines without the line endings, in file order.
+    :raises TimeIndexError: On read errors, or corrupt data.
+    """
+    index: Optional[TimeIndex] = TimeIndex.load(file_path)
+    if index is None:
+        try:
+            yield from _filter_lines(logFormat.iter_lines(logFormat.iter_archive_chunks(file_path, _READ_SIZE)),
+                                     start, end)
+        except OSError as err:
+            raise TimeIndexError(1, *err.args)
+        except (zlib.error, EOFError) as err:
+            raise TimeIndexError(2, *err.args)
+    elif index.overlaps(start, end):
+        yield from index.iter_lines(start, end)
+    return
+
+
+def iter_time_range(file_paths: list[str], start: Optional[int], end: Optional[int]) -> Iterator[tuple[str, bytes]]:
+    """
+    Read the lines generated in a time range from stored archives, skipping the archives whose time index shows they
+        are out of range, and reading archives without a current time index in full.
+    :param file_paths: list[str]: The archive paths.
+    :param start: Optional[int]: The start of the range, inclusive, None for no start.
+    :param end: Optional[int]: The end of the range, exclusive, None for no end.
+    :return: Iterator[tuple[str, bytes]]: The archive path, and the line without the line ending.
+    :raises TimeIndexError: On read errors, or corrupt data.
+    """
+    for file_path in file_paths:
+        for line in iter_archive_range(file_path, start, end):
+            yield file_path, line
+    return
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+    File: timeMerge.py: Time ordered merge of the lines of stored archives.
+        Methods:
+            iter_reordered: Put the nearly ordered lines of one archive into generated_at order.
+            merge_archives: Merge archives into one stream in generated_at order.
+
+        Notes:
+            Lines in an archive are only out of order by a few seconds, so each archive is put in order with a heap
+            holding just the lines inside that window, then the archives are k-way merged with another heap, one
+            entry per open archive. Archives are opened in order of the earliest generated_at in their time index,
+            only once the merge reaches that time, so just the archives overlapping the current time are open at once,
+            and memory is bound by their reorder windows, not the number or size of the archives. Time indexes are
+            built for the archives without a current one, if that fails the archive is opened from the start. Ties
+            keep archive order, then file order, so the merge is stable.
+"""
+from typing import Optional, Final, Iterable, Iterator
+import heapq
+import logParser
+from timeIndex import TimeIndexError, TimeIndex, build_time_index, iter_archive_range
+
+DEFAULT_MAX_DISORDER: Final[int] = 5
+DEFAULT_MAX_BUFFERED: Final[int] = 100000
+
+
+def iter_reordered(lines: Iterable[bytes],
+                   max_disorder: int = DEFAULT_MAX_DISORDER,
+                   max_buffered: int = DEFAULT_MAX_BUFFERED,
+                   ) -> Iterator[tuple[int, bytes]]:
+    """
+    Put the nearly ordered lines of one archive into generated_at order with a bounded reorder buffer. A line is
+        released once a line max_disorder seconds newer has been seen, or when the buffer is full.
+    :param lines: Iterable[bytes]: The lines, without line endings.
+    :param max_disorder: int: How far out of order, in seconds, lines can be. Defaults to DEFAULT_MAX_DISORDER.
+    :param max_buffered: int: The most lines to hold. Defaults to DEFAULT_MAX_BUFFERED.
+    :return: Iterator[tuple[int, bytes]]: The generated_at time, and the line. Lines without a valid time are skipped.
+    """
+    buffer: list[tuple[int, int, bytes]] = []
+    newest: Optional[int] = None
+    for sequence, line in enumerate(lines):
+        line_time: Optional[int] = logParser.get_time(line)
+        if line_time is None:
+            continue
+        heapq.heappush(buffer, (line_time, sequence, line))
+        if newest is None or line_time > newest:
+            newest = line_time
+        while buffer and (buffer[0][0] <= newest - max_disorder or len(buffer) > max_buffered):
+            line_time, _, line = heapq.heappop(buffer)
+            yield line_time, line
+    while buffer:
+        line_time, _, line = heapq.heappop(buffer)
+        yield line_time, line
+    return
+
+
+def _keyed(archive_number: int,
+           file_path: str,
+           start: Optional[int],
+           end: Optional[int],
+           max_disorder: int,
+           max_buffered: int,
+           ) -> Iterator[tuple[int, int, str, bytes]]:
+    """
+    The reordered lines of one archive, as heap entries for the merge.
+    :param archive_number: int: The position of the archive, to break ties.
+    :param file_path: str: The archive path.
+    :param start: Optional[int]: The start of the range, inclusive, None for no start.
+    :param end: Optional[int]: The end of the range, exclusive, None for no end.
+    :param max_disorder: int: How far out of order, in seconds, lines can be.
+    :param max_buffered: int: The most lines to hold.
+    :return: Iterator[tuple[int, int, str, bytes]]: The time, archive number, path, and line.
+    """
+    for line_time, line in iter_reordered(iter_archive_range(file_path, start, end), max_disorder, max_buffered):
+        yield line_time, archive_number, file_path, line
+    return
+
+
+def merge_archives(file_paths: list[str],
+                   start: Optional[int] = None,
+                   end: Optional[int] = None,
+                   max_disorder: int = DEFAULT_MAX_DISORDER,
+                   max_buffered: int = DEFAULT_MAX_BUFFERED,
+                   ) -> Iterator[tuple[int, str, bytes]]:
+    """
+    Merge the lines of archives into one stream in generated_at order, skipping the archives whose time index shows
+        they're outside the time range.
+    :param file_paths: list[str]: The archive paths.
+    :param start: Optional[int]: The start of the range, inclusive. Defaults to None, no start.
+    :param end: Optional[int]: The end of the range, exclusive. Defaults to None, no end.
+    :param max_disorder: int: How far out of order, in seconds, lines can be. Defaults to DEFAULT_MAX_DISORDER.
+    :param max_buffered: int: The most lines to hold per archive. Defaults to DEFAULT_MAX_BUFFERED.
+    :return: Iterator[tuple[int, str, bytes]]: The generated_at time, archive path, and line without the line ending.
+    :raises TimeIndexError: On read errors, or corrupt data.
+    """
+    # Archives by the earliest time they can have a line at, those that can't be indexed first:
+    waiting: list[tuple[int, int, str]] = []
+    unindexed: list[tuple[int, str]] = []
+    for archive_number, file_path in enumerate(file_paths):
+        time_index: Optional[TimeIndex] = TimeIndex.load(file_path)
+        if time_index is None:
+            try:
+                time_index = build_time_index(file_path)
+            except TimeIndexError as err:
+                if err.error_number != 3:
+                    raise
+                unindexed.append((archive_number, file_path))
+                continue
+        if time_index.generated_at is None or not time_index.overlaps(start, end):
+            continue
+        waiting.append((time_index.generated_at[0], archive_number, file_path))
+    waiting.sort(reverse=True)
+    # Heap of the next line of each open archive, (time, archive number, path, line, stream):
+    heap: list[tuple[int, int, str, bytes, Iterator[tuple[int, int, str, bytes]]]] = []
+
+    def open_archive(archive_number: int, file_path: str) -> None:
+        stream: Iterator[tuple[int, int, str, bytes]] = _keyed(archive_number, file_path, start, end, max_disorder,
+                                                               max_buffered)
+        for entry in stream:
+            heapq.heappush(heap, entry + (stream,))
+            break
+        return
+
+    for archive_number, file_path in unindexed:
+        open_archive(archive_number, file_path)
+    while heap or waiting:
+        # Open the archives that may have lines at or before the next one:
+        while waiting and (not heap or waiting[-1][0] <= heap[0][0]):
+            _, archive_number, file_path = waiting.pop()
+            open_archive(archive_number, file_path)
+        if not heap:
+            continue
+        line_time, archive_number, file_path, line, stream = heap[0]
+        yield line_time, file_path, line
+        for entry in stream:
+            heapq.heapreplace(heap, entry + (stream,))
+            break
+        else:
+            heapq.heappop(heap)
+    return
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+    File: topK.py: The most frequent programs, sources, and message prefixes over stored archives.
+        Classes:
+            TopKError(Exception): Errors generated while counting.
+        Methods:
+            message_prefix: The first words of a message.
+            archive_heavy_hitters: Count one archive into a HeavyHitters per column.
+            collect_heavy_hitters: Count many archives in a process pool, merging the sketches.
+
+        Notes:
+            Each archive is read once, in its own process, into a sketches.HeavyHitters per column. Lines are counted
+            in batches with a Counter first, so an item seen many times in a batch is hashed once, then the batch
+            counts go into the sketches, so memory is bounded by the batch size, the sketch size, and the number of
+            candidates, not by the number of distinct values. The per archive results are merged as they finish.
+            Counts are estimates that are never low, and are high by at most e / width of the lines counted.
+"""
+from typing import Optional, Final, Iterable
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+import os
+import zlib
+import logFormat
+import logParser
+from sketches import HeavyHitters
+from timeIndex import TimeIndexError, TimeIndex, iter_archive_range
+
+PREFIX: Final[str] = 'prefix'
+TOP_COLUMNS: Final[tuple[str, ...]] = ('program', 'source_name', 'source_ip', 'facility_name', 'severity_name',
+                                       PREFIX)
+DEFAULT_K: Final[int] = 10
+DEFAULT_WIDTH: Final[int] = 16384
+DEFAULT_DEPTH: Final[int] = 4
+DEFAULT_PREFIX_WORDS: Final[int] = 3
+# Candidates kept per archive for each of the top k, so items that are heavy overall survive the merge:
+_CANDIDATE_FACTOR: Final[int] = 4
+_BATCH_LINES: Final[int] = logParser.DEFAULT_BATCH_SIZE
+
+
+class TopKError(Exception):
+    """Class to store top k errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'ValueError: unknown column name.',
+        2: 'ValueError: k, width, depth, and prefix words must be greater than zero.',
+        3: 'Error while reading an archive.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+def message_prefix(message: bytes, words: int = DEFAULT_PREFIX_WORDS) -> bytes:
+    """
+    The first words of a message, ie: b'GET /api/31 req-0204f8 done' -> b'GET /api/31 req-0204f8'.
+    :param message: bytes: The message.
+    :param words: int: How many words. Defaults to DEFAULT_PREFIX_WORDS.
+    :return: bytes
+    """
+    return b' '.join(message.split(None, words)[:words])
+
+
+def _count_lines(lines: Iterable[bytes],
+                 columns: tuple[int, ...],
+                 trackers: list[HeavyHitters],
+                 prefix_words: int,
+                 ) -> None:
+    """
+    Count lines into the trackers, a batch at a time.
+    :param lines: Iterable[bytes]: The lines, without line endings.
+    :param columns: tuple[int, ...]: The column index of each tracker, logFormat.MESSAGE for message prefixes.
+    :param trackers: list[HeavyHitters]: The trackers.
+    :param prefix_words: int: The words in a message prefix.
+    :return: None
+    """
+    iterator = iter(lines)
+    max_split: int = max(columns) + 1 if max(columns) < logFormat.MESSAGE else logFormat.NUM_COLUMNS - 1
+    while batch := list(islice(iterator, _BATCH_LINES)):
+        counts: list[Counter] = [Counter() for _ in columns]
+        for line in batch:
+            fields: list[bytes] = line.split(b'\t', max_split)
+            for counter, column in zip(counts, columns):
+                if column >= len(fields):
+                    continue
+                counter[message_prefix(fields[column], prefix_words) if column == logFormat.MESSAGE
+                        else fields[column]] += 1
+        for counter, tracker in zip(counts, trackers):
+            for item, count in counter.items():
+                tracker.add(item, count)
+    return
+
+
+def archive_heavy_hitters(file_path: str,
+                          columns: tuple[str, ...],
+                          k: int = DEFAULT_K,
+                          width: int = DEFAULT_WIDTH,
+                          depth: int = DEFAULT_DEPTH,
+                          prefix_words: int = DEFAULT_PREFIX_WORDS,
+                          start: Optional[int] = None,
+                          end: Optional[int] = None,
+                          ) -> dict[str, HeavyHitters]:
+    """
+    Count one archive into a HeavyHitters per column.
+    :param file_path: str: The path to the archive.
+    :param columns: tuple[str, ...]: The columns, each one of TOP_COLUMNS.
+    :param k: int: The number of top items wanted. Defaults to DEFAULT_K.
+    :param width: int: The sketch counters per row. Defaults to DEFAULT_WIDTH.
+    :param depth: int: The sketch rows. Defaults to DEFAULT_DEPTH.
+    :param prefix_words: int: The words in a message prefix. Defaults to DEFAULT_PREFIX_WORDS.
+    :param start: Optional[int]: Only count lines generated at or after this time. Defaults to None.
+    :param end: Optional[int]: Only count lines generated before this time. Defaults to None.
+    :return: dict[str, HeavyHitters]: The trackers by column.
+    :raises TopKError: On bad arguments, and read errors.
+    """
+    for column in columns:
+        if column not in TOP_COLUMNS:
+            raise TopKError(1, column)
+    if k < 1 or width < 1 or depth < 1 or prefix_words < 1:
+        raise TopKError(2)
+    column_indexes: tuple[int, ...] = tuple(logFormat.MESSAGE if column == PREFIX else logFormat.COLUMNS.index(column)
+                                            for column in columns)
+    trackers: list[HeavyHitters] = [HeavyHitters(k * _CANDIDATE_FACTOR, width, depth) for _ in columns]
+    try:
+        if start is None and end is None:
+            lines: Iterable[bytes] = logFormat.iter_lines(logFormat.iter_archive_chunks(file_path))
+        else:
+            lines = iter_archive_range(file_path, start, end)
+        _count_lines(lines, column_indexes, trackers, prefix_words)
+    except TimeIndexError as err:
+        raise TopKError(3, "%s: %s" % (file_path, err.error_message))
+    except (OSError, EOFError, zlib.error, ModuleNotFoundError) as err:
+        raise TopKError(3, "%s: %s" % (file_path, str(err)))
+    return dict(zip(columns, trackers))
+
+
+def collect_heavy_hitters(file_paths: list[str],
+                          columns: tuple[str, ...],
+                          k: int = DEFAULT_K,
+                          width: int = DEFAULT_WIDTH,
+                          depth: int = DEFAULT_DEPTH,
+                          prefix_words: int = DEFAULT_PREFIX_WORDS,
+                          start: Optional[int] = None,
+                          end: Optional[int] = None,
+                          max_workers: Optional[int] = None,
+                          ) -> dict[str, list[tuple[bytes, int]]]:
+    """
+    Find the most frequent values of columns over many archives, counting each archive in a process pool and merging
+        the sketches. Archives whose time index shows they're outside the time range are skipped.
+    :param file_paths: list[str]: The archive paths.
+    :param columns: tuple[str, ...]: The columns, each one of TOP_COLUMNS.
+    :param k: int: The number of top items. Defaults to DEFAULT_K.
+    :param width: int: The sketch counters per row. Defaults to DEFAULT_WIDTH.
+    :param depth: int: The sketch rows. Defaults to DEFAULT_DEPTH.
+    :param prefix_words: int: The words in a message prefix. Defaults to DEFAULT_PREFIX_WORDS.
+    :param start: Optional[int]: Only count lines generated at or after this time. Defaults to None.
+    :param end: Optional[int]: Only count lines generated before this time. Defaults to None.
+    :param max_workers: Optional[int]: The number of processes. Defaults to None, the number of cores.
+    :return: dict[str, list[tuple[bytes, int]]]: The top k items, and their estimated counts, largest first, by
+             column.
+    :raises TopKError: On bad arguments, and read errors.
+    """
+    for column in columns:
+        if column not in TOP_COLUMNS:
+            raise TopKError(1, column)
+    if k < 1 or width < 1 or depth < 1 or prefix_words < 1:
+        raise TopKError(2)
+    if start is not None or end is not None:
+        file_paths = [file_path for file_path in file_paths
+                      if (time_index := TimeIndex.load(file_path)) is None or time_index.overlaps(start, end)]
+    merged: dict[str, HeavyHitters] = {column: HeavyHitters(k * _CANDIDATE_FACTOR, width, depth)
+                                       for column in columns}
+    if len(file_paths) > 0:
+        cpu_count: int = os.cpu_count() or 1
+        if max_workers is None or max_workers > cpu_count:
+            max_workers = cpu_count
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(file_paths))) as pool:
+            futures = [pool.submit(archive_heavy_hitters, file_path, columns, k, width, depth, prefix_words, start,
+                                   end)
+                       for file_path in file_paths]
+            for future in as_completed(futures):
+                for column, trackers in future.result().items():
+                    merged[column].merge(trackers)
+    return {column: tracker.top(k) for column, tracker in merged.items()}
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+    File: trigramIndex.py: Per archive trigram sidecars of each block, for regex search.
+        Classes:
+            TrigramIndexError(Exception): Errors generated while building trigram indexes.
+            TrigramIndex(object): The blocks of an archive containing each trigram.
+        Methods:
+            trigram_index_path: The path of the trigram sidecar for an archive.
+            literal_trigrams: The trigrams of required literals.
+            build_trigram_index: Build the trigram sidecar of an archive.
+            iter_candidate_lines: Read only the lines of the blocks that may hold a match.
+
+        Notes:
+            Blocks are the time index blocks, so they line up with the gzip index checkpoints when there is one, and
+            candidate blocks are read with TimeIndex.iter_block_lines(). Trigrams are 3 lower case bytes packed into
+            an int, byte0 << 16 | byte1 << 8 | byte2. A regex is decomposed into the literals every match must contain
+            with search.required_literals(), and a block is a candidate when it holds every trigram of them. Any
+            block may still not match, the full regex is always run on the lines read.
+
+            Sidecar layout, native byte order:
+                header (magic, archive size, block count, trigram count),
+                block uncompressed offsets uint64 [block count], trigrams uint32 [trigram count] sorted,
+                block bitmaps [trigram count][(block count + 7) // 8], bit n of a bitmap set if block n holds it.
+"""
+from typing import Optional, Final, Iterable, Iterator
+from array import array
+import bisect
+import os
+import struct
+import zlib
+import logFormat
+from timeIndex import TimeIndexError, TimeIndex, build_time_index
+
+HAS_NUMPY: bool = False
+try:
+    import numpy
+    HAS_NUMPY = True
+except ModuleNotFoundError:
+    pass
+
+TRIGRAM_INDEX_SUFFIX: Final[str] = '.trigrams'
+TRIGRAM_MAGIC: Final[bytes] = b'PTTRIG01'
+_HEADER: Final[struct.Struct] = struct.Struct('8sQQQ')
+_READ_SIZE: Final[int] = 1048576
+
+
+class TrigramIndexError(Exception):
+    """Class to store trigram index errors."""
+    _errorMessages: Final[dict[int, str]] = {
+        0: 'No error.',
+        1: 'Error while reading the archive.',
+        2: 'OSError while writing the trigram index.',
+    }
+
+    def __init__(self, error_number: int, *args: object) -> None:
+        super().__init__(error_number, *args)
+        self.error_number = error_number
+        self.error_message = self._errorMessages[error_number]
+        return
+
+
+def trigram_index_path(file_path: str) -> str:
+    """
+    The path of the trigram sidecar for an archive.
+    :param file_path: str: The path to the archive.
+    :return: str
+    """
+    return logFormat.sidecar_path(file_path, TRIGRAM_INDEX_SUFFIX)
+
+
+def literal_trigrams(literals: Iterable[bytes]) -> list[int]:
+    """
+    The trigrams of required literals, ie: [b'req-00'] -> the trigrams of b'req', b'eq-', b'q-0', b'-00'.
+    :param literals: Iterable[bytes]: The literals, literals shorter than 3 bytes have none.
+    :return: list[int]: The distinct packed trigrams, in sorted order.
+    """
+    trigrams: set[int] = set()
+    for literal in literals:
+        literal = literal.lower()
+        for position in range(len(literal) - 2):
+            trigrams.add(int.from_bytes(literal[position:position + 3], 'big'))
+    return sorted(trigrams)
+
+
+def _block_trigrams(data: bytes):
+    """
+    The distinct trigrams of a block.
+    :param data: bytes: The block data.
+    :return: The packed trigrams, a sorted numpy array, or a set without NumPy.
+    """
+    data = data.lower()
+    if HAS_NUMPY:
+        values = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.uint32)
+        return numpy.unique((values[:-2] << 16) | (values[1:-1] << 8) | values[2:])
+    return {int.from_bytes(trigram, 'big') for trigram in {data[position:position + 3]
+                                                           for position in range(len(data) - 2)}}
+
+
+class TrigramIndex(object):
+    """
+    The blocks of an archive containing each trigram.
+    """
+
+    def __init__(self, time_index: TimeIndex, block_count: int, trigrams: array, bitmaps: bytes) -> None:
+        """
+        Initialize the index.
+        :param time_index: TimeIndex: The time index the blocks come from.
+        :param block_count: int: The number of blocks.
+        :param trigrams: array: The packed trigrams, sorted, as array('I').
+        :param bitmaps: bytes: The block bitmap of each trigram.
+        """
+        self._time_index: TimeIndex = time_index
+        self._block_count: int = block_count
+        self._trigrams: array = trigrams
+        self._bitmaps: bytes = bitmaps
+        self._bitmap_size: int = (block_count + 7) // 8
+        return
+
+    @classmethod
+    def load(cls, file_path: str):
+        """
+        Load the trigram index of an archive.
+        :param file_path: str: The path to the archive.
+        :return: Optional[TrigramIndex]: The index, or None if there isn't a current index, and time index, for the
+                 archive.
+        """
+        time_index: Optional[TimeIndex] = TimeIndex.load(file_path)
+        if time_index is None:
+            return None
+        try:
+            with open(trigram_index_path(file_path), 'rb') as file_handle:
+                data: bytes = file_handle.read()
+            magic, source_size, block_count, trigram_count = _HEADER.unpack_from(data)
+        except (OSError, struct.error):
+            return None
+        if magic != TRIGRAM_MAGIC or source_size != os.path.getsize(file_path):
+            return None
+        offsets = array('Q')
+        trigrams = array('I')
+        offset: int = _HEADER.size
+        try:
+            offsets.frombytes(data[offset:offset + block_count * offsets.itemsize])
+            offset += block_count * offsets.itemsize
+            trigrams.frombytes(data[offset:offset + trigram_count * trigrams.itemsize])
+            offset += trigram_count * trigrams.itemsize
+        except ValueError:
+            return None
+        bitmaps: bytes = data[offset:]
+        # The blocks must be the ones the time index reads:
+        if (offsets.tolist() != [block[1] for block in time_index.blocks] or len(trigrams) != trigram_count
+                or len(bitmaps) != trigram_count * ((block_count + 7) // 8)):
+            return None
+        return cls(time_index, block_count, trigrams, bitmaps)
+
+    @property
+    def time_index(self) -> TimeIndex:
+        """
+        The time index the blocks come from.
+        :return: TimeIndex
+        """
+        return self._time_index
+
+    @property
+    def block_count(self) -> int:
+        """
+        The number of blocks.
+        :return: int
+        """
+        return self._block_count
+
+    def candidate_blocks(self, trigrams: list[int]) -> list[int]:
+        """
+        The blocks holding every trigram.
+        :param trigrams: list[int]: The packed trigrams.
+        :return: list[int]: The block numbers, in order, every block if trigrams is empty.
+        """
+        blocks: int = (1 << self._block_count) - 1
+        for trigram in trigrams:
+            position: int = bisect.bisect_left(self._trigrams, trigram)
+            if position >= len(self._trigrams) or self._trigrams[position] != trigram:
+                return []
+            start: int = position * self._bitmap_size
+            blocks &= int.from_bytes(self._bitmaps[start:start + self._bitmap_size], 'little')
+            if blocks == 0:
+                return []
+        return [block_number for block_number in range(self._block_count) if blocks >> block_number & 1]
+
+
+def build_trigram_index(file_path: str) -> TrigramIndex:
+    """
+    Build and save the trigram sidecar of an archive, building its time index first if it doesn't have a current one.
+    :param file_path: str: The path to the archive.
+    :return: TrigramIndex: The index.
+    :raises TrigramIndexError: On read and write errors.
+    """
+    try:
+        time_index: TimeIndex = TimeIndex.load(file_path) or build_time_index(file_path)
+    except TimeIndexError as err:
+        raise TrigramIndexError(1, "%s: %s" % (file_path, err.error_message))
+    starts: list[int] = [block[1] for block in time_index.blocks]
+    block_trigrams: list = []
+    block_data: list[bytes] = []
+    offset: int = 0
+    try:
+        for chunk in logFormat.iter_archive_chunks(file_path, _READ_SIZE):
+            chunk_start: int = 0
+            # Split the chunk at each block start inside it:
+            while len(block_trigrams) + 1 < len(starts) and starts[len(block_trigrams) + 1] < offset + len(chunk):
+                split: int = starts[len(block_trigrams) + 1] - offset
+                block_data.append(chunk[chunk_start:split])
+                block_trigrams.append(_block_trigrams(b''.join(block_data)))
+                block_data = []
+                chunk_start = split
+            block_data.append(chunk[chunk_start:])
+            offset += len(chunk)
+    except (OSError, EOFError, zlib.error, ModuleNotFoundError) as err:
+        raise TrigramIndexError(1, "%s: %s" % (file_path, str(err)))
+    if starts:
+        block_trigrams.append(_block_trigrams(b''.join(block_data)))
+    block_count: int = len(block_trigrams)
+    bitmap_size: int = (block_count + 7) // 8
+    if HAS_NUMPY and block_count > 0:
+        all_trigrams = numpy.unique(numpy.concatenate(block_trigrams))
+        bitmap_matrix = numpy.zeros((len(all_trigrams), max(bitmap_size, 1)), dtype=numpy.uint8)
+        for block_number, trigrams in enumerate(block_trigrams):
+            bitmap_matrix[numpy.searchsorted(all_trigrams, trigrams), block_number // 8] |= 1 << (block_number % 8)
+        trigram_array = array('I', all_trigrams.astype(numpy.uint32).tobytes())
+        bitmaps: bytes = bitmap_matrix.tobytes()
+    else:
+        trigram_blocks: dict[int, int] = {}
+        for block_number, trigrams in enumerate(block_trigrams):
+            for trigram in trigrams:
+                trigram_blocks[trigram] = trigram_blocks.get(trigram, 0) | 1 << block_number
+        trigram_array = array('I', sorted(trigram_blocks))
+        bitmaps = b''.join(trigram_blocks[trigram].to_bytes(bitmap_size, 'little') for trigram in trigram_array)
+    temp_path: str = trigram_index_path(file_path) + '.tmp'
+    try:
+        with open(temp_path, 'wb') as file_handle:
+            file_handle.write(_HEADER.pack(TRIGRAM_MAGIC, os.path.getsize(file_path), block_count, len(trigram_array)))
+            array('Q', starts).tofile(file_handle)
+            trigram_array.tofile(file_handle)
+            file_handle.write(bitmaps)
+        os.replace(temp_path, trigram_index_path(file_path))
+    except OSError as err:
+        raise TrigramIndexError(2, "%s: %s" % (file_path, str(err)))
+    return TrigramIndex(time_index, block_count, trigram_array, bitmaps)
+
+
+def iter_candidate_lines(file_path: str, literals: list[bytes]) -> Iterator[bytes]:
+    """
+    Read the lines of the blocks that hold every trigram of the literals, or every line when the archive doesn't have
+        a current trigram index, or the literals have no trigrams.
+    :param file_path: str: The path to the archive.
+    :param literals: list[bytes]: The literals every match must contain.
+    :return: Iterator[bytes]: The lines, without line endings, in file order.
+    :raises TimeIndexError: On read errors, or corrupt data, in the candidate blocks.
+    :raises OSError: On read errors without a trigram index.
+    """
+    trigrams: list[int] = literal_trigrams(literals)
+    trigram_index: Optional[TrigramIndex] = TrigramIndex.load(file_path) if trigrams else None
+    if trigram_index is None:
+        yield from logFormat.iter_lines(logFormat.iter_archive_chunks(file_path, _READ_SIZE))
+        return
+    yield from trigram_index.time_index.iter_block_lines(trigram_index.candidate_blocks(trigrams))
+    return